@@ -620,6 +620,8 @@ echo "prefix= " >> ./setup.cfg
 which pip3
 python3 -c "import boto3"
 pip3 install --quiet -r ../requirements.txt --target .
+# The function runs without the Lambda layer, so the helper library is packaged with it
+pip3 install --quiet --no-deps "$source_dir"/lib/MediaInsightsEngineLambdaHelper/dist/*.whl --target .
 zip -q -r9 ../dist/ddbstream.zip .
 popd || exit 1
 zip -q -g dist/ddbstream.zip ./*.py
@@ -703,6 +705,8 @@ touch ./setup.cfg
 echo "[install]" > ./setup.cfg
 echo "prefix= " >> ./setup.cfg
 pip3 install --quiet -r ../requirements.txt --target .
+# The function runs without the Lambda layer, so the helper library is packaged with it
+pip3 install --quiet --no-deps "$source_dir"/lib/MediaInsightsEngineLambdaHelper/dist/*.whl --target .
 zip -q -r9 ../dist/workflowstream.zip .
 popd || exit 1
 
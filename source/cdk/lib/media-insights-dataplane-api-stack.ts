@@ -145,6 +145,8 @@ export class DataplaneApiStack extends cdk.NestedStack {
             key: deploymentPackageKey.valueAsString,
         };
         cfnApiHandler.tracing = tracingConfigMode.valueAsString;
+        // Routes asynchronous asset deletion jobs before handing API requests to the Chalice app
+        cfnApiHandler.handler = 'app.handler';
 
         // Override properties of the API Handler Role
 
@@ -233,11 +235,18 @@ export class DataplaneApiStack extends cdk.NestedStack {
                   "Action": [
                     "dynamodb:Query"
                   ],
-                  "Resource": cdk.Stack.of(this).formatArn({
-                    service: 'dynamodb',
-                    resource: 'table',
-                    resourceName: `${dataplaneTableName.valueAsString}/index/LockIndex`,
-                  }),
+                  "Resource": [
+                    cdk.Stack.of(this).formatArn({
+                      service: 'dynamodb',
+                      resource: 'table',
+                      resourceName: `${dataplaneTableName.valueAsString}/index/LockIndex`,
+                    }),
+                    cdk.Stack.of(this).formatArn({
+                      service: 'dynamodb',
+                      resource: 'table',
+                      resourceName: `${dataplaneTableName.valueAsString}/index/AssetCreated`,
+                    }),
+                  ],
                 },
                 {
                   "Effect": "Allow",
@@ -280,6 +289,24 @@ export class DataplaneApiStack extends cdk.NestedStack {
             },
             policyName: "MieDataplaneApiHandlerRolePolicy",
         }];
+
+        // Asset deletion jobs continue in new invocations of the API handler, see handler in app.py.  The grant
+        // names the function's own ARN, so it is attached to the role separately to avoid a circular dependency
+        // between the role and the function.
+        new iam.CfnPolicy(this, 'ApiHandlerSelfInvokePolicy', {
+            policyName: "MieDataplaneApiHandlerSelfInvokePolicy",
+            roles: [cfnApiHandlerRole.ref],
+            policyDocument: {
+              "Version": "2012-10-17",
+              "Statement": [
+                {
+                  "Effect": "Allow",
+                  "Action": "lambda:InvokeFunction",
+                  "Resource": cdk.Fn.getAtt(cfnApiHandler.logicalId, 'Arn'),
+                }
+              ]
+            },
+        });
     }
 
     getLogicalId(element: cdk.CfnElement): string {
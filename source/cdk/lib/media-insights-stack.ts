@@ -101,6 +101,12 @@ export class MediaInsightsStack extends Stack {
             type: 'String',
             default: "",
         });
+        const workflowEventFieldMaxBytes = new CfnParameter(this, 'WorkflowEventFieldMaxBytes', {
+            type: 'Number',
+            description: "(Optional) Workflow execution status change messages replace any field whose JSON encoding is larger than this many bytes with a reference to the workflow execution.  0 publishes every field in full.",
+            default: 0,
+            minValue: 0,
+        });
         const solutionId = new CfnParameter(this, 'SolutionId', {
             description: "(Optional) AWS Solution Id used for reporting purposes",
             type: 'String',
@@ -120,7 +126,7 @@ export class MediaInsightsStack extends Stack {
                 Label: {
                     default: "System Configuration"
                 },
-                Parameters: [ "MaxConcurrentWorkflows" ],
+                Parameters: [ "MaxConcurrentWorkflows", "WorkflowEventFieldMaxBytes" ],
             }]
         });
 
@@ -290,6 +296,26 @@ export class MediaInsightsStack extends Stack {
             },
         });
 
+        const operationCallbackTable = createTable(this, 'OperationCallback', {
+            partitionKey: {
+                name: 'JobId',
+                type: dynamodb.AttributeType.STRING,
+            },
+            timeToLiveAttribute: 'ExpiresAt',
+        });
+
+        // Adjacency list of the operations and stages each workflow is built from
+        const workflowDependencyTable = createTable(this, 'WorkflowDependency', {
+            partitionKey: {
+                name: 'Dependency',
+                type: dynamodb.AttributeType.STRING,
+            },
+            sortKey: {
+                name: 'WorkflowName',
+                type: dynamodb.AttributeType.STRING,
+            },
+        });
+
         const workflowExecutionTable = createTable(this, 'WorkflowExecution', {
             partitionKey: {
                 name: 'Id',
@@ -314,6 +340,21 @@ export class MediaInsightsStack extends Stack {
             }
         });
 
+        // Asset listing sorted and ranged by creation time, see find_workflow_executions_by_assetid in the
+        // workflow API.  DynamoDB creates one global secondary index per table update, so add any further
+        // index to this table in a later release.
+        workflowExecutionTable.addGlobalSecondaryIndex({
+            indexName: 'WorkflowExecutionAssetIdCreated',
+            partitionKey: {
+                name: 'AssetId',
+                type: dynamodb.AttributeType.STRING,
+            },
+            sortKey: {
+                name: 'Created',
+                type: dynamodb.AttributeType.STRING,
+            },
+        });
+
         const dataplaneTable = createTable(this, 'DataplaneTable', {
             partitionKey: {
                 name: 'AssetId',
@@ -336,6 +377,20 @@ export class MediaInsightsStack extends Stack {
             nonKeyAttributes: ['LockedBy'],
         });
 
+        // Assets by creation time, bucketed by month, see list_all_assets in the dataplane API
+        dataplaneTable.addGlobalSecondaryIndex({
+            indexName: 'AssetCreated',
+            partitionKey: {
+                name: 'CreatedMonth',
+                type: dynamodb.AttributeType.STRING,
+            },
+            sortKey: {
+                name: 'Created',
+                type: dynamodb.AttributeType.STRING,
+            },
+            projectionType: dynamodb.ProjectionType.KEYS_ONLY,
+        });
+
 
         //
         // Services - S3
@@ -487,6 +542,34 @@ export class MediaInsightsStack extends Stack {
             enforceSSL: true,
         });
 
+        // Queued workflow executions with a High or Low Priority wait on their own queue, the workflow scheduler
+        // admits from all of the queues in a weighted-fair way
+        const highPriorityStageExecutionQueue = new sqs.Queue(this, 'HighPriorityStageExecutionQueue', {
+            queueName: `${Aws.STACK_NAME}-StageExecHigh`,
+            visibilityTimeout: Duration.hours(12),
+            receiveMessageWaitTime: Duration.seconds(20),
+            deadLetterQueue: {
+                queue: stageExecutionDeadLetterQueue,
+                maxReceiveCount: 1, // Don't retry if stage times out
+            },
+            encryption: sqs.QueueEncryption.KMS,
+            encryptionMasterKey: keyAlias,
+            enforceSSL: true,
+        });
+
+        const lowPriorityStageExecutionQueue = new sqs.Queue(this, 'LowPriorityStageExecutionQueue', {
+            queueName: `${Aws.STACK_NAME}-StageExecLow`,
+            visibilityTimeout: Duration.hours(12),
+            receiveMessageWaitTime: Duration.seconds(20),
+            deadLetterQueue: {
+                queue: stageExecutionDeadLetterQueue,
+                maxReceiveCount: 1, // Don't retry if stage times out
+            },
+            encryption: sqs.QueueEncryption.KMS,
+            encryptionMasterKey: keyAlias,
+            enforceSSL: true,
+        });
+
         workflowExecutionEventTopic.addSubscription(new subscriptions.SqsSubscription(workflowExecutionEventQueue));
 
         //
@@ -589,6 +672,7 @@ export class MediaInsightsStack extends Stack {
                     workflowExecutionTable.tableArn,
                     `${workflowExecutionTable.tableArn}/index/*`,
                     systemTable.tableArn,
+                    operationCallbackTable.tableArn,
                 ],
             }),
             new iam.PolicyStatement({
@@ -615,9 +699,13 @@ export class MediaInsightsStack extends Stack {
                     "sqs:ChangeMessageVisibility",
                     "sqs:ReceiveMessage",
                     "sqs:SendMessage",
+                    // The workflow scheduler reports the depth of the execution queues
+                    "sqs:GetQueueAttributes",
                 ],
                 resources: [
                     stageExecutionQueue.queueArn,
+                    highPriorityStageExecutionQueue.queueArn,
+                    lowPriorityStageExecutionQueue.queueArn,
                     workflowExecutionLambdaDeadLetterQueue.queueArn,
                 ],
             }),
@@ -642,7 +730,22 @@ export class MediaInsightsStack extends Stack {
             assumedBy: new iam.ServicePrincipal('lambda.amazonaws.com'),
             inlinePolicies: {
                 [`${Aws.STACK_NAME}-stage-execution-lambda`]: new iam.PolicyDocument({
-                    statements: lambdaRolePolicyStatements
+                    statements: [
+                        // The workflow scheduler reclaims the operation concurrency tokens of executions that ended
+                        new iam.PolicyStatement({
+                            effect: iam.Effect.ALLOW,
+                            actions: ['states:DescribeExecution'],
+                            resources: [
+                                Stack.of(this).formatArn({
+                                    service: 'states',
+                                    resource: 'execution',
+                                    resourceName: '*:*',
+                                    arnFormat: ArnFormat.COLON_RESOURCE_NAME,
+                                })
+                            ],
+                        }),
+                        ...lambdaRolePolicyStatements,
+                    ]
                 })
             }
         });
@@ -664,6 +767,23 @@ export class MediaInsightsStack extends Stack {
                                 "arn:aws:lambda:*:*:function:*CompleteStageLambda*",
                                 "arn:aws:lambda:*:*:function:*OperatorFailedLambda*",
                                 "arn:aws:lambda:*:*:function:*FilterOperationLambda*",
+                                "arn:aws:lambda:*:*:function:*OperationCallbackLambda*",
+                            ],
+                        }),
+                        // Operation concurrency tokens are taken and returned by the operation state machines
+                        new iam.PolicyStatement({
+                            effect: iam.Effect.ALLOW,
+                            actions: ['dynamodb:UpdateItem'],
+                            resources: [systemTable.tableArn],
+                        }),
+                        new iam.PolicyStatement({
+                            effect: iam.Effect.ALLOW,
+                            actions: [
+                                'kms:GenerateDataKey',
+                                'kms:Decrypt',
+                            ],
+                            resources: [
+                                mieKey.keyArn
                             ],
                         }),
                         new iam.PolicyStatement({
@@ -870,6 +990,8 @@ export class MediaInsightsStack extends Stack {
         //
 
         const STAGE_EXECUTION_QUEUE_URL = stageExecutionQueue.queueUrl;
+        const HIGH_PRIORITY_EXECUTION_QUEUE_URL = highPriorityStageExecutionQueue.queueUrl;
+        const LOW_PRIORITY_EXECUTION_QUEUE_URL = lowPriorityStageExecutionQueue.queueUrl;
         const STAGE_TABLE_NAME = stageTable.tableName;
         const OPERATION_TABLE_NAME = operationTable.tableName;
         const WORKFLOW_EXECUTION_TABLE_NAME = workflowExecutionTable.tableName;
@@ -922,6 +1044,8 @@ export class MediaInsightsStack extends Stack {
         const workflowSchedulerLambda = new lambda.Function(this, 'WorkflowSchedulerLambda', {
             environment: {
                 STAGE_EXECUTION_QUEUE_URL,
+                HIGH_PRIORITY_EXECUTION_QUEUE_URL,
+                LOW_PRIORITY_EXECUTION_QUEUE_URL,
                 STAGE_TABLE_NAME,
                 OPERATION_TABLE_NAME,
                 WORKFLOW_EXECUTION_TABLE_NAME,
@@ -973,6 +1097,20 @@ export class MediaInsightsStack extends Stack {
                                 })
                             ],
                         }),
+                        new iam.PolicyStatement({
+                            effect: iam.Effect.ALLOW,
+                            actions: [
+                                "states:SendTaskSuccess",
+                            ],
+                            resources: [
+                                Stack.of(this).formatArn({
+                                    service: 'states',
+                                    resource: 'stateMachine',
+                                    resourceName: '*',
+                                    arnFormat: ArnFormat.COLON_RESOURCE_NAME,
+                                })
+                            ],
+                        }),
                         new iam.PolicyStatement({
                             effect: iam.Effect.ALLOW,
                             actions: [
@@ -1061,6 +1199,7 @@ export class MediaInsightsStack extends Stack {
                 OPERATION_TABLE_NAME,
                 WORKFLOW_EXECUTION_TABLE_NAME,
                 WORKFLOW_TABLE_NAME,
+                SYSTEM_TABLE_NAME,
             },
             handler: "app.filter_operation_lambda",
             tracing: lambda.Tracing.PASS_THROUGH,
@@ -1087,6 +1226,7 @@ export class MediaInsightsStack extends Stack {
                 botoConfig,
                 STAGE_EXECUTION_QUEUE_URL,
                 STAGE_TABLE_NAME,
+                SYSTEM_TABLE_NAME,
                 OPERATION_TABLE_NAME,
                 WORKFLOW_EXECUTION_TABLE_NAME,
                 WORKFLOW_TABLE_NAME,
@@ -1119,10 +1259,89 @@ export class MediaInsightsStack extends Stack {
             timeout: Duration.seconds(900),
         });
 
+        const OPERATION_CALLBACK_TABLE_NAME = operationCallbackTable.tableName;
+
+        const registerOperationCallbackLambda = new lambda.Function(this, 'RegisterOperationCallbackLambda', {
+            environment: {
+                botoConfig,
+                STAGE_EXECUTION_QUEUE_URL,
+                STAGE_TABLE_NAME,
+                OPERATION_TABLE_NAME,
+                WORKFLOW_EXECUTION_TABLE_NAME,
+                WORKFLOW_TABLE_NAME,
+                OPERATION_CALLBACK_TABLE_NAME,
+            },
+            handler: "app.register_operation_callback_lambda",
+            tracing: lambda.Tracing.PASS_THROUGH,
+            code: codeFromRegionalBucket('workflow.zip'),
+            layers: [ python311Layer ],
+            memorySize: 256,
+            role: operationLambdaExecutionRole,
+            runtime: lambda.Runtime.PYTHON_3_11,
+            timeout: Duration.seconds(60),
+        });
+
+        const operationCallbackLambda = new lambda.Function(this, 'OperationCallbackLambda', {
+            environment: {
+                botoConfig,
+                STAGE_EXECUTION_QUEUE_URL,
+                STAGE_TABLE_NAME,
+                OPERATION_TABLE_NAME,
+                WORKFLOW_EXECUTION_TABLE_NAME,
+                WORKFLOW_TABLE_NAME,
+                OPERATION_CALLBACK_TABLE_NAME,
+            },
+            handler: "app.operation_callback_lambda",
+            tracing: lambda.Tracing.PASS_THROUGH,
+            code: codeFromRegionalBucket('workflow.zip'),
+            layers: [ python311Layer ],
+            memorySize: 256,
+            role: operationLambdaExecutionRole,
+            runtime: lambda.Runtime.PYTHON_3_11,
+            timeout: Duration.seconds(60),
+        });
+
+        // Service job completion events resume the async operations waiting for them
+        new events.Rule(this, 'TranscribeJobCallbackEvent', {
+            description: "resumes operations waiting on Amazon Transcribe jobs",
+            eventPattern: {
+                source: ["aws.transcribe"],
+                detailType: ["Transcribe Job State Change"],
+                detail: {
+                    TranscriptionJobStatus: [
+                        "COMPLETED",
+                        "FAILED",
+                    ],
+                },
+            },
+            targets: [
+                new targets.LambdaFunction(operationCallbackLambda)
+            ],
+        }).node.addDependency(operationCallbackLambda);
+
+        new events.Rule(this, 'MediaConvertJobCallbackEvent', {
+            description: "resumes operations waiting on AWS Elemental MediaConvert jobs",
+            eventPattern: {
+                source: ["aws.mediaconvert"],
+                detailType: ["MediaConvert Job State Change"],
+                detail: {
+                    status: [
+                        "COMPLETE",
+                        "ERROR",
+                        "CANCELED",
+                    ],
+                },
+            },
+            targets: [
+                new targets.LambdaFunction(operationCallbackLambda)
+            ],
+        }).node.addDependency(operationCallbackLambda);
+
         const workflowExecutionStreamingFunction = new lambda.Function(this, 'WorkflowExecutionStreamingFunction', {
             environment: {
                 botoConfig,
                 TOPIC_ARN: workflowExecutionEventTopic.topicArn,
+                MESSAGE_FIELD_MAX_BYTES: workflowEventFieldMaxBytes.valueAsString,
             },
             handler: "workflowstream.lambda_handler",
             code: codeFromRegionalBucket('workflowstream.zip'),
@@ -1150,6 +1369,8 @@ export class MediaInsightsStack extends Stack {
             operatorFailedLambda,
             startWaitOperationLambda,
             checkWaitOperationLambda,
+            registerOperationCallbackLambda,
+            operationCallbackLambda,
             workflowExecutionStreamingFunction,
             anonymizedDataCustomResource,
         ].forEach(l => util.setNagSuppressRules(l,
@@ -1173,6 +1394,10 @@ export class MediaInsightsStack extends Stack {
         workflowExecutionStreamingFunction.addEventSourceMapping('EventMapping', {
             eventSourceArn: workflowExecutionTable.tableStreamArn!,
             startingPosition: lambda.StartingPosition.LATEST,
+            // Only status changes are published and a new or deleted execution has none
+            filters: [
+                lambda.FilterCriteria.filter({ eventName: lambda.FilterRule.isEqual('MODIFY') }),
+            ],
         });
 
         //
@@ -1206,6 +1431,8 @@ export class MediaInsightsStack extends Stack {
             operationTable,
             historyTable,
             workflowExecutionTable,
+            operationCallbackTable,
+            workflowDependencyTable,
             dataplaneTable,
             dataplaneLogsBucket,
             dataplaneBucket,
@@ -1219,6 +1446,8 @@ export class MediaInsightsStack extends Stack {
             operatorFailedLambda,
             startWaitOperationLambda,
             checkWaitOperationLambda,
+            registerOperationCallbackLambda,
+            operationCallbackLambda,
             workflowExecutionStreamingFunction,
         ].forEach(util.addMediaInsightsTag);
 
@@ -1247,6 +1476,8 @@ export class MediaInsightsStack extends Stack {
                 botoConfig,
                 ShortUUID,
                 StageExecutionQueueUrl: stageExecutionQueue.queueUrl,
+                HighPriorityStageExecutionQueueUrl: highPriorityStageExecutionQueue.queueUrl,
+                LowPriorityStageExecutionQueueUrl: lowPriorityStageExecutionQueue.queueUrl,
                 StageExecutionRole: stepFunctionRole.roleArn,
                 StepFunctionLogGroupArn: stepFunctionLogGroup.logGroupArn,
                 OperationTableName: operationTable.tableName,
@@ -1255,11 +1486,15 @@ export class MediaInsightsStack extends Stack {
                 WorkflowTableName: workflowTable.tableName,
                 HistoryTableName: historyTable.tableName,
                 SystemTableName: systemTable.tableName,
+                WorkflowDependencyTableName: workflowDependencyTable.tableName,
                 SqsQueueArn: stageExecutionQueue.queueArn,
+                HighPrioritySqsQueueArn: highPriorityStageExecutionQueue.queueArn,
+                LowPrioritySqsQueueArn: lowPriorityStageExecutionQueue.queueArn,
                 MediaInsightsOnAwsPython311Layer: python311Layer.layerVersionArn,
                 TracingConfigMode: `${Fn.conditionIf(enableTraceOnEntryPoints.logicalId, lambda.Tracing.ACTIVE, lambda.Tracing.PASS_THROUGH)}`,
                 CompleteStageLambdaArn: completeStageLambda.functionArn,
                 FilterOperationLambdaArn: filterOperationLambda.functionArn,
+                RegisterOperationCallbackLambdaArn: registerOperationCallbackLambda.functionArn,
                 WorkflowSchedulerLambdaArn: workflowSchedulerLambda.functionArn,
                 DataplaneEndpoint: `${dataplaneApiStack.nestedStackResource!.getAtt('Outputs.APIHandlerName')}`,
                 DataplaneHandlerArn: `${dataplaneApiStack.nestedStackResource!.getAtt('Outputs.APIHandlerArn')}`,
@@ -1290,6 +1525,7 @@ export class MediaInsightsStack extends Stack {
             kmsKey: mieKey,
             parameters: {
                 DataPlaneBucket: dataplaneBucket.bucketName,
+                DataPlaneTableName: dataplaneTable.tableName,
                 ExternalBucketArn: externalBucketArn.valueAsString,
                 DataPlaneEndpoint: `${dataplaneApiStack.nestedStackResource!.getAtt('Outputs.APIHandlerName')}`,
                 DataPlaneHandlerArn: `${dataplaneApiStack.nestedStackResource!.getAtt('Outputs.APIHandlerArn')}`,
@@ -26,6 +26,7 @@ interface FunctionEnvironmentProperty {
         STACK_SHORT_UUID: string;
         SYSTEM_TABLE_NAME: string;
         WORKFLOW_TABLE_NAME: string;
+        WORKFLOW_DEPENDENCY_TABLE_NAME: string;
         STAGE_TABLE_NAME: string;
         WORKFLOW_EXECUTION_TABLE_NAME: string;
         HISTORY_TABLE_NAME: string;
@@ -88,6 +89,11 @@ export class WorkflowApiStack extends cdk.NestedStack {
             description: "Table used to store workflow definitions",
         });
 
+        const workflowDependencyTableName = new cdk.CfnParameter(this, 'WorkflowDependencyTableName', {
+            type: 'String',
+            description: "Table used to look up the workflows that use an operation or stage",
+        });
+
         const stageTableName = new cdk.CfnParameter(this, 'StageTableName', {
             type: 'String',
             description: "Table used to store stage definitions",
@@ -108,6 +114,16 @@ export class WorkflowApiStack extends cdk.NestedStack {
             description: "Queue used to post stage executions for processing",
         });
 
+        const highPriorityStageExecutionQueueUrl = new cdk.CfnParameter(this, 'HighPriorityStageExecutionQueueUrl', {
+            type: 'String',
+            description: "Queue used to post High priority stage executions for processing",
+        });
+
+        const lowPriorityStageExecutionQueueUrl = new cdk.CfnParameter(this, 'LowPriorityStageExecutionQueueUrl', {
+            type: 'String',
+            description: "Queue used to post Low priority stage executions for processing",
+        });
+
         const stepFunctionLogGroupArn = new cdk.CfnParameter(this, 'StepFunctionLogGroupArn', {
             type: 'String',
             description: "ARN of the log group used for logging step functions with Cloudwatch",
@@ -133,6 +149,11 @@ export class WorkflowApiStack extends cdk.NestedStack {
             description: "Lambda that checks if an operation should execute",
         });
 
+        const registerOperationCallbackLambdaArn = new cdk.CfnParameter(this, 'RegisterOperationCallbackLambdaArn', {
+            type: 'String',
+            description: "Lambda that parks an async operation until its job completion event arrives",
+        });
+
         const workflowSchedulerLambdaArn = new cdk.CfnParameter(this, 'WorkflowSchedulerLambdaArn', {
             type: 'String',
             description: "Lambda that schedules workflows from the work queue",
@@ -163,6 +184,16 @@ export class WorkflowApiStack extends cdk.NestedStack {
             description: "Arn of the Media Insights on AWS workflow queue",
         });
 
+        const highPrioritySqsQueueArn = new cdk.CfnParameter(this, 'HighPrioritySqsQueueArn', {
+            type: 'String',
+            description: "Arn of the Media Insights on AWS High priority workflow queue",
+        });
+
+        const lowPrioritySqsQueueArn = new cdk.CfnParameter(this, 'LowPrioritySqsQueueArn', {
+            type: 'String',
+            description: "Arn of the Media Insights on AWS Low priority workflow queue",
+        });
+
         const mediaInsightsOnAwsPython311Layer = new cdk.CfnParameter(this, 'MediaInsightsOnAwsPython311Layer', {
             type: 'String',
             description: "Arn of the Media Insights on AWS Python 3.11 lambda layer",
@@ -220,13 +251,17 @@ export class WorkflowApiStack extends cdk.NestedStack {
                 v.STACK_SHORT_UUID = shortUUID.valueAsString;
                 v.SYSTEM_TABLE_NAME = systemTableName.valueAsString;
                 v.WORKFLOW_TABLE_NAME = workflowTableName.valueAsString;
+                v.WORKFLOW_DEPENDENCY_TABLE_NAME = workflowDependencyTableName.valueAsString;
                 v.WORKFLOW_EXECUTION_TABLE_NAME = workflowExecutionTableName.valueAsString;
                 v.HISTORY_TABLE_NAME = historyTableName.valueAsString;
                 v.STAGE_TABLE_NAME = stageTableName.valueAsString;
                 v.STAGE_EXECUTION_QUEUE_URL = stageExecutionQueueUrl.valueAsString;
+                v.HIGH_PRIORITY_EXECUTION_QUEUE_URL = highPriorityStageExecutionQueueUrl.valueAsString;
+                v.LOW_PRIORITY_EXECUTION_QUEUE_URL = lowPriorityStageExecutionQueueUrl.valueAsString;
                 v.OPERATION_TABLE_NAME = operationTableName.valueAsString;
                 v.COMPLETE_STAGE_LAMBDA_ARN = completeStageLambdaArn.valueAsString;
                 v.FILTER_OPERATION_LAMBDA_ARN = filterOperationLambdaArn.valueAsString;
+                v.REGISTER_OPERATION_CALLBACK_LAMBDA_ARN = registerOperationCallbackLambdaArn.valueAsString;
                 v.WORKFLOW_SCHEDULER_LAMBDA_ARN = workflowSchedulerLambdaArn.valueAsString;
                 v.STAGE_EXECUTION_ROLE = stageExecutionRole.valueAsString;
                 v.STEP_FUNCTION_LOG_GROUP_ARN = stepFunctionLogGroupArn.valueAsString;
@@ -281,7 +316,9 @@ export class WorkflowApiStack extends cdk.NestedStack {
                 "dynamodb:UpdateItem",
                 "dynamodb:DeleteItem",
                 "dynamodb:Scan",
-                "dynamodb:Query"
+                "dynamodb:Query",
+                "dynamodb:BatchGetItem",
+                "dynamodb:BatchWriteItem"
             ],
             "Resource": [
                 cdk.Stack.of(this).formatArn({
@@ -294,6 +331,11 @@ export class WorkflowApiStack extends cdk.NestedStack {
                     resource: 'table',
                     resourceName: workflowTableName.valueAsString,
                 }),
+                cdk.Stack.of(this).formatArn({
+                    service: 'dynamodb',
+                    resource: 'table',
+                    resourceName: workflowDependencyTableName.valueAsString,
+                }),
                 cdk.Stack.of(this).formatArn({
                     service: 'dynamodb',
                     resource: 'table',
@@ -331,7 +373,11 @@ export class WorkflowApiStack extends cdk.NestedStack {
                   "Action": [
                     "sqs:SendMessage"
                   ],
-                  "Resource": sqsQueueArn.valueAsString
+                  "Resource": [
+                    sqsQueueArn.valueAsString,
+                    highPrioritySqsQueueArn.valueAsString,
+                    lowPrioritySqsQueueArn.valueAsString
+                  ]
                 },
                 {
                   "Effect": "Allow",
@@ -83,6 +83,10 @@ export class OperatorLibraryStack extends NestedStack {
             type: 'String',
             description: "Bucket for the dataplane",
         });
+        const dataPlaneTableName = new CfnParameter(this, 'DataPlaneTableName', {
+            type: 'String',
+            description: "Name of the dataplane DynamoDB table",
+        });
         const externalBucketArn = new CfnParameter(this, 'ExternalBucketArn', {
             type: 'String',
             description: "The ARN for Amazon S3 resources that exist outside the stack which may need to be used as inputs to the workflows",
@@ -141,20 +145,6 @@ export class OperatorLibraryStack extends NestedStack {
         // IAM Roles
         //
 
-        const policyS3ReadOnly = new iam.PolicyStatement({
-            actions: [
-                's3:GetObject',
-            ],
-            resources: [
-                Stack.of(this).formatArn({
-                    service: 's3',
-                    region: '',
-                    account: '',
-                    resource: dataPlaneBucket.valueAsString,
-                    resourceName: '*',
-                })
-            ],
-        });
         const policyS3ReadWrite = new iam.PolicyStatement({
             actions: [
                 's3:GetObject',
@@ -204,6 +194,22 @@ export class OperatorLibraryStack extends NestedStack {
             actions: ['lambda:InvokeFunction'],
             resources: [dataPlaneHandlerArn.valueAsString],
         });
+        // Operators read and write asset metadata in the dataplane table and bucket directly, see DataPlane in
+        // MediaInsightsEngineLambdaHelper
+        const policyDataPlaneTable = new iam.PolicyStatement({
+            actions: [
+                'dynamodb:GetItem',
+                'dynamodb:PutItem',
+                'dynamodb:UpdateItem',
+            ],
+            resources: [
+                Stack.of(this).formatArn({
+                    service: 'dynamodb',
+                    resource: 'table',
+                    resourceName: dataPlaneTableName.valueAsString,
+                })
+            ],
+        });
         const policyXRay = new iam.PolicyStatement({
             actions: [
                 'xray:PutTraceSegments',
@@ -274,6 +280,8 @@ export class OperatorLibraryStack extends NestedStack {
                         policyS3ReadWrite,
                         policyS3Read,
                         policyInvokeDataPlaneHandler,
+                        policyDataPlaneTable,
+                        policyS3List,
                         policyXRay,
                         policyKmsDecrypt,
                     ]
@@ -294,6 +302,8 @@ export class OperatorLibraryStack extends NestedStack {
                         policyS3ReadWrite,
                         policyS3Read,
                         policyInvokeDataPlaneHandler,
+                        policyDataPlaneTable,
+                        policyS3List,
                         policyXRay,
                         policyKmsDecrypt,
                     ]
@@ -340,6 +350,8 @@ export class OperatorLibraryStack extends NestedStack {
                         policyS3ReadWrite,
                         policyS3Read,
                         policyInvokeDataPlaneHandler,
+                        policyDataPlaneTable,
+                        policyS3List,
                         policyXRay,
                         policyKmsEncryptDecrypt,
                     ]
@@ -370,6 +382,8 @@ export class OperatorLibraryStack extends NestedStack {
                         policyS3ReadWrite,
                         policyS3Read,
                         policyInvokeDataPlaneHandler,
+                        policyDataPlaneTable,
+                        policyS3List,
                         policyXRay,
                         policyKmsDecrypt,
                     ]
@@ -386,6 +400,8 @@ export class OperatorLibraryStack extends NestedStack {
                         policyS3ReadWrite,
                         policyS3Read,
                         policyInvokeDataPlaneHandler,
+                        policyDataPlaneTable,
+                        policyS3List,
                         policyXRay,
                         policyKmsDecrypt,
                     ]
@@ -437,6 +453,7 @@ export class OperatorLibraryStack extends NestedStack {
                         policyS3Read,
                         policyS3List,
                         policyInvokeDataPlaneHandler,
+                        policyDataPlaneTable,
                         policyXRay,
                         policyKmsDecrypt,
                     ]
@@ -470,6 +487,8 @@ export class OperatorLibraryStack extends NestedStack {
                         policyS3ReadWrite,
                         policyS3Read,
                         policyInvokeDataPlaneHandler,
+                        policyDataPlaneTable,
+                        policyS3List,
                         policyXRay,
                         policyKmsDecrypt,
                     ]
@@ -556,6 +575,8 @@ export class OperatorLibraryStack extends NestedStack {
                             resources: ['*'],
                         }),
                         policyInvokeDataPlaneHandler,
+                        policyDataPlaneTable,
+                        policyS3List,
                         policyXRay,
                         policyKmsDecryptGrant,
                     ]
@@ -597,8 +618,10 @@ export class OperatorLibraryStack extends NestedStack {
                             ],
                         }),
                         policyInvokeDataPlaneHandler,
+                        policyDataPlaneTable,
+                        policyS3List,
                         policyLogEvents,
-                        policyS3ReadOnly,
+                        policyS3ReadWrite,
                         policyS3Read,
                         new iam.PolicyStatement({
                             actions: [
@@ -659,6 +682,7 @@ export class OperatorLibraryStack extends NestedStack {
         const mediaconvertRole = mediaConvertS3Role.roleArn;
         const DataplaneEndpoint = dataPlaneEndpoint.valueAsString;
         const DATAPLANE_BUCKET = dataPlaneBucket.valueAsString;
+        const DATAPLANE_TABLE_NAME = dataPlaneTableName.valueAsString;
         const MEDIACONVERT_ENDPOINT = mediaConvertEndpoint.valueAsString;
         const LD_LIBRARY_PATH = "/opt/python/";
         const botoConfig = boto3UserAgent.valueAsString;
@@ -682,6 +706,13 @@ export class OperatorLibraryStack extends NestedStack {
             const layer = pythonLayers[`${runtime}`];
             const func = new lambda.Function(scope, id, {
                 ...props,
+                // Every operator talks to the dataplane in direct mode instead of invoking the dataplane API
+                environment: {
+                    ...props.environment,
+                    DATAPLANE_CLIENT_MODE: "direct",
+                    DATAPLANE_BUCKET,
+                    DATAPLANE_TABLE_NAME,
+                },
                 layers: [layer],
                 code: sourceCodeMap.codeFromRegionalBucket(codeArchive),
                 runtime,
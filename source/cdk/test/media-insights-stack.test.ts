@@ -51,3 +51,22 @@ test('Snapshot media-insights root stack test', () => {
     // THEN
     expect(template).toMatchSnapshot();
 });
+
+test('Workflow scheduler can read the execution queue depth', () => {
+    const app = new App();
+    const stack = new MediaInsightsStack(
+        app,
+        'MiTestStack'
+    );
+    const template = Template.fromStack(stack);
+
+    // THEN
+    const roles = template.findResources('AWS::IAM::Role');
+    const statements = roles['StageExecutionRole'].Properties.Policies
+        .flatMap((policy: any) => policy.PolicyDocument.Statement);
+    const queueStatement = statements.find((statement: any) => [].concat(statement.Action).includes('sqs:GetQueueAttributes'));
+    expect(queueStatement).toBeDefined();
+    for (const queue of ['StageExecutionQueue', 'HighPriorityStageExecutionQueue', 'LowPriorityStageExecutionQueue']) {
+        expect(queueStatement.Resource).toContainEqual({ 'Fn::GetAtt': [queue, 'Arn'] });
+    }
+});
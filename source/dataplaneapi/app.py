@@ -3,19 +3,20 @@
 
 from chalice import Chalice
 from chalice import IAMAuthorizer
-from chalice import NotFoundError, BadRequestError, ChaliceViewError
+from chalice import NotFoundError, BadRequestError, ChaliceViewError, Response
 from botocore.client import ClientError
-from decimal import Decimal
-from botocore.config import Config
 from aws_xray_sdk.core import patch_all
+from MediaInsightsEngineLambdaHelper.clients import get_client, get_resource
+from MediaInsightsEngineLambdaHelper.dataplane_storage import DataplaneStorage, DataplaneStorageError, \
+    AssetNotFoundError, InvalidRequestError, normalize_results, encode_cursor, decode_cursor, format_created_month, \
+    GLOBAL_ATTRIBUTES, INDEX_ATTRIBUTES
 
-import boto3
 import os
-import uuid
 import json
 import logging
 import datetime
-import base64
+import time
+import uuid
 
 
 def is_aws():
@@ -33,16 +34,12 @@ if is_aws():
 #   *   Narrow exception scopes
 #   *   Better way to bubble exceptions to lambda helper class
 #   *   Normalize pattern for referencing URI params inside a function
-#   *   Move global_attributes list to a top level variable
 
 '''
 except ClientError as e:
     print(e.response['Error']['Message'])
 '''
 
-mie_config = json.loads(os.environ['botoConfig'])
-config = Config(**mie_config)
-
 formatter = logging.Formatter('{%(pathname)s:%(lineno)d} %(levelname)s - %(message)s')
 handler = logging.StreamHandler()
 handler.setFormatter(formatter)
@@ -58,8 +55,8 @@ framework_version = os.environ['FRAMEWORK_VERSION']
 
 # DDB resources
 dataplane_table_name = os.environ['DATAPLANE_TABLE_NAME']
-dynamo_client = boto3.client('dynamodb', config=config)
-dynamo_resource = boto3.resource('dynamodb', config=config)
+dynamo_client = get_client('dynamodb')
+dynamo_resource = get_resource('dynamodb')
 
 # S3 resources
 dataplane_s3_bucket = os.environ['DATAPLANE_BUCKET']
@@ -71,16 +68,22 @@ authorizer = IAMAuthorizer()
 # TODO: Should we add a variable for the upload bucket?
 
 base_s3_uri = 'private/assets/'
-s3_client = boto3.client('s3', config=config)
-s3_resource = boto3.resource('s3', config=config)
 
+# Asset listings, see list_all_assets
+ASSET_PAGE_MAX_LIMIT = 1000
+ASSET_SCAN_MAX_SEGMENTS = 1000000
+
+# Asset deletions started with DELETE /metadata/{asset_id}?async=true run as invocations of this function with a
+# DeleteAssetJob event, see handler. A job that runs out of time continues in a new invocation.
+DELETE_ASSET_JOB = 'DeleteAssetJob'
+DELETE_JOB_RESERVED_SECONDS = 20
+s3_client = get_client('s3')
+lambda_client = get_client('lambda')
 
-class DecimalEncoder(json.JSONEncoder):
-    def default(self, obj):
-        if isinstance(obj, Decimal):
-            return str(obj)
-            # Let the base class default method raise the TypeError
-        return json.JSONEncoder.default(self, obj)
+# Metadata layout, pointer updates and paging are implemented by the shared storage module so that the
+# DataPlane helper's direct client mode reads and writes exactly what this API does
+storage = DataplaneStorage(dataplane_s3_bucket, dataplane_table_name, s3_client=s3_client,
+                           dynamo_resource=dynamo_resource)
 
 
 def check_required_input(key, dict, objectname):
@@ -89,123 +92,106 @@ def check_required_input(key, dict, objectname):
             key, objectname))
 
 
-def write_metadata_to_s3(bucket, key, data):
-    encoded = json.dumps(data, cls=DecimalEncoder)
-    try:
-        s3_client.put_object(Bucket=bucket, Key=key, Body=encoded)
-    except ClientError as e:
-        error = e.response['Error']['Message']
-        logger.error("Exception occurred while writing asset metadata to s3: {e}".format(e=error))
-        return {"Status": "Error", "Message": error}
-    except Exception as e:
-        logger.error("Exception occurred while writing asset metadata to s3")
-        return {"Status": "Error", "Message": e}
-    else:
-        logger.info("Wrote asset metadata to s3")
-        return {"Status": "Success"}
-
-
-def read_metadata_from_s3(bucket, key):
-    try:
-        obj = s3_client.get_object(
-            Bucket=bucket,
-            Key=key
-        )
-    except ClientError as e:
-        error = e.response['Error']['Message']
-        logger.error("Exception occurred while reading asset metadata from s3: {e}".format(e=error))
-        return {"Status": "Error", "Message": error}
-    except Exception as e:
-        logger.error("Exception occurred while reading asset metadata from s3")
-        return {"Status": "Error", "Message": e}
-    else:
-        results = obj['Body'].read().decode('utf-8')
-        return {"Status": "Success", "Object": results}
+def raise_storage_error(e):
+    if isinstance(e, AssetNotFoundError):
+        raise NotFoundError(str(e))
+    if isinstance(e, InvalidRequestError):
+        raise BadRequestError(str(e))
+    raise ChaliceViewError(str(e))
 
 
 def delete_s3_objects(keys):
-    objects = []
-    for key in keys:
-        objects.append({"Key": key})
-    try:
-        response = s3_client.delete_objects(
-            Bucket=dataplane_s3_bucket,
-            Delete={
-                'Objects': objects
-            }
-        )
-    except ClientError as e:
-        error = e.response['Error']['Message']
-        logger.error("Exception occurred while deleting asset metadata from s3: {e}".format(e=error))
-        return {"Status": "Error", "Message": error}
-    except Exception as e:
-        logger.error("Exception occurred while deleting asset metadata from s3")
-        return {"Status": "Error", "Message": e}
-    else:
-        return {"Status": "Success", "Message": response}
-
+    return storage.delete_metadata_objects(keys)
 
-def read_asset_from_db(asset_id, **kwargs):
-    def log_exception_retreiving_metadata_for_asset(asset_id, error):
-        logger.error("Exception occurred while retreiving metadata for {asset}: {e}".format(asset=asset_id, e=error))
 
-    def format_unable_to_retrieve_metadata_error(error):
-        return "Unable to retrieve metadata: {e}".format(e=error)
+def delete_asset_objects(asset_id, keys, continuation_token=None, deadline=None):
+    """
+    Delete the objects of an asset: the given keys outside the asset directory, then everything under it.
 
-    table_name = dataplane_table_name
+    :return: The status of storage.delete_prefix, with a ContinuationToken when the deadline was reached
+    """
+    if keys:
+        delete = delete_s3_objects(keys)
+        if delete["Status"] != "Success":
+            return delete
+    return storage.delete_prefix(base_s3_uri + asset_id + '/', continuation_token=continuation_token,
+                                 deadline=deadline)
 
-    try:
-        table = dynamo_resource.Table(table_name)
-        asset_item = table.get_item(
-            Key={
-                "AssetId": asset_id
-            },
-            **kwargs
-        )
-    except ClientError as e:
-        error = e.response['Error']['Message']
-        log_exception_retreiving_metadata_for_asset(asset_id, error)
-        raise ChaliceViewError(format_unable_to_retrieve_metadata_error(error))
-    except Exception as e:
-        log_exception_retreiving_metadata_for_asset(asset_id, e)
-        raise ChaliceViewError(format_unable_to_retrieve_metadata_error(e))
 
-    if "Item" not in asset_item:
-        raise NotFoundError(
-            "Exception occurred while verifying asset exists: {asset} does not exist".format(asset=asset_id))
+def format_job_key(job_id):
+    return 'private/jobs/' + job_id + '.json'
 
-    return asset_item["Item"]
 
+def invoke_delete_asset_job(function_name, job):
+    lambda_client.invoke(
+        FunctionName=function_name,
+        InvocationType='Event',
+        Payload=json.dumps({DELETE_ASSET_JOB: job})
+    )
 
-def build_cursor_object(next_object, remaining):
-    cursor = {
-        "next": next_object,
-        "remaining": remaining
-    }
-    return cursor
 
+def read_delete_asset_job(job_id):
+    job = storage.read_metadata(format_job_key(job_id))
+    if job["Status"] != "Success":
+        return None
+    return json.loads(job["Object"])
 
-def encode_cursor(cursor):
-    cursor = json.dumps(cursor)
-    encoded = base64.urlsafe_b64encode(cursor.encode('UTF-8')).decode('ascii')
-    return encoded
 
+def run_delete_asset_job(job, context):
+    """
+    Run a deletion job until it is done or the invocation runs out of time.
 
-def decode_cursor(cursor):
-    decoded = json.loads(base64.b64decode(cursor).decode('utf-8'))
-    return decoded
+    The keys outside the asset directory are read from the job object written by delete_asset, a list of them
+    can be larger than an async invocation payload.  A job that fails is saved with the Error status.
+    """
+    try:
+        keys = []
+        if "ContinuationToken" not in job:
+            stored_job = read_delete_asset_job(job["JobId"])
+            if stored_job is None:
+                raise ValueError("Deletion job {job} not found".format(job=job["JobId"]))
+            keys = stored_job.get("Keys", [])
+        deadline = time.time() + context.get_remaining_time_in_millis() / 1000 - DELETE_JOB_RESERVED_SECONDS
+        delete = delete_asset_objects(job["AssetId"], keys, continuation_token=job.get("ContinuationToken"),
+                                      deadline=deadline)
+        if delete["Status"] == "Success":
+            job["DeletedCount"] = job.get("DeletedCount", 0) + len(delete["Message"].get("Deleted", []))
+            if "ContinuationToken" in delete:
+                logger.info("Continuing deletion job {job} in a new invocation".format(job=job["JobId"]))
+                job["ContinuationToken"] = delete["ContinuationToken"]
+                invoke_delete_asset_job(context.function_name, job)
+                return job
+            job.pop("ContinuationToken", None)
+            job["Status"] = "Complete"
+            logger.info("Completed deletion job {job} for asset: {asset}".format(job=job["JobId"], asset=job["AssetId"]))
+        else:
+            job["Status"] = "Error"
+            job["Message"] = delete["Message"] if isinstance(delete["Message"], dict) else str(delete["Message"])
+            logger.error("Deletion job {job} failed for asset: {asset}".format(job=job["JobId"], asset=job["AssetId"]))
+    except Exception as e:
+        job["Status"] = "Error"
+        job["Message"] = str(e)
+        logger.error("Deletion job {job} failed for asset: {asset}: {e}".format(job=job["JobId"], asset=job["AssetId"],
+                                                                               e=e))
+    storage.write_metadata(format_job_key(job["JobId"]), job)
+    return job
 
 
-def is_metadata_list(metadata):
-    return isinstance(metadata, list)
+def handler(event, context):
+    """
+    Entry point of the API handler function, routes deletion jobs to run_delete_asset_job and everything else to
+    the Chalice app.
+    """
+    if DELETE_ASSET_JOB in event:
+        return run_delete_asset_job(event[DELETE_ASSET_JOB], context)
+    return app(event, context)
 
 
-def next_page_valid(metadata, page_num):
+def read_asset_from_db(asset_id, **kwargs):
     try:
-        metadata[page_num]
-        return True
-    except IndexError:
-        return False
+        return storage.read_asset(asset_id, **kwargs)
+    except DataplaneStorageError as e:
+        raise_storage_error(e)
 
 
 def format_exception(e):
@@ -258,7 +244,7 @@ def upload():
     """
     print('/upload request: ' + app.current_request.raw_body.decode())
     region = os.environ['AWS_REGION']
-    s3 = boto3.client('s3', region_name=region, config=Config(signature_version='s3v4', s3={'addressing_style': 'virtual'}))
+    s3 = get_client('s3', region_name=region, signature_version='s3v4', s3={'addressing_style': 'virtual'})
     # limit uploads to 5GB
     max_upload_size = 5368709120
     try:
@@ -295,7 +281,7 @@ def download():
     """
     print('/download request: ' + app.current_request.raw_body.decode())
     region = os.environ['AWS_REGION']
-    s3 = boto3.client('s3', region_name=region, config=Config(signature_version='s3v4', s3={'addressing_style': 'virtual'}))
+    s3 = get_client('s3', region_name=region, signature_version='s3v4', s3={'addressing_style': 'virtual'})
     # expire the URL in
     try:
         response = s3.generate_presigned_url('get_object',
@@ -327,10 +313,7 @@ def media_upload_path(asset_id, workflow_id):
         ChaliceViewError - 500
     """
     try:
-        response = {
-            "S3Bucket": dataplane_s3_bucket,
-            "S3Key": 'private/assets/' + asset_id + "/workflows/" + workflow_id + "/"
-        }
+        response = storage.generate_media_storage_path(asset_id, workflow_id)
     except Exception as e:
         logging.info(e)
         raise ChaliceViewError(
@@ -371,73 +354,25 @@ def create_asset():
         ChaliceViewError - 500
     """
 
-    table_name = dataplane_table_name
-    bucket = dataplane_s3_bucket
-    uri = base_s3_uri
-
     asset = json.loads(app.current_request.raw_body.decode())
     logger.info(asset)
 
-    # create a uuid for the asset
-
-    asset_id = str(uuid.uuid4())
-
     # check required inputs
 
-    def log_exception_occurred_during_asset_creation(error):
-        logger.error("Exception occurred during asset creation: {e}".format(e=error))
-
     try:
         media_type = asset['Input']['MediaType']
         source_key = asset['Input']['S3Key']
         source_bucket = asset['Input']['S3Bucket']
     except KeyError as e:
-        log_exception_occurred_during_asset_creation(e)
+        logger.error("Exception occurred during asset creation: {e}".format(e=e))
         raise BadRequestError("Missing required inputs for asset creation: {e}".format(e=e))
     else:
         logger.info("Creating an asset from: {bucket}/{key}".format(bucket=source_bucket, key=source_key))
 
-    # create directory structure in s3 dataplane bucket for the asset
-    directory = uri + asset_id + "/"
-
     try:
-        s3_client.put_object(
-            Bucket=bucket,
-            Key=directory
-        )
-    except ClientError as e:
-        error = e.response['Error']['Message']
-        log_exception_occurred_during_asset_creation(error)
-        raise ChaliceViewError("Unable to create asset directory in the dataplane bucket: {e}".format(e=error))
-    except Exception as e:
-        log_exception_occurred_during_asset_creation(e)
-        raise ChaliceViewError("Exception when creating dynamo item for asset: {e}".format(e=e))
-    else:
-        logger.info("Created asset directory structure: {directory}".format(directory=directory))
-
-    ts = str(datetime.datetime.now().timestamp())
-
-    try:
-        table = dynamo_resource.Table(table_name)
-        table.put_item(
-            Item={
-                "AssetId": asset_id,
-                "MediaType": media_type,
-                "S3Bucket": source_bucket,
-                "S3Key": source_key,
-                "Created": ts
-            }
-        )
-    except ClientError as e:
-        error = e.response['Error']['Message']
-        log_exception_occurred_during_asset_creation(error)
-        raise ChaliceViewError("Unable to create asset item in dynamo: {e}".format(e=error))
-    except Exception as e:
-        log_exception_occurred_during_asset_creation(e)
-        raise ChaliceViewError("Exception when creating dynamo item for asset: {e}".format(e=e))
-    else:
-        logger.info("Completed asset creation for asset: {asset}".format(asset=asset_id))
-        return {"AssetId": asset_id, "MediaType": media_type, "S3Bucket": source_bucket, "S3Key": source_key}
+        return storage.create_asset(media_type, source_bucket, source_key)
+    except DataplaneStorageError as e:
+        raise_storage_error(e)
 
 
 def parse_paginate_settings(query_params):
@@ -468,6 +403,15 @@ def parse_paginate_settings(query_params):
     return paginated, end_pagination
 
 
+def parse_page_setting(query_params):
+    if query_params is None or "page" not in query_params:
+        return None
+    try:
+        return int(query_params["page"])
+    except ValueError:
+        raise BadRequestError("Query param page must be an integer")
+
+
 def log_exception_while_storing_metadata_for_asset(asset, error):
     logger.error("Exception occurred while storing metadata for {asset}: {e}".format(asset=asset, e=error))
 
@@ -476,7 +420,7 @@ def parse_operator_workflow_and_result_from_body(body, asset):
     try:
         operator_name = body['OperatorName']
         workflow_id = body['WorkflowId']
-        results = json.loads(json.dumps(body['Results']), parse_float=Decimal)
+        results = normalize_results(body['Results'])
     except KeyError as e:
         log_exception_while_storing_metadata_for_asset(asset, e)
         raise BadRequestError("Missing required inputs for storing metadata: {e}".format(e=e))
@@ -496,21 +440,6 @@ def parse_operator_workflow_and_result_from_body(body, asset):
     return operator_name, workflow_id, results
 
 
-# Verify asset exists before adding metadata and check if pointers exist for this operator
-def get_pointers_for_operator(asset, operator_name):
-    asset_item = read_asset_from_db(asset)
-
-    try:
-        pointers = asset_item[operator_name]
-    except KeyError:
-        logger.info("No pointers have been stored for this operator")
-        pointers = []
-    else:
-        logger.info("Retrieved existing pointers")
-
-    return pointers
-
-
 @app.route('/metadata/{asset_id}', cors=True, methods=['POST'], authorizer=authorizer)
 def put_asset_metadata(asset_id):
     """
@@ -521,9 +450,16 @@ def put_asset_metadata(asset_id):
     the "end" query param must be set to "true", which will tell the dataplane that the paginated session is
     over and update the pointer for that metadata type.
 
+    Each page is stored as its own object, '<operator>/page-00000.json', '<operator>/page-00001.json' and so on.
+    The final page also writes '<operator>/manifest.json', which lists every page and is what the pointer
+    references. Callers should pass the number of each page, so that a page stored again after a retry
+    overwrites the earlier copy. A page without a number is numbered after the pages already stored, which lists
+    them on every call.
+
     Query String Params:
     :param paginate: Boolean to tell dataplane that the results will come in as pages.
     :param end: Boolean to declare the last page in a set of paginated results.
+    :param page: The number of the page in a set of paginated results, counting from 0.
 
     Body:
 
@@ -553,112 +489,83 @@ def put_asset_metadata(asset_id):
 
     # TODO: Maybe add some enforcement around only being able to end paginated calls if called from the same workflow
 
-    bucket = dataplane_s3_bucket
     asset = asset_id
 
     body = json.loads(app.current_request.raw_body.decode())
     query_params = app.current_request.query_params
 
     paginated, end_pagination = parse_paginate_settings(query_params)
+    page = parse_page_setting(query_params)
 
     operator_name, workflow_id, results = parse_operator_workflow_and_result_from_body(body, asset)
 
-    # Key that we'll write the results too
-    metadata_key = base_s3_uri + asset + '/' + 'workflows' + '/' + workflow_id + '/' + operator_name + '.json'
-
-    # Verify asset exists before adding metadata and check if pointers exist for this operator
-
-    # TODO: This check happens every time we have an additional call when storing paginated results,
-    #  could likely refactor this to avoid that
-
-    pointers = get_pointers_for_operator(asset, operator_name)
-
-    # We wont update dynamo unless we successfully write to s3
+    try:
+        return storage.store_asset_metadata(asset, operator_name, workflow_id, results, paginated, end_pagination,
+                                            page)
+    except DataplaneStorageError as e:
+        raise_storage_error(e)
 
-    wrote_to_s3 = False
 
-    # write results to s3
+@app.route('/metadata/{asset_id}/batch', cors=True, methods=['POST'], authorizer=authorizer)
+def put_asset_metadata_batch(asset_id):
+    """
+    Adds many pages or many operators of metadata for an asset in one request.
 
-    str_page = ''
-    str_paginated = ''
+    The objects are written in parallel and the pointers of every operator that was completed by the batch are
+    updated together. Each item takes the same fields as the body of POST /metadata/{asset_id}, with the
+    paginated, end and page query params given as the Paginated and EndPagination flags and the Page number of the
+    item. Pages of the same operator without a number are numbered in the order they are listed. A batch can hold
+    at most 100 items.
 
-    if paginated:
-        str_page = ' page'
-        str_paginated = ' paginated'
+    Body:
 
-        # Check if the operator already generated metadata in this workflow execution
-        check_existing = read_metadata_from_s3(bucket, metadata_key)
-        if check_existing['Status'] == 'Error':
-            # Write the first page directly, format it as a list
-            logger.info("Operator has not stored results during this worfklow execution, writing first page to S3")
-            formatted_result = [results]
-            # Overwrite results so it will get written to s3
-            results = formatted_result
-        else:
-            # Pull in the existing metadata
-            existing_results = json.loads(check_existing['Object'])
-            # Append new data
-            existing_results.append(results)
-            # Overwrite results so it will get written back to s3
-            results = existing_results
-
-    store_results = write_metadata_to_s3(bucket, metadata_key, results)
-    if store_results['Status'] == 'Success':
-        logging.info(
-            'Wrote {operator} metadata{page} to S3 for asset: {asset}'.format(asset=asset, operator=operator_name, page=str_page))
-        wrote_to_s3 = True
-    else:
-        logging.error('Unable to write{paginated} metadata to s3 for asset: {asset}'.format(asset=asset, paginated=str_paginated))
-        raise ChaliceViewError("Exception occurred while writing metadata to s3: {e}".format(e=store_results["Message"]))
+    .. code-block:: python
 
-    # Update pointer for results
-    return update_pointer_for_operator(asset, operator_name, pointers, workflow_id, metadata_key,
-                                       paginated, end_pagination, wrote_to_s3)
+        {
+            "Items": [
+                {
+                    "OperatorName": "{some_operator}",
+                    "Results": "{json_formatted_results}",
+                    "WorkflowId": "workflow-id",
+                    "Paginated": true,
+                    "EndPagination": false,
+                    "Page": 0
+                }
+            ]
+        }
 
+    Returns:
 
-def update_pointer_for_operator(asset, operator_name, pointers, workflow_id, metadata_key,
-                                paginated, end_pagination, wrote_to_s3):
-    bucket = dataplane_s3_bucket
-    table_name = dataplane_table_name
+        The status of the batch and of each item, in the order of the request. Items that updated a pointer also
+        include the S3 Bucket and S3 Key that the pointer references.
 
-    # We only update pointer for results if all the pages are written successfully
-    if not paginated and wrote_to_s3 or end_pagination and wrote_to_s3:
-        # update the pointer list in dynamo
+        .. code-block:: python
 
-        # we store pointers as list to keep reference of results from different executions for the same operator
+            {
+                "Status": "Success|Error",
+                "Results": [
+                    {"OperatorName": $operator, "Status": "$status", "Bucket": $bucket, "Key": $metadata_key},
+                    {"OperatorName": $operator, "Status": "Error", "Message": $message}
+                ]
+            }
 
-        pointer = {"workflow": workflow_id, "pointer": metadata_key}
-        pointers.insert(0, pointer)
+    Raises:
+        BadRequestError - 400
+        NotFoundError - 404
+        ChaliceViewError - 500
+    """
+    body = json.loads(app.current_request.raw_body.decode())
 
-        update_expression = "SET #operator_result = :result"
-        expression_attr_name = {"#operator_result": operator_name}
-        expression_attr_val = {":result": pointers}
+    try:
+        items = body['Items']
+    except (KeyError, TypeError) as e:
+        log_exception_while_storing_metadata_for_asset(asset_id, e)
+        raise BadRequestError("Missing required inputs for storing metadata: {e}".format(e=e))
 
-        try:
-            table = dynamo_resource.Table(table_name)
-            table.update_item(
-                Key={
-                    "AssetId": asset
-                },
-                UpdateExpression=update_expression,
-                ExpressionAttributeNames=expression_attr_name,
-                ExpressionAttributeValues=expression_attr_val,
-            )
-        except ClientError as e:
-            error = e.response['Error']['Message']
-            logger.error("Exception occurred during metadata pointer update: {e}".format(e=error))
-            raise ChaliceViewError("Unable to update metadata pointer: {e}".format(e=error))
-        except Exception as e:
-            logger.error("Exception updating pointer in dynamo {e}".format(e=e))
-            raise ChaliceViewError(format_exception(e))
-        else:
-            logger.info("Successfully stored {operator} metadata for asset: {asset} in the dataplane".format(
-                operator=operator_name, asset=asset))
-            return {"Status": "Success", "Bucket": bucket, "Key": metadata_key}
-    elif paginated and not end_pagination and wrote_to_s3:
-        return {"Status": "Success"}
-    else:
-        return {"Status": "Failed"}
+    try:
+        return storage.store_asset_metadata_batch(asset_id, items)
+    except DataplaneStorageError as e:
+        raise_storage_error(e)
 
 
 @app.route('/metadata/{asset_id}', cors=True, methods=['GET'], authorizer=authorizer)
@@ -692,83 +599,18 @@ def get_asset_metadata(asset_id):
 
     logging.info("Returning all metadata for asset: {asset_id}".format(asset_id=asset_id))
 
-    def create_response(asset_id, results, remaining, operator_name=None):
-        response = {"asset_id": asset_id}
-
-        if operator_name:
-            response["operator"] = operator_name
-
-        if remaining:
-            next_page = remaining[0]
-            next_page["page"] = 0
-            new_cursor = build_cursor_object(next_page, remaining)
-
-            # Add page cursor to the response
-            response["cursor"] = encode_cursor(new_cursor)
-
-        response["results"] = results
-
-        return response
-
     # Check if cursor is present, if not this is the first request
 
     query_params = app.current_request.query_params
 
-    first_call = query_params is None
-
-    if first_call:
-        asset_attributes = read_asset_from_db(asset_id)
-
-        # TODO: Should clarify varaible names for first page in the context of the
-        #  entire request vs. a page for a specific operator
-        global_attributes = ['MediaType', 'S3Key', 'S3Bucket', 'AssetId', 'Created']
-        remaining_attributes = list(set(asset_attributes.keys()) - set(global_attributes))
-
-        global_asset_info = dict([(attr, asset_attributes[attr]) for attr in global_attributes if attr != "AssetId"])
-
-        remaining = [{attr: asset_attributes[attr][0]["pointer"]}
-                     for attr in remaining_attributes
-                     if attr not in ("Locked", "LockedAt", "LockedBy")]
-
-        # Create the response
-        response = create_response(asset_id, global_asset_info, remaining)
-
-        return response
-
-    cursor = query_params['cursor']
-    decoded_cursor = decode_cursor(cursor)
-    operator_name = [k for k in decoded_cursor["next"].keys() if k != "page"][0]
-    pointer = decoded_cursor["next"][operator_name]
-    page_num = decoded_cursor["next"]["page"]
-    remaining = decoded_cursor["remaining"]
-
-    # TODO: Add error handling for s3 call
-    s3_object = read_metadata_from_s3(dataplane_s3_bucket, pointer)
-
-    operator_metadata = json.loads(s3_object["Object"])
-    if is_metadata_list(operator_metadata):
-        next_page_num = page_num + 1
-
-        page_data = operator_metadata[page_num]
-
-        if next_page_valid(operator_metadata, next_page_num):
-            next_page = {operator_name: pointer, "page": next_page_num}
-            new_cursor = build_cursor_object(next_page, remaining)
-            response = {"asset_id": asset_id, "operator": operator_name,
-                        "cursor": encode_cursor(new_cursor),
-                        "results": page_data}
-        else:
-            del remaining[0]
-            response = create_response(asset_id, page_data, remaining, operator_name=operator_name)
-
-        return response
-
-    page = operator_metadata
-
-    del remaining[0]
-    response = create_response(asset_id, page, remaining, operator_name=operator_name)
+    cursor = None
+    if query_params is not None:
+        cursor = query_params['cursor']
 
-    return response
+    try:
+        return storage.retrieve_asset_metadata(asset_id, cursor=cursor)
+    except DataplaneStorageError as e:
+        raise_storage_error(e)
 
 
 # TODO: I need to do some bugfixing, this method works but I think I'm sending the last page back twice
@@ -784,6 +626,9 @@ def get_asset_metadata_operator(asset_id, operator_name):
 
     Once all results have been retrieved, no cursor key will be present in the response.
 
+    Clients with read access to the dataplane bucket can pass pointer=true to receive the location of the metadata
+    instead, and read all pages from S3 themselves.
+
     Returns:
 
         Metadata that a specific operator created
@@ -797,6 +642,17 @@ def get_asset_metadata_operator(asset_id, operator_name):
                 "results": first_page_data
             }
 
+        Or, with pointer=true, the location of the metadata object, or of the manifest of segmented metadata
+
+        .. code-block:: python
+
+            {
+                "asset_id": asset_id,
+                "operator": operator_name,
+                "S3Bucket": bucket,
+                "S3Key": key
+            }
+
     Raises:
         ChaliceViewError - 500
     """
@@ -805,67 +661,18 @@ def get_asset_metadata_operator(asset_id, operator_name):
 
     # Check if cursor is present, if not this is the first request
 
-    first_call = app.current_request.query_params is None
-
-    if first_call:
-        projection_expression = "#attr"
-        expression_attribute_names = {"#attr": operator_name}
-        asset_attributes = read_asset_from_db(
-            asset_id,
-            ProjectionExpression=projection_expression,
-            ExpressionAttributeNames=expression_attribute_names
-        )
-
-        pointer = asset_attributes[operator_name][0]["pointer"]
-        s3_object = read_metadata_from_s3(dataplane_s3_bucket, pointer)
-        # TODO: Add error handling for s3 call
-        operator_metadata = json.loads(s3_object["Object"])
-        if is_metadata_list(operator_metadata):
-            first_page_num = 0
-            next_page_num = first_page_num + 1
-
-            first_page_data = operator_metadata[first_page_num]
-
-            if next_page_valid(operator_metadata, next_page_num):
-                next_page = {operator_name: pointer, "page": next_page_num}
-                # TODO: Do I really need this for getting results of a specific operator?
-                remaining = [operator_name]
-                new_cursor = build_cursor_object(next_page, remaining)
-                response = {"asset_id": asset_id, "operator": operator_name,
-                            "cursor": encode_cursor(new_cursor),
-                            "results": first_page_data}
-            else:
-                response = {"asset_id": asset_id, "operator": operator_name, "results": first_page_data}
-        else:
-            page = operator_metadata
-            response = {"asset_id": asset_id, "operator": operator_name, "results": page}
-
-        return response
-
-    cursor = app.current_request.query_params['cursor']
-    decoded_cursor = decode_cursor(cursor)
-
-    pointer = decoded_cursor["next"][operator_name]
-    page_num = decoded_cursor["next"]["page"]
-
-    next_page_num = page_num + 1
+    cursor = None
+    pointer = False
+    if app.current_request.query_params is not None:
+        cursor = app.current_request.query_params.get('cursor')
+        pointer = app.current_request.query_params.get('pointer') == 'true'
 
-    # TODO: Add error handling for s3 call
-    s3_object = read_metadata_from_s3(dataplane_s3_bucket, pointer)
-
-    operator_metadata = json.loads(s3_object["Object"])
-    page_data = operator_metadata[page_num]
-
-    if next_page_valid(operator_metadata, next_page_num) is True:
-        next_page = {operator_name: pointer, "page": next_page_num}
-        remaining = [operator_name]
-        new_cursor = build_cursor_object(next_page, remaining)
-        response = {"asset_id": asset_id, "operator": operator_name,
-                    "cursor": encode_cursor(new_cursor), "results": page_data}
-    else:
-        response = {"asset_id": asset_id, "operator": operator_name, "results": page_data}
-
-    return response
+    try:
+        if pointer:
+            return storage.retrieve_operator_pointer(asset_id, operator_name)
+        return storage.retrieve_operator_metadata(asset_id, operator_name, cursor=cursor)
+    except DataplaneStorageError as e:
+        raise_storage_error(e)
 
 
 @app.route('/checkout/{asset_id}', cors=True, methods=['POST'], authorizer=authorizer)
@@ -1027,31 +834,179 @@ def list_all_locked_assets():
         return {"locks": locks}
 
 
+def current_created_month():
+    return format_created_month(datetime.datetime.now().timestamp())
+
+
+def next_created_month(month):
+    year, month = (int(part) for part in month.split('-'))
+    return '{:04d}-{:02d}'.format(year + month // 12, month % 12 + 1)
+
+
+def parse_int_query_param(query_params, name, minimum, maximum):
+    try:
+        value = int(query_params[name])
+    except ValueError:
+        raise BadRequestError("Query parameter {} must be an integer".format(name))
+    if not minimum <= value <= maximum:
+        raise BadRequestError("Query parameter {} must be between {} and {}".format(name, minimum, maximum))
+    return value
+
+
+def parse_asset_list_params(query_params):
+    """
+    Read the paging, created-time and segment query parameters of GET /metadata.
+    """
+    query_params = query_params or {}
+    params = {
+        "paginated": "limit" in query_params or "cursor" in query_params or "createdAfter" in query_params,
+        "limit": ASSET_PAGE_MAX_LIMIT,
+        "cursor": {},
+        "created_after": None,
+        "segment": None,
+        "total_segments": None
+    }
+
+    if "limit" in query_params:
+        params["limit"] = parse_int_query_param(query_params, "limit", 1, ASSET_PAGE_MAX_LIMIT)
+
+    if "cursor" in query_params:
+        try:
+            params["cursor"] = decode_cursor(query_params["cursor"])
+        except ValueError:
+            raise BadRequestError("Query parameter cursor is not valid")
+        if not isinstance(params["cursor"], dict):
+            raise BadRequestError("Query parameter cursor is not valid")
+
+    # The created range of a listing is kept in its cursor, so later pages only need the cursor
+    created_after = params["cursor"].get("createdAfter", query_params.get("createdAfter"))
+    if created_after is not None:
+        try:
+            params["created_after"] = str(float(created_after))
+        except ValueError:
+            raise BadRequestError("Query parameter createdAfter must be a timestamp in seconds since the epoch")
+
+    if "segment" in query_params or "totalSegments" in query_params:
+        if "segment" not in query_params or "totalSegments" not in query_params:
+            raise BadRequestError("Query parameters segment and totalSegments must be passed together")
+        if params["created_after"] is not None:
+            raise BadRequestError("Query parameter createdAfter can not be combined with a segment")
+        params["total_segments"] = parse_int_query_param(query_params, "totalSegments", 1, ASSET_SCAN_MAX_SEGMENTS)
+        params["segment"] = parse_int_query_param(query_params, "segment", 0, params["total_segments"] - 1)
+
+    return params
+
+
+def scan_assets(table, params):
+    """
+    List assets in table order, optionally from one segment of a parallel scan.
+    """
+    scan_args = {
+        'Select': 'SPECIFIC_ATTRIBUTES',
+        'AttributesToGet': [
+            'AssetId',
+        ]
+    }
+    if params["segment"] is not None:
+        scan_args['Segment'] = params["segment"]
+        scan_args['TotalSegments'] = params["total_segments"]
+    if "key" in params["cursor"]:
+        scan_args['ExclusiveStartKey'] = params["cursor"]["key"]
+
+    asset_ids = []
+    while True:
+        if params["paginated"]:
+            scan_args['Limit'] = params["limit"] - len(asset_ids)
+        assets = table.scan(**scan_args)
+        asset_ids.extend(asset["AssetId"] for asset in assets["Items"])
+        last_evaluated_key = assets.get("LastEvaluatedKey")
+        if last_evaluated_key is None or (params["paginated"] and len(asset_ids) >= params["limit"]):
+            break
+        scan_args['ExclusiveStartKey'] = last_evaluated_key
+
+    response = {"assets": asset_ids}
+    if params["paginated"] and last_evaluated_key is not None:
+        response["cursor"] = encode_cursor({"key": last_evaluated_key})
+    return response
+
+
+def query_assets_created_after(table, params):
+    """
+    List the assets created after a time, oldest first, from the month partitions of the AssetCreated index.
+    """
+    month = params["cursor"].get("month", format_created_month(params["created_after"]))
+    last_evaluated_key = params["cursor"].get("key")
+    last_month = current_created_month()
+
+    asset_ids = []
+    while month <= last_month and len(asset_ids) < params["limit"]:
+        query_args = {
+            'IndexName': 'AssetCreated',
+            'KeyConditionExpression': 'CreatedMonth = :month AND Created > :created_after',
+            'ExpressionAttributeValues': {
+                ':month': month,
+                ':created_after': params["created_after"]
+            },
+            'Limit': params["limit"] - len(asset_ids)
+        }
+        if last_evaluated_key is not None:
+            query_args['ExclusiveStartKey'] = last_evaluated_key
+        assets = table.query(**query_args)
+        asset_ids.extend(asset["AssetId"] for asset in assets["Items"])
+        last_evaluated_key = assets.get("LastEvaluatedKey")
+        if last_evaluated_key is None:
+            month = next_created_month(month)
+
+    response = {"assets": asset_ids}
+    if month <= last_month:
+        cursor = {"createdAfter": params["created_after"], "month": month}
+        if last_evaluated_key is not None:
+            cursor["key"] = last_evaluated_key
+        response["cursor"] = encode_cursor(cursor)
+    return response
+
+
 @app.route('/metadata', cors=True, methods=['GET'], authorizer=authorizer)
 def list_all_assets():
     """
+    Lists the asset ids in the dataplane.
+
+    Without query parameters all assets are returned. Bulk clients should page through the assets instead:
+
+    limit: Return at most this many asset ids and a cursor for the next page, up to 1000.
+
+    cursor: The cursor returned with the previous page. Once all assets have been retrieved, no cursor key will be
+    present in the response.
+
+    createdAfter: Only list assets created after this time, in seconds since the epoch, oldest first. Assets
+    created before the AssetCreated index was added to the dataplane table are not listed by this filter.
+
+    segment, totalSegments: Only list one segment of a parallel scan, so that a full export can be split over
+    totalSegments concurrent clients.
+
     Returns:
-        Dict containing a list of all assets by their asset_id. The list returns empty if no assets have been created.
+        Dict containing a list of assets by their asset_id. The list returns empty if no assets have been created.
 
         .. code-block:: python
             {
-                "assets": ["$asset_id_1", "$asset_id_2"...]
+                "assets": ["$asset_id_1", "$asset_id_2"...],
+                "cursor": encoded_cursor_value
             }
     Raises:
+        BadRequestError - 400
         ChaliceViewError - 500
     """
 
     logging.info("Returning a list of all assets")
     table_name = dataplane_table_name
+    params = parse_asset_list_params(app.current_request.query_params)
 
     try:
         table = dynamo_resource.Table(table_name)
-        assets = table.scan(
-            Select='SPECIFIC_ATTRIBUTES',
-            AttributesToGet=[
-                'AssetId',
-            ]
-        )
+        if params["created_after"] is not None:
+            response = query_assets_created_after(table, params)
+        else:
+            response = scan_assets(table, params)
     except ClientError as e:
         error = e.response['Error']['Message']
         logger.error("Exception occurred during request to list assets: {e}".format(e=error))
@@ -1060,18 +1015,8 @@ def list_all_assets():
         logger.error("Exception listing assets {e}".format(e=e))
         raise ChaliceViewError(format_exception(e))
     else:
-        if "Items" in assets:
-            logger.info("Retrieved assets from the dataplane: {}".format(assets))
-            asset_ids = []
-            for asset in assets["Items"]:
-                asset_ids.append(asset["AssetId"])
-            response = {"assets": asset_ids}
-
-            return response
-        else:
-            logger.info("No assets have been created in the dataplane")
-            response = {"assets": ""}
-            return response
+        logger.info("Retrieved {} assets from the dataplane".format(len(response["assets"])))
+        return response
 
 
 @app.route('/metadata/{asset_id}/{operator_name}', cors=True, methods=['DELETE'], authorizer=authorizer)
@@ -1130,7 +1075,7 @@ def delete_operator_metadata(asset_id, operator_name):
     keys = []
     for item in deleted_pointers:
         for pointer in item.values():
-            keys.append(pointer)
+            keys.extend(storage.expand_pointer_keys(pointer))
     delete = delete_s3_objects(keys)
     if delete["Status"] == "Success":
         logger.info(
@@ -1146,8 +1091,11 @@ def delete_asset(asset_id):
     """
     Deletes an asset and all metadata from the dataplane.
 
+    Assets with many objects should be deleted with the async=true query parameter. The asset is removed right
+    away and its objects are deleted in the background, poll GET /deletion/{job_id} for the result.
+
     Returns:
-        Deletion status from dataplane.
+        Deletion status from dataplane, or with async=true a 202 response with the JobId of the deletion.
     Raises:
         ChaliceViewError - 500
     """
@@ -1178,32 +1126,41 @@ def delete_asset(asset_id):
     except KeyError as e:
         raise ChaliceViewError(format_unable_to_delete_asset_error(e))
 
-    global_attributes = ['MediaType', 'S3Key', 'S3Bucket', 'AssetId', 'Created']
-    remaining_attributes = list(set(attributes_to_delete.keys()) - set(global_attributes))
+    remaining_attributes = list(set(attributes_to_delete.keys()) - set(GLOBAL_ATTRIBUTES) - set(INDEX_ATTRIBUTES))
 
-    # Build list of all s3 objects that the asset had pointers to
+    # Everything under the asset directory is listed and deleted, including workflow artifacts that no pointer
+    # references. Only the objects outside of it are collected from the pointers and the source media key.
+    asset_path = base_s3_uri + asset_id + '/'
     keys = []
     for attr in remaining_attributes:
         attr_pointers = attributes_to_delete[attr]
         for item in attr_pointers:
             for pointer in item.values():
-                keys.append(pointer)
-    keys.append(attributes_to_delete['S3Key'])
+                if not pointer.startswith(asset_path):
+                    keys.extend(storage.expand_pointer_keys(pointer))
+    if not attributes_to_delete['S3Key'].startswith(asset_path):
+        keys.append(attributes_to_delete['S3Key'])
 
-    # Delete all the objects from S3
-    logger.info("Deleting the metadata objects from s3")
-    delete = delete_s3_objects(keys)
-    if delete["Status"] == "Success":
-        # Now delete the assets directory
-        logger.info("Deleted metadata objects from s3")
-        asset_path = base_s3_uri + asset_id + '/'
+    query_params = app.current_request.query_params
+    if query_params is not None and query_params.get("async") == "true":
+        job = {"JobId": str(uuid.uuid4()), "AssetId": asset, "Status": "Started"}
+        # The keys are stored with the job object rather than sent with the invocation, whose payload is limited
+        # to 256 KB
+        store = storage.write_metadata(format_job_key(job["JobId"]), dict(job, Keys=keys))
+        if store["Status"] != "Success":
+            raise ChaliceViewError(format_unable_to_delete_asset_error(store["Message"]))
         try:
-            logger.info("Cleaning up asset directory after metadata deletion")
-            s3_resource.Object(dataplane_s3_bucket, asset_path).delete()
+            invoke_delete_asset_job(app.lambda_context.function_name, job)
         except ClientError as e:
             error = e.response['Error']['Message']
             raise ChaliceViewError(format_unable_to_delete_asset_error(error))
+        logger.info("Started deletion job {job} for asset: {asset}".format(job=job["JobId"], asset=asset))
+        return Response(body=job, status_code=202)
 
+    # Delete all the objects from S3
+    logger.info("Deleting the metadata objects from s3")
+    delete = delete_asset_objects(asset_id, keys)
+    if delete["Status"] == "Success":
         logger.info(
             "Successfully deleted asset: {asset} from the dataplane".format(asset=asset))
         return "Deleted asset: {asset} from the dataplane".format(asset=asset)
@@ -1211,3 +1168,30 @@ def delete_asset(asset_id):
     logger.error("Unable to delete asset: {asset}".format(asset=asset))
     raise ChaliceViewError(
         "Unable to delete asset from the dataplane: {error}".format(error=delete["Message"]))
+
+
+@app.route('/deletion/{job_id}', cors=True, methods=['GET'], authorizer=authorizer)
+def get_delete_asset_job(job_id):
+    """
+    Returns the status of an asset deletion started with DELETE /metadata/{asset_id}?async=true.
+
+    Returns:
+
+        .. code-block:: python
+
+            {
+                "JobId": job_id,
+                "AssetId": asset_id,
+                "Status": "Started" | "Complete" | "Error",
+                "DeletedCount": number_of_deleted_objects,
+                "Message": errors (on Error)
+            }
+
+    Raises:
+        NotFoundError - 404
+    """
+    job = read_delete_asset_job(job_id)
+    if job is None:
+        raise NotFoundError("Deletion job {job} not found".format(job=job_id))
+    job.pop("Keys", None)
+    return job
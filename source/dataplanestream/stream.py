@@ -2,13 +2,15 @@
 # SPDX-License-Identifier: Apache-2.0
 
 import os
+import time
 import boto3
 import json
 import decimal
-from boto3.dynamodb.types import TypeDeserializer
 from botocore import config
 from aws_xray_sdk.core import xray_recorder
 from aws_xray_sdk.core import patch_all
+from MediaInsightsEngineLambdaHelper.metrics import put_metric
+from MediaInsightsEngineLambdaHelper.stream_records import decode_attributes, diff_operators, latest_result
 
 patch_all()
 
@@ -17,7 +19,15 @@ config = config.Config(**mie_config)
 
 ks = boto3.client('kinesis', config=config)
 stream_name = os.environ['StreamName']
-serializer = TypeDeserializer()
+
+# Pointers to paginated results reference a manifest that lists one object per page
+SEGMENTED_MANIFEST_SUFFIX = '/manifest.json'
+
+# Limits of a Kinesis PutRecords request
+KINESIS_BATCH_MAX_RECORDS = 500
+KINESIS_BATCH_MAX_BYTES = 5 * 1024 * 1024
+# Records Kinesis rejects, e.g. when a shard is throttled, are retried with a backoff before the batch fails
+KINESIS_MAX_RETRIES = 5
 
 
 class DecimalEncoder(json.JSONEncoder):
@@ -27,87 +37,86 @@ class DecimalEncoder(json.JSONEncoder):
         return super(DecimalEncoder, self).default(o)
 
 
-def deserialize(data):
-    if isinstance(data, list):
-        return [deserialize(v) for v in data]
-
-    if isinstance(data, dict):
-        try:
-            return serializer.deserialize(data)
-        except TypeError:
-            return {k: deserialize(v) for k, v in data.items()}
-    else:
-        return data
-
-
-def put_ks_record(pkey, data):
-    ks.put_record(
-        StreamName=stream_name,
-        Data=json.dumps(data, cls=DecimalEncoder),
-        PartitionKey=pkey,
-    )
-
-
-def diff_item_images(item_1, item_2):
-    operators = []
-
-    item_1_items = item_1.items()
-
-    # Get attributes that store pointers
-    for item in item_1_items:
-        if isinstance(item[1], list):
-            print("Adding the following to operator comparison list:", item)
-            operators.append(item[0])
-
-    # This could probably be a string, but keeping as a list for now until this design is tested
-    modified_operator = []
-
-    for operator in operators:
-        item_1_pointer = item_1[operator][0]["pointer"]
-        item_2_pointer = item_2[operator][0]["pointer"]
-
-        print("Comparing:", item_1_pointer, "with:", item_2_pointer)
-
-        if item_1_pointer != item_2_pointer:
-            changed = {"operator": operator, "pointer": item_1_pointer, "workflow": item_1[operator][0]["workflow"]}
-            print("Found the modified operator:", changed)
-            modified_operator.append(changed)
-
-    if len(modified_operator) > 1:
-        # This really shouldn't happen, but adding just in case... see comment about storing as a string instead
-        print("We somehow got modified pointers for more than one operator in one stream event")
-    else:
-        try:
-            modified = modified_operator[0]
-        except Exception as e:
-            print("Unable to return the modified operator:", e)
-        else:
-            return modified
+def chunk_ks_records(records):
+    chunk = []
+    chunk_bytes = 0
+    for record in records:
+        record_bytes = len(record["Data"].encode("utf-8")) + len(record["PartitionKey"].encode("utf-8"))
+        if chunk and (len(chunk) == KINESIS_BATCH_MAX_RECORDS or chunk_bytes + record_bytes > KINESIS_BATCH_MAX_BYTES):
+            yield chunk
+            chunk = []
+            chunk_bytes = 0
+        chunk.append(record)
+        chunk_bytes += record_bytes
+    if chunk:
+        yield chunk
+
+
+def put_ks_chunk(records):
+    attempt = 0
+    while True:
+        response = ks.put_records(StreamName=stream_name, Records=records)
+        if not response.get("FailedRecordCount"):
+            return attempt
+        failed = [record for record, result in zip(records, response["Records"]) if "ErrorCode" in result]
+        if attempt == KINESIS_MAX_RETRIES:
+            raise Exception("Unable to put {count} records into the stream".format(count=len(failed)))
+        print("Retrying", len(failed), "records rejected by the stream")
+        time.sleep(min(1, 0.05 * 2 ** attempt))
+        attempt += 1
+        records = failed
+
+
+def put_ks_records(records):
+    """
+    Put records into the stream with as few PutRecords requests as the limits allow.
+
+    The stream keeps the records of an asset in order because they share a partition key. A retried record
+    would be written after records that followed it in the same request, so a request never holds two records
+    of the same asset: the n-th record of every asset is sent in the n-th round, after the records of the
+    previous round were accepted.
+
+    :param records: List of (partition_key, data) tuples in stream order
+    """
+    rounds = []
+    counts = {}
+    for pkey, data in records:
+        position = counts.get(pkey, 0)
+        counts[pkey] = position + 1
+        if position == len(rounds):
+            rounds.append([])
+        rounds[position].append({"Data": json.dumps(data, cls=DecimalEncoder), "PartitionKey": pkey})
+
+    start = time.time()
+    requests = 0
+    retries = 0
+    for round_records in rounds:
+        for chunk in chunk_ks_records(round_records):
+            retries += put_ks_chunk(chunk)
+            requests += 1
+
+    if requests:
+        put_metric('DataplaneStreamBatchSize', len(records) / requests)
+        put_metric('DataplaneStreamPutRetries', retries)
+        put_metric('DataplaneStreamPutLatency', int((time.time() - start) * 1000), unit='Milliseconds')
 
 
 def determine_item_change(stream_record):
-    new_item = stream_record["NewImage"]
-    old_item = stream_record["OldImage"]
-
-    new_attributes = set(new_item.keys())
-    old_attributes = set(old_item.keys())
-
-    # Check for new or removed attribute first
-    if new_attributes == old_attributes:
-        print("No attributes added or removed, this must be a modification on an existing attribute")
-        modified_attribute = diff_item_images(new_item, old_item)
-        return modified_attribute
-    else:
-        # Determine if new or removed
-        new = new_attributes - old_attributes
-        removed = old_attributes - new_attributes
-
-        if new != set():
-            new = str(list(new)[0])
-            return {"operator": new, "pointer": new_item[new][0]["pointer"], "workflow": new_item[new][0]["workflow"]}
-        if removed != set():
-            removed = str(list(removed)[0])
-            return {"operator": removed}
+    new_image = stream_record["NewImage"]
+    old_image = stream_record["OldImage"]
+
+    added, removed, modified = diff_operators(new_image, old_image)
+    if added:
+        result = latest_result(new_image[added[0]])
+        return {"operator": added[0], "pointer": result["pointer"], "workflow": result["workflow"]}
+    if removed:
+        return {"operator": removed[0]}
+    if len(modified) > 1:
+        # An asset item is updated for one operator at a time, so this shouldn't happen
+        print("We somehow got modified pointers for more than one operator in one stream event:", modified)
+    elif modified:
+        result = latest_result(new_image[modified[0]])
+        return {"operator": modified[0], "pointer": result["pointer"], "workflow": result["workflow"]}
 
 
 def build_metadata_object(stream_record, action):
@@ -124,11 +133,12 @@ def build_metadata_object(stream_record, action):
             metadata_object["Pointer"] = modified_attribute["pointer"]
             metadata_object["Operator"] = modified_attribute["operator"]
             metadata_object["Workflow"] = modified_attribute["workflow"]
+            # Consumers read the manifest and then each page it lists rather than a single object
+            if modified_attribute["pointer"].endswith(SEGMENTED_MANIFEST_SUFFIX):
+                metadata_object["Layout"] = "segmented"
     if action == "INSERT":
         items = stream_record["NewImage"]
-        for item in items:
-            if item != "AssetId":
-                metadata_object[item] = items[item]
+        metadata_object = decode_attributes(items, [item for item in items if item != "AssetId"])
         metadata_object["Action"] = "INSERT"
     if action == "REMOVE":
         # For a delete we just need to pass the asset id and the action to remove
@@ -138,21 +148,22 @@ def build_metadata_object(stream_record, action):
         print("Unable to build metadata object")
         return {"Status": "Error"}
     else:
-        print(metadata_object)
         return {"Status": "Success", "Results": metadata_object}
 
 
 def lambda_handler(event, _context):
     print("Stream record received:", event)
+    ks_records = []
     for record in event["Records"]:
-        deserialized_record = deserialize(record["dynamodb"])
-        print(deserialized_record)
-        asset_id = deserialized_record["Keys"]["AssetId"]
+        # The images stay encoded, build_metadata_object decodes only the attributes it reads
+        stream_record = record["dynamodb"]
+        asset_id = stream_record["Keys"]["AssetId"]["S"]
         event_type = record["eventName"]
         if event_type in {"MODIFY", "INSERT", "REMOVE"}:
-            metadata = build_metadata_object(deserialized_record, event_type)
+            metadata = build_metadata_object(stream_record, event_type)
             if metadata["Status"] == "Success":
                 print('Putting the following data into the stream:', metadata["Results"])
-                put_ks_record(asset_id, metadata["Results"])
+                ks_records.append((asset_id, metadata["Results"]))
             else:
                 print("Nothing to put into stream")
+    put_ks_records(ks_records)
@@ -2,10 +2,13 @@
 # SPDX-License-Identifier: Apache-2.0
 
 import json
-import boto3
 import os
 import uuid
 import time
+from MediaInsightsEngineLambdaHelper.dataplane_storage import DataplaneStorage, DataplaneStorageError, DecimalEncoder, \
+    normalize_results
+from MediaInsightsEngineLambdaHelper.clients import get_client
+from MediaInsightsEngineLambdaHelper.references import ReferenceDict, reference_key_prefix, spill_values
 
 # Package for implementing operations for the AWS Media Analysis Solution
 
@@ -17,6 +20,10 @@ class Status:
     WORKFLOW_STATUS_ERROR = "Error"
     WORKFLOW_STATUS_COMPLETE = "Complete"
 
+    WORKFLOW_PRIORITY_HIGH = "High"
+    WORKFLOW_PRIORITY_NORMAL = "Normal"
+    WORKFLOW_PRIORITY_LOW = "Low"
+
     STAGE_STATUS_NOT_STARTED = "Not Started"
     STAGE_STATUS_STARTED = "Started"
     STAGE_STATUS_EXECUTING = "Executing"
@@ -43,12 +50,17 @@ class MediaInsightsOperationHelper:
         self.asset_id = event["AssetId"]
         self.workflow_execution_id = event["WorkflowExecutionId"]
         self.input = event["Input"]
+        # Large values from earlier stages may have been spilled to S3, they are read back on first access
+        if isinstance(self.input, dict) and "MetaData" in self.input:
+            self.input["MetaData"] = ReferenceDict(self.input["MetaData"])
         self.configuration = event["Configuration"]
         self.status = event["Status"]
         if "MetaData" in event:
-            self.metadata = event["MetaData"]
+            self.metadata = event["MetaData"] = ReferenceDict(event["MetaData"])
         else:
-            self.metadata = {}
+            self.metadata = ReferenceDict()
+        # S3 keys of the values spilled by return_output_object, so calling it again writes nothing
+        self.spilled_keys = set()
         if "Media" in event:
             self.media = event["Media"]
         else:
@@ -61,9 +73,18 @@ class MediaInsightsOperationHelper:
     def return_output_object(self):
         """Method to return the output object that was created
 
+        MetaData values larger than OUTPUT_SPILL_THRESHOLD_BYTES are stored in the dataplane bucket and returned
+        as references when the operator has the OUTPUT_SPILL_THRESHOLD_BYTES and DATAPLANE_BUCKET environment
+        variables, see MediaInsightsEngineLambdaHelper.references.
+
         :return: Dict of the output object
         """
-        return {"Name": self.name, "AssetId": self.asset_id, "WorkflowExecutionId": self.workflow_execution_id,  "Input": self.input, "Configuration": self.configuration, "Status": self.status, "MetaData": self.metadata, "Media": self.media}
+        metadata = self.metadata
+        if "DATAPLANE_BUCKET" in os.environ:
+            metadata = spill_values(metadata, os.environ["DATAPLANE_BUCKET"],
+                                    reference_key_prefix(self.asset_id, self.workflow_execution_id),
+                                    written=self.spilled_keys)
+        return {"Name": self.name, "AssetId": self.asset_id, "WorkflowExecutionId": self.workflow_execution_id,  "Input": self.input, "Configuration": self.configuration, "Status": self.status, "MetaData": metadata, "Media": self.media}
 
     def update_workflow_status(self, status):
         """ Method to update the status of the output object
@@ -162,9 +183,22 @@ class MasExecutionError(Exception):
 class DataPlane:
     """Helper Class for interacting with the dataplane"""
 
-    def __init__(self):
+    CLIENT_MODE_LAMBDA = "lambda"
+    CLIENT_MODE_DIRECT = "direct"
+
+    def __init__(self, mode=None):
+        """
+        :param mode: "lambda" to invoke the dataplane API function, or "direct" to read and write the dataplane
+        bucket and table from this process. Defaults to the DATAPLANE_CLIENT_MODE environment variable, then "lambda".
+        Direct mode needs the DATAPLANE_BUCKET and DATAPLANE_TABLE_NAME environment variables.
+
+        """
+        self.mode = mode or os.environ.get("DATAPLANE_CLIENT_MODE", self.CLIENT_MODE_LAMBDA)
+        if self.mode == self.CLIENT_MODE_DIRECT:
+            self.storage = DataplaneStorage(os.environ["DATAPLANE_BUCKET"], os.environ["DATAPLANE_TABLE_NAME"])
+            return
         self.dataplane_function_name = os.environ["DataplaneEndpoint"]
-        self.lambda_client = boto3.client('lambda')
+        self.lambda_client = get_client('lambda')
         self.lambda_invoke_object = {
             # some api uri
             "resource": "",
@@ -232,6 +266,16 @@ class DataPlane:
         dataplane_response = json.loads(response)
         return json.loads(dataplane_response["body"])
 
+    def call_storage(self, method, *args, **kwargs):
+        # Errors are returned in the same shape as the error responses of the dataplane API
+        try:
+            return json.loads(json.dumps(method(*args, **kwargs), cls=DecimalEncoder))
+        except DataplaneStorageError as e:
+            return {"Code": e.code, "Message": str(e)}
+        except Exception as e:
+            print("Exception occurred in the dataplane storage client: {e}".format(e=e))
+            return {"Code": "InternalServerError", "Message": "An internal server error occurred."}
+
     def create_asset(self, media_type, s3bucket, s3key):
         """
         Method to create an asset in the dataplane
@@ -242,6 +286,9 @@ class DataPlane:
 
         :return: Dataplane response
         """
+        if self.mode == self.CLIENT_MODE_DIRECT:
+            return self.call_storage(self.storage.create_asset, media_type, s3bucket, s3key)
+
         path = "/create"
         resource = "/create"
         method = "POST"
@@ -249,7 +296,8 @@ class DataPlane:
         dataplane_response = self.call_dataplane(path, resource, method, body)
         return dataplane_response
 
-    def store_asset_metadata(self, asset_id, operator_name, workflow_id, results, paginate=False, end=False):
+    def store_asset_metadata(self, asset_id, operator_name, workflow_id, results, paginate=False, end=False,
+                             page=None):
         """
         Method to store asset metadata in the dataplane
 
@@ -261,11 +309,16 @@ class DataPlane:
         Pagination params:
         :param paginate: Boolean to tell dataplane that the results will come in as pages
         :param end: Boolean to declare the last page in a set of paginated results
+        :param page: Number of the page in a set of paginated results, counting from 0
 
         :return: Dataplane response
 
         """
 
+        if self.mode == self.CLIENT_MODE_DIRECT:
+            return self.call_storage(self.storage.store_asset_metadata, asset_id, operator_name, workflow_id,
+                                     normalize_results(results), paginate, end, page)
+
         path = "/metadata/{asset_id}".format(asset_id=asset_id)
         resource = "/metadata/{asset_id}"
         path_params = {"asset_id": asset_id}
@@ -279,12 +332,39 @@ class DataPlane:
                 query_params["paginated"] = "true"
             if end is True:
                 query_params["end"] = "true"
+            if page is not None:
+                query_params["page"] = str(page)
         else:
             query_params = None
 
         dataplane_response = self.call_dataplane(path, resource, method, body, path_params, query_params)
         return dataplane_response
 
+    def store_asset_metadata_batch(self, asset_id, items):
+        """
+        Method to store many pages or many operators of asset metadata in the dataplane with one request
+
+        :param asset_id: The id of the asset
+        :param items: List of metadata to store, each a dict of OperatorName, WorkflowId and Results with
+            optional Paginated and EndPagination booleans and Page number. Pages of the same operator without a
+            number are stored in list order.
+
+        :return: Dataplane response with the status of the batch and of each item
+
+        """
+
+        if self.mode == self.CLIENT_MODE_DIRECT:
+            return self.call_storage(self.storage.store_asset_metadata_batch, asset_id, normalize_results(items))
+
+        path = "/metadata/{asset_id}/batch".format(asset_id=asset_id)
+        resource = "/metadata/{asset_id}/batch"
+        path_params = {"asset_id": asset_id}
+        method = "POST"
+        body = {"Items": items}
+
+        dataplane_response = self.call_dataplane(path, resource, method, body, path_params)
+        return dataplane_response
+
     def retrieve_asset_metadata(self, asset_id, operator_name=None, cursor=None):
         """
         Method to retrieve metadata from the dataplane
@@ -294,6 +374,11 @@ class DataPlane:
         :param cursor: Optional parameter for retrieving additional pages of asset metadata
         :return: Dataplane response
         """
+        if self.mode == self.CLIENT_MODE_DIRECT:
+            if operator_name:
+                return self.call_storage(self.storage.retrieve_operator_metadata, asset_id, operator_name, cursor)
+            return self.call_storage(self.storage.retrieve_asset_metadata, asset_id, cursor)
+
         if operator_name:
             path = "/metadata/{asset_id}/{operator}".format(asset_id=asset_id, operator=operator_name)
             resource = "/metadata/{asset_id}/{operator_name}"
@@ -311,7 +396,39 @@ class DataPlane:
         dataplane_response = self.call_dataplane(path, resource, method, None, path_params, query_params)
         return dataplane_response
 
+    def retrieve_operator_metadata_all(self, asset_id, operator_name):
+        """
+        Method to retrieve every page of the metadata an operator stored, with one call
+        :param asset_id: The id of the asset
+        :param operator_name: The name of the operator that created the metadata
+        :return: Dataplane response with the list of pages as results, or an error response
+
+        In lambda mode the dataplane API only returns the location of the metadata, which is then read from the
+        dataplane bucket by this process, so the pages are not limited by the size of a Lambda response.
+        """
+        if self.mode == self.CLIENT_MODE_DIRECT:
+            return self.call_storage(self.storage.retrieve_operator_metadata_all, asset_id, operator_name)
+
+        path = "/metadata/{asset_id}/{operator}".format(asset_id=asset_id, operator=operator_name)
+        resource = "/metadata/{asset_id}/{operator_name}"
+        path_params = {"asset_id": asset_id, "operator_name": operator_name}
+        method = "GET"
+        query_params = {"pointer": "true"}
+        dataplane_response = self.call_dataplane(path, resource, method, None, path_params, query_params)
+        if "S3Key" not in dataplane_response:
+            return dataplane_response
+
+        storage = DataplaneStorage(dataplane_response["S3Bucket"], os.environ.get("DATAPLANE_TABLE_NAME"))
+        pages = self.call_storage(storage.read_all_metadata_pages, dataplane_response["S3Key"])
+        # Pages are returned as a list, errors as a dict
+        if isinstance(pages, dict):
+            return pages
+        return {"asset_id": asset_id, "operator": operator_name, "results": pages}
+
     def generate_media_storage_path(self, asset_id, workflow_id):
+        if self.mode == self.CLIENT_MODE_DIRECT:
+            return self.call_storage(self.storage.generate_media_storage_path, asset_id, workflow_id)
+
         path = "/mediapath/{asset_id}/{workflow_id}".format(asset_id=asset_id, workflow_id=workflow_id)
         resource = "/mediapath/{asset_id}/{workflow_id}"
         path_params = {"asset_id": asset_id, "workflow_id": workflow_id}
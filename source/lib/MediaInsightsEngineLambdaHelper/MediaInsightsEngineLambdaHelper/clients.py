@@ -0,0 +1,69 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: Apache-2.0
+
+import json
+import os
+import threading
+
+import boto3
+from botocore.config import Config
+
+# Shared boto3 clients and resources for every Lambda function in the framework.
+#
+# Clients are created on first use and cached for the life of the execution environment, so warm invocations
+# reuse the same connection pool and TLS sessions instead of building new clients. Every client is created with
+# the solution botoConfig on top of tuned connection defaults.
+
+DEFAULT_MAX_POOL_CONNECTIONS = 25
+
+_clients = {}
+_lock = threading.Lock()
+
+
+def client_config(**config_options):
+    """
+    Build the botocore Config used for every client: connection defaults, then the botoConfig environment
+    variable, then any options passed by the caller.
+    """
+    config = Config(max_pool_connections=DEFAULT_MAX_POOL_CONNECTIONS, tcp_keepalive=True)
+    config = config.merge(Config(**json.loads(os.environ.get('botoConfig', '{}'))))
+    if config_options:
+        config = config.merge(Config(**config_options))
+    return config
+
+
+def _get_cached(kind, service_name, region_name, endpoint_url, config_options):
+    key = (kind, service_name, region_name, endpoint_url, json.dumps(config_options, sort_keys=True))
+    cached = _clients.get(key)
+    if cached is not None:
+        return cached
+    # boto3 sessions are not thread safe, so clients are only ever created under the lock
+    with _lock:
+        if key not in _clients:
+            factory = boto3.client if kind == 'client' else boto3.resource
+            _clients[key] = factory(service_name, region_name=region_name, endpoint_url=endpoint_url,
+                                    config=client_config(**config_options))
+        return _clients[key]
+
+
+def get_client(service_name, region_name=None, endpoint_url=None, **config_options):
+    """
+    Return the shared boto3 client for a service, creating it on first use.
+
+    :param service_name: The AWS service, e.g. 's3'
+    :param region_name: Optional region, defaults to the region of the function
+    :param endpoint_url: Optional endpoint, e.g. the account specific MediaConvert endpoint
+    :param config_options: Optional botocore Config options, e.g. signature_version='s3v4'
+
+    :return: A client that is shared by every caller asking for the same service, region, endpoint and options
+    """
+    return _get_cached('client', service_name, region_name, endpoint_url, config_options)
+
+
+def get_resource(service_name, region_name=None, endpoint_url=None, **config_options):
+    """
+    Return the shared boto3 resource for a service, creating it on first use.
+
+    Takes the same parameters as get_client.
+    """
+    return _get_cached('resource', service_name, region_name, endpoint_url, config_options)
@@ -0,0 +1,863 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: Apache-2.0
+
+import base64
+import datetime
+import json
+import logging
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from decimal import Decimal
+
+from botocore.client import ClientError
+
+from MediaInsightsEngineLambdaHelper.clients import get_client, get_resource
+
+# Storage layout for asset metadata in the dataplane, shared by the dataplane API and the direct client mode
+# of the DataPlane helper so both read and write exactly the same objects and pointers.
+
+logger = logging.getLogger(__name__)
+
+BASE_S3_URI = 'private/assets/'
+GLOBAL_ATTRIBUTES = ['MediaType', 'S3Key', 'S3Bucket', 'AssetId', 'Created']
+LOCK_ATTRIBUTES = ("Locked", "LockedAt", "LockedBy")
+# Attributes that only key the asset listing index, see format_created_month
+INDEX_ATTRIBUTES = ("CreatedMonth",)
+
+# Paginated operator results are written as one immutable object per page under '<operator>/' and the
+# final page also writes a manifest listing every page. Older results are stored as a single '<operator>.json'.
+SEGMENT_PAGE_PREFIX = 'page-'
+SEGMENT_MANIFEST_NAME = 'manifest.json'
+
+# A batch write stores its objects concurrently, but never with more threads than the default S3 connection pool
+BATCH_MAX_ITEMS = 100
+BATCH_WRITE_WORKERS = 10
+
+# Deletes are sent in batches of the DeleteObjects maximum. Keys that S3 reports in the Errors of a batch, e.g.
+# when it asks to slow down, are retried with a backoff.
+DELETE_BATCH_MAX_KEYS = 1000
+DELETE_MAX_RETRIES = 4
+
+
+class DataplaneStorageError(Exception):
+    # Codes match the error responses of the dataplane API so callers see the same shape in either mode
+    code = "ChaliceViewError"
+
+
+class AssetNotFoundError(DataplaneStorageError):
+    code = "NotFoundError"
+
+
+class InvalidRequestError(DataplaneStorageError):
+    code = "BadRequestError"
+
+
+class DecimalEncoder(json.JSONEncoder):
+    def default(self, obj):
+        if isinstance(obj, Decimal):
+            return str(obj)
+            # Let the base class default method raise the TypeError
+        return json.JSONEncoder.default(self, obj)
+
+
+def normalize_results(results):
+    return json.loads(json.dumps(results), parse_float=Decimal)
+
+
+def format_metadata_prefix(asset_id, workflow_id):
+    return BASE_S3_URI + asset_id + '/' + 'workflows' + '/' + workflow_id + '/'
+
+
+def format_page_key(segment_prefix, page_num):
+    return segment_prefix + SEGMENT_PAGE_PREFIX + str(page_num).zfill(5) + '.json'
+
+
+def format_segment_manifest(segment_prefix, page_count):
+    pages = [format_page_key(segment_prefix, page_num) for page_num in range(page_count)]
+    return {"Layout": "segmented", "PageCount": page_count, "Pages": pages}
+
+
+def is_page_number(page):
+    return isinstance(page, int) and not isinstance(page, bool) and page >= 0
+
+
+def is_segmented_pointer(pointer):
+    return pointer.endswith('/' + SEGMENT_MANIFEST_NAME)
+
+
+def format_created_month(created):
+    """
+    The partition of the AssetCreated index for an asset Created timestamp, one partition per UTC month.
+    """
+    return datetime.datetime.utcfromtimestamp(float(created)).strftime('%Y-%m')
+
+
+def format_delete_result(results):
+    # results is a list of (deleted, errors) tuples, one per batch
+    message = {}
+    deleted = [obj for batch_deleted, _ in results for obj in batch_deleted]
+    errors = [error for _, batch_errors in results for error in batch_errors]
+    if deleted:
+        message["Deleted"] = deleted
+    if errors:
+        logger.error("Unable to delete {count} objects from s3".format(count=len(errors)))
+        message["Errors"] = errors
+        return {"Status": "Error", "Message": message}
+    return {"Status": "Success", "Message": message}
+
+
+def build_cursor_object(next_object, remaining):
+    cursor = {
+        "next": next_object,
+        "remaining": remaining
+    }
+    return cursor
+
+
+def encode_cursor(cursor):
+    cursor = json.dumps(cursor)
+    encoded = base64.urlsafe_b64encode(cursor.encode('UTF-8')).decode('ascii')
+    return encoded
+
+
+def decode_cursor(cursor):
+    decoded = json.loads(base64.urlsafe_b64decode(cursor).decode('utf-8'))
+    return decoded
+
+
+def next_page_valid(metadata, page_num):
+    try:
+        metadata[page_num]
+        return True
+    except IndexError:
+        return False
+
+
+def is_metadata_list(metadata):
+    return isinstance(metadata, list)
+
+
+class DataplaneStorage:
+    """Reads and writes asset metadata in the dataplane bucket and table"""
+
+    def __init__(self, bucket, table_name, s3_client=None, dynamo_resource=None):
+        """
+        :param bucket: The dataplane S3 bucket
+        :param table_name: The dataplane DynamoDB table
+        :param s3_client: Optional S3 client, created on first use when omitted
+        :param dynamo_resource: Optional DynamoDB resource, created on first use when omitted
+
+        """
+        self.bucket = bucket
+        self.table_name = table_name
+        self._s3_client = s3_client
+        self._dynamo_resource = dynamo_resource
+
+    @property
+    def s3_client(self):
+        if self._s3_client is None:
+            self._s3_client = get_client('s3')
+        return self._s3_client
+
+    @property
+    def dynamo_resource(self):
+        if self._dynamo_resource is None:
+            self._dynamo_resource = get_resource('dynamodb')
+        return self._dynamo_resource
+
+    def write_metadata(self, key, data):
+        encoded = json.dumps(data, cls=DecimalEncoder)
+        try:
+            self.s3_client.put_object(Bucket=self.bucket, Key=key, Body=encoded)
+        except ClientError as e:
+            error = e.response['Error']['Message']
+            logger.error("Exception occurred while writing asset metadata to s3: {e}".format(e=error))
+            return {"Status": "Error", "Message": error}
+        except Exception as e:
+            logger.error("Exception occurred while writing asset metadata to s3")
+            return {"Status": "Error", "Message": e}
+        else:
+            logger.info("Wrote asset metadata to s3")
+            return {"Status": "Success"}
+
+    def read_metadata(self, key):
+        try:
+            obj = self.s3_client.get_object(
+                Bucket=self.bucket,
+                Key=key
+            )
+        except ClientError as e:
+            error = e.response['Error']['Message']
+            logger.error("Exception occurred while reading asset metadata from s3: {e}".format(e=error))
+            return {"Status": "Error", "Message": error}
+        except Exception as e:
+            logger.error("Exception occurred while reading asset metadata from s3")
+            return {"Status": "Error", "Message": e}
+        else:
+            results = obj['Body'].read().decode('utf-8')
+            return {"Status": "Success", "Object": results}
+
+    def list_metadata_pages(self, segment_prefix):
+        page_keys = []
+        kwargs = {"Bucket": self.bucket, "Prefix": segment_prefix + SEGMENT_PAGE_PREFIX}
+        try:
+            while True:
+                response = self.s3_client.list_objects_v2(**kwargs)
+                page_keys.extend([obj["Key"] for obj in response.get("Contents", [])])
+                if not response.get("IsTruncated"):
+                    break
+                kwargs["ContinuationToken"] = response["NextContinuationToken"]
+        except ClientError as e:
+            error = e.response['Error']['Message']
+            logger.error("Exception occurred while listing metadata pages in s3: {e}".format(e=error))
+            return {"Status": "Error", "Message": error}
+        except Exception as e:
+            logger.error("Exception occurred while listing metadata pages in s3")
+            return {"Status": "Error", "Message": e}
+        else:
+            page_keys.sort(key=lambda key: int(key[len(segment_prefix + SEGMENT_PAGE_PREFIX):-len('.json')]))
+            return {"Status": "Success", "Pages": page_keys}
+
+    def read_segment_manifest(self, pointer):
+        s3_object = self.read_metadata(pointer)
+        if s3_object["Status"] == "Error":
+            raise DataplaneStorageError("Unable to read metadata manifest: {e}".format(e=s3_object["Message"]))
+        return json.loads(s3_object["Object"])
+
+    def read_metadata_page(self, pointer, page_num):
+        """
+        Read one page of operator metadata from either the segmented or the single object layout.
+
+        Returns a tuple of the page data and the number of the next page, which is None when no pages remain.
+        """
+        next_page_num = page_num + 1
+
+        if is_segmented_pointer(pointer):
+            pages = self.read_segment_manifest(pointer)["Pages"]
+            s3_object = self.read_metadata(pages[page_num])
+            if s3_object["Status"] == "Error":
+                raise DataplaneStorageError("Unable to read metadata page {key}: {e}".format(
+                    key=pages[page_num], e=s3_object["Message"]))
+            page_data = json.loads(s3_object["Object"])
+            if next_page_valid(pages, next_page_num):
+                return page_data, next_page_num
+            return page_data, None
+
+        s3_object = self.read_metadata(pointer)
+        if s3_object["Status"] == "Error":
+            raise DataplaneStorageError("Unable to read metadata: {e}".format(e=s3_object["Message"]))
+        pages = json.loads(s3_object["Object"])
+        if not is_metadata_list(pages):
+            return pages, None
+        page_data = pages[page_num]
+
+        if next_page_valid(pages, next_page_num):
+            return page_data, next_page_num
+        return page_data, None
+
+    def read_all_metadata_pages(self, pointer):
+        """
+        Read every page of operator metadata from either the segmented or the single object layout.
+
+        Returns the list of pages in order. Metadata that is not paginated is returned as a list of one page, like
+        reading it page by page would.
+        """
+        if is_segmented_pointer(pointer):
+            pages = self.read_segment_manifest(pointer)["Pages"]
+            if not pages:
+                return []
+            with ThreadPoolExecutor(max_workers=min(BATCH_WRITE_WORKERS, len(pages))) as executor:
+                s3_objects = list(executor.map(self.read_metadata, pages))
+            for key, s3_object in zip(pages, s3_objects):
+                if s3_object["Status"] == "Error":
+                    raise DataplaneStorageError("Unable to read metadata page {key}: {e}".format(
+                        key=key, e=s3_object["Message"]))
+            return [json.loads(s3_object["Object"]) for s3_object in s3_objects]
+
+        s3_object = self.read_metadata(pointer)
+        if s3_object["Status"] == "Error":
+            raise DataplaneStorageError("Unable to read metadata: {e}".format(e=s3_object["Message"]))
+        pages = json.loads(s3_object["Object"])
+        if not is_metadata_list(pages):
+            return [pages]
+        return pages
+
+    def expand_pointer_keys(self, pointer):
+        if not is_segmented_pointer(pointer):
+            return [pointer]
+        try:
+            pages = self.read_segment_manifest(pointer)["Pages"]
+        except Exception as e:
+            logger.error("Unable to read pages from metadata manifest {pointer}: {e}".format(pointer=pointer, e=e))
+            pages = []
+        return pages + [pointer]
+
+    def delete_object_batch(self, keys):
+        # Returns the deleted objects and the errors left after the retries
+        deleted = []
+        attempt = 0
+        while True:
+            response = self.s3_client.delete_objects(
+                Bucket=self.bucket,
+                Delete={
+                    'Objects': [{"Key": key} for key in keys]
+                }
+            )
+            deleted.extend(response.get("Deleted", []))
+            errors = response.get("Errors", [])
+            if not errors or attempt == DELETE_MAX_RETRIES:
+                return deleted, errors
+            logger.warning("Retrying {count} objects that could not be deleted".format(count=len(errors)))
+            time.sleep(min(2, 0.1 * 2 ** attempt))
+            attempt += 1
+            keys = [error["Key"] for error in errors]
+
+    def delete_metadata_objects(self, keys):
+        """
+        Delete objects from the dataplane bucket, in concurrent batches of up to 1000 keys.
+
+        :param keys: The object keys, duplicates are deleted once
+
+        :return: {"Status", "Message"} where Message has the Deleted objects and any Errors left after the retries,
+            in the format of the DeleteObjects response
+        """
+        keys = list(dict.fromkeys(keys))
+        batches = [keys[start:start + DELETE_BATCH_MAX_KEYS] for start in range(0, len(keys), DELETE_BATCH_MAX_KEYS)]
+        try:
+            if not batches:
+                results = []
+            else:
+                with ThreadPoolExecutor(max_workers=min(BATCH_WRITE_WORKERS, len(batches))) as executor:
+                    results = list(executor.map(self.delete_object_batch, batches))
+        except ClientError as e:
+            error = e.response['Error']['Message']
+            logger.error("Exception occurred while deleting asset metadata from s3: {e}".format(e=error))
+            return {"Status": "Error", "Message": error}
+        except Exception as e:
+            logger.error("Exception occurred while deleting asset metadata from s3")
+            return {"Status": "Error", "Message": e}
+        return format_delete_result(results)
+
+    def delete_prefix(self, prefix, continuation_token=None, deadline=None):
+        """
+        Delete every object under a prefix. Each listed page of keys is deleted while the next one is listed.
+
+        :param prefix: The key prefix, e.g. the directory of an asset
+        :param continuation_token: Resume the listing of an earlier call that stopped at its deadline
+        :param deadline: Optional time.time() after which no further pages are listed
+
+        :return: {"Status", "Message"} as for delete_metadata_objects, plus the ContinuationToken of the next page
+            when the deadline was reached
+        """
+        kwargs = {"Bucket": self.bucket, "Prefix": prefix}
+        if continuation_token is not None:
+            kwargs["ContinuationToken"] = continuation_token
+        next_token = None
+        try:
+            with ThreadPoolExecutor(max_workers=BATCH_WRITE_WORKERS) as executor:
+                futures = []
+                while True:
+                    response = self.s3_client.list_objects_v2(**kwargs)
+                    keys = [obj["Key"] for obj in response.get("Contents", [])]
+                    if keys:
+                        futures.append(executor.submit(self.delete_object_batch, keys))
+                    next_token = response.get("NextContinuationToken") if response.get("IsTruncated") else None
+                    if next_token is None or (deadline is not None and time.time() >= deadline):
+                        break
+                    kwargs["ContinuationToken"] = next_token
+                results = [future.result() for future in futures]
+        except ClientError as e:
+            error = e.response['Error']['Message']
+            logger.error("Exception occurred while deleting {prefix} from s3: {e}".format(prefix=prefix, e=error))
+            return {"Status": "Error", "Message": error}
+        except Exception as e:
+            logger.error("Exception occurred while deleting {prefix} from s3".format(prefix=prefix))
+            return {"Status": "Error", "Message": e}
+        result = format_delete_result(results)
+        if next_token is not None:
+            result["ContinuationToken"] = next_token
+        return result
+
+    def read_asset(self, asset_id, **kwargs):
+        try:
+            table = self.dynamo_resource.Table(self.table_name)
+            asset_item = table.get_item(
+                Key={
+                    "AssetId": asset_id
+                },
+                **kwargs
+            )
+        except ClientError as e:
+            error = e.response['Error']['Message']
+            logger.error("Exception occurred while retreiving metadata for {asset}: {e}".format(asset=asset_id, e=error))
+            raise DataplaneStorageError("Unable to retrieve metadata: {e}".format(e=error))
+        except Exception as e:
+            logger.error("Exception occurred while retreiving metadata for {asset}: {e}".format(asset=asset_id, e=e))
+            raise DataplaneStorageError("Unable to retrieve metadata: {e}".format(e=e))
+
+        if "Item" not in asset_item:
+            raise AssetNotFoundError(
+                "Exception occurred while verifying asset exists: {asset} does not exist".format(asset=asset_id))
+
+        return asset_item["Item"]
+
+    def create_asset(self, media_type, source_bucket, source_key):
+        asset_id = str(uuid.uuid4())
+
+        # create directory structure in s3 dataplane bucket for the asset
+        directory = BASE_S3_URI + asset_id + "/"
+
+        try:
+            self.s3_client.put_object(
+                Bucket=self.bucket,
+                Key=directory
+            )
+        except ClientError as e:
+            error = e.response['Error']['Message']
+            logger.error("Exception occurred during asset creation: {e}".format(e=error))
+            raise DataplaneStorageError("Unable to create asset directory in the dataplane bucket: {e}".format(e=error))
+        except Exception as e:
+            logger.error("Exception occurred during asset creation: {e}".format(e=e))
+            raise DataplaneStorageError("Exception when creating dynamo item for asset: {e}".format(e=e))
+        else:
+            logger.info("Created asset directory structure: {directory}".format(directory=directory))
+
+        ts = str(datetime.datetime.now().timestamp())
+
+        try:
+            table = self.dynamo_resource.Table(self.table_name)
+            table.put_item(
+                Item={
+                    "AssetId": asset_id,
+                    "MediaType": media_type,
+                    "S3Bucket": source_bucket,
+                    "S3Key": source_key,
+                    "Created": ts,
+                    "CreatedMonth": format_created_month(ts)
+                }
+            )
+        except ClientError as e:
+            error = e.response['Error']['Message']
+            logger.error("Exception occurred during asset creation: {e}".format(e=error))
+            raise DataplaneStorageError("Unable to create asset item in dynamo: {e}".format(e=error))
+        except Exception as e:
+            logger.error("Exception occurred during asset creation: {e}".format(e=e))
+            raise DataplaneStorageError("Exception when creating dynamo item for asset: {e}".format(e=e))
+        else:
+            logger.info("Completed asset creation for asset: {asset}".format(asset=asset_id))
+            return {"AssetId": asset_id, "MediaType": media_type, "S3Bucket": source_bucket, "S3Key": source_key}
+
+    def generate_media_storage_path(self, asset_id, workflow_id):
+        return {
+            "S3Bucket": self.bucket,
+            "S3Key": BASE_S3_URI + asset_id + "/workflows/" + workflow_id + "/"
+        }
+
+    def get_pointers_for_operator(self, asset_id, operator_name):
+        # Verify asset exists before adding metadata and check if pointers exist for this operator
+        asset_item = self.read_asset(asset_id)
+
+        try:
+            pointers = asset_item[operator_name]
+        except KeyError:
+            logger.info("No pointers have been stored for this operator")
+            pointers = []
+        else:
+            logger.info("Retrieved existing pointers")
+
+        return pointers
+
+    def store_asset_metadata(self, asset_id, operator_name, workflow_id, results, paginate=False, end=False,
+                             page=None):
+        """
+        Write operator results and, unless more pages are expected, update the pointer to them.
+
+        :param page: The number of a page of paginated results, counting from 0. A numbered page is written to its
+            own object, so storing it again overwrites it. Pages without a number are numbered after the pages
+            already stored, which lists the stored pages on every call.
+
+        :return: The same response as POST /metadata/{asset_id}
+        """
+        if end and not paginate:
+            raise InvalidRequestError("Must pass required query parameter: paginated")
+        if page is not None and not (paginate and is_page_number(page)):
+            raise InvalidRequestError("The page number must be a non-negative integer of paginated results")
+        if not isinstance(results, dict):
+            raise InvalidRequestError(
+                "Exception occurred while storing metadata for {asset}: results are not the required data type, dict".format(
+                    asset=asset_id))
+
+        # Key that we'll write the results too
+        metadata_prefix = format_metadata_prefix(asset_id, workflow_id)
+        metadata_key = metadata_prefix + operator_name + '.json'
+
+        # TODO: This check happens every time we have an additional call when storing paginated results,
+        #  could likely refactor this to avoid that
+
+        pointers = self.get_pointers_for_operator(asset_id, operator_name)
+
+        if paginate:
+            # Each page is written once to its own object, so storing a page never rewrites the pages before it
+            segment_prefix = metadata_prefix + operator_name + '/'
+            if page is None:
+                existing_pages = self.list_metadata_pages(segment_prefix)
+                if existing_pages['Status'] == 'Error':
+                    raise DataplaneStorageError("Exception occurred while listing metadata pages in s3: {e}".format(
+                        e=existing_pages["Message"]))
+                page = len(existing_pages['Pages'])
+            metadata_key = format_page_key(segment_prefix, page)
+            logger.info("Writing page {page_num} of {operator} metadata".format(page_num=page,
+                                                                               operator=operator_name))
+
+        store_results = self.write_metadata(metadata_key, results)
+        if store_results['Status'] != 'Success':
+            logger.error('Unable to write metadata to s3 for asset: {asset}'.format(asset=asset_id))
+            raise DataplaneStorageError("Exception occurred while writing metadata to s3: {e}".format(
+                e=store_results["Message"]))
+        logger.info('Wrote {operator} metadata to S3 for asset: {asset}'.format(asset=asset_id, operator=operator_name))
+
+        if paginate and not end:
+            return {"Status": "Success"}
+
+        if paginate:
+            # The manifest is what the pointer references once every page has been written
+            metadata_key = segment_prefix + SEGMENT_MANIFEST_NAME
+            manifest = format_segment_manifest(segment_prefix, page + 1)
+            store_manifest = self.write_metadata(metadata_key, manifest)
+            if store_manifest['Status'] != 'Success':
+                logger.error('Unable to write metadata manifest to s3 for asset: {asset}'.format(asset=asset_id))
+                raise DataplaneStorageError("Exception occurred while writing metadata manifest to s3: {e}".format(
+                    e=store_manifest["Message"]))
+
+        self.update_pointer_for_operator(asset_id, operator_name, pointers, workflow_id, metadata_key)
+        return {"Status": "Success", "Bucket": self.bucket, "Key": metadata_key}
+
+    def write_metadata_objects(self, objects):
+        # objects is a list of (key, data) tuples, the returned statuses are in the same order
+        if not objects:
+            return []
+        with ThreadPoolExecutor(max_workers=min(BATCH_WRITE_WORKERS, len(objects))) as executor:
+            return list(executor.map(lambda obj: self.write_metadata(*obj), objects))
+
+    def store_asset_metadata_batch(self, asset_id, items):
+        """
+        Write many pages or many operators of results for one asset and update every changed pointer at once.
+
+        Each item is {"OperatorName", "WorkflowId", "Results"} with optional "Paginated" and "EndPagination" flags
+        and "Page" number that mean the same as the paginated, end and page query params of
+        POST /metadata/{asset_id}. Pages of the same operator without a number are numbered after the previous
+        page in the batch, or after the stored pages. A failed item does not fail the rest of the batch,
+        except that the last page of a paginated set is only committed when every page of that set was stored.
+
+        :return: The same response as POST /metadata/{asset_id}/batch
+        """
+        if not isinstance(items, list) or not items:
+            raise InvalidRequestError("Items must be a non-empty list of metadata to store")
+        if len(items) > BATCH_MAX_ITEMS:
+            raise InvalidRequestError("A batch can store at most {limit} items".format(limit=BATCH_MAX_ITEMS))
+
+        asset_item = self.read_asset(asset_id)
+
+        statuses = [None] * len(items)
+        writes = []
+        # Paginated sets in this batch, keyed by operator and workflow
+        segments = {}
+        # Pointers to add once their objects are stored, in the order of the items that complete them
+        completions = []
+
+        for index, item in enumerate(items):
+            try:
+                operator_name = item['OperatorName']
+                workflow_id = item['WorkflowId']
+                results = normalize_results(item['Results'])
+            except (KeyError, TypeError) as e:
+                statuses[index] = {"Status": "Error",
+                                   "Message": "Missing required inputs for storing metadata: {e}".format(e=e)}
+                continue
+            paginate = item.get('Paginated', False) is True
+            end = item.get('EndPagination', False) is True
+            page = item.get('Page')
+            if end and not paginate:
+                statuses[index] = {"Status": "Error", "Message": "EndPagination requires Paginated"}
+                continue
+            if page is not None and not (paginate and is_page_number(page)):
+                statuses[index] = {"Status": "Error",
+                                   "Message": "Page must be a non-negative integer of paginated results"}
+                continue
+            if not isinstance(results, dict):
+                statuses[index] = {"Status": "Error", "Message": "Results are not the required data type, dict"}
+                continue
+
+            metadata_prefix = format_metadata_prefix(asset_id, workflow_id)
+            if not paginate:
+                metadata_key = metadata_prefix + operator_name + '.json'
+                if any(completion["Key"] == metadata_key for completion in completions):
+                    statuses[index] = {"Status": "Error",
+                                       "Message": "{operator} is stored more than once in this batch".format(
+                                           operator=operator_name)}
+                    continue
+                writes.append((index, metadata_key, results))
+                completions.append({"Operator": operator_name, "Workflow": workflow_id, "Key": metadata_key,
+                                    "Items": [index], "Index": index})
+                continue
+
+            segment = segments.get((operator_name, workflow_id))
+            if segment is None:
+                # NextPage is the number of the next unnumbered page, only looked up when the batch has one
+                segment = {"Prefix": metadata_prefix + operator_name + '/', "NextPage": None, "Items": [],
+                           "Ended": False}
+                segments[(operator_name, workflow_id)] = segment
+            elif segment["Ended"]:
+                statuses[index] = {"Status": "Error",
+                                   "Message": "Pagination for {operator} already ended in this batch".format(
+                                       operator=operator_name)}
+                continue
+
+            if page is None and segment["NextPage"] is None:
+                existing_pages = self.list_metadata_pages(segment["Prefix"])
+                if existing_pages['Status'] == 'Error':
+                    statuses[index] = {"Status": "Error",
+                                       "Message": "Exception occurred while listing metadata pages in s3: {e}".format(
+                                           e=existing_pages["Message"])}
+                    continue
+                segment["NextPage"] = len(existing_pages['Pages'])
+            if page is None:
+                page = segment["NextPage"]
+            segment["NextPage"] = page + 1
+
+            metadata_key = format_page_key(segment["Prefix"], page)
+            segment["Items"].append(index)
+            writes.append((index, metadata_key, results))
+            if end:
+                segment["Ended"] = True
+                completions.append({"Operator": operator_name, "Workflow": workflow_id,
+                                    "Key": segment["Prefix"] + SEGMENT_MANIFEST_NAME, "Items": segment["Items"],
+                                    "Index": index, "Manifest": format_segment_manifest(segment["Prefix"], page + 1)})
+
+        logger.info("Writing {count} metadata objects for asset: {asset}".format(count=len(writes), asset=asset_id))
+        write_statuses = self.write_metadata_objects([(key, data) for _, key, data in writes])
+        for (index, metadata_key, _), write_status in zip(writes, write_statuses):
+            if write_status['Status'] == 'Success':
+                statuses[index] = {"Status": "Success"}
+            else:
+                statuses[index] = {"Status": "Error",
+                                   "Message": "Exception occurred while writing metadata to s3: {e}".format(
+                                       e=write_status["Message"])}
+
+        ready = []
+        for completion in completions:
+            if all(statuses[index]["Status"] == "Success" for index in completion["Items"]):
+                ready.append(completion)
+            else:
+                statuses[completion["Index"]] = {"Status": "Error",
+                                                 "Message": "Not every page of {operator} was stored".format(
+                                                     operator=completion["Operator"])}
+
+        manifests = [completion for completion in ready if "Manifest" in completion]
+        manifest_statuses = self.write_metadata_objects([(completion["Key"], completion["Manifest"])
+                                                         for completion in manifests])
+        for completion, manifest_status in zip(manifests, manifest_statuses):
+            if manifest_status['Status'] != 'Success':
+                ready.remove(completion)
+                statuses[completion["Index"]] = {"Status": "Error",
+                                                 "Message": "Exception occurred while writing metadata manifest to s3: {e}".format(
+                                                     e=manifest_status["Message"])}
+
+        if ready:
+            try:
+                self.update_pointers(asset_id, asset_item, ready)
+            except DataplaneStorageError as e:
+                for completion in ready:
+                    statuses[completion["Index"]] = {"Status": "Error", "Message": str(e)}
+            else:
+                for completion in ready:
+                    statuses[completion["Index"]] = {"Status": "Success", "Bucket": self.bucket,
+                                                     "Key": completion["Key"]}
+
+        response = []
+        for item, status in zip(items, statuses):
+            operator_name = item.get('OperatorName') if isinstance(item, dict) else None
+            response.append(dict(OperatorName=operator_name, **status))
+        batch_status = "Success" if all(status["Status"] == "Success" for status in statuses) else "Error"
+        return {"Status": batch_status, "Results": response}
+
+    def update_pointers(self, asset_id, asset_item, completions):
+        # Adds the pointers of every completed operator with a single update_item
+        pointers = {}
+        for completion in completions:
+            operator_name = completion["Operator"]
+            if operator_name not in pointers:
+                pointers[operator_name] = list(asset_item.get(operator_name, []))
+            pointers[operator_name].insert(0, {"workflow": completion["Workflow"], "pointer": completion["Key"]})
+
+        update_expressions = []
+        expression_attr_name = {}
+        expression_attr_val = {}
+        for num, (operator_name, operator_pointers) in enumerate(pointers.items()):
+            update_expressions.append("#operator_result{num} = :result{num}".format(num=num))
+            expression_attr_name["#operator_result{num}".format(num=num)] = operator_name
+            expression_attr_val[":result{num}".format(num=num)] = operator_pointers
+
+        try:
+            table = self.dynamo_resource.Table(self.table_name)
+            table.update_item(
+                Key={
+                    "AssetId": asset_id
+                },
+                UpdateExpression="SET " + ", ".join(update_expressions),
+                ExpressionAttributeNames=expression_attr_name,
+                ExpressionAttributeValues=expression_attr_val,
+            )
+        except ClientError as e:
+            error = e.response['Error']['Message']
+            logger.error("Exception occurred during metadata pointer update: {e}".format(e=error))
+            raise DataplaneStorageError("Unable to update metadata pointer: {e}".format(e=error))
+        except Exception as e:
+            logger.error("Exception updating pointer in dynamo {e}".format(e=e))
+            raise DataplaneStorageError("Exception: {e}".format(e=e))
+        else:
+            logger.info("Successfully stored metadata for {operators} for asset: {asset} in the dataplane".format(
+                operators=", ".join(pointers.keys()), asset=asset_id))
+
+    def update_pointer_for_operator(self, asset_id, operator_name, pointers, workflow_id, metadata_key):
+        # we store pointers as list to keep reference of results from different executions for the same operator
+        pointer = {"workflow": workflow_id, "pointer": metadata_key}
+        pointers.insert(0, pointer)
+
+        update_expression = "SET #operator_result = :result"
+        expression_attr_name = {"#operator_result": operator_name}
+        expression_attr_val = {":result": pointers}
+
+        try:
+            table = self.dynamo_resource.Table(self.table_name)
+            table.update_item(
+                Key={
+                    "AssetId": asset_id
+                },
+                UpdateExpression=update_expression,
+                ExpressionAttributeNames=expression_attr_name,
+                ExpressionAttributeValues=expression_attr_val,
+            )
+        except ClientError as e:
+            error = e.response['Error']['Message']
+            logger.error("Exception occurred during metadata pointer update: {e}".format(e=error))
+            raise DataplaneStorageError("Unable to update metadata pointer: {e}".format(e=error))
+        except Exception as e:
+            logger.error("Exception updating pointer in dynamo {e}".format(e=e))
+            raise DataplaneStorageError("Exception: {e}".format(e=e))
+        else:
+            logger.info("Successfully stored {operator} metadata for asset: {asset} in the dataplane".format(
+                operator=operator_name, asset=asset_id))
+
+    def retrieve_asset_metadata(self, asset_id, cursor=None):
+        """
+        Return global asset information or, given a cursor, the next page of operator metadata.
+
+        :return: The same response as GET /metadata/{asset_id}
+        """
+        def create_response(results, remaining, operator_name=None):
+            response = {"asset_id": asset_id}
+
+            if operator_name:
+                response["operator"] = operator_name
+
+            if remaining:
+                next_page = remaining[0]
+                next_page["page"] = 0
+                new_cursor = build_cursor_object(next_page, remaining)
+
+                # Add page cursor to the response
+                response["cursor"] = encode_cursor(new_cursor)
+
+            response["results"] = results
+
+            return response
+
+        if cursor is None:
+            asset_attributes = self.read_asset(asset_id)
+
+            remaining_attributes = list(set(asset_attributes.keys()) - set(GLOBAL_ATTRIBUTES) - set(INDEX_ATTRIBUTES))
+
+            global_asset_info = dict([(attr, asset_attributes[attr]) for attr in GLOBAL_ATTRIBUTES if attr != "AssetId"])
+
+            remaining = [{attr: asset_attributes[attr][0]["pointer"]}
+                         for attr in remaining_attributes
+                         if attr not in LOCK_ATTRIBUTES]
+
+            return create_response(global_asset_info, remaining)
+
+        decoded_cursor = decode_cursor(cursor)
+        operator_name = [k for k in decoded_cursor["next"].keys() if k != "page"][0]
+        pointer = decoded_cursor["next"][operator_name]
+        page_num = decoded_cursor["next"]["page"]
+        remaining = decoded_cursor["remaining"]
+
+        page_data, next_page_num = self.read_metadata_page(pointer, page_num)
+
+        if next_page_num is not None:
+            next_page = {operator_name: pointer, "page": next_page_num}
+            new_cursor = build_cursor_object(next_page, remaining)
+            return {"asset_id": asset_id, "operator": operator_name,
+                    "cursor": encode_cursor(new_cursor),
+                    "results": page_data}
+
+        del remaining[0]
+        return create_response(page_data, remaining, operator_name=operator_name)
+
+    def read_operator_pointer(self, asset_id, operator_name):
+        asset_attributes = self.read_asset(
+            asset_id,
+            ProjectionExpression="#attr",
+            ExpressionAttributeNames={"#attr": operator_name}
+        )
+        try:
+            return asset_attributes[operator_name][0]["pointer"]
+        except KeyError:
+            raise DataplaneStorageError("No metadata has been stored for operator {operator} of asset {asset}".format(
+                operator=operator_name, asset=asset_id))
+
+    def retrieve_operator_metadata(self, asset_id, operator_name, cursor=None):
+        """
+        Return one page of the metadata an operator stored for an asset.
+
+        :return: The same response as GET /metadata/{asset_id}/{operator_name}
+        """
+        if cursor is None:
+            pointer = self.read_operator_pointer(asset_id, operator_name)
+            page_num = 0
+        else:
+            decoded_cursor = decode_cursor(cursor)
+
+            pointer = decoded_cursor["next"][operator_name]
+            page_num = decoded_cursor["next"]["page"]
+
+        page_data, next_page_num = self.read_metadata_page(pointer, page_num)
+
+        if next_page_num is not None:
+            next_page = {operator_name: pointer, "page": next_page_num}
+            # TODO: Do I really need this for getting results of a specific operator?
+            remaining = [operator_name]
+            new_cursor = build_cursor_object(next_page, remaining)
+            return {"asset_id": asset_id, "operator": operator_name,
+                    "cursor": encode_cursor(new_cursor), "results": page_data}
+
+        return {"asset_id": asset_id, "operator": operator_name, "results": page_data}
+
+    def retrieve_operator_metadata_all(self, asset_id, operator_name):
+        """
+        Return every page of the metadata an operator stored for an asset.
+
+        :return: The asset id, operator name and the list of pages as results
+        """
+        pointer = self.read_operator_pointer(asset_id, operator_name)
+        return {"asset_id": asset_id, "operator": operator_name, "results": self.read_all_metadata_pages(pointer)}
+
+    def retrieve_operator_pointer(self, asset_id, operator_name):
+        """
+        Return the location of the metadata an operator stored for an asset, for clients that read it from S3.
+
+        :return: The asset id, operator name and the S3Bucket and S3Key of the metadata object or manifest
+        """
+        pointer = self.read_operator_pointer(asset_id, operator_name)
+        return {"asset_id": asset_id, "operator": operator_name, "S3Bucket": self.bucket, "S3Key": pointer}
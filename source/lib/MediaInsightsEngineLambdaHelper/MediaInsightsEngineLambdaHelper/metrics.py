@@ -0,0 +1,42 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: Apache-2.0
+
+import json
+import os
+import sys
+import time
+
+# CloudWatch metrics for the framework Lambda functions.
+#
+# Metrics are written to the function log in the CloudWatch embedded metric format, so CloudWatch extracts them
+# from the log stream without an extra API call or IAM permission on the hot path.
+
+METRICS_NAMESPACE = os.environ.get('METRICS_NAMESPACE', 'MediaInsightsEngine')
+
+
+def put_metric(name, value, unit='Count', dimensions=None):
+    """
+    Emit a single metric value.
+
+    :param name: The metric name, e.g. 'WorkflowSchedulerTriggersCoalesced'
+    :param value: The metric value
+    :param unit: A CloudWatch unit, e.g. 'Count' or 'Milliseconds'
+    :param dimensions: Optional dict of dimension names to values
+    """
+    dimensions = dimensions or {}
+    record = {
+        "_aws": {
+            "Timestamp": int(time.time() * 1000),
+            "CloudWatchMetrics": [
+                {
+                    "Namespace": METRICS_NAMESPACE,
+                    "Dimensions": [list(dimensions)],
+                    "Metrics": [{"Name": name, "Unit": unit}]
+                }
+            ]
+        },
+        name: value
+    }
+    record.update(dimensions)
+    # The Lambda log handler prefixes log records, so the record is written to stdout as a plain JSON line
+    sys.stdout.write(json.dumps(record) + "\n")
@@ -0,0 +1,118 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: Apache-2.0
+
+import hashlib
+import json
+import os
+
+from MediaInsightsEngineLambdaHelper.clients import get_client
+from MediaInsightsEngineLambdaHelper.dataplane_storage import DecimalEncoder
+
+# References to operator outputs that were spilled to the dataplane bucket.
+#
+# Operator MetaData values end up in the workflow execution item, in the stage Outputs and in the Globals passed to
+# every later stage as Step Functions input. Step Functions payloads are limited to 256 KB and DynamoDB items to
+# 400 KB. An operator Lambda with the OUTPUT_SPILL_THRESHOLD_BYTES and DATAPLANE_BUCKET environment variables writes
+# any value larger than the threshold to S3 and replaces it by a small typed reference:
+#
+#     {"MieReferenceType": "S3", "S3Bucket": "<bucket>", "S3Key": "<key>", "ContentLength": <bytes>}
+#
+# Spilling is off unless the threshold is set, because the references are passed on as they are. Operators read
+# them through a ReferenceDict, which resolves them on access, but GET /workflow/execution/{Id}, the stage Outputs
+# and the Globals of the workflow execution status messages carry the reference in place of the value. Consumers
+# of those read the S3 object, see resolve_reference.
+
+REFERENCE_TYPE_KEY = "MieReferenceType"
+REFERENCE_TYPE_S3 = "S3"
+
+# 0 or unset keeps every value in place
+SPILL_THRESHOLD_BYTES = int(os.environ.get("OUTPUT_SPILL_THRESHOLD_BYTES") or 0)
+
+
+def is_reference(value):
+    return isinstance(value, dict) and value.get(REFERENCE_TYPE_KEY) == REFERENCE_TYPE_S3
+
+
+def reference_key_prefix(asset_id, workflow_execution_id):
+    """
+    The S3 prefix for spilled values, under the asset so they are removed together with it.
+    """
+    return 'private/assets/{}/workflows/{}/references/'.format(asset_id, workflow_execution_id)
+
+
+def spill_values(values, bucket, key_prefix, threshold=None, written=None):
+    """
+    Write every value whose JSON encoding is larger than the threshold to S3.
+
+    The object key is derived from the content, so spilling the same value again references the same object.
+
+    :param values: Dict of output values, e.g. operator MetaData
+    :param bucket: The dataplane bucket
+    :param key_prefix: S3 prefix for the spilled values, see reference_key_prefix
+    :param threshold: Optional size in bytes, defaults to OUTPUT_SPILL_THRESHOLD_BYTES. 0 spills nothing.
+    :param written: Optional set of the S3 keys already written, they are not written again
+
+    :return: A new dict with large values replaced by references
+    """
+    threshold = SPILL_THRESHOLD_BYTES if threshold is None else threshold
+    if not threshold:
+        return dict(values)
+    spilled = {}
+    for key, value in values.items():
+        if is_reference(value):
+            spilled[key] = value
+            continue
+        body = json.dumps(value, cls=DecimalEncoder).encode('utf-8')
+        if len(body) <= threshold:
+            spilled[key] = value
+            continue
+        s3_key = '{}{}-{}.json'.format(key_prefix, key, hashlib.sha256(body).hexdigest())
+        if written is None or s3_key not in written:
+            get_client('s3').put_object(Bucket=bucket, Key=s3_key, Body=body, ContentType='application/json')
+            if written is not None:
+                written.add(s3_key)
+        spilled[key] = {
+            REFERENCE_TYPE_KEY: REFERENCE_TYPE_S3,
+            "S3Bucket": bucket,
+            "S3Key": s3_key,
+            "ContentLength": len(body)
+        }
+    return spilled
+
+
+def resolve_reference(value):
+    """
+    Read a spilled value back from S3. Values that are not references are returned unchanged.
+    """
+    if not is_reference(value):
+        return value
+    response = get_client('s3').get_object(Bucket=value["S3Bucket"], Key=value["S3Key"])
+    return json.loads(response["Body"].read())
+
+
+class ReferenceDict(dict):
+    """
+    A dict of output values that resolves spilled values when they are read.
+
+    Indexing and get() return the resolved value.  The dict itself keeps the reference, so iteration and JSON
+    serialization pass spilled values on as references whether or not they were read.  Resolved values are cached
+    by their S3 location, so each one is only downloaded once.  Assign a changed value back to keep it in the output.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._resolved = {}
+
+    def __getitem__(self, key):
+        value = dict.__getitem__(self, key)
+        if not is_reference(value):
+            return value
+        location = (value["S3Bucket"], value["S3Key"])
+        if location not in self._resolved:
+            self._resolved[location] = resolve_reference(value)
+        return self._resolved[location]
+
+    def get(self, key, default=None):
+        if key in self:
+            return self[key]
+        return default
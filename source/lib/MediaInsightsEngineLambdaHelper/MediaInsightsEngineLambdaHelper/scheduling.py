@@ -0,0 +1,321 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: Apache-2.0
+
+import os
+import time
+
+from botocore.exceptions import ClientError
+
+from MediaInsightsEngineLambdaHelper.metrics import put_metric
+
+# Workflow and operation admission state shared by the workflow API and the workflow functions.
+#
+# The system table holds a counter of the workflows in the Started state, which the scheduler checks before it
+# admits a queued workflow, a marker coalescing scheduler triggers, and the concurrency budgets of operations with
+# the leases held on them. Every function takes the system table resource of the caller, so each Lambda function
+# keeps using its own shared clients.
+
+# System table item counting the workflows that are in the Started state.  The scheduler takes a slot
+# before starting a workflow and a slot is given back whenever a workflow leaves the Started state.
+RUNNING_WORKFLOWS_COUNTER = 'RunningWorkflows'
+
+# System table item holding the time, in epoch milliseconds, until which a scheduler run is already on its way.
+# Scheduler triggers before that time are coalesced into the pending run.
+SCHEDULER_PENDING_MARKER = 'WorkflowSchedulerPendingUntil'
+
+# Prefix of the system table items holding per-operation concurrency budgets, e.g. "MaxConcurrentOperations:Transcribe"
+OPERATION_CONCURRENCY_PREFIX = 'MaxConcurrentOperations:'
+
+# Map attribute of an operation budget item holding a lease for every running instance of the operation, keyed by
+# the arn of the state machine execution running it.  The number of leases is the number of tokens in use.
+OPERATION_LEASES = 'Leases'
+
+# How long a scheduler trigger waits for the invoked scheduler to start before another trigger invokes it again
+SCHEDULER_TRIGGER_WINDOW_MS = int(os.environ.get("SCHEDULER_TRIGGER_WINDOW_MS", 5000))
+
+
+def _condition_failed(error):
+    return error.response['Error']['Code'] == 'ConditionalCheckFailedException'
+
+
+def get_running_workflow_count(system_table):
+    """
+    Read the running workflow counter.
+
+    :return: The number of running workflow slots in use, or None if the counter has not been created yet
+    """
+    response = system_table.get_item(
+        Key={
+            'Name': RUNNING_WORKFLOWS_COUNTER
+        },
+        ConsistentRead=True)
+    if "Value" not in response.get("Item", {}):
+        return None
+    return int(response["Item"]["Value"])
+
+
+def acquire_workflow_slot(system_table, max_concurrent_workflows):
+    """
+    Take a running workflow slot from the counter.
+
+    The conditional update makes concurrent schedulers unable to admit more than
+    max_concurrent_workflows workflows between them.
+
+    :return: True if a slot was taken, False if all of the slots are in use
+    """
+    try:
+        system_table.update_item(
+            Key={
+                'Name': RUNNING_WORKFLOWS_COUNTER
+            },
+            UpdateExpression='SET #value = if_not_exists(#value, :zero) + :one',
+            ConditionExpression='attribute_not_exists(#value) OR #value < :max',
+            ExpressionAttributeNames={
+                '#value': 'Value'
+            },
+            ExpressionAttributeValues={
+                ':zero': 0,
+                ':one': 1,
+                ':max': max_concurrent_workflows
+            }
+        )
+    except ClientError as e:
+        if not _condition_failed(e):
+            raise
+        return False
+    return True
+
+
+def release_workflow_slot(system_table):
+    """
+    Give a running workflow slot back.  The counter never goes below zero.
+
+    :return: True if a slot was given back
+    """
+    try:
+        system_table.update_item(
+            Key={
+                'Name': RUNNING_WORKFLOWS_COUNTER
+            },
+            UpdateExpression='SET #value = #value - :one',
+            ConditionExpression='#value > :zero',
+            ExpressionAttributeNames={
+                '#value': 'Value'
+            },
+            ExpressionAttributeValues={
+                ':zero': 0,
+                ':one': 1
+            }
+        )
+    except ClientError as e:
+        if not _condition_failed(e):
+            raise
+        # The counter can reach zero early when it was reconciled while this workflow was being started
+        put_metric('WorkflowSlotReleasesIgnored', 1)
+        return False
+    return True
+
+
+def reconcile_running_workflows(system_table, counted, started):
+    """
+    Bring the running workflow counter in line with the number of workflows in the Started state.
+
+    A missing counter is seeded with the started count, so workflows that were running before the counter was
+    created hold their slots.  A counter above the started count, e.g. after a function died between changing a
+    workflow status and releasing its slot, is lowered to it.  Both writes are conditional on the counter still
+    holding the value that was read, so slots taken or given back in the meantime are never lost.
+
+    The counter is never raised above an existing value: a workflow that holds a slot but is not Started yet,
+    because the scheduler is still starting its state machine, is not in the started count.
+
+    :param counted: The counter value, as returned by get_running_workflow_count
+    :param started: The number of workflow executions in the Started state
+    :return: The counter value after reconciliation
+    """
+    if counted is not None and started >= counted:
+        return counted
+
+    if counted is None:
+        condition_expression = 'attribute_not_exists(#value)'
+        expression_attribute_values = {':started': started}
+    else:
+        condition_expression = '#value = :counted'
+        expression_attribute_values = {':started': started, ':counted': counted}
+
+    try:
+        system_table.update_item(
+            Key={
+                'Name': RUNNING_WORKFLOWS_COUNTER
+            },
+            UpdateExpression='SET #value = :started',
+            ConditionExpression=condition_expression,
+            ExpressionAttributeNames={
+                '#value': 'Value'
+            },
+            ExpressionAttributeValues=expression_attribute_values
+        )
+    except ClientError as e:
+        if not _condition_failed(e):
+            raise
+        # Another function changed the counter first, so its value is the current one
+        return get_running_workflow_count(system_table) or 0
+
+    put_metric('RunningWorkflowsReconciled', (counted or 0) - started)
+    return started
+
+
+def trigger_workflow_scheduler(system_table, lambda_client, scheduler_lambda_arn):
+    """
+    Invoke the workflow scheduler unless a scheduler run is already pending.
+
+    The pending marker is set with a conditional write, so a burst of triggers from many workflows results in
+    a single scheduler invocation.  The scheduler clears the marker before it reads the queue, so a trigger
+    is only coalesced into a run that has not looked at the queue yet.
+    """
+    now = int(time.time() * 1000)
+    try:
+        system_table.update_item(
+            Key={
+                'Name': SCHEDULER_PENDING_MARKER
+            },
+            UpdateExpression='SET #value = :pending_until',
+            ConditionExpression='attribute_not_exists(#value) OR #value < :now',
+            ExpressionAttributeNames={
+                '#value': 'Value'
+            },
+            ExpressionAttributeValues={
+                ':pending_until': now + SCHEDULER_TRIGGER_WINDOW_MS,
+                ':now': now
+            }
+        )
+    except ClientError as e:
+        if not _condition_failed(e):
+            raise
+        put_metric('WorkflowSchedulerTriggersCoalesced', 1)
+        return False
+
+    lambda_client.invoke(
+        FunctionName=scheduler_lambda_arn,
+        InvocationType='Event'
+    )
+    put_metric('WorkflowSchedulerTriggers', 1)
+    return True
+
+
+def clear_scheduler_pending(system_table):
+    """
+    Let the next scheduler trigger through.  Called by the scheduler before it reads the queues.
+    """
+    system_table.delete_item(
+        Key={
+            'Name': SCHEDULER_PENDING_MARKER
+        }
+    )
+
+
+def get_operation_budget(system_table, operation_name):
+    """
+    Read the concurrency budget of an operation.
+
+    A budget stored without the map of leases, e.g. by a release that did not limit operations, gets an empty
+    one, because the state machine can only take a token by adding a lease to the map.
+
+    :return: The number of instances of the operation allowed to run at the same time, or None if the
+        operation is not limited
+    """
+    name = OPERATION_CONCURRENCY_PREFIX + operation_name
+    response = system_table.get_item(
+        Key={
+            'Name': name
+        },
+        ProjectionExpression='#value, #leases',
+        ExpressionAttributeNames={
+            '#value': 'Value',
+            '#leases': OPERATION_LEASES
+        })
+    item = response.get("Item", {})
+    if "Value" not in item:
+        return None
+    if OPERATION_LEASES not in item:
+        try:
+            system_table.update_item(
+                Key={
+                    'Name': name
+                },
+                UpdateExpression='SET #leases = if_not_exists(#leases, :no_leases)',
+                ConditionExpression='attribute_exists(#value)',
+                ExpressionAttributeNames={
+                    '#value': 'Value',
+                    '#leases': OPERATION_LEASES
+                },
+                ExpressionAttributeValues={
+                    ':no_leases': {}
+                })
+        except ClientError as e:
+            if not _condition_failed(e):
+                raise
+            # The budget was removed in the meantime
+            return None
+    return int(item["Value"])
+
+
+def list_operation_leases(system_table):
+    """
+    List the leases held on every operation budget.
+
+    :return: A dict of budget item names to the list of execution arns holding a lease on the budget
+    """
+    scan_params = {
+        'FilterExpression': 'begins_with(#name, :prefix) AND attribute_exists(#leases)',
+        'ProjectionExpression': '#name, #leases',
+        'ExpressionAttributeNames': {
+            '#name': 'Name',
+            '#leases': OPERATION_LEASES
+        },
+        'ExpressionAttributeValues': {
+            ':prefix': OPERATION_CONCURRENCY_PREFIX
+        }
+    }
+    response = system_table.scan(**scan_params)
+    items = response['Items']
+    while 'LastEvaluatedKey' in response:
+        response = system_table.scan(ExclusiveStartKey=response['LastEvaluatedKey'], **scan_params)
+        items.extend(response['Items'])
+    return {item['Name']: list(item[OPERATION_LEASES]) for item in items if item[OPERATION_LEASES]}
+
+
+def reclaim_operation_leases(system_table, is_reclaimable):
+    """
+    Give back the leases of state machine executions that can no longer release them, e.g. because the execution
+    was stopped or timed out while the operation was running.
+
+    :param is_reclaimable: Called with the execution arn of each lease, returns True if the lease is to be reclaimed
+    :return: The number of leases reclaimed
+    """
+    reclaimed = 0
+    for name, execution_arns in list_operation_leases(system_table).items():
+        for execution_arn in execution_arns:
+            if not is_reclaimable(execution_arn):
+                continue
+            try:
+                # Releasing a lease twice is harmless, the condition only saves the write
+                system_table.update_item(
+                    Key={
+                        'Name': name
+                    },
+                    UpdateExpression='REMOVE #leases.#lease',
+                    ConditionExpression='attribute_exists(#leases.#lease)',
+                    ExpressionAttributeNames={
+                        '#leases': OPERATION_LEASES,
+                        '#lease': execution_arn
+                    }
+                )
+            except ClientError as e:
+                if not _condition_failed(e):
+                    raise
+                continue
+            reclaimed += 1
+
+    if reclaimed:
+        put_metric('OperationLeasesReclaimed', reclaimed)
+    return reclaimed
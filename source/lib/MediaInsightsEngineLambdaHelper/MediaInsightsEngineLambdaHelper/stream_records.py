@@ -0,0 +1,111 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: Apache-2.0
+
+from decimal import Decimal
+
+from boto3.dynamodb.types import Binary
+
+# Decoding of DynamoDB stream records for the stream functions.
+#
+# Stream records carry the item images as DynamoDB attribute values, e.g. {"Status": {"S": "Complete"}}. The stream
+# functions read only a few attributes of each image, so they decode those attributes one by one instead of the whole
+# record. Values are decoded like boto3's TypeDeserializer: numbers become Decimal and sets become Python sets.
+
+
+def _decode_map(data):
+    return {name: decode_value(value) for name, value in data.items()}
+
+
+def _decode_list(data):
+    return [decode_value(value) for value in data]
+
+
+_DECODERS = {
+    "S": lambda data: data,
+    "N": Decimal,
+    "BOOL": lambda data: data,
+    "NULL": lambda data: None,
+    "M": _decode_map,
+    "L": _decode_list,
+    "B": Binary,
+    "SS": set,
+    "NS": lambda data: {Decimal(value) for value in data},
+    "BS": lambda data: {Binary(value) for value in data},
+}
+
+
+def decode_value(value):
+    """
+    Decode a single attribute value, e.g. {"S": "Complete"} to "Complete".
+    """
+    for type_name, data in value.items():
+        try:
+            decoder = _DECODERS[type_name]
+        except KeyError:
+            raise TypeError("Unsupported DynamoDB type: {}".format(type_name))
+        return decoder(data)
+    raise TypeError("Empty DynamoDB attribute value")
+
+
+def decode_attributes(image, names=None):
+    """
+    Decode attributes of an item image.
+
+    :param image: NewImage, OldImage or Keys of a stream record
+    :param names: Optional names of the attributes to decode, all attributes when omitted
+
+    :return: A dict of decoded values; attributes missing from the image are left out
+    """
+    if names is None:
+        return _decode_map(image)
+    return {name: decode_value(image[name]) for name in names if name in image}
+
+
+def deserialize(data):
+    """
+    Decode anything that contains attribute values, e.g. a whole stream record.
+
+    Dicts with a single DynamoDB type key are decoded as attribute values, other dicts and lists are walked.
+    """
+    if isinstance(data, list):
+        return [deserialize(value) for value in data]
+    if isinstance(data, dict):
+        if len(data) == 1:
+            type_name = next(iter(data))
+            if type_name in _DECODERS:
+                return _DECODERS[type_name](data[type_name])
+        return {name: deserialize(value) for name, value in data.items()}
+    return data
+
+
+def latest_result(value):
+    """
+    The newest result pointer of an operator attribute in an asset image, decoded.
+
+    Operator attributes list the results of an operator newest first, e.g.
+    {"L": [{"M": {"pointer": {"S": "<key>"}, "workflow": {"S": "<id>"}}}, ...]}
+    """
+    return _decode_map(value["L"][0]["M"])
+
+
+def diff_operators(new_image, old_image):
+    """
+    Find the operators whose results were added, removed or replaced between two images of an asset item.
+
+    Both images are walked once and only the newest pointer of each operator attribute is compared, without
+    decoding the images.
+
+    :return: Lists of operator names (added, removed, modified) in image order
+    """
+    added = []
+    modified = []
+    for name, value in new_image.items():
+        if "L" not in value:
+            continue
+        old_value = old_image.get(name)
+        if old_value is None:
+            added.append(name)
+        elif value["L"][0]["M"]["pointer"] != old_value["L"][0]["M"]["pointer"]:
+            modified.append(name)
+    removed = [name for name, value in old_image.items() if "L" in value and name not in new_image]
+    return added, removed, modified
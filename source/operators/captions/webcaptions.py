@@ -2,37 +2,44 @@
 # SPDX-License-Identifier: Apache-2.0
 
 import json
-import boto3
 from botocore.client import ClientError
 import urllib3
-import math
 import os
 import ntpath
 import html
 import webvtt
 from io import StringIO
-from botocore import config
 from urllib.parse import urlparse
 
 from MediaInsightsEngineLambdaHelper import MediaInsightsOperationHelper
 from MediaInsightsEngineLambdaHelper import MasExecutionError
 from MediaInsightsEngineLambdaHelper import DataPlane
+from MediaInsightsEngineLambdaHelper.clients import get_client, get_resource
 
-mie_config = json.loads(os.environ['botoConfig'])
-config = config.Config(**mie_config)
-
-s3 = boto3.client('s3', config=config)
-s3_resource = boto3.resource('s3')
+s3 = get_client('s3')
+s3_resource = get_resource('s3')
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 headers = {"Content-Type": "application/json"}
 dataplane = DataPlane()
 
 
-translate_client = boto3.client('translate', config=config)
-polly = boto3.client('polly', config=config)
+translate_client = get_client('translate')
+polly = get_client('polly')
 
 not_supported = "not supported"
 
+# Rules for breaking a transcript into captions. Each can be overridden in the operator Configuration.
+DEFAULT_CAPTION_RULES = {
+    "MaxWordsPerCaption": 25,
+    "MaxCharactersPerCaption": 120,
+    "MaxSilenceSeconds": 1.5,
+    # A caption ends after any of these punctuation marks
+    "CaptionBreakPunctuation": ".?!"
+}
+
+# Caption files are uploaded in parts of this size, S3 requires at least 5 MB for every part but the last
+CAPTIONS_UPLOAD_PART_BYTES = 8 * 1024 * 1024
+
 
 class WebCaptions:
     def __init__(self, operator_object):
@@ -42,6 +49,8 @@ class WebCaptions:
         """
         print("WebCaptions operator_object = {}".format(operator_object.return_output_object()))
         self.operator_object = operator_object
+        # WebCaptions read or stored by this invocation, by operator name. Callers must not modify them.
+        self.web_captions_cache = {}
 
         try:
             self.transcribe_operator_name = "TranscribeVideo"
@@ -73,6 +82,14 @@ class WebCaptions:
             if "ExistingSubtitlesObject" in self.operator_object.configuration:
                 self.existing_subtitles_object = self.operator_object.configuration["ExistingSubtitlesObject"]
                 self.existing_subtitles = True
+
+            configuration = self.operator_object.configuration
+            self.caption_rules = {
+                "max_words": int(configuration.get("MaxWordsPerCaption", DEFAULT_CAPTION_RULES["MaxWordsPerCaption"])),
+                "max_characters": int(configuration.get("MaxCharactersPerCaption", DEFAULT_CAPTION_RULES["MaxCharactersPerCaption"])),
+                "max_silence": float(configuration.get("MaxSilenceSeconds", DEFAULT_CAPTION_RULES["MaxSilenceSeconds"])),
+                "break_punctuation": configuration.get("CaptionBreakPunctuation", DEFAULT_CAPTION_RULES["CaptionBreakPunctuation"])
+            }
         except KeyError as e:
             self.operator_object.update_workflow_status("Error")
             self.operator_object.add_workflow_metadata(WebCaptionsError="No valid inputs {e}".format(e=e))
@@ -118,120 +135,26 @@ class WebCaptions:
 
     def get_transcript(self):
 
-        transcript = []
-
-        response = dataplane.retrieve_asset_metadata(self.asset_id, operator_name=self.transcribe_operator_name)
-        transcript.append(response["results"])
-
-        while "cursor" in response:
-            response = dataplane.retrieve_asset_metadata(self.asset_id, operator_name=self.transcribe_operator_name, cursor=response["cursor"])
-            transcript.append(response["results"])
-
-        return transcript
-
-    class TranscribeContext:
-        end_time = 0.0
-        word_count = 0
-        captions = []
-        caption = None
-
-    def _transcribe(self, tc, item):
-        max_length = 120
-        max_words = 25
-        max_silence = 1.5
-
-        is_punctuation = item["type"] == "punctuation"
-
-        if tc.caption is None:
-
-            # Start of a line with punctuation, just skip it
-            if is_punctuation:
-                return
-
-            # Create a new caption line
-            tc.caption = {
-                "start": float(item["start_time"]),
-                "caption": "",
-                "wordConfidence": []
-            }
-
-        if not is_punctuation:
-
-            start_time = float(item["start_time"])
-
-            # Check to see if there has been a long silence
-            # between the last recorded word and start a new
-            # caption if this is the case, ending the last time
-            # as this one starts.
-
-            if (len(tc.caption["caption"]) > 0) and ((tc.end_time + max_silence) < start_time):
-
-                tc.caption["end"] = start_time
-                tc.captions.append(tc.caption)
-
-                tc.caption = {
-                    "start": float(start_time),
-                    "caption": "",
-                    "wordConfidence": []
-                }
-
-                tc.word_count = 0
-
-            tc.end_time = float(item["end_time"])
-
-        requires_space = (not is_punctuation) and (len(tc.caption["caption"]) > 0)
-
-        if requires_space:
-            tc.caption["caption"] += " "
-
-        # Process tweaks
-
-        text = item["alternatives"][0]["content"]
-        confidence = item["alternatives"][0]["confidence"]
-        text_lower = text.lower()
-
-        tc.caption["caption"] += text
-
-        # Track raw word confidence
-        if not is_punctuation:
-            tc.caption["wordConfidence"].append(
-                {
-                    "w": text_lower,
-                    "c": float(confidence)
-                }
-            )
-            # Count words
-            tc.word_count += 1
+        response = dataplane.retrieve_operator_metadata_all(self.asset_id, self.transcribe_operator_name)
+        if "results" not in response:
+            self.operator_object.update_workflow_status("Error")
+            self.operator_object.add_workflow_metadata(WebCaptionsError="Unable to read transcript {e}".format(e=response))
+            raise MasExecutionError(self.operator_object.return_output_object())
 
-        # If we have reached a good amount of text finalize the caption
-        if (tc.word_count >= max_words) or (len(tc.caption["caption"]) >= max_length) or is_punctuation and text in "...?!":
-            tc.caption["end"] = tc.end_time
-            tc.captions.append(tc.caption)
-            tc.word_count = 0
-            tc.caption = None
+        return response["results"]
 
     def transcribe_to_web_captions(self, transcripts):
-
-        tc = self.TranscribeContext()
-
-        for item in (item for transcript in transcripts for item in transcript["results"]["items"]):
-            self._transcribe(tc, item)
-
-        # Close the last caption if required
-
-        if tc.caption is not None:
-            tc.caption["end"] = tc.end_time
-            tc.captions.append(tc.caption)
-
-        return tc.captions
+        items = [item for transcript in transcripts for item in transcript["results"]["items"]]
+        return segment_captions(transcript_columns(items), **self.caption_rules)
 
     def get_web_captions(self, language_code):
         webcaptions_operator_name = self.web_captions_operator_name(language_code)
         print(webcaptions_operator_name)
 
-        response = dataplane.retrieve_asset_metadata(self.asset_id, operator_name=webcaptions_operator_name)
-        print(response)
-        return response["results"]["WebCaptions"]
+        if webcaptions_operator_name not in self.web_captions_cache:
+            response = dataplane.retrieve_asset_metadata(self.asset_id, operator_name=webcaptions_operator_name)
+            self.web_captions_cache[webcaptions_operator_name] = response["results"]["WebCaptions"]
+        return self.web_captions_cache[webcaptions_operator_name]
 
     def put_web_captions(self, webcaptions, language_code=None, source=""):
         webcaptions_operator_name = self.web_captions_operator_name(language_code, source)
@@ -240,6 +163,7 @@ class WebCaptions:
         response = dataplane.store_asset_metadata(asset_id=self.asset_id, operator_name=webcaptions_operator_name, workflow_id=self.workflow_id, results=web_captions, paginate=False)
 
         if response.get("Status") == "Success":
+            self.web_captions_cache[webcaptions_operator_name] = webcaptions
             return self.operator_object.return_output_object()
 
         self.operator_object.update_workflow_status("Error")
@@ -262,13 +186,7 @@ class WebCaptions:
         return transcript
 
     def web_captions_to_text_transcript(self, webcaptions):
-
-        transcript = ""
-
-        for caption in webcaptions:
-            transcript = transcript + caption["caption"]
-
-        return transcript
+        return "".join(caption["caption"] for caption in webcaptions)
 
     def put_web_captions_collection(self, operator, collection):
 
@@ -290,45 +208,25 @@ class WebCaptions:
                 raise MasExecutionError(self.operator_object.return_output_object())
 
     def web_captions_to_srt(self, webcaptions):
-        srt = ''
-
-        index = 1
-
-        for caption in webcaptions:
-
-            srt += str(index) + '\n'
-            srt += format_time_srt(float(caption["start"])) + ' --> ' + format_time_srt(float(caption["end"])) + '\n'
-            srt += caption["caption"] + '\n\n'
-            index += 1
-
-        return srt
+        return "".join(srt_chunks(webcaptions))
 
     def put_srt(self, lang, srt):
-        response = dataplane.generate_media_storage_path(self.asset_id, self.workflow_id)
-
-        bucket = response["S3Bucket"]
-        key = response["S3Key"] + self.captions_operator_name(lang) + ".srt"
-        s3_object = s3_resource.Object(bucket, key)
-
-        s3_object.put(Body=srt)
-
-        metadata = {
-            "OperatorName": self.captions_operator_name(lang),
-            "Results": {"S3Bucket": bucket, "S3Key": key},
-            "WorkflowId": self.workflow_id,
-            "LanguageCode": lang
-        }
-
-        return metadata
+        # srt is the file content or an iterable of pieces of it, e.g. srt_chunks(webcaptions)
+        return self.put_captions_file(lang, ".srt", srt)
 
     def put_vtt(self, lang, vtt):
+        # vtt is the file content or an iterable of pieces of it, e.g. vtt_chunks(webcaptions)
+        return self.put_captions_file(lang, ".vtt", vtt)
+
+    def put_captions_file(self, lang, extension, body):
         response = dataplane.generate_media_storage_path(self.asset_id, self.workflow_id)
 
         bucket = response["S3Bucket"]
-        key = response["S3Key"] + self.captions_operator_name(lang) + ".vtt"
-        s3_object = s3_resource.Object(bucket, key)
+        key = response["S3Key"] + self.captions_operator_name(lang) + extension
 
-        s3_object.put(Body=vtt)
+        if isinstance(body, str):
+            body = [body]
+        upload_text(s3_resource.Object(bucket, key), body)
 
         metadata = {
             "OperatorName": self.captions_operator_name(lang),
@@ -340,14 +238,7 @@ class WebCaptions:
         return metadata
 
     def web_captions_to_vtt(self, webcaptions):
-        vtt = 'WEBVTT\n\n'
-
-        for caption in webcaptions:
-
-            vtt += format_time_vtt(float(caption["start"])) + ' --> ' + format_time_vtt(float(caption["end"])) + '\n'
-            vtt += caption["caption"] + '\n\n'
-
-        return vtt
+        return "".join(vtt_chunks(webcaptions))
 
     # Converts a delimited file back to web captions format.
     # Uses the source web captions to get timestamps and source caption text (saved in sourceCaption field).
@@ -563,8 +454,7 @@ def create_srt(event, _context):
 
         webcaptions = webcaptions_object.get_web_captions(lang)
 
-        srt = webcaptions_object.web_captions_to_srt(webcaptions)
-        metadata = webcaptions_object.put_srt(lang, srt)
+        metadata = webcaptions_object.put_srt(lang, srt_chunks(webcaptions))
 
         captions_collection.append(metadata)
 
@@ -604,8 +494,7 @@ def create_vtt(event, _context):
 
         webcaptions = webcaptions_object.get_web_captions(lang)
 
-        vtt = webcaptions_object.web_captions_to_vtt(webcaptions)
-        metadata = webcaptions_object.put_vtt(lang, vtt)
+        metadata = webcaptions_object.put_vtt(lang, vtt_chunks(webcaptions))
 
         captions_collection.append(metadata)
 
@@ -1020,34 +909,170 @@ def vtt_to_web_captions(operator_object, vtt_object):
     return webcaptions
 
 
-# Format an SRT timestamp in HH:MM:SS,mmm
-def format_time_srt(time_seconds):
+def transcript_columns(items):
+    """
+    Split Transcribe items into columns with one entry per word, so the segmentation reads plain lists instead of
+    item dicts. Times and confidence scores are converted to floats in bulk.
+
+    :return: (start, end, content, confidence, punctuation) lists; punctuation holds the punctuation marks that
+        follow the word, or None
+    """
+    start = []
+    end = []
+    content = []
+    confidence = []
+    punctuation = []
+    for item in items:
+        alternative = item["alternatives"][0] if "alternatives" in item else None
+        if item["type"] == "punctuation":
+            # Punctuation before the first word is dropped like punctuation at the start of any caption
+            if punctuation:
+                text = alternative["content"] if alternative else ""
+                if punctuation[-1] is None:
+                    punctuation[-1] = [text]
+                else:
+                    punctuation[-1].append(text)
+            continue
+        start.append(item["start_time"])
+        end.append(item["end_time"])
+        content.append(alternative["content"])
+        confidence.append(alternative["confidence"])
+        punctuation.append(None)
+    return list(map(float, start)), list(map(float, end)), content, list(map(float, confidence)), punctuation
 
-    ONE_HOUR = 60 * 60
-    ONE_MINUTE = 60
-    hours = math.floor(time_seconds / ONE_HOUR)
-    remainder = time_seconds - (hours * ONE_HOUR)
-    minutes = math.floor(remainder / 60)
-    remainder = remainder - (minutes * ONE_MINUTE)
-    seconds = math.floor(remainder)
-    remainder = remainder - seconds
-    millis = remainder
 
-    return str(hours).zfill(2) + ':' + str(minutes).zfill(2) + ':' + str(seconds).zfill(2) + ',' + str(math.floor(millis * 1000)).zfill(3)
+def segment_captions(columns, max_words=25, max_characters=120, max_silence=1.5, break_punctuation=".?!"):
+    """
+    Break a transcript into web captions.
+
+    A caption ends when it reaches max_words words or max_characters characters, after a punctuation mark in
+    break_punctuation, or before a word that follows a silence longer than max_silence seconds. Punctuation at the
+    start of a caption is dropped.
+
+    :param columns: Transcript columns, see transcript_columns
+    :return: List of captions with start, caption, wordConfidence and end
+    """
+    captions = []
+    # The open caption is kept as a list of text pieces and its length, and joined when it is closed
+    pieces = None
+    length = 0
+    word_confidence = None
+    caption_start = 0.0
+    end_time = 0.0
+    word_count = 0
+
+    for start, end, text, confidence, marks in zip(*columns):
+        if pieces is not None and length and end_time + max_silence < start:
+            # A long silence ends the caption when the next word starts
+            captions.append({"start": caption_start, "caption": "".join(pieces), "wordConfidence": word_confidence, "end": start})
+            pieces = None
+        if pieces is None:
+            pieces = [text]
+            length = len(text)
+            word_confidence = [{"w": text.lower(), "c": confidence}]
+            caption_start = start
+            word_count = 1
+        else:
+            if length:
+                pieces.append(" ")
+                length += 1
+            pieces.append(text)
+            length += len(text)
+            word_confidence.append({"w": text.lower(), "c": confidence})
+            word_count += 1
+        end_time = end
+
+        if word_count >= max_words or length >= max_characters:
+            captions.append({"start": caption_start, "caption": "".join(pieces), "wordConfidence": word_confidence, "end": end_time})
+            pieces = None
+            continue
+        if marks is not None:
+            for mark in marks:
+                pieces.append(mark)
+                length += len(mark)
+                if length >= max_characters or mark in break_punctuation:
+                    captions.append({"start": caption_start, "caption": "".join(pieces), "wordConfidence": word_confidence, "end": end_time})
+                    pieces = None
+                    # Punctuation after the end of a caption is dropped
+                    break
+
+    # Close the last caption
+    if pieces is not None:
+        captions.append({"start": caption_start, "caption": "".join(pieces), "wordConfidence": word_confidence, "end": end_time})
+
+    return captions
+
+
+# Caption files are serialized one cue at a time, so a feature length transcript is never built up with repeated
+# string concatenation and can be uploaded while it is being serialized.
+
+def srt_chunks(webcaptions):
+    for index, caption in enumerate(webcaptions, 1):
+        yield "%d\n%s --> %s\n%s\n\n" % (index, format_time_srt(caption["start"]), format_time_srt(caption["end"]),
+                                        caption["caption"])
+
+
+def vtt_chunks(webcaptions):
+    yield "WEBVTT\n\n"
+    for caption in webcaptions:
+        yield "%s --> %s\n%s\n\n" % (format_time_vtt(caption["start"]), format_time_vtt(caption["end"]), caption["caption"])
+
+
+def upload_text(s3_object, chunks):
+    """
+    Upload text from an iterable of strings to an S3 object.
+
+    Text that fits in one part is written with a single PutObject, longer text with a multipart upload that sends
+    each part as soon as enough text was produced.
+    """
+    parts = []
+    multipart_upload = None
+    buffer = []
+    buffer_bytes = 0
+    try:
+        for chunk in chunks:
+            data = chunk.encode("utf-8")
+            buffer.append(data)
+            buffer_bytes += len(data)
+            if buffer_bytes >= CAPTIONS_UPLOAD_PART_BYTES:
+                if multipart_upload is None:
+                    multipart_upload = s3_object.initiate_multipart_upload()
+                part_number = len(parts) + 1
+                response = multipart_upload.Part(part_number).upload(Body=b"".join(buffer))
+                parts.append({"ETag": response["ETag"], "PartNumber": part_number})
+                buffer = []
+                buffer_bytes = 0
+
+        if multipart_upload is None:
+            s3_object.put(Body=b"".join(buffer).decode("utf-8"))
+            return
+        if buffer:
+            part_number = len(parts) + 1
+            response = multipart_upload.Part(part_number).upload(Body=b"".join(buffer))
+            parts.append({"ETag": response["ETag"], "PartNumber": part_number})
+        multipart_upload.complete(MultipartUpload={"Parts": parts})
+    except Exception:
+        if multipart_upload is not None:
+            multipart_upload.abort()
+        raise
+
+
+# Timestamps are formatted from whole milliseconds, Transcribe reports times with millisecond precision
+def format_timestamp(time_seconds, separator):
+    seconds, millis = divmod(int(round(float(time_seconds) * 1000)), 1000)
+    minutes, seconds = divmod(seconds, 60)
+    hours, minutes = divmod(minutes, 60)
+    return "%02d:%02d:%02d%s%03d" % (hours, minutes, seconds, separator, millis)
+
+
+# Format an SRT timestamp in HH:MM:SS,mmm
+def format_time_srt(time_seconds):
+    return format_timestamp(time_seconds, ",")
 
 
 # Format a VTT timestamp in HH:MM:SS.mmm
 def format_time_vtt(time_seconds):
-    ONE_HOUR = 60 * 60
-    ONE_MINUTE = 60
-    hours = math.floor(time_seconds / ONE_HOUR)
-    remainder = time_seconds - (hours * ONE_HOUR)
-    minutes = math.floor(remainder / 60)
-    remainder = remainder - (minutes * ONE_MINUTE)
-    seconds = math.floor(remainder)
-    remainder = remainder - seconds
-    millis = remainder
-    return str(hours).zfill(2) + ':' + str(minutes).zfill(2) + ':' + str(seconds).zfill(2) + '.' + str(math.floor(millis * 1000)).zfill(3)
+    return format_timestamp(time_seconds, ".")
 
 
 # Parse a VTT timestamp in HH:MM:SS.mmm into seconds
@@ -1,24 +1,19 @@
 # Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
 # SPDX-License-Identifier: Apache-2.0
 
-import boto3
-from botocore import config
 import tarfile
-import os
-import json
 from io import BytesIO
 from aws_xray_sdk.core import xray_recorder
 from aws_xray_sdk.core import patch_all
 from MediaInsightsEngineLambdaHelper import MediaInsightsOperationHelper
 from MediaInsightsEngineLambdaHelper import MasExecutionError
 from MediaInsightsEngineLambdaHelper import DataPlane
+from MediaInsightsEngineLambdaHelper.clients import get_client
 
 patch_all()
 
-mie_config = json.loads(os.environ['botoConfig'])
-config = config.Config(**mie_config)
-comprehend = boto3.client('comprehend', config=config)
-s3_client = boto3.client('s3', config=config)
+comprehend = get_client('comprehend')
+s3_client = get_client('s3')
 headers = {"Content-Type": "application/json"}
 
 
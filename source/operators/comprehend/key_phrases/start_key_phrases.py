@@ -30,22 +30,19 @@
 ###############################################################################
 
 import os
-import boto3
 import json
-from botocore import config
 from aws_xray_sdk.core import xray_recorder
 from aws_xray_sdk.core import patch_all
 from MediaInsightsEngineLambdaHelper import MediaInsightsOperationHelper
 from MediaInsightsEngineLambdaHelper import MasExecutionError
 from MediaInsightsEngineLambdaHelper import DataPlane
+from MediaInsightsEngineLambdaHelper.clients import get_client
 
 patch_all()
 
-mie_config = json.loads(os.environ['botoConfig'])
-config = config.Config(**mie_config)
-comprehend = boto3.client('comprehend', config=config)
+comprehend = get_client('comprehend')
 
-s3 = boto3.client('s3', config=config)
+s3 = get_client('s3')
 comprehend_role = os.environ['comprehendRole']
 region = os.environ['AWS_REGION']
 headers = {"Content-Type": "application/json"}
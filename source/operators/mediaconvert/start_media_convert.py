@@ -2,34 +2,24 @@
 # SPDX-License-Identifier: Apache-2.0
 
 import os
-import boto3
-import json
-from botocore import config
 from aws_xray_sdk.core import xray_recorder
 from aws_xray_sdk.core import patch_all
 
 from MediaInsightsEngineLambdaHelper import MediaInsightsOperationHelper
 from MediaInsightsEngineLambdaHelper import MasExecutionError
+from MediaInsightsEngineLambdaHelper.clients import get_client
 
 patch_all()
 
 region = os.environ['AWS_REGION']
-mie_config = json.loads(os.environ['botoConfig'])
 dataplane_bucket = os.environ['DATAPLANE_BUCKET']
-config = config.Config(**mie_config)
 
 mediaconvert_role = os.environ['mediaconvertRole']
-mediaconvert = boto3.client("mediaconvert", config=config, region_name=region)
-
-media_convert_client = None
 
 
 def get_mediaconvert_client():
     mediaconvert_endpoint = os.environ["MEDIACONVERT_ENDPOINT"]
-    global media_convert_client
-    if media_convert_client is None:
-        media_convert_client = boto3.client("mediaconvert", region_name=region, endpoint_url=mediaconvert_endpoint)
-    return media_convert_client
+    return get_client("mediaconvert", region_name=region, endpoint_url=mediaconvert_endpoint)
 
 
 def lambda_handler(event, _context):
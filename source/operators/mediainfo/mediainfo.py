@@ -26,7 +26,6 @@
 
 import os
 import json
-import boto3
 from aws_xray_sdk.core import xray_recorder
 from aws_xray_sdk.core import patch_all
 from pymediainfo import MediaInfo
@@ -34,7 +33,7 @@ from pymediainfo import MediaInfo
 from MediaInsightsEngineLambdaHelper import MediaInsightsOperationHelper
 from MediaInsightsEngineLambdaHelper import MasExecutionError
 from MediaInsightsEngineLambdaHelper import DataPlane
-from botocore.config import Config
+from MediaInsightsEngineLambdaHelper.clients import get_client
 
 patch_all()
 
@@ -70,7 +69,7 @@ def lambda_handler(event, _context):
     # Using dualstack endpoint because all dualstack endpoints are regional-only, which we want.
     # Otherwise, boto3 tries to use the global virtual (legacy) endpoint, which causes mediainfo
     # to fail to fetch the media file unless it is in us-east-1 region.
-    s3_cli = boto3.client("s3", region_name=region, config=Config(signature_version='s3v4', use_dualstack_endpoint=True, s3={'addressing_style': 'virtual'}))
+    s3_cli = get_client("s3", region_name=region, signature_version='s3v4', use_dualstack_endpoint=True, s3={'addressing_style': 'virtual'})
     metadata_json = {}
     try:
         # The number of seconds that the Signed URL is valid:
@@ -1,22 +1,18 @@
 # Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
 # SPDX-License-Identifier: Apache-2.0
 
-import boto3
 import json
-import os
-from botocore import config
 from aws_xray_sdk.core import xray_recorder
 from aws_xray_sdk.core import patch_all
 from MediaInsightsEngineLambdaHelper import MediaInsightsOperationHelper
 from MediaInsightsEngineLambdaHelper import MasExecutionError
+from MediaInsightsEngineLambdaHelper.clients import get_client
 
 patch_all()
 
-mie_config = json.loads(os.environ['botoConfig'])
-config = config.Config(**mie_config)
-polly = boto3.client('polly', config=config)
-s3 = boto3.client('s3', config=config)
-comprehend = boto3.client('comprehend')
+polly = get_client('polly')
+s3 = get_client('s3')
+comprehend = get_client('comprehend')
 
 # TODO: Move voiceid to a user configurable variable
 
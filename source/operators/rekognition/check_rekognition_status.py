@@ -7,24 +7,41 @@
 #   data to the MI dataplane when the job is complete.
 ###############################################################################
 
-import os
-import boto3
 import json
-from botocore import config
+import os
 from aws_xray_sdk.core import xray_recorder
 from aws_xray_sdk.core import patch_all
 from MediaInsightsEngineLambdaHelper import OutputHelper
 from MediaInsightsEngineLambdaHelper import MasExecutionError
 from MediaInsightsEngineLambdaHelper import DataPlane
+from MediaInsightsEngineLambdaHelper.clients import get_client
 
 patch_all()
 
 operator_name = os.environ['OPERATOR_NAME']
 output_object = OutputHelper(operator_name)
 
-mie_config = json.loads(os.environ['botoConfig'])
-config = config.Config(**mie_config)
-rek = boto3.client('rekognition', config=config)
+rek = get_client('rekognition')
+
+# The pages read by one invocation are stored with one batch request. The batch is sent early once it grows past
+# this size, so a request to the dataplane API stays under the Lambda payload limit.
+STORE_BATCH_MAX_BYTES = 4 * 1024 * 1024
+
+
+def store_pages(dataplane, asset_id, job_id, pages, metadata_error_key):
+    """Stores the pages read so far with one dataplane request and raises MasExecutionError if any page fails."""
+    if not pages:
+        return
+    metadata_upload = dataplane.store_asset_metadata_batch(asset_id, pages)
+
+    # If dataplane request failed then mark workflow as failed
+    if metadata_upload.get("Status", '') != "Success":
+        output_object.update_workflow_status("Error")
+        output_object.add_workflow_metadata(**{metadata_error_key: "Unable to upload metadata for {asset}: {error}".format(asset=asset_id, error=metadata_upload)}, JobId=job_id)
+        raise MasExecutionError(output_object.return_output_object())
+
+    # Log that these pages have been successfully uploaded to the dataplane
+    print("Uploaded {count} pages of metadata for asset: {asset}, job {JobId}".format(count=len(pages), asset=asset_id, JobId=job_id))
 
 
 def get_status(event, get_rek_status, metadata_error_key):
@@ -69,6 +86,10 @@ def get_status(event, get_rek_status, metadata_error_key):
     # reading reko results from where this Lambda's previous invocation left off.
     pagination_token = metadata.get("PageToken", '')
     is_paginated = "PageToken" in metadata
+    # Numbering the pages lets the dataplane overwrite a page that is stored again after a retry
+    page_number = metadata.get("PageNumber", 0)
+    pages = []
+    pages_bytes = 0
 
     # Read and persist 10 reko pages per invocation of this Lambda
     for _ in range(11):
@@ -83,6 +104,9 @@ def get_status(event, get_rek_status, metadata_error_key):
             print(e)
             print("WARNING: Invalid pagination token found. Restarting read from first page.")
             pagination_token = ''
+            page_number = 0
+            pages = []
+            pages_bytes = 0
             continue
 
         # If the reko job is IN_PROGRESS then return. We'll check again after a step function wait.
@@ -112,24 +136,26 @@ def get_status(event, get_rek_status, metadata_error_key):
         # If we were paging or need to start, is_paginated needs to reflect that.
         is_paginated = is_paginated or have_next_token
 
-        # Persist rekognition results (current page)
+        # Queue rekognition results (current page) for the batch write
         # If we've been saving pages, then tell dataplane this is the last page
-        metadata_upload = dataplane.store_asset_metadata(asset_id=asset_id, operator_name=operator_name, workflow_id=workflow_id, results=response, paginate=is_paginated, end=is_end)
-
-        # If dataplane request failed then mark workflow as failed
-        if metadata_upload.get("Status", '') != "Success":
-            output_object.update_workflow_status("Error")
-            output_object.add_workflow_metadata(**{metadata_error_key: "Unable to upload metadata for {asset}: {error}".format(asset=asset_id, error=metadata_upload)}, JobId=job_id)
-            raise MasExecutionError(output_object.return_output_object())
-
-        # Log that this page has been successfully uploaded to the dataplane
-        print("Uploaded metadata for asset: {asset}, job {JobId}, page {page}".format(asset=asset_id, JobId=job_id, page=pagination_token))
+        page = {"OperatorName": operator_name, "WorkflowId": workflow_id, "Results": response,
+                "Paginated": is_paginated, "EndPagination": is_end}
+        if is_paginated:
+            page["Page"] = page_number
+            page_number += 1
+        pages.append(page)
+        pages_bytes += len(json.dumps(response, default=str))
+        if pages_bytes >= STORE_BATCH_MAX_BYTES:
+            store_pages(dataplane, asset_id, job_id, pages, metadata_error_key)
+            pages = []
+            pages_bytes = 0
 
         # Get the next pagination token if it exists:
         pagination_token = response.get('NextToken', '')
 
         # If reko results didn't contain more pages, we're done; mark the stage as complete.
         if not have_next_token:
+            store_pages(dataplane, asset_id, job_id, pages, metadata_error_key)
             output_object.add_workflow_metadata(JobId=job_id)
             output_object.update_workflow_status("Complete")
             return output_object.return_output_object()
@@ -138,8 +164,9 @@ def get_status(event, get_rek_status, metadata_error_key):
     # pass the pagination token to the workflow metadata and let our step function
     # invoker restart this Lambda. The pagination token allows this Lambda
     # continue from where it left off.
+    store_pages(dataplane, asset_id, job_id, pages, metadata_error_key)
     output_object.update_workflow_status("Executing")
-    output_object.add_workflow_metadata(PageToken=pagination_token, JobId=job_id, AssetId=asset_id, WorkflowExecutionId=workflow_id)
+    output_object.add_workflow_metadata(PageToken=pagination_token, PageNumber=page_number, JobId=job_id, AssetId=asset_id, WorkflowExecutionId=workflow_id)
     return output_object.return_output_object()
 
 
@@ -27,14 +27,14 @@
 ###############################################################################
 
 import json
-import boto3
 from aws_xray_sdk.core import xray_recorder
 from aws_xray_sdk.core import patch_all
 from MediaInsightsEngineLambdaHelper import MediaInsightsOperationHelper
 from MediaInsightsEngineLambdaHelper import MasExecutionError
 from MediaInsightsEngineLambdaHelper import DataPlane
+from MediaInsightsEngineLambdaHelper.clients import get_client
 
-s3 = boto3.client('s3')
+s3 = get_client('s3')
 
 patch_all()
 
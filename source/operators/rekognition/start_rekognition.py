@@ -8,24 +8,20 @@
 ###############################################################################
 
 import os
-import json
-from botocore import config
 import urllib
-import boto3
 from aws_xray_sdk.core import xray_recorder
 from aws_xray_sdk.core import patch_all
 from MediaInsightsEngineLambdaHelper import OutputHelper
 from MediaInsightsEngineLambdaHelper import MasExecutionError
 from MediaInsightsEngineLambdaHelper import DataPlane
+from MediaInsightsEngineLambdaHelper.clients import get_client
 
 patch_all()
 
 operator_name = os.environ['OPERATOR_NAME']
 output_object = OutputHelper(operator_name)
 
-mie_config = json.loads(os.environ['botoConfig'])
-config = config.Config(**mie_config)
-rek = boto3.client('rekognition', config=config)
+rek = get_client('rekognition')
 
 # Placeholder for an image processor function that is not implemented
 NOT_IMPLEMENTED = True
@@ -2,24 +2,21 @@
 # SPDX-License-Identifier: Apache-2.0
 
 import os
-import boto3
 import urllib3
 import json
-from botocore import config
 from aws_xray_sdk.core import xray_recorder
 from aws_xray_sdk.core import patch_all
 from MediaInsightsEngineLambdaHelper import MediaInsightsOperationHelper
 from MediaInsightsEngineLambdaHelper import MasExecutionError
 from MediaInsightsEngineLambdaHelper import DataPlane
+from MediaInsightsEngineLambdaHelper.clients import get_client
 
 patch_all()
 
 region = os.environ['AWS_REGION']
 
-mie_config = json.loads(os.environ['botoConfig'])
-config = config.Config(**mie_config)
-transcribe = boto3.client("transcribe", config=config)
-s3 = boto3.client('s3', config=config)
+transcribe = get_client('transcribe')
+s3 = get_client('s3')
 
 
 def lambda_handler(event, _context):
@@ -1,10 +1,8 @@
 # Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
 # SPDX-License-Identifier: Apache-2.0
 
-import boto3
 import os
 import json
-from botocore import config
 from aws_xray_sdk.core import xray_recorder
 from aws_xray_sdk.core import patch_all
 import tempfile
@@ -15,13 +13,12 @@ from nltk.tokenize.punkt import PunktSentenceTokenizer
 from MediaInsightsEngineLambdaHelper import DataPlane
 from MediaInsightsEngineLambdaHelper import MediaInsightsOperationHelper
 from MediaInsightsEngineLambdaHelper import MasExecutionError
+from MediaInsightsEngineLambdaHelper.clients import get_client
 
 patch_all()
 
-mie_config = json.loads(os.environ['botoConfig'])
-config = config.Config(**mie_config)
-translate_client = boto3.client('translate', config=config)
-s3 = boto3.client('s3', config=config)
+translate_client = get_client('translate')
+s3 = get_client('s3')
 
 def _load_tokenizer(lang: str) -> PunktSentenceTokenizer:
     """
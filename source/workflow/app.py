@@ -1,16 +1,23 @@
 # Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
 # SPDX-License-Identifier: Apache-2.0
 
-import boto3
 from aws_xray_sdk.core import xray_recorder
 from aws_xray_sdk.core import patch_all
-from botocore import config
 import logging
 import os
 import json
+import random
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
 from MediaInsightsEngineLambdaHelper import Status as awsmie
 from MediaInsightsEngineLambdaHelper import MediaInsightsOperationHelper
 from MediaInsightsEngineLambdaHelper import MasExecutionError
+from MediaInsightsEngineLambdaHelper.clients import get_client, get_resource
+from MediaInsightsEngineLambdaHelper.metrics import put_metric
+from MediaInsightsEngineLambdaHelper.scheduling import acquire_workflow_slot, clear_scheduler_pending, \
+    get_operation_budget, get_running_workflow_count, reclaim_operation_leases, reconcile_running_workflows, \
+    release_workflow_slot, trigger_workflow_scheduler
 
 patch_all()
 
@@ -34,6 +41,24 @@ OPERATION_TABLE_NAME = os.environ["OPERATION_TABLE_NAME"]
 WORKFLOW_EXECUTION_TABLE_NAME = os.environ["WORKFLOW_EXECUTION_TABLE_NAME"]
 STAGE_EXECUTION_QUEUE_URL = os.environ["STAGE_EXECUTION_QUEUE_URL"]
 
+# Queued workflows wait on one queue per priority.  The normal priority queue is the stage execution queue, the
+# high and low priority queues are optional.
+EXECUTION_QUEUES = {
+    priority: queue_url for priority, queue_url in (
+        (awsmie.WORKFLOW_PRIORITY_HIGH, os.environ.get("HIGH_PRIORITY_EXECUTION_QUEUE_URL")),
+        (awsmie.WORKFLOW_PRIORITY_NORMAL, STAGE_EXECUTION_QUEUE_URL),
+        (awsmie.WORKFLOW_PRIORITY_LOW, os.environ.get("LOW_PRIORITY_EXECUTION_QUEUE_URL"))
+    ) if queue_url
+}
+# Share of the free workflow slots each queue gets while more than one queue has workflows waiting
+EXECUTION_QUEUE_WEIGHTS = {
+    awsmie.WORKFLOW_PRIORITY_HIGH: 6,
+    awsmie.WORKFLOW_PRIORITY_NORMAL: 3,
+    awsmie.WORKFLOW_PRIORITY_LOW: 1
+}
+# Long poll briefly so an empty queue does not hold up the other queues
+EXECUTION_QUEUE_WAIT_SECONDS = 1
+
 ATT_NAME_WORKFLOW_NAME = '#workflow_name'
 ATT_NAME_WORKFLOW_STATUS = '#workflow_status'
 ATT_VALUE_WORKFLOW_STATUS = ':workflow_status'
@@ -47,7 +72,7 @@ else:
 if "SYSTEM_TABLE_NAME" in os.environ:
     SYSTEM_TABLE_NAME = os.environ["SYSTEM_TABLE_NAME"]
 else:
-    ""
+    SYSTEM_TABLE_NAME = ""
 
 if "ShortUUID" in os.environ:
     ShortUUID = os.environ["ShortUUID"]
@@ -57,20 +82,30 @@ if "DEFAULT_MAX_CONCURRENT_WORKFLOWS" in os.environ:
 else:
     DEFAULT_MAX_CONCURRENT_WORKFLOWS = 10
 
-mie_config = json.loads(os.environ['botoConfig'])
-config = config.Config(**mie_config)
+# Table holding the task tokens of async operations waiting for the completion event of their service job
+OPERATION_CALLBACK_TABLE_NAME = os.environ.get("OPERATION_CALLBACK_TABLE_NAME", "")
+
+# Operation metadata keys holding the id of a service job that announces its completion with an EventBridge event
+CALLBACK_JOB_ID_KEYS = ('TranscribeJobId', 'MediaconvertJobId')
+
+# Callback items are removed by the table time to live once nobody can be waiting for them any more
+CALLBACK_TOKEN_TTL_SECONDS = 7 * 24 * 3600
+CALLBACK_COMPLETED_TTL_SECONDS = 3600
+
+# Number of state machines the scheduler starts at the same time
+SCHEDULER_START_WORKERS = 10
 
 # DynamoDB
-DYNAMO_CLIENT = boto3.resource("dynamodb", config=config)
+DYNAMO_CLIENT = get_resource("dynamodb")
 
 # Step Functions
-SFN_CLIENT = boto3.client('stepfunctions', config=config)
+SFN_CLIENT = get_client('stepfunctions')
 
 # Simple Queue Service
-SQS_CLIENT = boto3.client('sqs', config=config)
+SQS_CLIENT = get_client('sqs')
 
 # Lambda
-LAMBDA_CLIENT = boto3.client("lambda", config=config)
+LAMBDA_CLIENT = get_client("lambda")
 
 
 def log_workflow_execution(workflow_execution):
@@ -116,19 +151,171 @@ def list_workflow_executions_by_status(status):
     return workflow_executions
 
 
-def workflow_scheduler_lambda(event, _context):
+def count_started_workflows():
+    table = DYNAMO_CLIENT.Table(WORKFLOW_EXECUTION_TABLE_NAME)
+    query_params = {
+        'IndexName': 'WorkflowExecutionStatus',
+        'ExpressionAttributeNames': {
+            ATT_NAME_WORKFLOW_STATUS: "Status"
+        },
+        'ExpressionAttributeValues': {
+            ATT_VALUE_WORKFLOW_STATUS: awsmie.WORKFLOW_STATUS_STARTED
+        },
+        'KeyConditionExpression': '{} = {}'.format(ATT_NAME_WORKFLOW_STATUS, ATT_VALUE_WORKFLOW_STATUS),
+        'Select': 'COUNT'
+    }
+
+    response = table.query(**query_params)
+    count = response['Count']
+    while 'LastEvaluatedKey' in response:
+        response = table.query(ExclusiveStartKey=response['LastEvaluatedKey'], **query_params)
+        count += response['Count']
+    return count
+
 
+def is_execution_running(execution_arn):
+    try:
+        response = SFN_CLIENT.describe_execution(executionArn=execution_arn)
+    except SFN_CLIENT.exceptions.ExecutionDoesNotExist:
+        return False
+    return response["status"] == "RUNNING"
+
+
+def mark_workflow_started(workflow_execution, queued_workflow_status, state_machine_execution_arn):
+    """
+    Set the status of a workflow taken off the queue to Started, along with the state machine execution
+    arn when a new state machine was started, in a single write.
+
+    The update only applies while the workflow still has the status it was queued with, so a state machine
+    that has already moved the workflow on is never set back to Started.
+
+    :return: True if the workflow was marked Started
+    """
     execution_table = DYNAMO_CLIENT.Table(WORKFLOW_EXECUTION_TABLE_NAME)
+    update_expression = 'SET {} = {}'.format(ATT_NAME_WORKFLOW_STATUS, ATT_VALUE_WORKFLOW_STATUS)
+    expression_attribute_values = {
+        ATT_VALUE_WORKFLOW_STATUS: awsmie.WORKFLOW_STATUS_STARTED,
+        ':queued_status': queued_workflow_status
+    }
+    if state_machine_execution_arn:
+        update_expression += ', StateMachineExecutionArn = :arn'
+        expression_attribute_values[':arn'] = state_machine_execution_arn
+
+    try:
+        execution_table.update_item(
+            Key={
+                'Id': workflow_execution["Id"]
+            },
+            UpdateExpression=update_expression,
+            ConditionExpression='{} = :queued_status'.format(ATT_NAME_WORKFLOW_STATUS),
+            ExpressionAttributeNames={
+                ATT_NAME_WORKFLOW_STATUS: "Status"
+            },
+            ExpressionAttributeValues=expression_attribute_values
+        )
+    except DYNAMO_CLIENT.meta.client.exceptions.ConditionalCheckFailedException:
+        return False
+    return True
+
+
+def start_queued_workflow(workflow_execution):
+    """
+    Start a workflow that has been taken off the queue and holds a running workflow slot.
+
+    If the workflow cannot be started its slot is given back and the workflow is set to Error.
+    """
+    logger.info("Starting workflow execution {}".format(workflow_execution["Id"]))
+    queued_workflow_status = workflow_execution['Status']
+
+    try:
+        state_machine_execution_arn = None
+
+        # Resumed workflows state machines are already executing since they just paused
+        # to wait for some external action
+        if queued_workflow_status != awsmie.WORKFLOW_STATUS_RESUMED:
+            # Kick off the state machine for the workflow
+            response = SFN_CLIENT.start_execution(
+                stateMachineArn=workflow_execution["Workflow"]["StateMachineArn"],
+                name=workflow_execution["Workflow"]["Name"] + workflow_execution["Id"],
+                input=json.dumps(workflow_execution["Workflow"]["Stages"][workflow_execution["CurrentStage"]])
+            )
+            state_machine_execution_arn = response["executionArn"]
+
+        if not mark_workflow_started(workflow_execution, queued_workflow_status, state_machine_execution_arn):
+            # The workflow was deleted or finished before it could be marked Started, so it never used its slot
+            logger.info("Workflow execution {} is no longer {}".format(workflow_execution["Id"], queued_workflow_status))
+            release_workflow_slot(DYNAMO_CLIENT.Table(SYSTEM_TABLE_NAME))
+
+    except Exception as e:
+
+        logger.info("Exception starting workflow execution {}: {}".format(workflow_execution["Id"], e))
+        release_workflow_slot(DYNAMO_CLIENT.Table(SYSTEM_TABLE_NAME))
+        update_workflow_execution_status(workflow_execution["Id"], awsmie.WORKFLOW_STATUS_ERROR, "Exception in workflow_scheduler_lambda {}".format(e))
+        raise
+
+
+def put_execution_queue_depth_metrics():
+    # Metrics are best effort, a failure to read a queue must never keep the scheduler from admitting workflows
+    for priority, queue_url in EXECUTION_QUEUES.items():
+        try:
+            response = SQS_CLIENT.get_queue_attributes(
+                QueueUrl=queue_url,
+                AttributeNames=['ApproximateNumberOfMessages']
+            )
+            put_metric('ExecutionQueueDepth', int(response['Attributes']['ApproximateNumberOfMessages']),
+                       dimensions={'Queue': priority})
+        except Exception as e:
+            logger.info("Unable to read the depth of the {} priority execution queue: {}".format(priority, e))
+
+
+def receive_queued_workflows(priorities, capacity):
+    """
+    Receive up to capacity queued workflows, sharing the capacity between the queues in priorities.
+
+    Each slot is drawn by a lottery weighted by EXECUTION_QUEUE_WEIGHTS, so every queue with waiting workflows
+    gets its share of the slots over time and a large low priority backlog can not starve the other queues.
+    Queues found empty are removed from priorities.
+
+    :return: A list of (priority, message) tuples
+    """
+    draws = Counter(random.choices(priorities, weights=[EXECUTION_QUEUE_WEIGHTS[priority] for priority in priorities], k=capacity))
+    received = []
+    for priority, count in draws.items():
+        messages = SQS_CLIENT.receive_message(
+            QueueUrl=EXECUTION_QUEUES[priority],
+            MaxNumberOfMessages=count,
+            WaitTimeSeconds=EXECUTION_QUEUE_WAIT_SECONDS,
+            AttributeNames=['SentTimestamp']
+        )
+        if 'Messages' not in messages:  # when the queue is exhausted, the response dict contains no 'Messages' key
+            logger.info('{} priority queue is empty'.format(priority))
+            priorities.remove(priority)
+            continue
+        received.extend((priority, message) for message in messages['Messages'])
+    return received
+
+
+def workflow_scheduler_lambda(event, _context):
+
     arn = ""
-    workflow_execution = {}
     max_concurrent_workflows = DEFAULT_MAX_CONCURRENT_WORKFLOWS
+    # Slots taken for messages that have not been handed to start_queued_workflow yet must be given back if we fail
+    unclaimed_slots = 0
 
     try:
         logger.info(json.dumps(event))
 
-        # Get the MaxConcurrent configruation parameter, if it is not set, use the default
         system_table = DYNAMO_CLIENT.Table(SYSTEM_TABLE_NAME)
 
+        # Workflows queued from now on need another scheduler run, so let the next trigger through
+        clear_scheduler_pending(system_table)
+
+        # The schedule rule runs the scheduler every minute, which also gives back the operation concurrency
+        # tokens of executions whose end the workflow error handler missed
+        if event.get("source") == "aws.events":
+            reclaim_operation_leases(system_table, lambda execution_arn: not is_execution_running(execution_arn))
+
+        # Get the MaxConcurrent configruation parameter, if it is not set, use the default
         # Check if any configuration has been added yet
         response = system_table.get_item(
             Key={
@@ -141,78 +328,100 @@ def workflow_scheduler_lambda(event, _context):
             logger.info("Got MaxConcurrentWorkflows = {}".format(response["Item"]["Value"]))
 
         # Check if there are slots to run a workflow
-        # TODO - we really need consistent read here.  Index query is not consistent read
-        started_workflows = list_workflow_executions_by_status(awsmie.WORKFLOW_STATUS_STARTED)
-        num_started_workflows = len(started_workflows)
+        num_started_workflows = get_running_workflow_count(system_table)
+
+        # A counter that was never created, or that still counts workflows whose slot was not given back, is
+        # corrected from the workflow executions before it keeps queued workflows waiting
+        if num_started_workflows is None or num_started_workflows >= max_concurrent_workflows:
+            num_started_workflows = reconcile_running_workflows(system_table, num_started_workflows, count_started_workflows())
+
+        put_execution_queue_depth_metrics()
 
         if num_started_workflows >= max_concurrent_workflows:
             logger.info("MaxConcurrentWorkflows has been reached {}/{} - nothing to do".format(num_started_workflows, max_concurrent_workflows))
 
-        # We can only read 10 messages at a time from the queue.  Loop reading from the queue until
-        # it is empty or we are out of slots
+        # We can only read 10 messages at a time from the queues.  Loop reading from the queues until
+        # they are empty or we are out of slots
+        priorities = list(EXECUTION_QUEUES)
         while (num_started_workflows < max_concurrent_workflows):
 
             capacity = min(int(max_concurrent_workflows - num_started_workflows), 10)
 
             logger.info("MaxConcurrentWorkflows has not been reached {}/{} - check if a workflow is available to run".format(num_started_workflows, max_concurrent_workflows))
 
-            # Check if there are workflows waiting to run on the STAGE_EXECUTION_QUEUE_URL
-            messages = SQS_CLIENT.receive_message(
-                QueueUrl=STAGE_EXECUTION_QUEUE_URL,
-                MaxNumberOfMessages=capacity
-            )
-            if 'Messages' not in messages:  # when the queue is exhausted, the response dict contains no 'Messages' key
-                logger.info('Queue is empty')
-                break
-
-            for message in messages['Messages']:  # 'Messages' is a list
-                # process the messages
-                logger.info(message['Body'])
-                # next, we delete the message from the queue so no one else will process it again,
-                # once it is in our hands it is going run or fail, no reprocessing
-                # TODO - we may want to delay deleting the message until complete_stage is called on the
-                # final stage so we can detect hung workflows and time them out.  For now, do the simple thing.
-                SQS_CLIENT.delete_message(QueueUrl=STAGE_EXECUTION_QUEUE_URL, ReceiptHandle=message['ReceiptHandle'])
-
-                workflow_execution = json.loads(message['Body'])
-                queued_workflow_status = workflow_execution['Status']
-                workflow_execution['Status'] = awsmie.WORKFLOW_STATUS_STARTED
-
-                # Update the workflow status now to indicate we have taken it off the queue
-                update_workflow_execution_status(workflow_execution["Id"], awsmie.WORKFLOW_STATUS_STARTED, "")
-
-                # Resumed workflows state machines are already executing since they just paused
-                # to wait for some external action
-                if queued_workflow_status != awsmie.WORKFLOW_STATUS_RESUMED:
-                    # Kick off the state machine for the workflow
-                    response = SFN_CLIENT.start_execution(
-                        stateMachineArn=workflow_execution["Workflow"]["StateMachineArn"],
-                        name=workflow_execution["Workflow"]["Name"] + workflow_execution["Id"],
-                        input=json.dumps(workflow_execution["Workflow"]["Stages"][workflow_execution["CurrentStage"]])
-                    )
-
-                    workflow_execution["StateMachineExecutionArn"] = response["executionArn"]
-
-                    # Update the workflow with the state machine id
-                    response = execution_table.update_item(
-                        Key={
-                            'Id': workflow_execution["Id"]
-                        },
-                        UpdateExpression='SET StateMachineExecutionArn = :arn',
-                        ExpressionAttributeValues={
-                            ':arn': response["executionArn"]
-                        }
-                    )
-
-            started_workflows = list_workflow_executions_by_status(awsmie.WORKFLOW_STATUS_STARTED)
-            num_started_workflows = len(started_workflows)
+            # Check if there are workflows waiting to run on the execution queues
+            received = receive_queued_workflows(priorities, capacity)
+            if not received:
+                if not priorities:
+                    logger.info('Queue is empty')
+                    break
+                continue
+
+            # Another scheduler may have taken the slots we counted, so each workflow must take its own slot.
+            admitted = []
+            for priority, message in received:
+                if not acquire_workflow_slot(system_table, max_concurrent_workflows):
+                    break
+                unclaimed_slots += 1
+                admitted.append((priority, message))
+
+            # Messages that could not get a slot are put back on their queue for the next scheduler run.
+            unscheduled = received[len(admitted):]
+            if unscheduled:
+                logger.info("MaxConcurrentWorkflows was reached by another scheduler - returning {} messages to the queue".format(len(unscheduled)))
+                for priority in EXECUTION_QUEUES:
+                    entries = [{'Id': str(index), 'ReceiptHandle': message['ReceiptHandle'], 'VisibilityTimeout': 0}
+                               for index, (message_priority, message) in enumerate(unscheduled) if message_priority == priority]
+                    if entries:
+                        SQS_CLIENT.change_message_visibility_batch(QueueUrl=EXECUTION_QUEUES[priority], Entries=entries)
+
+            # next, we delete the messages from the queues so no one else will process them again,
+            # once they are in our hands they are going run or fail, no reprocessing
+            # TODO - we may want to delay deleting the message until complete_stage is called on the
+            # final stage so we can detect hung workflows and time them out.  For now, do the simple thing.
+            workflow_executions = []
+            now = int(time.time() * 1000)
+            for priority in EXECUTION_QUEUES:
+                messages = [message for message_priority, message in admitted if message_priority == priority]
+                if not messages:
+                    continue
+                response = SQS_CLIENT.delete_message_batch(
+                    QueueUrl=EXECUTION_QUEUES[priority],
+                    Entries=[{'Id': str(index), 'ReceiptHandle': message['ReceiptHandle']}
+                             for index, message in enumerate(messages)]
+                )
+                # A message that could not be deleted will be received again, so it is left for that scheduler run
+                failed = {entry['Id'] for entry in response.get('Failed', [])}
+                for index, message in enumerate(messages):
+                    if str(index) in failed:
+                        logger.info("Unable to delete message {} - leaving it on the queue".format(message['ReceiptHandle']))
+                        release_workflow_slot(system_table)
+                    else:
+                        logger.info(message['Body'])
+                        workflow_executions.append(json.loads(message['Body']))
+                        if 'SentTimestamp' in message.get('Attributes', {}):
+                            put_metric('ExecutionQueueWaitTime', now - int(message['Attributes']['SentTimestamp']),
+                                       unit='Milliseconds', dimensions={'Queue': priority})
+                    unclaimed_slots -= 1
+
+            # Start the admitted workflows concurrently.  Leaving the with block waits for all of them and
+            # result() raises the first failure after the rest of the batch has been started.
+            if workflow_executions:
+                with ThreadPoolExecutor(max_workers=min(SCHEDULER_START_WORKERS, len(workflow_executions))) as executor:
+                    futures = [executor.submit(start_queued_workflow, workflow_execution) for workflow_execution in workflow_executions]
+                for future in futures:
+                    future.result()
+
+            if unscheduled:
+                return arn
+
+            num_started_workflows = get_running_workflow_count(system_table) or 0
 
     except Exception as e:
 
         logger.info("Exception in scheduler {}".format(e))
-        if "Id" in workflow_execution:
-
-            update_workflow_execution_status(workflow_execution["Id"], awsmie.WORKFLOW_STATUS_ERROR, "Exception in workflow_scheduler_lambda {}".format(e))
+        for _ in range(unclaimed_slots):
+            release_workflow_slot(system_table)
         raise
 
     return arn
@@ -227,10 +436,12 @@ def filter_operation_lambda(event, _context):
     returns:
     Operation output
     - Operation status "Skipped" if operation should be skipped
+    - ConcurrencyLimited True if the operation has to take a concurrency token before it starts
     '''
     logger.info(json.dumps(event))
 
     operation_object = MediaInsightsOperationHelper(event)
+    concurrency_limited = False
 
     if operation_object.configuration["MediaType"] != "MetadataOnly" and operation_object.configuration["MediaType"] not in operation_object.input["Media"]:
 
@@ -243,8 +454,11 @@ def filter_operation_lambda(event, _context):
     else:
 
         operation_object.update_workflow_status(awsmie.OPERATION_STATUS_STARTED)
+        concurrency_limited = get_operation_budget(DYNAMO_CLIENT.Table(SYSTEM_TABLE_NAME), operation_object.name) is not None
 
-    return operation_object.return_output_object()
+    output_object = operation_object.return_output_object()
+    output_object["ConcurrencyLimited"] = concurrency_limited
+    return output_object
 
 
 def start_wait_operation_lambda(event, _context):
@@ -323,15 +537,106 @@ def check_wait_operation_lambda(event, _context):
 #
 
 
+def register_operation_callback_lambda(event, _context):
+    '''
+    Park an async operation until its service job announces that it finished
+
+    event is
+    - TaskToken: the task token of the state waiting for the callback
+    - Operation: the operation output of the start or monitor lambda
+
+    The job may finish before the callback is registered.  Whichever of this function and
+    operation_callback_lambda updates the callback item last sees the other one and resumes the operation.
+    '''
+    logger.info(json.dumps(event))
+
+    metadata = event["Operation"].get("MetaData", {})
+    job_id = next((metadata[key] for key in CALLBACK_JOB_ID_KEYS if key in metadata), None)
+    if job_id is None:
+        # The state times out and checks the job status instead
+        logger.warning("Operation {} has no job to wait for".format(event["Operation"]["Name"]))
+        return
+
+    callback_table = DYNAMO_CLIENT.Table(OPERATION_CALLBACK_TABLE_NAME)
+    response = callback_table.update_item(
+        Key={
+            'JobId': job_id
+        },
+        UpdateExpression='SET TaskToken = :task_token, ExpiresAt = :expires_at',
+        ExpressionAttributeValues={
+            ':task_token': event["TaskToken"],
+            ':expires_at': int(time.time()) + CALLBACK_TOKEN_TTL_SECONDS
+        },
+        ReturnValues='ALL_OLD'
+    )
+
+    if response.get('Attributes', {}).get('Completed'):
+        logger.info("Job {} completed before its callback was registered".format(job_id))
+        resume_operation(job_id, event["TaskToken"])
+
+
+def operation_callback_lambda(event, _context):
+    '''
+    Resume the operation waiting on a service job when the job state change event arrives
+
+    event is an EventBridge job state change event from Amazon Transcribe or AWS Elemental MediaConvert
+    '''
+    logger.info(json.dumps(event))
+
+    detail = event["detail"]
+    job_id = detail.get("TranscriptionJobName") or detail.get("jobId")
+
+    callback_table = DYNAMO_CLIENT.Table(OPERATION_CALLBACK_TABLE_NAME)
+    response = callback_table.update_item(
+        Key={
+            'JobId': job_id
+        },
+        UpdateExpression='SET Completed = :completed, ExpiresAt = :expires_at',
+        ExpressionAttributeValues={
+            ':completed': True,
+            ':expires_at': int(time.time()) + CALLBACK_COMPLETED_TTL_SECONDS
+        },
+        ReturnValues='ALL_OLD'
+    )
+
+    task_token = response.get('Attributes', {}).get('TaskToken')
+    if task_token:
+        resume_operation(job_id, task_token)
+        put_metric('OperationCallbacks', 1, dimensions={'Source': event["source"]})
+
+
+def resume_operation(job_id, task_token):
+    DYNAMO_CLIENT.Table(OPERATION_CALLBACK_TABLE_NAME).delete_item(
+        Key={
+            'JobId': job_id
+        }
+    )
+    try:
+        # The monitor lambda of the operation collects the job results
+        SFN_CLIENT.send_task_success(taskToken=task_token, output='{}')
+    except (SFN_CLIENT.exceptions.TaskTimedOut, SFN_CLIENT.exceptions.TaskDoesNotExist,
+            SFN_CLIENT.exceptions.InvalidToken):
+        # The state already gave up waiting and checked the job status itself
+        logger.info("Operation waiting on job {} is no longer waiting for a callback".format(job_id))
+
+
 def complete_stage_execution_lambda(event, _context):
     '''
     event is a stage execution object
     '''
     logger.info(json.dumps(event))
-    return complete_stage_execution(event["Name"], event["Status"], event["Outputs"], event["WorkflowExecutionId"])
+    return complete_stage_execution(event["Name"], event["Status"], event["Outputs"], event["WorkflowExecutionId"],
+                                    event["Input"], event.get("Next"))
 
 
-def complete_stage_execution(stage_name, status, outputs, workflow_execution_id):
+def complete_stage_execution(stage_name, status, outputs, workflow_execution_id, stage_input, next_stage=None):
+    """
+    Save the result of a stage and move the workflow execution on to the next stage, or end it, in a single write.
+
+    :param stage_input: The Globals the stage was started with
+    :param next_stage: The name of the stage that follows, None if the stage is the last one
+    :return: The next stage object to execute, or an empty object at the end of the workflow
+    """
 
     def format_error_message(error):
         return "Exception while rolling up stage status {}".format(error)
@@ -339,25 +644,12 @@ def complete_stage_execution(stage_name, status, outputs, workflow_execution_id)
     try:
 
         execution_table = DYNAMO_CLIENT.Table(WORKFLOW_EXECUTION_TABLE_NAME)
-        # lookup the workflow
-        response = execution_table.get_item(
-            Key={
-                'Id': workflow_execution_id
-            },
-            ConsistentRead=True)
-
-        workflow_execution = response.get("Item")
-        if "Item" not in response:
-            raise ValueError(
-                "Exception: workflow execution id '%s' not found" % workflow_execution_id)
-
-        log_workflow_execution(workflow_execution)
-
-        # Get the workflow stages
-        stages = workflow_execution["Workflow"]["Stages"]
 
         # Roll-up the results of the stage execution.  If anything fails here, we will fail the
         # stage, but still attempt to update the workflow execution the stage belongs to
+        rollup_error = None
+        media = {}
+        metadata = {}
         try:
             # Roll up operation status
             # # if any operation did not complete successfully, the stage has failed
@@ -372,10 +664,6 @@ def complete_stage_execution(stage_name, status, outputs, workflow_execution_id)
 
             logger.info("Stage status: {}".format(status))
 
-            stages[stage_name]["Outputs"] = outputs
-
-            workflow_execution["Globals"].setdefault("MetaData", {})
-
             # Roll up operation media and metadata outputs from this stage and add them to
             # the global workflow metadata:
             #
@@ -386,238 +674,179 @@ def complete_stage_execution(stage_name, status, outputs, workflow_execution_id)
             #        then the global value is replaced by the stage output value
 
             # Roll up media
-            stage_output_media_type_keys = []
             for operation, media_type in ((operation, media_type)
                                           for operation in outputs
                                           for media_type in operation.get("Media", {}).keys()):
                 # replace media with trasformed or created media from this stage
                 logger.info(media_type)
-                if media_type in stage_output_media_type_keys:
+                if media_type in media:
                     raise ValueError(
                         "Duplicate mediaType '%s' found in operation output media.  mediaType keys must be unique within a stage." % media_type)
 
-                workflow_execution["Globals"]["Media"][media_type] = operation["Media"][media_type]
-                stage_output_media_type_keys.append(media_type)
+                media[media_type] = operation["Media"][media_type]
 
             # Roll up metadata
             for operation, key in ((operation, key)
                                    for operation in outputs
                                    for key in operation.get("MetaData", {}).keys()):
                 logger.info(key)
-                workflow_execution["Globals"]["MetaData"][key] = operation["MetaData"][key]
-
-            stages[stage_name]["Status"] = status
+                metadata[key] = operation["MetaData"][key]
 
         # The status roll up failed.  Handle the error and fall through to update the workflow status
         except Exception as e:
 
-            message = format_error_message(e)
-            logger.info(message)
-            update_workflow_execution_status(workflow_execution["Id"], awsmie.WORKFLOW_STATUS_ERROR, message)
+            logger.info(format_error_message(e))
+            rollup_error = e
             status = awsmie.STAGE_STATUS_ERROR
+            media = {}
+            metadata = {}
+
+        # The Globals of the next stage are the Globals this stage was started with, updated with the stage outputs.
+        # Only this function writes Globals, one stage at a time, so they match the Globals in the execution item.
+        workflow_globals = dict(stage_input)
+        workflow_globals["Media"] = dict(stage_input.get("Media", {}), **media)
+        workflow_globals["MetaData"] = dict(stage_input.get("MetaData", {}), **metadata)
+
+        # Save the stage result and only the Globals keys it changed, and move the workflow execution on in the
+        # same write
+        update_expression = 'SET Workflow.Stages.#stage.Outputs = :outputs, Workflow.Stages.#stage.#stage_status = :stage_status'
+        attribute_names = {
+            '#stage': stage_name,
+            '#stage_status': 'Status'
+        }
+        attribute_values = {
+            ':outputs': outputs,
+            ':stage_status': status
+        }
+        for path, values in (('Globals.Media', media), ('Globals.MetaData', metadata)):
+            for index, (key, value) in enumerate(values.items()):
+                placeholder = '{}{}'.format(path.split('.')[1].lower(), index)
+                update_expression += ', {}.#{} = :{}'.format(path, placeholder, placeholder)
+                attribute_names['#' + placeholder] = key
+                attribute_values[':' + placeholder] = value
 
-            raise ValueError("Error rolling up stage status: %s" % e)
-
-        logger.info("Updating the workflow status in dynamodb: current stage {}, globals {}".format(stages[stage_name], workflow_execution["Globals"]))
-        # Save the new stage and workflow status
+        if status == awsmie.STAGE_STATUS_ERROR:
+            # The workflow status is set to Error with the error message below
+            current_stage = "End"
+        elif next_stage is not None:
+            current_stage = next_stage
+            update_expression += ', Workflow.Stages.#next_stage.Input = :next_stage_input, ' \
+                                 'Workflow.Stages.#next_stage.#stage_status = :next_stage_status'
+            attribute_names['#next_stage'] = next_stage
+            attribute_values[':next_stage_input'] = workflow_globals
+            attribute_values[':next_stage_status'] = awsmie.STAGE_STATUS_STARTED
+        else:
+            current_stage = "End"
+            update_expression += ', {} = {}'.format(ATT_NAME_WORKFLOW_STATUS, ATT_VALUE_WORKFLOW_STATUS)
+            attribute_names[ATT_NAME_WORKFLOW_STATUS] = 'Status'
+            attribute_values[ATT_VALUE_WORKFLOW_STATUS] = awsmie.WORKFLOW_STATUS_COMPLETE
+        update_expression += ', CurrentStage = {}'.format(ATT_VALUE_CURRENT_STAGE)
+        attribute_values[ATT_VALUE_CURRENT_STAGE] = current_stage
+
+        logger.info("Updating the workflow execution in dynamodb: stage {}, status {}, media {}, metadata {}, "
+                    "current stage {}".format(stage_name, status, list(media), list(metadata), current_stage))
+        update_params = {}
+        if ATT_NAME_WORKFLOW_STATUS in attribute_names:
+            # The old workflow status tells whether this write moved the workflow out of Started
+            update_params['ReturnValues'] = 'UPDATED_OLD'
         response = execution_table.update_item(
             Key={
                 'Id': workflow_execution_id
             },
-            UpdateExpression='SET Workflow.Stages.#stage = :stage, Globals = :globals',
-            ExpressionAttributeNames={
-                '#stage': stage_name
-            },
-            ExpressionAttributeValues={
-                # ':stage': json.dumps(stage)
-                ':stage': stages[stage_name],
-                ':globals': workflow_execution["Globals"]
-                # ':step_function_arn': step_function_execution_arn
-            }
+            UpdateExpression=update_expression,
+            ConditionExpression='attribute_exists(Id)',
+            ExpressionAttributeNames=attribute_names,
+            ExpressionAttributeValues=attribute_values,
+            **update_params
         )
 
-        # Start the next stage for execution
-        # TODO - try always completing stage
-        # status == awsmie.STAGE_STATUS_COMPLETE:
-        workflow_execution = start_next_stage_execution(
-            stage_name, workflow_execution)
+        if rollup_error is not None:
+            raise ValueError("Error rolling up stage status: %s" % rollup_error)
 
         if status == awsmie.STAGE_STATUS_ERROR:
             raise ValueError("Stage {} encountered and error during execution, aborting the workflow".format(stage_name))
 
+        if current_stage == "End":
+            workflow_status_changed(response.get("Attributes", {}).get("Status"), awsmie.WORKFLOW_STATUS_COMPLETE)
+            return {}
+
+        # Pass the next stage out to be consumed by the next stage.  Its definition does not change while the
+        # workflow runs, so only that stage is read, without a consistent read.
+        response = execution_table.get_item(
+            Key={
+                'Id': workflow_execution_id
+            },
+            ProjectionExpression='Workflow.Stages.#stage',
+            ExpressionAttributeNames={
+                '#stage': next_stage
+            }
+        )
+        next_stage_execution = response["Item"]["Workflow"]["Stages"][next_stage]
+        next_stage_execution["Input"] = workflow_globals
+        next_stage_execution["Status"] = awsmie.STAGE_STATUS_STARTED
+        return next_stage_execution
+
     except Exception as e:
         logger.info("Exception {}".format(e))
 
-        # Need a try/catch here? Try to save the status
         message = format_error_message(e)
-        execution_table.put_item(Item=workflow_execution)
-        update_workflow_execution_status(workflow_execution["Id"], awsmie.WORKFLOW_STATUS_ERROR, message)
+        update_workflow_execution_status(workflow_execution_id, awsmie.WORKFLOW_STATUS_ERROR, message)
 
         raise ValueError(
             "Exception: '%s'" % e)
 
-    # If it is not the end of the workflow, pass the next stage out to be consumed by the next stage.
-    stages["End"] = {}
-    return stages[workflow_execution["CurrentStage"]]
-
-
-def start_next_stage_execution(stage_name, workflow_execution):
-
-    try:
-        logger.info("START NEXT STAGE: stage_name {}".format(stage_name))
-
-        execution_table = DYNAMO_CLIENT.Table(WORKFLOW_EXECUTION_TABLE_NAME)
-
-        current_stage = stage_name
-
-        message = "stage completed with status {}".format(workflow_execution["Workflow"]["Stages"][current_stage]["Status"])
-
-        if "End" in workflow_execution["Workflow"]["Stages"][current_stage]:
-
-            if workflow_execution["Workflow"]["Stages"][current_stage]["End"]:
-                workflow_execution["CurrentStage"] = "End"
-                workflow_execution["Status"] = workflow_execution["Workflow"]["Stages"][current_stage]["Status"]
-
-            # Save the new stage
-            execution_table.update_item(
-                Key={
-                    'Id': workflow_execution["Id"]
-                },
-                UpdateExpression='SET CurrentStage = :current_stage',
-                ExpressionAttributeValues={
-                    ATT_VALUE_CURRENT_STAGE: "End"
-                }
-            )
-
-            update_workflow_execution_status(workflow_execution["Id"], workflow_execution["Status"], message)
-
-        elif workflow_execution["Workflow"]["Stages"][current_stage]["Status"] == "Error":
-            workflow_execution["Status"] = workflow_execution["Workflow"]["Stages"][current_stage]["Status"]
-
-            # Save the new stage and workflow status
-            execution_table.update_item(
-                Key={
-                    'Id': workflow_execution["Id"]
-                },
-                UpdateExpression='SET CurrentStage = :current_stage',
-                ExpressionAttributeValues={
-                    ATT_VALUE_CURRENT_STAGE: "End"
-                }
-            )
 
-            update_workflow_execution_status(workflow_execution["Id"], workflow_execution["Status"], message)
-
-        elif "Next" in workflow_execution["Workflow"]["Stages"][current_stage]:
-            current_stage = workflow_execution["CurrentStage"] = workflow_execution[
-                "Workflow"]["Stages"][current_stage]["Next"]
-
-            workflow_execution["Workflow"]["Stages"][current_stage]["Input"] = workflow_execution["Globals"]
-            workflow_execution["Workflow"]["Stages"][current_stage]["Status"] = awsmie.STAGE_STATUS_STARTED
-
-            try:
-                logger.info(
-                    "Updating workflow with new current stage")
-                logger.info(json.dumps(workflow_execution))
-
-                workitem = {
-                    "WorkflowExecutionId": workflow_execution["Id"],
-                    "stage": workflow_execution["Workflow"]["Stages"][current_stage]
-                }
-
-                # IMPORTANT: update the workflow_execution before queueing the work item...the
-                # queued workitem must match the current stage when we start stage execution.
-                # execution_table.put_item(Item=workflow_execution)
-                execution_table.update_item(
-                    Key={
-                        'Id': workflow_execution["Id"]
-                    },
-                    UpdateExpression='SET Workflow.Stages.#stage = :stage, CurrentStage = :current_stage',
-                    ExpressionAttributeNames={
-                        '#stage': current_stage,
-                    },
-                    ExpressionAttributeValues={
-                        ':stage': workflow_execution["Workflow"]["Stages"][current_stage],
-                        ATT_VALUE_CURRENT_STAGE: current_stage
-
-
-                    }
-                )
-
-                update_workflow_execution_status(workflow_execution["Id"], workflow_execution["Status"], message)
-                logger.info(json.dumps(workitem))
-
-            except Exception as e:
-                message = "Exception queuing work item: {} ".format(e)
-
-                workflow_execution["Status"] = awsmie.WORKFLOW_STATUS_ERROR
-
-                logger.info(message)
-
-                update_workflow_execution_status(workflow_execution["Id"], workflow_execution["Status"], message)
-
-                # raise ChaliceViewError(
-                raise ValueError(message)
-
-    except Exception as e:
-        workflow_execution["Status"] = awsmie.WORKFLOW_STATUS_ERROR
-        message = "Exception {}".format(e)
-        logger.info(message)
-        update_workflow_execution_status(workflow_execution["Id"], workflow_execution["Status"], message)
-        # raise ChaliceViewError(
-        raise ValueError(
-            "Exception: '%s'" % e)
-
-    log_workflow_execution(workflow_execution)
-    return workflow_execution
-
-
-def update_workflow_execution_status(id, status, message):
+def update_workflow_execution_status(id, status, message, current_stage=None):
     """
     Get the workflow execution by id from dyanamo and assign to this object
     :param id: The id of the workflow execution
     :param status: The new status of the workflow execution
+    :param current_stage: Optional stage to move the workflow execution to in the same write, e.g. "End"
 
     """
     logger.info("Update workflow execution {} set status = {}".format(id, status)) #nosec
     execution_table = DYNAMO_CLIENT.Table(WORKFLOW_EXECUTION_TABLE_NAME)
 
+    update_expression = 'SET {} = {}'.format(ATT_NAME_WORKFLOW_STATUS, ATT_VALUE_WORKFLOW_STATUS)
+    attribute_values = {
+        ATT_VALUE_WORKFLOW_STATUS: status
+    }
     if status == awsmie.WORKFLOW_STATUS_ERROR:
-        execution_table.update_item(
-            Key={
-                'Id': id
-            },
-            UpdateExpression='SET {} = {}, Message = :message'.format(
-                ATT_NAME_WORKFLOW_STATUS, ATT_VALUE_WORKFLOW_STATUS),
-            ExpressionAttributeNames={
-                ATT_NAME_WORKFLOW_STATUS: "Status"
-            },
-            ExpressionAttributeValues={
-                ATT_VALUE_WORKFLOW_STATUS: status,
-                ':message': message
+        update_expression += ', Message = :message'
+        attribute_values[':message'] = message
+    if current_stage is not None:
+        update_expression += ', CurrentStage = {}'.format(ATT_VALUE_CURRENT_STAGE)
+        attribute_values[ATT_VALUE_CURRENT_STAGE] = current_stage
+
+    response = execution_table.update_item(
+        Key={
+            'Id': id
+        },
+        UpdateExpression=update_expression,
+        ExpressionAttributeNames={
+            ATT_NAME_WORKFLOW_STATUS: "Status"
+        },
+        ExpressionAttributeValues=attribute_values,
+        ReturnValues='UPDATED_OLD'
+    )
+    workflow_status_changed(response.get("Attributes", {}).get("Status"), status)
 
-            }
-        )
-    else:
-        execution_table.update_item(
-            Key={
-                'Id': id
-            },
-            UpdateExpression='SET {} = {}'.format(
-                ATT_NAME_WORKFLOW_STATUS, ATT_VALUE_WORKFLOW_STATUS),
-            ExpressionAttributeNames={
-                ATT_NAME_WORKFLOW_STATUS: "Status"
-            },
-            ExpressionAttributeValues={
-                ATT_VALUE_WORKFLOW_STATUS: status
-            }
-        )
+
+def workflow_status_changed(old_status, status):
+    """
+    Give back the running workflow slot and trigger the workflow scheduler after a workflow status write
+
+    :param old_status: The workflow status before the write
+    :param status: The workflow status written
+    """
+    # Only the update that moves the workflow out of Started sees the old Started status, so the slot
+    # is given back exactly once
+    if old_status == awsmie.WORKFLOW_STATUS_STARTED and status != awsmie.WORKFLOW_STATUS_STARTED:
+        release_workflow_slot(DYNAMO_CLIENT.Table(SYSTEM_TABLE_NAME))
 
     if status in [awsmie.WORKFLOW_STATUS_QUEUED, awsmie.WORKFLOW_STATUS_COMPLETE, awsmie.WORKFLOW_STATUS_ERROR]:
         # Trigger the workflow_scheduler
-        LAMBDA_CLIENT.invoke(
-            FunctionName=WORKFLOW_SCHEDULER_LAMBDA_ARN,
-            InvocationType='Event'
-        )
+        trigger_workflow_scheduler(DYNAMO_CLIENT.Table(SYSTEM_TABLE_NAME), LAMBDA_CLIENT, WORKFLOW_SCHEDULER_LAMBDA_ARN)
 
 # Find all of the execution error events for a state machine execution
 def get_execution_errors(arn):
@@ -712,6 +941,9 @@ def workflow_error_handler_lambda(event, _context):
         if workflow["StateMachineExecutionArn"] == event["detail"]["executionArn"]:
             update_workflow_execution_status(workflow["Id"], awsmie.WORKFLOW_STATUS_ERROR, message)
 
+    # A halted execution can not release the operation concurrency tokens it holds
+    reclaim_operation_leases(DYNAMO_CLIENT.Table(SYSTEM_TABLE_NAME), lambda execution_arn: execution_arn == state_machine_execution)
+
     response = {
       "stateMachineExecution": state_machine_execution,
       "errorMessage": message
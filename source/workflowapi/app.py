@@ -4,25 +4,28 @@
 from chalice import Chalice
 from chalice import IAMAuthorizer
 from chalice import NotFoundError, BadRequestError, ChaliceViewError, ConflictError
-import boto3
 from boto3 import resource
 from botocore.client import ClientError
-from boto3.dynamodb.conditions import Attr
 from aws_xray_sdk.core import xray_recorder
 from aws_xray_sdk.core import patch_all
 
 import uuid
+import base64
+import hashlib
+import re
 import logging
+import time
 import os
 from datetime import datetime
-from operator import itemgetter
-from botocore import config
 import json
 import decimal
 from jsonschema import validate, ValidationError
 from urllib.request import build_opener, HTTPHandler, Request
 from MediaInsightsEngineLambdaHelper import DataPlane
 from MediaInsightsEngineLambdaHelper import Status as awsmie
+from MediaInsightsEngineLambdaHelper.clients import get_client, get_resource
+from MediaInsightsEngineLambdaHelper.scheduling import OPERATION_CONCURRENCY_PREFIX, OPERATION_LEASES, \
+    release_workflow_slot, trigger_workflow_scheduler
 
 APP_NAME = "workflowapi"
 API_STAGE = "dev"
@@ -36,6 +39,30 @@ S_STATUS = "$.Status"
 ATT_NAME_WORKFLOW_NAME = '#workflow_name'
 ATT_NAME_WORKFLOW_STATUS = '#workflow_status'
 ATT_VALUE_WORKFLOW_STATUS = ':workflow_status'
+# Operation metadata keys holding the id of a service job that announces its completion with an EventBridge
+# event.  Async operations reporting one of these wait for the event instead of polling, see create_operation_asl
+CALLBACK_JOB_ID_KEYS = ('TranscribeJobId', 'MediaconvertJobId')
+# How long an operation waits for the completion event before it checks the job status itself
+CALLBACK_SAFETY_NET_SECONDS = 300
+# How often async operations without a completion event check their job status, see poll_schedule.  Can be
+# overridden with the PollPolicy of an operation.
+DEFAULT_POLL_POLICY = {
+    "InitialSeconds": 10,
+    "Multiplier": 2,
+    "MaxSeconds": 480
+}
+# Workflow execution listings, see list_workflow_executions
+EXECUTION_PAGE_DEFAULT_LIMIT = 100
+EXECUTION_PAGE_MAX_LIMIT = 1000
+EXECUTION_FIELD_PATTERN = re.compile(r'^[A-Za-z0-9_]+(\.[A-Za-z0-9_]+)*$')
+EXECUTION_SUMMARY_PROJECTION = "Id, AssetId, CurrentStage, Created, StateMachineExecutionArn, {}, Workflow.{}".format(
+    ATT_NAME_WORKFLOW_STATUS, ATT_NAME_WORKFLOW_NAME)
+# Key prefixes of the workflow dependency index, which lists the workflows built from each operation and stage
+DEPENDENCY_OPERATION_PREFIX = 'Operation:'
+DEPENDENCY_STAGE_PREFIX = 'Stage:'
+# System table item marking the dependency index as complete, see ensure_workflow_dependency_index
+WORKFLOW_DEPENDENCY_INDEX_MARKER = 'WorkflowDependencyIndex'
+WORKFLOW_DEPENDENCY_INDEX_READY = False
 CREATE = 'CREATE!'
 UPDATE = 'UPDATE!'
 DELETE = 'DELETE!'
@@ -74,35 +101,42 @@ STAGE_TABLE_NAME = os.environ["STAGE_TABLE_NAME"]
 OPERATION_TABLE_NAME = os.environ["OPERATION_TABLE_NAME"]
 WORKFLOW_EXECUTION_TABLE_NAME = os.environ["WORKFLOW_EXECUTION_TABLE_NAME"]
 HISTORY_TABLE_NAME = os.environ["HISTORY_TABLE_NAME"]
+WORKFLOW_DEPENDENCY_TABLE_NAME = os.environ["WORKFLOW_DEPENDENCY_TABLE_NAME"]
 STAGE_EXECUTION_QUEUE_URL = os.environ["STAGE_EXECUTION_QUEUE_URL"]
+# One queue per workflow execution Priority, see workflow_scheduler_lambda
+EXECUTION_QUEUES = {
+    priority: queue_url for priority, queue_url in (
+        (awsmie.WORKFLOW_PRIORITY_HIGH, os.environ.get("HIGH_PRIORITY_EXECUTION_QUEUE_URL")),
+        (awsmie.WORKFLOW_PRIORITY_NORMAL, STAGE_EXECUTION_QUEUE_URL),
+        (awsmie.WORKFLOW_PRIORITY_LOW, os.environ.get("LOW_PRIORITY_EXECUTION_QUEUE_URL"))
+    ) if queue_url
+}
 STAGE_EXECUTION_ROLE = os.environ["STAGE_EXECUTION_ROLE"]
 STEP_FUNCTION_LOG_GROUP_ARN = os.environ["STEP_FUNCTION_LOG_GROUP_ARN"]
 # TODO testing NoQ execution
 COMPLETE_STAGE_LAMBDA_ARN = os.environ["COMPLETE_STAGE_LAMBDA_ARN"]
 FILTER_OPERATION_LAMBDA_ARN = os.environ["FILTER_OPERATION_LAMBDA_ARN"]
 OPERATOR_FAILED_LAMBDA_ARN = os.environ["OPERATOR_FAILED_LAMBDA_ARN"]
+REGISTER_OPERATION_CALLBACK_LAMBDA_ARN = os.environ["REGISTER_OPERATION_CALLBACK_LAMBDA_ARN"]
 WORKFLOW_SCHEDULER_LAMBDA_ARN = os.environ["WORKFLOW_SCHEDULER_LAMBDA_ARN"]
 
-mie_config = json.loads(os.environ['botoConfig'])
-config = config.Config(**mie_config)
-
 # DynamoDB
-DYNAMO_CLIENT = boto3.client("dynamodb", config=config)
-DYNAMO_RESOURCE = boto3.resource("dynamodb", config=config)
+DYNAMO_CLIENT = get_client("dynamodb")
+DYNAMO_RESOURCE = get_resource("dynamodb")
 
 # Step Functions
-SFN_CLIENT = boto3.client('stepfunctions', config=config)
+SFN_CLIENT = get_client('stepfunctions')
 
 # Simple Queue Service
-SQS_RESOURCE = boto3.resource('sqs', config=config)
-SQS_CLIENT = boto3.client('sqs', config=config)
+SQS_RESOURCE = get_resource('sqs')
+SQS_CLIENT = get_client('sqs')
 
 # IAM resource
-IAM_CLIENT = boto3.client('iam', config=config)
-IAM_RESOURCE = boto3.resource('iam', config=config)
+IAM_CLIENT = get_client('iam')
+IAM_RESOURCE = get_resource('iam')
 
 # Lambda
-LAMBDA_CLIENT = boto3.client("lambda", config=config)
+LAMBDA_CLIENT = get_client("lambda")
 
 # Transcribe
 TRANSCRIBE_CLIENT = None
@@ -151,6 +185,76 @@ def format_exception(error):
     return "Exception '%s'" % error
 
 
+# DynamoDB accepts at most 100 keys per batch_get_item request
+BATCH_GET_MAX_KEYS = 100
+# Number of times keys left unprocessed by a batch_get_item request are retried before giving up
+BATCH_GET_MAX_RETRIES = 8
+
+
+def batch_get_by_name(table_name, names, consistent_read=False):
+    """
+    Read the items with the given names from one of the tables keyed on Name.
+
+    :param table_name: The operation, stage or workflow table
+    :param names: The names to read, duplicates are read once
+    :param consistent_read: Use strongly consistent reads
+
+    :return: Dict of name to item for the names that exist
+    :raises ChaliceViewError: If some of the keys are still unprocessed after BATCH_GET_MAX_RETRIES retries
+    """
+    names = list(dict.fromkeys(names))
+    items = {}
+    for start in range(0, len(names), BATCH_GET_MAX_KEYS):
+        request_items = {
+            table_name: {
+                'Keys': [{'Name': name} for name in names[start:start + BATCH_GET_MAX_KEYS]]
+            }
+        }
+        if consistent_read:
+            request_items[table_name]['ConsistentRead'] = True
+        attempt = 0
+        while request_items:
+            response = DYNAMO_RESOURCE.batch_get_item(RequestItems=request_items)
+            for item in response["Responses"].get(table_name, []):
+                items[item["Name"]] = item
+            # Keys DynamoDB could not read within the request limits are retried with a short backoff
+            request_items = response.get("UnprocessedKeys")
+            if request_items:
+                if attempt == BATCH_GET_MAX_RETRIES:
+                    raise ChaliceViewError("Exception: {} keys of table {} could not be read after {} retries".format(
+                        len(request_items[table_name]["Keys"]), table_name, BATCH_GET_MAX_RETRIES))
+                time.sleep(min(1, 0.05 * 2 ** attempt))
+                attempt += 1
+    return items
+
+
+# Compiled stage and workflow state machines.  Operations and stages are never changed in place, a new
+# definition always gets a new Id, so the compiled ASL for a set of definitions is kept for the life of the
+# function instance.
+COMPILED_ASL_CACHE = {}
+COMPILED_ASL_CACHE_SIZE = 256
+
+
+def get_compiled_asl(source, compile_asl):
+    """
+    Return the compiled ASL for a set of definitions, compiling it on a cache miss.
+
+    :param source: The definitions the ASL is compiled from, e.g. the Name, Id, Version and ASL of every
+        operation in a stage.  The cache is keyed on a digest of this value.
+    :param compile_asl: Function building the ASL from the definitions
+
+    :return: The compiled ASL, callers must not modify it
+    """
+    key = hashlib.sha256(json.dumps(source).encode('utf-8')).hexdigest()
+    if key not in COMPILED_ASL_CACHE:
+        if len(COMPILED_ASL_CACHE) >= COMPILED_ASL_CACHE_SIZE:
+            COMPILED_ASL_CACHE.clear()
+        COMPILED_ASL_CACHE[key] = compile_asl()
+    else:
+        logger.info("Using cached state machine {}".format(key))
+    return COMPILED_ASL_CACHE[key]
+
+
 SCHEMA = load_apischema()
 
 
@@ -223,6 +327,22 @@ def create_system_configuration_api():
             This setting is checked each time the WorkflowSchedulerLambda is run and may
             take up to 60 seconds to take effect.
 
+        MaxConcurrentOperations:<OperationName>
+
+            Sets the maximum number of instances of one operation that are allowed to run
+            concurrently across all workflows, e.g. "MaxConcurrentOperations:TranscribeVideo".
+            An operation that finds its budget used up waits with an exponential backoff
+            until a running instance of the same operation completes or fails.  Use this to
+            stay under the quota of the service an operator calls.  The token of a workflow
+            that is stopped, times out or aborts is reclaimed by the workflow error handler,
+            or at the latest by the next scheduled run of the workflow scheduler.
+
+            The budget is checked each time an operation starts and takes effect
+            immediately for operations created since budgets were supported.  Operations
+            created by an earlier release have no token states in their state machine and are
+            not limited until they are deleted and created again, together with the stages and
+            workflows that use them.  Operations without a budget are not limited.
+
     Returns:
         None
 
@@ -244,7 +364,28 @@ def create_system_configuration_api():
             if config["Value"] < 1:
                 raise BadRequestError("MaxConcurrentWorkflows must be a value > 1")
 
-        system_table.put_item(Item=config)
+        if config["Name"].startswith(OPERATION_CONCURRENCY_PREFIX):
+            if not config["Name"][len(OPERATION_CONCURRENCY_PREFIX):]:
+                raise BadRequestError("{} must be followed by an operation name".format(OPERATION_CONCURRENCY_PREFIX))
+            if not isinstance(config["Value"], int) or config["Value"] < 1:
+                raise BadRequestError("{} must be an integer value > 0".format(config["Name"]))
+            # Only the budget is replaced, the leases held by running operations are kept
+            system_table.update_item(
+                Key={
+                    'Name': config["Name"]
+                },
+                UpdateExpression='SET #value = :value, #leases = if_not_exists(#leases, :no_leases)',
+                ExpressionAttributeNames={
+                    '#value': 'Value',
+                    '#leases': OPERATION_LEASES
+                },
+                ExpressionAttributeValues={
+                    ':value': config["Value"],
+                    ':no_leases': {}
+                }
+            )
+        else:
+            system_table.put_item(Item=config)
     except Exception as e:
         log_exception(e)
         raise ChaliceViewError(format_exception(e))
@@ -330,9 +471,18 @@ def create_operation_api():
                     ...
                 }
             "StartLambdaArn":arn,
-            "MonitorLambdaArn":arn
+            "MonitorLambdaArn":arn,
+            "PollPolicy": {
+                "InitialSeconds": 10,
+                "Multiplier": 2,
+                "MaxSeconds": 480
+                }
             }
 
+    PollPolicy is optional and only used by Async operators.  The status of the operation is
+    checked after InitialSeconds, then the wait between checks grows by Multiplier up to
+    MaxSeconds.  Missing keys take the values above.
+
     Returns:
         A dict mapping keys to the corresponding operation.
 
@@ -403,7 +553,16 @@ def create_operation(operation):
 
         # Build the operation state machine.
 
-        operation_asl = ASYNC_OPERATION_ASL if operation["Type"] == "Async" else SYNC_OPERATION_ASL
+        if operation["Type"] == "Async":
+            if "PollPolicy" in operation:
+                poll_policy = {**DEFAULT_POLL_POLICY, **operation["PollPolicy"]}
+                operation_asl = create_operation_asl(True, poll_policy)
+                # DynamoDB does not take floats
+                operation["PollPolicy"] = json.loads(json.dumps(poll_policy), parse_float=decimal.Decimal)
+            else:
+                operation_asl = ASYNC_OPERATION_ASL
+        else:
+            operation_asl = SYNC_OPERATION_ASL
 
         # Setup task parameters in step function.  This filters out the paramters from
         # the stage data structure that belong to this specific operation and passes the
@@ -505,7 +664,24 @@ def create_operation(operation):
     return operation
 
 
-def create_operation_asl(is_async):
+def poll_schedule(poll_policy):
+    """ Lists the waits, in seconds, between the status checks of an async operation.
+
+    The last wait repeats until the operation completes.
+    """
+    seconds = poll_policy["InitialSeconds"]
+    if poll_policy["Multiplier"] <= 1:
+        return [seconds]
+
+    schedule = []
+    while seconds < poll_policy["MaxSeconds"]:
+        schedule.append(int(round(seconds)))
+        seconds *= poll_policy["Multiplier"]
+    schedule.append(poll_policy["MaxSeconds"])
+    return schedule
+
+
+def create_operation_asl(is_async, poll_policy=DEFAULT_POLL_POLICY):
     """ Creates a template structure defining a state machine for an operation.
 
     The template contains placeholders for %%OPERATION_NAME%% and %%STAGE_NAME%%.
@@ -518,11 +694,19 @@ def create_operation_asl(is_async):
     # Name the states of the state machine
     state_filter = "Filter %%OPERATION_NAME%% Media Type? (%%STAGE_NAME%%)"
     state_skip = "Skip %%OPERATION_NAME%%? (%%STAGE_NAME%%)"
+    state_acquire_token = "Acquire %%OPERATION_NAME%% Token (%%STAGE_NAME%%)"
     state_no_start = "%%OPERATION_NAME%% Not Started (%%STAGE_NAME%%)"
     state_execute = "Execute %%OPERATION_NAME%% (%%STAGE_NAME%%)"
+    state_async_has_callback = "Can %%OPERATION_NAME%% Call Back? (%%STAGE_NAME%%)"
+    state_async_callback = "Wait For %%OPERATION_NAME%% Callback (%%STAGE_NAME%%)"
+    state_async_backoff = "Back Off %%OPERATION_NAME%% Polling? (%%STAGE_NAME%%)"
+    state_async_next_poll = "Schedule Next %%OPERATION_NAME%% Status Check (%%STAGE_NAME%%)"
     state_async_wait = "%%OPERATION_NAME%% Wait (%%STAGE_NAME%%)"
     state_async_status = "Get %%OPERATION_NAME%% Status (%%STAGE_NAME%%)"
     state_check_complete = "Did %%OPERATION_NAME%% Complete (%%STAGE_NAME%%)"
+    state_holds_token = "Does %%OPERATION_NAME%% Hold A Token? (%%STAGE_NAME%%)"
+    state_release_token_failed = "Release %%OPERATION_NAME%% Token After Failure (%%STAGE_NAME%%)"
+    state_release_token_succeeded = "Release %%OPERATION_NAME%% Token (%%STAGE_NAME%%)"
     state_failed = "%%OPERATION_NAME%% Failed (%%STAGE_NAME%%)"
     state_succeeded = "%%OPERATION_NAME%% Succeeded (%%STAGE_NAME%%)"
 
@@ -548,6 +732,63 @@ def create_operation_asl(is_async):
         "ResultPath": S_OUTPUTS
     }]
 
+    # Once the operation may hold a concurrency token, failures have to give it back first
+    catch_release_token = [{
+        "ErrorEquals": ["States.ALL"],
+        "Next": state_holds_token,
+        "ResultPath": S_OUTPUTS
+    }]
+
+    # Operation concurrency tokens are leases on the system table item holding the budget of the
+    # operation, see create_system_configuration_api.  Each lease is keyed by the arn of the state
+    # machine execution, so the workflow error handler and the scheduler can reclaim the leases of
+    # executions that were stopped, timed out or aborted before they could release them.  The DynamoDB
+    # service integration takes and releases the lease directly from the state machine.
+    token_key = {
+        "Name": {"S": OPERATION_CONCURRENCY_PREFIX + "%%OPERATION_NAME%%"}
+    }
+    token_attribute_names = {
+        "#leases": OPERATION_LEASES,
+        "#lease.$": "$$.Execution.Id"
+    }
+
+    token_throttle_retry = [{
+        "ErrorEquals": [
+            "DynamoDB.ProvisionedThroughputExceededException",
+            "DynamoDB.RequestLimitExceeded",
+            "DynamoDB.InternalServerErrorException"
+        ],
+        "IntervalSeconds": 2,
+        "MaxAttempts": 5,
+        "BackoffRate": 2
+    }]
+    # Taking a token only retries throttling, the other errors of the update mean the budget is gone
+    token_retry = [dict(token_throttle_retry[0],
+                        ErrorEquals=token_throttle_retry[0]["ErrorEquals"] + ["DynamoDB.AmazonDynamoDBException"])]
+
+    # Removing the lease can not take more than the one token the execution holds, even when it is repeated.
+    # A lease that is already gone, e.g. because the budget was removed, has nothing left to release.
+    def release_token(next_state):
+        return {
+            "Type": "Task",
+            "Resource": "arn:aws:states:::dynamodb:updateItem",
+            "Parameters": {
+                "TableName": SYSTEM_TABLE_NAME,
+                "Key": token_key,
+                "UpdateExpression": "REMOVE #leases.#lease",
+                "ConditionExpression": "attribute_exists(#leases.#lease)",
+                "ExpressionAttributeNames": token_attribute_names
+            },
+            "ResultPath": None,
+            "Next": next_state,
+            "Retry": token_retry,
+            "Catch": [{
+                "ErrorEquals": ["DynamoDB.ConditionalCheckFailedException"],
+                "Next": next_state,
+                "ResultPath": None
+            }]
+        }
+
     # Build the states
     states = {
         state_filter: {
@@ -565,43 +806,96 @@ def create_operation_asl(is_async):
             "Resource": FILTER_OPERATION_LAMBDA_ARN,
             "ResultPath": S_OUTPUTS,
             "OutputPath": S_OUTPUTS,
+            "Assign": {"tokenHeld": False},
             "Next": state_skip,
             "Retry": retry,
             "Catch": catch
 
         },
+        # Only operations with a concurrency budget take a token, the filter lambda looks the budget up
         state_skip: {
             "Type": "Choice",
-            "Choices": [{
-                "Variable": S_STATUS,
-                "StringEquals": awsmie.OPERATION_STATUS_STARTED,
-                "Next": state_execute
-            }],
+            "Choices": [
+                {
+                    "And": [
+                        {"Variable": S_STATUS, "StringEquals": awsmie.OPERATION_STATUS_STARTED},
+                        {"Variable": "$.ConcurrencyLimited", "BooleanEquals": True}
+                    ],
+                    "Next": state_acquire_token
+                },
+                {
+                    "Variable": S_STATUS,
+                    "StringEquals": awsmie.OPERATION_STATUS_STARTED,
+                    "Next": state_execute
+                }
+            ],
             "Default": state_no_start
         },
         state_no_start: {
             "Type": "Succeed"
         },
+        # Take a token when the operation has a budget left.  Without a token the condition check fails
+        # and the state is retried with a capped, jittered exponential backoff until a running instance of
+        # the operation releases its token.  An execution that already holds the lease, e.g. when a write
+        # is retried after a timeout, keeps it.  When the budget item or its leases are removed while the
+        # operation waits, the condition passes and the update of the missing lease map is rejected, so
+        # the operation fails right away instead of waiting out the retries.
+        state_acquire_token: {
+            "Type": "Task",
+            "Resource": "arn:aws:states:::dynamodb:updateItem",
+            "Parameters": {
+                "TableName": SYSTEM_TABLE_NAME,
+                "Key": token_key,
+                "UpdateExpression": "SET #leases.#lease = :acquired",
+                "ConditionExpression": "attribute_not_exists(#value) OR attribute_not_exists(#leases) OR "
+                                       "attribute_exists(#leases.#lease) OR size(#leases) < #value",
+                "ExpressionAttributeNames": dict(token_attribute_names, **{"#value": "Value"}),
+                "ExpressionAttributeValues": {":acquired": {"S.$": "$$.State.EnteredTime"}}
+            },
+            "ResultPath": None,
+            "Assign": {"tokenHeld": True},
+            "Next": state_execute,
+            "Retry": [{
+                "ErrorEquals": ["DynamoDB.ConditionalCheckFailedException"],
+                "IntervalSeconds": 5,
+                "MaxAttempts": 100,
+                "BackoffRate": 2,
+                "MaxDelaySeconds": 300,
+                "JitterStrategy": "FULL"
+            }] + token_throttle_retry,
+            "Catch": catch
+        },
         state_execute: {
             "Type": "Task",
             "Resource": "%%OPERATION_START_LAMBDA%%",
             "ResultPath": S_OUTPUTS,
             "OutputPath": S_OUTPUTS,
             # Next state depends on whether this is async or not.
-            "Next": state_async_wait if is_async else state_check_complete,
+            "Next": state_async_has_callback if is_async else state_check_complete,
             "Retry": retry,
-            "Catch": catch
+            "Catch": catch_release_token
         }
     }
 
-    # There are two possible choices in completion check state but the first one
-    # is only relevant if it is async. Default first choice is the second index.
+    if is_async:
+        # Restart the poll schedule, see state_async_backoff
+        states[state_execute]["Assign"] = {"pollIndex": 0}
+
+    # The first of the choices in the completion check state is only relevant
+    # if it is async. Default first choice is the second index.
     first_choice = 1
     choices = [
         {
             "Variable": S_STATUS,
             "StringEquals": "Executing",
-            "Next": state_async_wait
+            "Next": state_async_has_callback
+        },
+        {
+            "And": [
+                {"Variable": S_STATUS, "StringEquals": "Complete"},
+                {"Variable": "$tokenHeld", "BooleanEquals": True}
+            ],
+            "Next": state_release_token_succeeded
         },
         {
             "Variable": S_STATUS,
@@ -613,12 +907,79 @@ def create_operation_asl(is_async):
     # In async mode, we have to insert a wait state and a status check.
     if is_async:
         # Set the first choice index to 0, the first index in the array so we get
-        # both choices in the completion check state.
+        # all the choices in the completion check state.
         first_choice = 0
 
+        # Jobs that announce their completion park the operation until the event arrives.  Everything
+        # else polls the job status with a growing wait between the checks.
+        states[state_async_has_callback] = {
+            "Type": "Choice",
+            "Choices": [{
+                "Or": [{"Variable": "$.MetaData." + key, "IsPresent": True} for key in CALLBACK_JOB_ID_KEYS],
+                "Next": state_async_callback
+            }],
+            "Default": state_async_backoff
+        }
+
+        # The position in the poll schedule is kept in state machine variables, so it survives the monitor
+        # lambda replacing the state with its output.  Past the end of the schedule the last wait repeats.
+        schedule = poll_schedule(poll_policy)
+
+        states[state_async_backoff] = {
+            "Type": "Choice",
+            "Choices": [{
+                "Variable": "$pollIndex",
+                "NumericLessThan": len(schedule),
+                "Next": state_async_next_poll
+            }],
+            "Default": state_async_wait
+        }
+
+        states[state_async_next_poll] = {
+            "Type": "Pass",
+            "Assign": {
+                "pollSeconds.$": "States.ArrayGetItem(States.Array({}), $pollIndex)".format(
+                    ", ".join(str(seconds) for seconds in schedule)),
+                "pollIndex.$": "States.MathAdd($pollIndex, 1)"
+            },
+            "Next": state_async_wait
+        }
+
+        # The register lambda stores the task token under the job id and the completion event hands it
+        # back with SendTaskSuccess.  When no event arrives in time the job status is checked anyway, so a
+        # lost event only slows the operation down.  When the token can not be registered at all the
+        # operation falls back to polling the job status.
+        states[state_async_callback] = {
+            "Type": "Task",
+            "Resource": "arn:aws:states:::lambda:invoke.waitForTaskToken",
+            "Parameters": {
+                "FunctionName": REGISTER_OPERATION_CALLBACK_LAMBDA_ARN,
+                "Payload": {
+                    "TaskToken.$": "$$.Task.Token",
+                    "Operation.$": "$"
+                }
+            },
+            "ResultPath": None,
+            "TimeoutSeconds": CALLBACK_SAFETY_NET_SECONDS,
+            "Next": state_async_status,
+            "Retry": retry,
+            "Catch": [
+                {
+                    "ErrorEquals": ["States.Timeout"],
+                    "Next": state_async_status,
+                    "ResultPath": "$.CallbackTimeout"
+                },
+                {
+                    "ErrorEquals": ["States.ALL"],
+                    "Next": state_async_backoff,
+                    "ResultPath": "$.CallbackError"
+                }
+            ]
+        }
+
         states[state_async_wait] = {
             "Type": "Wait",
-            "Seconds": 10,
+            "SecondsPath": "$pollSeconds",
             "Next": state_async_status
         }
 
@@ -627,16 +988,30 @@ def create_operation_asl(is_async):
             "Resource": "%%OPERATION_MONITOR_LAMBDA%%",
             "Next": state_check_complete,
             "Retry": retry,
-            "Catch": catch
+            "Catch": catch_release_token
         }
 
     # Add the rest of the states needed by both sync and async mode.
     states[state_check_complete] = {
         "Type": "Choice",
-        "Choices": choices[first_choice:2],
+        "Choices": choices[first_choice:],
+        "Default": state_holds_token
+    }
+
+    states[state_holds_token] = {
+        "Type": "Choice",
+        "Choices": [{
+            "Variable": "$tokenHeld",
+            "BooleanEquals": True,
+            "Next": state_release_token_failed
+        }],
         "Default": state_failed
     }
 
+    states[state_release_token_failed] = release_token(state_failed)
+
+    states[state_release_token_succeeded] = release_token(state_succeeded)
+
     states[state_failed] = {
         "Type": "Task",
         "End": True,
@@ -955,62 +1330,27 @@ def create_stage(stage):
             raise ConflictError(
                 "A stage with the name '%s' already exists" % name)
 
-        # Build the stage state machine.  The stage machine consists of a parallel state with
-        # branches for each operator and a call to the stage completion lambda at the end.
-        # The parallel state takes a stage object as input.  Each
-        # operator returns and operatorOutput object. The outputs for each operator are
-        # returned from the parallel state as elements of the "outputs" array.
-        stage_asl = {
-            "StartAt": "Preprocess Media",
-            "States": {
-                "Complete Stage {}".format(name): {
-                    "Type": "Task",
-                    # TODO - testing NoQ workflows
-                    "Resource": COMPLETE_STAGE_LAMBDA_ARN,
-                    "End": True
-                }
-
-            }
-        }
-        complete_stage = "Complete Stage {}".format(name)
-        stage_asl["StartAt"] = name
-        stage_asl["States"][name] = {
-            "Type": "Parallel",
-            "Next": complete_stage,
-            "ResultPath": S_OUTPUTS,
-            "Branches": [
-            ],
-            "Catch": [
-                {
-                    "ErrorEquals": ["States.ALL"],
-                    "Next": complete_stage,
-                    "ResultPath": S_OUTPUTS
-                }
-            ]
-        }
-
-        # Add a branch to the stage state machine for each operation, build up default
-        # Configuration for the stage based on the operator Configuration
-
+        # Build up default Configuration for the stage based on the operator Configuration
+        operations = batch_get_by_name(OPERATION_TABLE_NAME, stage["Operations"])
         for op in stage["Operations"]:
-            # lookup base workflow
-            operation = get_operation_by_name(op)
-            logger.info(json.dumps(operation, cls=DecimalEncoder))
-
-            stage_asl["States"][name]["Branches"].append(
-                json.loads(operation["StateMachineAsl"]))
-            configuration[op] = operation["Configuration"]
-
-        stage_asl_string = json.dumps(stage_asl)
-        stage_asl_string = stage_asl_string.replace("%%STAGE_NAME%%", stage["Name"])
-        stage_asl = json.loads(stage_asl_string)
-        logger.info(json.dumps(stage_asl))
+            if op not in operations:
+                raise NotFoundError(
+                    "Exception: operation '%s' not found" % op)
+            configuration[op] = operations[op]["Configuration"]
+
+        stage_asl_source = ["stage", name, [
+            [op, operations[op].get("Id"), operations[op].get("Version"), operations[op]["StateMachineAsl"]]
+            for op in stage["Operations"]
+        ]]
+        stage_definition = get_compiled_asl(
+            stage_asl_source, lambda: compile_stage_asl(name, [operations[op] for op in stage["Operations"]]))
+        logger.info(stage_definition)
 
         stage["Configuration"] = configuration
 
         # Build stage
 
-        stage["Definition"] = json.dumps(stage_asl)
+        stage["Definition"] = stage_definition
         stage["Version"] = "v0"
         stage["Id"] = str(uuid.uuid4())
         stage["Created"] = str(datetime.now().timestamp())
@@ -1030,6 +1370,48 @@ def create_stage(stage):
     return stage
 
 
+def compile_stage_asl(name, operations):
+    """
+    Build the stage state machine.  The stage machine consists of a parallel state with
+    branches for each operator and a call to the stage completion lambda at the end.
+    The parallel state takes a stage object as input.  Each
+    operator returns and operatorOutput object. The outputs for each operator are
+    returned from the parallel state as elements of the "outputs" array.
+
+    :param name: The stage name
+    :param operations: The operation definitions, in branch order
+
+    :return: The stage state machine definition as a JSON string
+    """
+    complete_stage = "Complete Stage {}".format(name)
+    stage_asl = {
+        "StartAt": name,
+        "States": {
+            complete_stage: {
+                "Type": "Task",
+                # TODO - testing NoQ workflows
+                "Resource": COMPLETE_STAGE_LAMBDA_ARN,
+                "End": True
+            },
+            name: {
+                "Type": "Parallel",
+                "Next": complete_stage,
+                "ResultPath": S_OUTPUTS,
+                "Branches": [json.loads(operation["StateMachineAsl"]) for operation in operations],
+                "Catch": [
+                    {
+                        "ErrorEquals": ["States.ALL"],
+                        "Next": complete_stage,
+                        "ResultPath": S_OUTPUTS
+                    }
+                ]
+            }
+        }
+    }
+
+    return json.dumps(stage_asl).replace("%%STAGE_NAME%%", name)
+
+
 @app.route('/workflow/stage', cors=True, methods=['PUT'], authorizer=authorizer)
 def update_stage():
     """ Update a stage NOT IMPLEMENTED
@@ -1327,6 +1709,8 @@ def create_workflow(trigger, workflow):
                 ATT_NAME_WORKFLOW_NAME: "Name"
             })
 
+        index_workflow_dependencies(workflow["Name"], added=workflow_dependencies(workflow))
+
     except ClientError as e:
         # Ignore the ConditionalCheckFailedException, bubble up
         # other exceptions.
@@ -1367,24 +1751,39 @@ def build_workflow(workflow):
 
     logger.info("Get stage definitions")
 
+    stages = batch_get_by_name(STAGE_TABLE_NAME, workflow["Stages"].keys())
     for name, stage in workflow["Stages"].items():
-        s = get_stage_by_name(name)
-
-        logger.info(json.dumps(s))
-
-        s["stateMachineAsl"] = json.loads(s["Definition"])
-        stage.update(s)
+        if name not in stages:
+            raise NotFoundError(
+                "Exception: stage '%s' not found" % name)
+        stage.update(stages[name])
 
         # save the operators for this stage to the list of operators in the
         # workflow.  This list is maintained to make finding workflows that
         # use an operator easier later
         workflow["Operations"].extend(stage["Operations"])
 
-        logger.info(json.dumps(s))
+    workflow_asl_source = ["workflow", workflow["StartAt"], [
+        [name, stage.get("Id"), stage.get("Version"), stage.get("Next"), stage.get("End", False), stage["Definition"]]
+        for name, stage in workflow["Stages"].items()
+    ]]
+    workflow_asl = get_compiled_asl(workflow_asl_source, lambda: compile_workflow_asl(workflow))
+    workflow["WorkflowAsl"] = workflow_asl
+
+    return workflow
+
+
+def compile_workflow_asl(workflow):
+    """
+    Merge the state machines of the workflow stages into the workflow state machine.
+
+    :param workflow: A workflow with the stage definitions merged into its Stages
+    :return: The workflow state machine definition
+    """
+    stage_asl = {name: json.loads(stage["Definition"]) for name, stage in workflow["Stages"].items()}
 
     # Build the workflow state machine.
-    start_stage_asl = workflow["Stages"][workflow["StartAt"]]["stateMachineAsl"]
-    start_at = start_stage_asl["StartAt"]
+    start_at = stage_asl[workflow["StartAt"]]["StartAt"]
     logger.info(start_at)
 
     workflow_asl = {
@@ -1394,43 +1793,26 @@ def build_workflow(workflow):
     }
 
     logger.info("Merge stages into workflow state machine")
-    for workflow_stage in workflow["Stages"].values():
-        logger.info("LOOP OVER WORKFLOW STAGES")
-        logger.info(json.dumps(workflow_stage))
+    for name, workflow_stage in workflow["Stages"].items():
 
         # if this stage is not the end stage
         # - link the end of this stages ASL to the start of the next stages ASL
         if "Next" in workflow_stage:
-            next_workflow_stage = workflow["Stages"][workflow_stage["Next"]]
-
-            logger.info("NEXT STAGE")
-            logger.info(json.dumps(next_workflow_stage))
-
             # Find the End state for this stages ASL and link it to the start of
             # the next stage ASL
-            print(json.dumps(workflow_stage["stateMachineAsl"]["States"]))
-            end_state = [k for k, v in workflow_stage["stateMachineAsl"]["States"].items() if "End" in v][0]
+            end_state = [k for k, v in stage_asl[name]["States"].items() if "End" in v][0]
 
             logger.info("END STATE {}".format(end_state))
 
-            workflow_stage["stateMachineAsl"]["States"][end_state]["Next"] = next_workflow_stage["stateMachineAsl"][
-                "StartAt"]
+            stage_asl[name]["States"][end_state]["Next"] = stage_asl[workflow_stage["Next"]]["StartAt"]
 
             # Remove the end key from the end state
-            workflow_stage["stateMachineAsl"]["States"][end_state].pop("End")
-
-        workflow_asl["States"].update(workflow_stage["stateMachineAsl"]["States"])
-
-        # Remove ASL from the stage since we rolled it into the workflow and ASL in saved in the stage defintition
-        workflow_stage.pop("stateMachineAsl")
+            stage_asl[name]["States"][end_state].pop("End")
 
-        logger.info("IN LOOP WORKFLOW")
-        logger.info(json.dumps(workflow_asl))
+        workflow_asl["States"].update(stage_asl[name]["States"])
 
     logger.info(json.dumps(workflow_asl))
-    workflow["WorkflowAsl"] = workflow_asl
-
-    return workflow
+    return workflow_asl
 
 
 @app.route('/workflow', cors=True, methods=['PUT'], authorizer=authorizer)
@@ -1506,6 +1888,7 @@ def update_workflow(new_workflow):
         check_required_input("Name", new_workflow, "Workflow Definition")
 
         workflow = get_workflow_by_name(new_workflow["Name"])
+        old_dependencies = workflow_dependencies(workflow)
 
         workflow["Operations"] = []
         workflow["StaleOperations"] = []
@@ -1550,6 +1933,10 @@ def update_workflow(new_workflow):
             # }
         )
 
+        # Index entries are rewritten as a whole so workflows that predate the index are repaired on update
+        dependencies = workflow_dependencies(workflow)
+        index_workflow_dependencies(workflow["Name"], added=dependencies, removed=old_dependencies - dependencies)
+
     except ClientError as e:
         # Ignore the ConditionalCheckFailedException, bubble up
         # other exceptions.
@@ -1601,18 +1988,9 @@ def list_workflows_by_operator(operator_name):
         500: Internal server error
     """
 
-    table = DYNAMO_RESOURCE.Table(WORKFLOW_TABLE_NAME)
-
-    response = table.scan(
-        FilterExpression=Attr("Operations").contains(operator_name),
-        ConsistentRead=True
-    )
-    workflows = response['Items']
-    while 'LastEvaluatedKey' in response:
-        response = table.scan(ExclusiveStartKey=response['LastEvaluatedKey'])
-        workflows.extend(response['Items'])
-
-    return workflows
+    return list_dependent_workflows(
+        DEPENDENCY_OPERATION_PREFIX + operator_name,
+        lambda workflow: operator_name in workflow.get("Operations", []))
 
 
 @app.route('/workflow/list/stage/{stage_name}', cors=True, methods=['GET'], authorizer=authorizer)
@@ -1627,18 +2005,96 @@ def list_workflows_by_stage(stage_name):
         500: ChaliceViewError - internal server error
     """
 
-    table = DYNAMO_RESOURCE.Table(WORKFLOW_TABLE_NAME)
+    return list_dependent_workflows(
+        DEPENDENCY_STAGE_PREFIX + stage_name,
+        lambda workflow: stage_name in workflow.get("Stages", {}))
 
-    response = table.scan(
-        FilterExpression=Attr("Stages." + stage_name).exists(),
-        ConsistentRead=True
-    )
-    workflows = response['Items']
-    while 'LastEvaluatedKey' in response:
-        response = table.scan(ExclusiveStartKey=response['LastEvaluatedKey'])
-        workflows.extend(response['Items'])
 
-    return workflows
+def workflow_dependencies(workflow):
+    """
+    The dependency index keys of a workflow, one for each operation and stage it is built from.
+    """
+    dependencies = {DEPENDENCY_OPERATION_PREFIX + operation for operation in workflow.get("Operations", [])}
+    dependencies.update(DEPENDENCY_STAGE_PREFIX + stage for stage in workflow.get("Stages", {}))
+    return dependencies
+
+
+def index_workflow_dependencies(workflow_name, added=(), removed=()):
+    """
+    Add and remove entries of a workflow in the dependency index.
+
+    :param workflow_name: The workflow name
+    :param added: Dependency keys the workflow now uses, see workflow_dependencies
+    :param removed: Dependency keys the workflow no longer uses
+    """
+    table = DYNAMO_RESOURCE.Table(WORKFLOW_DEPENDENCY_TABLE_NAME)
+    with table.batch_writer() as batch:
+        for dependency in sorted(removed):
+            batch.delete_item(Key={'Dependency': dependency, 'WorkflowName': workflow_name})
+        for dependency in sorted(added):
+            batch.put_item(Item={'Dependency': dependency, 'WorkflowName': workflow_name})
+
+
+def ensure_workflow_dependency_index():
+    """
+    Index the workflows that were created before the dependency index existed.  This runs once per deployment,
+    a marker in the system table records that the index is complete.
+    """
+    global WORKFLOW_DEPENDENCY_INDEX_READY
+    if WORKFLOW_DEPENDENCY_INDEX_READY:
+        return
+
+    system_table = DYNAMO_RESOURCE.Table(SYSTEM_TABLE_NAME)
+    response = system_table.get_item(Key={'Name': WORKFLOW_DEPENDENCY_INDEX_MARKER}, ConsistentRead=True)
+    if "Item" not in response:
+        logger.info("Indexing the dependencies of existing workflows")
+        table = DYNAMO_RESOURCE.Table(WORKFLOW_TABLE_NAME)
+        scan_args = {
+            'ProjectionExpression': '#name, Operations, Stages',
+            'ExpressionAttributeNames': {'#name': 'Name'},
+            'ConsistentRead': True
+        }
+        while True:
+            response = table.scan(**scan_args)
+            for workflow in response['Items']:
+                index_workflow_dependencies(workflow["Name"], added=workflow_dependencies(workflow))
+            if 'LastEvaluatedKey' not in response:
+                break
+            scan_args['ExclusiveStartKey'] = response['LastEvaluatedKey']
+        system_table.put_item(Item={'Name': WORKFLOW_DEPENDENCY_INDEX_MARKER, 'Value': API_VERSION})
+
+    WORKFLOW_DEPENDENCY_INDEX_READY = True
+
+
+def list_dependent_workflows(dependency, uses_dependency):
+    """
+    Look up the workflows that use an operation or stage in the dependency index.
+
+    :param dependency: The dependency index key
+    :param uses_dependency: Predicate on a workflow definition.  Index entries are written after the workflow,
+        so the definitions that were read are checked against it to drop stale entries.
+
+    :return: A list of workflow definitions
+    """
+    ensure_workflow_dependency_index()
+
+    table = DYNAMO_RESOURCE.Table(WORKFLOW_DEPENDENCY_TABLE_NAME)
+    query_args = {
+        'KeyConditionExpression': 'Dependency = :dependency',
+        'ExpressionAttributeValues': {':dependency': dependency},
+        'ProjectionExpression': 'WorkflowName',
+        'ConsistentRead': True
+    }
+    names = []
+    while True:
+        response = table.query(**query_args)
+        names.extend(item["WorkflowName"] for item in response['Items'])
+        if 'LastEvaluatedKey' not in response:
+            break
+        query_args['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+    workflows = batch_get_by_name(WORKFLOW_TABLE_NAME, names, consistent_read=True)
+    return [workflows[name] for name in names if name in workflows and uses_dependency(workflows[name])]
 
 
 @app.route('/workflow/{name}', cors=True, methods=['GET'], authorizer=authorizer)
@@ -1743,6 +2199,8 @@ def delete_workflow(name):
                 Key={
                     'Name': name
                 })
+
+            index_workflow_dependencies(name, removed=workflow_dependencies(workflow))
         else:
             workflow["Message"] = "Workflow '%s' not found" % name
 
@@ -1778,6 +2236,10 @@ def create_workflow_execution_api():
     objects can be passed in to override the default configuration of the operations
     within the stages.
 
+    The optional Priority selects the queue the workflow execution waits on until it can run.
+    Workflow executions are admitted from the queues in a weighted-fair way, so a large backlog of
+    Low priority executions does not hold up Normal or High priority ones.  The default is Normal.
+
     Body:
 
     .. code-block:: python
@@ -1785,6 +2247,7 @@ def create_workflow_execution_api():
         {
         "Name":"Default",
         "Input": media-object
+        "Priority": "High" | "Normal" | "Low"
         "Configuration": {
             {
             "stage-name": {
@@ -1859,6 +2322,10 @@ def create_workflow_execution(trigger, workflow_execution):
     except IndexError:
         raise BadRequestError('Input must contain either "AssetId" or "Media"')
 
+    priority = workflow_execution.get("Priority", awsmie.WORKFLOW_PRIORITY_NORMAL)
+    if priority not in EXECUTION_QUEUES:
+        raise BadRequestError('Priority must be one of {}'.format(", ".join(EXECUTION_QUEUES)))
+
     try:
         name = workflow_execution["Name"]
 
@@ -1897,7 +2364,7 @@ def create_workflow_execution(trigger, workflow_execution):
 
             asset_id = workflow_input["AssetId"]
 
-            workflow_execution_list = list_workflow_executions_by_assetid(asset_id)
+            workflow_execution_list = find_workflow_executions_by_assetid(asset_id)
             acceptable_status = [awsmie.WORKFLOW_STATUS_COMPLETE, awsmie.WORKFLOW_STATUS_ERROR]
             for workflow_execution in (workflow_execution
                                        for workflow_execution in workflow_execution_list
@@ -1922,21 +2389,19 @@ def create_workflow_execution(trigger, workflow_execution):
                 raise ChaliceViewError("Unable to retrieve asset: {e}".format(e=asset_id))
 
         workflow_execution = initialize_workflow_execution(trigger, name, asset_input, configuration, asset_id)
+        workflow_execution["Priority"] = priority
 
         execution_table.put_item(Item=workflow_execution)
         dynamo_status_queued = True
 
         # TODO - must set workflow status to error if this fails since we marked it as QUeued .  we had to do that to avoid
         # race condition on status with the execution itself.  Once we hand it off to the state machine, we can't touch the status again.
-        response = SQS_CLIENT.send_message(QueueUrl=STAGE_EXECUTION_QUEUE_URL, MessageBody=json.dumps(workflow_execution))
+        response = SQS_CLIENT.send_message(QueueUrl=EXECUTION_QUEUES[priority], MessageBody=json.dumps(workflow_execution))
         # the response contains MD5 of the body, a message Id, MD5 of message attributes, and a sequence number (for FIFO queues)
         logger.info('Message ID : {}'.format(response['MessageId']))
 
         # Trigger the workflow_scheduler
-        response = LAMBDA_CLIENT.invoke(
-            FunctionName=WORKFLOW_SCHEDULER_LAMBDA_ARN,
-            InvocationType='Event'
-        )
+        trigger_workflow_scheduler(DYNAMO_RESOURCE.Table(SYSTEM_TABLE_NAME), LAMBDA_CLIENT, WORKFLOW_SCHEDULER_LAMBDA_ARN)
 
     except Exception as e:
         log_exception(e)
@@ -2097,7 +2562,8 @@ def resume_workflow_execution(id, waiting_stage_name):
                 ATT_WORKFLOW_WAITING_STATUS: awsmie.WORKFLOW_STATUS_WAITING,
                 ATT_VALUE_WORKFLOW_STATUS: awsmie.WORKFLOW_STATUS_RESUMED,
                 ATT_WAITING_STAGE_NAME: waiting_stage_name
-            }
+            },
+            ReturnValues='ALL_NEW'
         )
     except ClientError as e:
         if e.response['Error']['Code'] == "ConditionalCheckFailedException":
@@ -2109,138 +2575,269 @@ def resume_workflow_execution(id, waiting_stage_name):
     # Queue the resumed workflow so it can run when resources are available
     # TODO - must set workflow status to error if this fails since we marked it as QUeued .  we had to do that to avoid
     # race condition on status with the execution itself.  Once we hand it off to the state machine, we can't touch the status again.
-    response = SQS_CLIENT.send_message(QueueUrl=STAGE_EXECUTION_QUEUE_URL, MessageBody=json.dumps(workflow_execution))
+    # It goes back on the queue of its priority
+    priority = response.get("Attributes", {}).get("Priority", awsmie.WORKFLOW_PRIORITY_NORMAL)
+    queue_url = EXECUTION_QUEUES.get(priority, STAGE_EXECUTION_QUEUE_URL)
+    response = SQS_CLIENT.send_message(QueueUrl=queue_url, MessageBody=json.dumps(workflow_execution))
     # the response contains MD5 of the body, a message Id, MD5 of message attributes, and a sequence number (for FIFO queues)
     logger.info('Message ID : {}'.format(response['MessageId']))
 
     # We just queued a workflow so, Trigger the workflow_scheduler
-    response = LAMBDA_CLIENT.invoke(
-        FunctionName=WORKFLOW_SCHEDULER_LAMBDA_ARN,
-        InvocationType='Event'
-    )
+    trigger_workflow_scheduler(DYNAMO_RESOURCE.Table(SYSTEM_TABLE_NAME), LAMBDA_CLIENT, WORKFLOW_SCHEDULER_LAMBDA_ARN)
 
     return workflow_execution
 
 
+def parse_execution_list_params(query_params):
+    """
+    Read the paging, projection and created-time filter query parameters of the workflow execution listings.
+
+    :param query_params: The request query parameters, or None
+
+    :return: Dict of the parsed parameters.  Paginated is set when limit or cursor was passed, listings without
+        them return a plain list of every execution as before.
+    """
+    query_params = query_params or {}
+    params = {
+        "Paginated": "limit" in query_params or "cursor" in query_params,
+        "Limit": EXECUTION_PAGE_DEFAULT_LIMIT,
+        "ExclusiveStartKey": None,
+        "Fields": None,
+        "CreatedAfter": query_params.get("created_after"),
+        "CreatedBefore": query_params.get("created_before")
+    }
+
+    if "limit" in query_params:
+        try:
+            params["Limit"] = int(query_params["limit"])
+        except ValueError:
+            raise BadRequestError("Query parameter limit must be an integer")
+        if not 1 <= params["Limit"] <= EXECUTION_PAGE_MAX_LIMIT:
+            raise BadRequestError("Query parameter limit must be between 1 and {}".format(EXECUTION_PAGE_MAX_LIMIT))
+
+    if "cursor" in query_params:
+        try:
+            params["ExclusiveStartKey"] = json.loads(base64.urlsafe_b64decode(query_params["cursor"].encode("ascii")))
+        except ValueError:
+            raise BadRequestError("Query parameter cursor is not valid")
+        if not isinstance(params["ExclusiveStartKey"], dict):
+            raise BadRequestError("Query parameter cursor is not valid")
+
+    if "fields" in query_params:
+        params["Fields"] = [field.strip() for field in query_params["fields"].split(",") if field.strip()]
+        for field in params["Fields"]:
+            if not EXECUTION_FIELD_PATTERN.match(field):
+                raise BadRequestError("Query parameter fields contains an invalid attribute path '{}'".format(field))
+
+    return params
+
+
+def add_execution_list_expressions(args, params, key_condition=None, created_sort_key=False):
+    """
+    Add the projection and created-time range of the listing parameters to query or scan arguments.
+
+    A time range is only supported on an index sorted on Created, where it is part of the key condition.  As a
+    filter it would read every execution outside the range to fill a page.
+
+    :param args: The query or scan arguments, updated in place
+    :param params: The parsed listing parameters, see parse_execution_list_params
+    :param key_condition: The key condition of a query, None for a scan
+    :param created_sort_key: True if the queried index has Created as its sort key
+    """
+    if not created_sort_key and (params["CreatedAfter"] is not None or params["CreatedBefore"] is not None):
+        raise BadRequestError("Query parameters created_after and created_before are only supported by "
+                              "GET /workflow/execution/asset/{asset_id}")
+
+    names = args.setdefault("ExpressionAttributeNames", {})
+    values = args.setdefault("ExpressionAttributeValues", {})
+
+    if params["Fields"]:
+        paths = []
+        for field in params["Fields"]:
+            path = []
+            for attribute in field.split("."):
+                alias = "#field{}".format(len(names))
+                names[alias] = attribute
+                path.append(alias)
+            paths.append(".".join(path))
+        args["ProjectionExpression"] = ", ".join(paths)
+
+    created_range = None
+    if params["CreatedAfter"] is not None or params["CreatedBefore"] is not None:
+        names["#created"] = "Created"
+    if params["CreatedAfter"] is not None and params["CreatedBefore"] is not None:
+        created_range = "#created BETWEEN :created_after AND :created_before"
+    elif params["CreatedAfter"] is not None:
+        created_range = "#created >= :created_after"
+    elif params["CreatedBefore"] is not None:
+        created_range = "#created <= :created_before"
+    if params["CreatedAfter"] is not None:
+        values[":created_after"] = params["CreatedAfter"]
+    if params["CreatedBefore"] is not None:
+        values[":created_before"] = params["CreatedBefore"]
+
+    if key_condition is not None:
+        args["KeyConditionExpression"] = key_condition
+    if created_range:
+        args["KeyConditionExpression"] += " AND " + created_range
+
+    if not names:
+        del args["ExpressionAttributeNames"]
+    if not values:
+        del args["ExpressionAttributeValues"]
+
+
+def read_workflow_executions(read, args, params):
+    """
+    Read one page, or for listings without limit and cursor all pages, of workflow executions.
+
+    :param read: The table query or scan method
+    :param args: The query or scan arguments
+    :param params: The parsed listing parameters, see parse_execution_list_params
+
+    :return: The list of executions, or for paginated listings a dict with the Items of the page and the Cursor
+        of the next page.  Cursor is left out on the last page.
+    """
+    if params["ExclusiveStartKey"]:
+        args["ExclusiveStartKey"] = params["ExclusiveStartKey"]
+
+    workflow_executions = []
+    while True:
+        if params["Paginated"]:
+            # A read stops at 1 MB and can return fewer items than the limit, keep reading until the page is full
+            args["Limit"] = params["Limit"] - len(workflow_executions)
+        response = read(**args)
+        workflow_executions.extend(response['Items'])
+        last_evaluated_key = response.get('LastEvaluatedKey')
+        if last_evaluated_key is None or (params["Paginated"] and len(workflow_executions) >= params["Limit"]):
+            break
+        args["ExclusiveStartKey"] = last_evaluated_key
+
+    if not params["Paginated"]:
+        return workflow_executions
+
+    page = {"Items": workflow_executions}
+    if last_evaluated_key is not None:
+        page["Cursor"] = base64.urlsafe_b64encode(
+            json.dumps(last_evaluated_key, cls=DecimalEncoder).encode("utf-8")).decode("ascii")
+    return page
+
+
 @app.route('/workflow/execution', cors=True, methods=['GET'], authorizer=authorizer)
 def list_workflow_executions():
     """ List all workflow executions
 
+    Query parameters:
+        limit: Return at most this many executions and a cursor for the next page
+        cursor: The Cursor returned with the previous page
+        fields: Comma separated attribute paths to return, e.g. Id,Status,Workflow.Name
+
     Returns:
-        A list of workflow executions.
+        A list of workflow executions.  When limit or cursor is passed, a dictionary with the Items of the page
+        and the Cursor of the next page.
 
     Raises:
         200: All workflow executions returned sucessfully.
+        400: Bad Request - invalid query parameter
         500: ChaliceViewError - internal server error
     """
 
     table = DYNAMO_RESOURCE.Table(WORKFLOW_EXECUTION_TABLE_NAME)
+    params = parse_execution_list_params(app.current_request.query_params)
 
-    response = table.scan()
-    workflow_executions = response['Items']
-    while 'LastEvaluatedKey' in response:
-        response = table.scan(ExclusiveStartKey=response['LastEvaluatedKey'])
-        workflow_executions.extend(response['Items'])
+    args = {}
+    add_execution_list_expressions(args, params)
 
-    return workflow_executions
+    return read_workflow_executions(table.scan, args, params)
 
 
 @app.route('/workflow/execution/status/{status}', cors=True, methods=['GET'], authorizer=authorizer)
 def list_workflow_executions_by_status(status):
     """ Get all workflow executions with the specified status
 
+    Query parameters:
+        The paging and projection parameters of GET /workflow/execution
+
     Returns:
-        A list of dictionaries containing the workflow executions with the requested status
+        A list of dictionaries containing the workflow executions with the requested status.  When limit or
+        cursor is passed, a dictionary with the Items of the page and the Cursor of the next page.
 
     Raises:
         200: All workflows returned sucessfully.
+        400: Bad Request - invalid query parameter
         404: Not found
         500: Internal server error
     """
     table = DYNAMO_RESOURCE.Table(WORKFLOW_EXECUTION_TABLE_NAME)
-    projection_expression = "Id, AssetId, CurrentStage, StateMachineExecutionArn, {}, Workflow.{}".format(
-        ATT_NAME_WORKFLOW_STATUS, ATT_NAME_WORKFLOW_NAME)
+    params = parse_execution_list_params(app.current_request.query_params)
 
-    response = table.query(
-        IndexName='WorkflowExecutionStatus',
-        ExpressionAttributeNames={
-            ATT_NAME_WORKFLOW_STATUS: "Status",
-            ATT_NAME_WORKFLOW_NAME: "Name"
+    args = {
+        "IndexName": "WorkflowExecutionStatus",
+        "ExpressionAttributeNames": {
+            ATT_NAME_WORKFLOW_STATUS: "Status"
         },
-        ExpressionAttributeValues={
+        "ExpressionAttributeValues": {
             ATT_VALUE_WORKFLOW_STATUS: status
-        },
-        KeyConditionExpression='{} = {}'.format(ATT_NAME_WORKFLOW_STATUS, ATT_VALUE_WORKFLOW_STATUS),
-        ProjectionExpression = projection_expression
-        )
+        }
+    }
+    if not params["Fields"]:
+        args["ExpressionAttributeNames"][ATT_NAME_WORKFLOW_NAME] = "Name"
+        args["ProjectionExpression"] = EXECUTION_SUMMARY_PROJECTION
+    add_execution_list_expressions(
+        args, params, '{} = {}'.format(ATT_NAME_WORKFLOW_STATUS, ATT_VALUE_WORKFLOW_STATUS))
 
-    workflow_executions = response['Items']
-    while 'LastEvaluatedKey' in response:
-        response = table.query(
-            ExclusiveStartKey=response['LastEvaluatedKey'],
-            IndexName='WorkflowExecutionStatus',
-            ExpressionAttributeNames={
-                ATT_NAME_WORKFLOW_STATUS: "Status",
-                ATT_NAME_WORKFLOW_NAME: "Name"
-            },
-            ExpressionAttributeValues={
-                ATT_VALUE_WORKFLOW_STATUS: status
-            },
-            KeyConditionExpression='{} = {}'.format(ATT_NAME_WORKFLOW_STATUS, ATT_VALUE_WORKFLOW_STATUS),
-            ProjectionExpression = projection_expression
-        )
-        workflow_executions.extend(response['Items'])
+    return read_workflow_executions(table.query, args, params)
 
-    return workflow_executions
 
 @app.route('/workflow/execution/asset/{asset_id}', cors=True, methods=['GET'], authorizer=authorizer)
 def list_workflow_executions_by_assetid(asset_id):
-    """ Get workflow executions by AssetId
+    """ Get workflow executions by AssetId, newest first
+
+    Query parameters:
+        The paging and projection parameters of GET /workflow/execution
+        created_after, created_before: Only return executions created in this range, in seconds since the epoch
 
     Returns:
-        A list of dictionaries containing the workflow executions matching the AssetId.
+        A list of dictionaries containing the workflow executions matching the AssetId.  When limit or cursor is
+        passed, a dictionary with the Items of the page and the Cursor of the next page.
 
     Raises:
         200: Workflow executions returned sucessfully.
+        400: Bad Request - invalid query parameter
         404: Not found
         500: ChaliceViewError - internal server error
     """
-    table = DYNAMO_RESOURCE.Table(WORKFLOW_EXECUTION_TABLE_NAME)
+    params = parse_execution_list_params(app.current_request.query_params)
+    return find_workflow_executions_by_assetid(asset_id, params)
 
-    projection_expression = "Id, AssetId, CurrentStage, Created, StateMachineExecutionArn, {}, Workflow.{}".format(
-        ATT_NAME_WORKFLOW_STATUS, ATT_NAME_WORKFLOW_NAME)
 
-    response = table.query(
-        IndexName='WorkflowExecutionAssetId',
-        ExpressionAttributeNames={
+def find_workflow_executions_by_assetid(asset_id, params=None):
+    """
+    Query the workflow executions of an asset, newest first.
+
+    :param asset_id: The asset id
+    :param params: The parsed listing parameters, by default all executions with the summary attributes
+    """
+    table = DYNAMO_RESOURCE.Table(WORKFLOW_EXECUTION_TABLE_NAME)
+    if params is None:
+        params = parse_execution_list_params(None)
+
+    args = {
+        "IndexName": "WorkflowExecutionAssetIdCreated",
+        "ScanIndexForward": False,
+        "ExpressionAttributeValues": {
+            ':assetid': asset_id
+        }
+    }
+    if not params["Fields"]:
+        args["ExpressionAttributeNames"] = {
             ATT_NAME_WORKFLOW_STATUS: "Status",
             ATT_NAME_WORKFLOW_NAME: "Name"
-        },
-        ExpressionAttributeValues={
-            ':assetid': asset_id
-        },
-        KeyConditionExpression='AssetId = :assetid',
-        ProjectionExpression = projection_expression
-        )
-    workflow_executions = response['Items']
-    while 'LastEvaluatedKey' in response:
-        response = table.query(
-            ExclusiveStartKey=response['LastEvaluatedKey'],
-            IndexName='WorkflowExecutionAssetId',
-            ExpressionAttributeNames={
-                ATT_NAME_WORKFLOW_STATUS: "Status",
-                ATT_NAME_WORKFLOW_NAME: "Name"
-            },
-            ExpressionAttributeValues={
-                ':assetid': asset_id
-            },
-            KeyConditionExpression='AssetId = :assetid',
-            ProjectionExpression=projection_expression
-        )
-        workflow_executions.extend(response['Items'])
+        }
+        args["ProjectionExpression"] = EXECUTION_SUMMARY_PROJECTION
+    add_execution_list_expressions(args, params, 'AssetId = :assetid', created_sort_key=True)
 
-    sorted_executions = sorted(workflow_executions, key=itemgetter('Created'), reverse=True)
-    return sorted_executions
+    return read_workflow_executions(table.query, args, params)
 
 
 @app.route('/workflow/execution/{id}', cors=True, methods=['GET'], authorizer=authorizer)
@@ -2250,6 +2847,13 @@ def get_workflow_execution_by_id(id):
     Returns:
         A dictionary containing the workflow execution.
 
+        Operators that spill large outputs, see OUTPUT_SPILL_THRESHOLD_BYTES, leave a reference in place of
+        each spilled value in Globals.MetaData and in the stage Outputs:
+
+        .. code-block:: python
+
+            {"MieReferenceType": "S3", "S3Bucket": "$bucket", "S3Key": "$key", "ContentLength": $bytes}
+
     Raises:
         200: Workflow executions returned sucessfully.
         404: Not found
@@ -2302,7 +2906,12 @@ def delete_workflow_execution(id):
         response = table.delete_item(
             Key={
                 'Id': id
-            })
+            },
+            ReturnValues='ALL_OLD')
+
+        # A deleted workflow that was still running no longer holds a running workflow slot
+        if response.get("Attributes", {}).get("Status") == awsmie.WORKFLOW_STATUS_STARTED:
+            release_workflow_slot(DYNAMO_RESOURCE.Table(SYSTEM_TABLE_NAME))
 
     except Exception as e:
 
@@ -2324,7 +2933,7 @@ def update_workflow_execution_status(id, status, message):
     execution_table = DYNAMO_RESOURCE.Table(WORKFLOW_EXECUTION_TABLE_NAME)
 
     if status == awsmie.WORKFLOW_STATUS_ERROR:
-        execution_table.update_item(
+        response = execution_table.update_item(
             Key={
                 'Id': id
             },
@@ -2336,10 +2945,11 @@ def update_workflow_execution_status(id, status, message):
                 ATT_VALUE_WORKFLOW_STATUS: status,
                 ':message': message
 
-            }
+            },
+            ReturnValues='UPDATED_OLD'
         )
     else:
-        execution_table.update_item(
+        response = execution_table.update_item(
             Key={
                 'Id': id
             },
@@ -2349,15 +2959,18 @@ def update_workflow_execution_status(id, status, message):
             },
             ExpressionAttributeValues={
                 ATT_VALUE_WORKFLOW_STATUS: status
-            }
+            },
+            ReturnValues='UPDATED_OLD'
         )
 
+    # Give back the running workflow slot when this update moved the workflow out of Started
+    old_status = response.get("Attributes", {}).get("Status")
+    if old_status == awsmie.WORKFLOW_STATUS_STARTED and status != awsmie.WORKFLOW_STATUS_STARTED:
+        release_workflow_slot(DYNAMO_RESOURCE.Table(SYSTEM_TABLE_NAME))
+
     if status in [awsmie.WORKFLOW_STATUS_QUEUED, awsmie.WORKFLOW_STATUS_COMPLETE, awsmie.WORKFLOW_STATUS_ERROR]:
         # Trigger the workflow_scheduler
-        LAMBDA_CLIENT.invoke(
-            FunctionName=WORKFLOW_SCHEDULER_LAMBDA_ARN,
-            InvocationType='Event'
-        )
+        trigger_workflow_scheduler(DYNAMO_RESOURCE.Table(SYSTEM_TABLE_NAME), LAMBDA_CLIENT, WORKFLOW_SCHEDULER_LAMBDA_ARN)
 
 # ================================================================================================
 #      ___        ______    ____                  _            ____                _
@@ -2372,14 +2985,14 @@ def update_workflow_execution_status(id, status, message):
 def get_transcribe_client():
     global TRANSCRIBE_CLIENT
     if TRANSCRIBE_CLIENT is None:
-        TRANSCRIBE_CLIENT = boto3.client('transcribe', region_name=os.environ['AWS_REGION'])
+        TRANSCRIBE_CLIENT = get_client('transcribe', region_name=os.environ['AWS_REGION'])
     return TRANSCRIBE_CLIENT
 
 
 def get_translate_client():
     global TRANSLATE_CLIENT
     if TRANSLATE_CLIENT is None:
-        TRANSLATE_CLIENT = boto3.client('translate', region_name=os.environ['AWS_REGION'])
+        TRANSLATE_CLIENT = get_client('translate', region_name=os.environ['AWS_REGION'])
     return TRANSLATE_CLIENT
 
 
@@ -9,7 +9,7 @@ import json
 import decimal
 from botocore.client import ClientError
 from botocore.config import Config
-from boto3.dynamodb.types import TypeDeserializer
+from MediaInsightsEngineLambdaHelper.stream_records import decode_attributes
 
 formatter = logging.Formatter('{%(pathname)s:%(lineno)d} %(levelname)s - %(message)s')
 handler = logging.StreamHandler()
@@ -19,14 +19,30 @@ logger = logging.getLogger('boto3')
 logger.setLevel(logging.INFO)
 logger.addHandler(handler)
 
-serializer = TypeDeserializer()
-
 mie_config = json.loads(os.environ['botoConfig'])
 config = Config(**mie_config)
 
 topic_arn = os.environ['TOPIC_ARN']
 sns = boto3.client('sns', config=config)
 
+# Fields of a status change message. Subscribers that need fewer fields can be served smaller messages by setting
+# MESSAGE_FIELDS to a comma separated subset.
+DEFAULT_MESSAGE_FIELDS = "EventTimestamp,WorkflowExecutionId,AssetId,Status,Globals,Configuration,Created"
+MESSAGE_FIELDS = [field.strip() for field in os.environ.get('MESSAGE_FIELDS', DEFAULT_MESSAGE_FIELDS).split(',')
+                  if field.strip()]
+# Fields whose JSON encoding is larger than this are replaced by a reference to the workflow execution, which
+# subscribers read from GET /workflow/execution/{Id}.  0 or unset publishes every field in full.
+MESSAGE_FIELD_MAX_BYTES = int(os.environ.get('MESSAGE_FIELD_MAX_BYTES') or 0)
+REFERENCE_TYPE_WORKFLOW_EXECUTION = "WorkflowExecution"
+
+# Limits of an SNS PublishBatch request
+SNS_BATCH_MAX_ENTRIES = 10
+SNS_BATCH_MAX_BYTES = 256 * 1024
+
+# Message fields and the image of the workflow execution item they are read from
+OLD_IMAGE_FIELDS = {"WorkflowExecutionId": "Id", "AssetId": "AssetId"}
+NEW_IMAGE_FIELDS = {"Status": "Status", "Globals": "Globals", "Configuration": "Configuration", "Created": "Created"}
+
 
 class DecimalEncoder(json.JSONEncoder):
     def default(self, o):
@@ -35,57 +51,92 @@ class DecimalEncoder(json.JSONEncoder):
         return super(DecimalEncoder, self).default(o)
 
 
-def deserialize(data):
-    if isinstance(data, list):
-        return [deserialize(v) for v in data]
-
-    if isinstance(data, dict):
-        try:
-            return serializer.deserialize(data)
-        except TypeError:
-            return {k: deserialize(v) for k, v in data.items()}
+def build_message(old_image, new_image, timestamp):
+    """
+    Build the status change message with the configured fields, decoding only the attributes they need.
+    """
+    old_fields = {field: OLD_IMAGE_FIELDS[field] for field in MESSAGE_FIELDS if field in OLD_IMAGE_FIELDS}
+    new_fields = {field: NEW_IMAGE_FIELDS[field] for field in MESSAGE_FIELDS if field in NEW_IMAGE_FIELDS}
+    old = decode_attributes(old_image, old_fields.values())
+    new = decode_attributes(new_image, new_fields.values())
+    # The reference needs the execution id, whether or not it is a message field
+    workflow_execution_id = old_image["Id"]["S"]
+
+    message = {}
+    for field in MESSAGE_FIELDS:
+        if field == "EventTimestamp":
+            message[field] = timestamp
+        elif field in old_fields:
+            message[field] = old.get(old_fields[field])
+        elif field in new_fields:
+            value = new.get(new_fields[field])
+            size = len(json.dumps(value, cls=DecimalEncoder))
+            if MESSAGE_FIELD_MAX_BYTES and size > MESSAGE_FIELD_MAX_BYTES:
+                value = {
+                    "MieReferenceType": REFERENCE_TYPE_WORKFLOW_EXECUTION,
+                    "Path": "/workflow/execution/{}".format(workflow_execution_id),
+                    "ContentLength": size
+                }
+            message[field] = value
+    return message
+
+
+def publish_messages(messages):
+    entries = []
+    for message in messages:
+        entries.append({
+            "Id": str(len(entries)),
+            "Message": json.dumps({'default': json.dumps(message, cls=DecimalEncoder)}),
+            "MessageStructure": "json"
+        })
+
+    batch = []
+    batch_bytes = 0
+    for entry in entries:
+        entry_bytes = len(entry["Message"].encode("utf-8"))
+        if batch and (len(batch) == SNS_BATCH_MAX_ENTRIES or batch_bytes + entry_bytes > SNS_BATCH_MAX_BYTES):
+            publish_batch(batch)
+            batch = []
+            batch_bytes = 0
+        batch.append(entry)
+        batch_bytes += entry_bytes
+    if batch:
+        publish_batch(batch)
+
+
+def publish_batch(entries):
+    try:
+        response = sns.publish_batch(TopicArn=topic_arn, PublishBatchRequestEntries=entries)
+    except ClientError as e:
+        error = e.response['Error']['Message']
+        logger.error(f"Exception occurred while publishing {len(entries)} messages to SNS: {error}")
     else:
-        return data
+        for failed in response.get("Failed", []):
+            logger.error(f"Failed to publish message {failed['Id']} to SNS: {failed.get('Message')}")
+        logger.info(f"Successfully published {len(response.get('Successful', []))} messages to SNS")
 
 
 def lambda_handler(event, _context):
-
+    messages = []
     for record in event["Records"]:
 
-        deserialized_record = deserialize(record["dynamodb"])
-        logger.info(f"Received event: {deserialized_record}")
-
         event_type = record["eventName"]
+        logger.info(f"Received {event_type} event: {record['dynamodb'].get('Keys')}")
 
         if event_type == "MODIFY":
             logger.info("event_type == MODIFY: Checking workflow status")
             timestamp = time.time()
-            old = deserialized_record["OldImage"]
-            new = deserialized_record["NewImage"]
+            old_image = record["dynamodb"]["OldImage"]
+            new_image = record["dynamodb"]["NewImage"]
 
-            if new["Status"] != old["Status"]:
+            # Compare the encoded values, the rest of the images is only decoded for a message
+            if new_image.get("Status") != old_image.get("Status"):
                 logger.info("Workflow status was changed: Creating message for SNS publishing")
-                message = {}
-                message["EventTimestamp"] = timestamp
-                message["WorkflowExecutionId"] = old["Id"]
-                message["AssetId"] = old["AssetId"]
-                message["Status"] = new["Status"]
-                message["Globals"] = new["Globals"]
-                message["Configuration"] = new["Configuration"]
-                message["Created"] = new["Created"]
+                message = build_message(old_image, new_image, timestamp)
                 logger.info(f"Publishing the following message: {message}")
-                try:
-                    response = sns.publish(
-                        TargetArn=topic_arn,
-                        Message=json.dumps({'default': json.dumps(message, cls=DecimalEncoder)}),
-                        MessageStructure='json'
-                    )
-                except ClientError as e:
-                    error = e.response['Error']['Message']
-                    logger.error(f"Exception occurred while publishing message to SNS: {error}")
-                else:
-                    logger.info(f"Successfully published message to SNS: {response}")
+                messages.append(message)
             else:
                 logger.info("Workflow status was not changed: Nothing to do")
         elif event_type in ("INSERT", "REMOVE"):
             logger.info("event_type == {}: Nothing to do".format(event_type))
+    publish_messages(messages)
@@ -0,0 +1,106 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: Apache-2.0
+
+###############################################################################
+# PURPOSE: Compare the decoding of DynamoDB stream batches by the stream functions with the recursive
+#  TypeDeserializer walk they used before.
+#
+# USAGE:
+#  python3 bench_stream_records.py [event.json ...]
+#
+#  Each file holds a recorded Lambda event, i.e. {"Records": [...]} as the dataplane stream function receives it.
+#  Without files, batches with the shape of the dataplane table stream are generated.
+###############################################################################
+
+import json
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '../../source/lib/MediaInsightsEngineLambdaHelper'))
+
+from boto3.dynamodb.types import TypeDeserializer
+from MediaInsightsEngineLambdaHelper.stream_records import diff_operators, latest_result
+
+serializer = TypeDeserializer()
+
+
+def legacy_deserialize(data):
+    if isinstance(data, list):
+        return [legacy_deserialize(v) for v in data]
+
+    if isinstance(data, dict):
+        try:
+            return serializer.deserialize(data)
+        except TypeError:
+            return {k: legacy_deserialize(v) for k, v in data.items()}
+    else:
+        return data
+
+
+def legacy_change(record):
+    stream_record = legacy_deserialize(record["dynamodb"])
+    new_item = stream_record["NewImage"]
+    old_item = stream_record["OldImage"]
+    if set(new_item) != set(old_item):
+        return None
+    for operator, value in new_item.items():
+        if isinstance(value, list) and value[0]["pointer"] != old_item[operator][0]["pointer"]:
+            return operator, value[0]["pointer"]
+
+
+def change(record):
+    stream_record = record["dynamodb"]
+    added, removed, modified = diff_operators(stream_record["NewImage"], stream_record["OldImage"])
+    if modified:
+        return modified[0], latest_result(stream_record["NewImage"][modified[0]])["pointer"]
+
+
+def operator_results(operator, count, pointer_id):
+    return {"L": [
+        {"M": {
+            "pointer": {"S": "private/assets/asset/{}/{}.json".format(operator, pointer_id - i)},
+            "workflow": {"S": "8d0fa1f4-0d2e-4cbe-9b69-0d0a6c5d1c2e"},
+            "created": {"N": str(1700000000 - i)}
+        }} for i in range(count)
+    ]}
+
+
+def generated_batch(records=100, operators=12, history=5):
+    batch = []
+    for n in range(records):
+        old_image = {
+            "AssetId": {"S": "asset-{}".format(n)},
+            "S3Bucket": {"S": "dataplane-bucket"},
+            "S3Key": {"S": "private/assets/asset-{}/input/video.mp4".format(n)},
+            "Created": {"N": "1700000000"}
+        }
+        for i in range(operators):
+            old_image["operator{}".format(i)] = operator_results("operator{}".format(i), history, i)
+        new_image = dict(old_image)
+        modified = "operator{}".format(n % operators)
+        new_image[modified] = operator_results(modified, history, 1000 + n)
+        batch.append({
+            "eventName": "MODIFY",
+            "dynamodb": {"Keys": {"AssetId": old_image["AssetId"]}, "NewImage": new_image, "OldImage": old_image}
+        })
+    return {"Records": batch}
+
+
+def run(name, event, number=20):
+    records = [record for record in event["Records"] if record["eventName"] == "MODIFY"]
+    assert [legacy_change(record) for record in records] == [change(record) for record in records]
+    legacy = min(timeit.repeat(lambda: [legacy_change(record) for record in records], number=number, repeat=3))
+    current = min(timeit.repeat(lambda: [change(record) for record in records], number=number, repeat=3))
+    print("{}: {} records, legacy {:.2f} ms/batch, current {:.2f} ms/batch, {:.1f}x".format(
+        name, len(records), legacy * 1000 / number, current * 1000 / number, legacy / current))
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        for path in sys.argv[1:]:
+            with open(path) as f:
+                run(path, json.load(f))
+    else:
+        run("generated", generated_batch())
+        run("generated, long history", generated_batch(history=50))
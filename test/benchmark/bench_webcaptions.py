@@ -0,0 +1,166 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: Apache-2.0
+
+###############################################################################
+# PURPOSE: Measure the caption segmentation and the SRT, VTT and text serializers of the WebCaptions operator on a
+#  long transcript, compared to the implementations they replaced.
+#
+# USAGE:
+#  python3 bench_webcaptions.py [hours]
+#
+#  A Transcribe transcript of the given length is generated, 3 hours by default.
+###############################################################################
+
+import math
+import os
+import random
+import sys
+import timeit
+
+source_dir = os.path.join(os.path.dirname(__file__), '../../source')
+sys.path.insert(0, os.path.join(source_dir, 'operators'))
+sys.path.insert(0, os.path.join(source_dir, 'lib/MediaInsightsEngineLambdaHelper'))
+os.environ.setdefault('botoConfig', '{}')
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+os.environ.setdefault('DATAPLANE_BUCKET', 'benchmark')
+os.environ.setdefault('DataplaneEndpoint', 'benchmark')
+
+from captions.webcaptions import segment_captions, srt_chunks, transcript_columns, vtt_chunks  # noqa: E402
+
+
+def legacy_segment_captions(items):
+    max_length = 120
+    max_words = 25
+    max_silence = 1.5
+    captions = []
+    caption = None
+    end_time = 0.0
+    word_count = 0
+    for item in items:
+        is_punctuation = item["type"] == "punctuation"
+        if caption is None:
+            if is_punctuation:
+                continue
+            caption = {"start": float(item["start_time"]), "caption": "", "wordConfidence": []}
+        if not is_punctuation:
+            start_time = float(item["start_time"])
+            if (len(caption["caption"]) > 0) and ((end_time + max_silence) < start_time):
+                caption["end"] = start_time
+                captions.append(caption)
+                caption = {"start": float(start_time), "caption": "", "wordConfidence": []}
+                word_count = 0
+            end_time = float(item["end_time"])
+        if (not is_punctuation) and (len(caption["caption"]) > 0):
+            caption["caption"] += " "
+        text = item["alternatives"][0]["content"]
+        confidence = item["alternatives"][0]["confidence"]
+        caption["caption"] += text
+        if not is_punctuation:
+            caption["wordConfidence"].append({"w": text.lower(), "c": float(confidence)})
+            word_count += 1
+        if (word_count >= max_words) or (len(caption["caption"]) >= max_length) or is_punctuation and text in "...?!":
+            caption["end"] = end_time
+            captions.append(caption)
+            word_count = 0
+            caption = None
+    if caption is not None:
+        caption["end"] = end_time
+        captions.append(caption)
+    return captions
+
+
+def generated_transcript(hours):
+    # About 150 words a minute with punctuation and the occasional pause
+    rng = random.Random(0)
+    items = []
+    time = 0.0
+    while time < hours * 3600:
+        duration = rng.randint(15, 60) / 100
+        items.append({
+            "start_time": "%.3f" % time,
+            "end_time": "%.3f" % (time + duration),
+            "alternatives": [{"confidence": "%.4f" % rng.random(), "content": "Word%d" % rng.randint(0, 5000)}],
+            "type": "pronunciation"
+        })
+        time += duration + (rng.randint(150, 300) / 100 if rng.random() < 0.02 else 0.08)
+        if rng.random() < 0.1:
+            items.append({"alternatives": [{"confidence": "0.0", "content": rng.choice(".,?!")}], "type": "punctuation"})
+    return items
+
+
+def legacy_format_time(time_seconds, separator):
+    hours = math.floor(time_seconds / 3600)
+    remainder = time_seconds - (hours * 3600)
+    minutes = math.floor(remainder / 60)
+    remainder = remainder - (minutes * 60)
+    seconds = math.floor(remainder)
+    millis = remainder - seconds
+    return str(hours).zfill(2) + ':' + str(minutes).zfill(2) + ':' + str(seconds).zfill(2) + separator + \
+        str(math.floor(millis * 1000)).zfill(3)
+
+
+def legacy_srt(webcaptions):
+    srt = ''
+    index = 1
+    for caption in webcaptions:
+        srt += str(index) + '\n'
+        srt += legacy_format_time(float(caption["start"]), ',') + ' --> ' + \
+            legacy_format_time(float(caption["end"]), ',') + '\n'
+        srt += caption["caption"] + '\n\n'
+        index += 1
+    return srt
+
+
+def legacy_vtt(webcaptions):
+    vtt = 'WEBVTT\n\n'
+    for caption in webcaptions:
+        vtt += legacy_format_time(float(caption["start"]), '.') + ' --> ' + \
+            legacy_format_time(float(caption["end"]), '.') + '\n'
+        vtt += caption["caption"] + '\n\n'
+    return vtt
+
+
+def legacy_text(webcaptions):
+    transcript = ""
+    for caption in webcaptions:
+        transcript = transcript + caption["caption"]
+    return transcript
+
+
+def generated_captions(hours):
+    # Transcribe cues of about 3 seconds with 8 words each
+    captions = []
+    for n in range(int(hours * 3600 / 3)):
+        start = n * 3 + 0.125
+        captions.append({
+            "start": start,
+            "end": start + 2.75,
+            "caption": " ".join("word{}".format((n + i) % 1000) for i in range(8)) + ".",
+        })
+    return captions
+
+
+def run(name, legacy, current, captions, number=5):
+    legacy_time = min(timeit.repeat(lambda: legacy(captions), number=number, repeat=3)) / number
+    current_time = min(timeit.repeat(lambda: current(captions), number=number, repeat=3)) / number
+    size = len(current(captions).encode("utf-8"))
+    print("{}: {:.1f} MB, legacy {:.1f} ms ({:.1f} MB/s), current {:.1f} ms ({:.1f} MB/s)".format(
+        name, size / 1e6, legacy_time * 1000, size / 1e6 / legacy_time, current_time * 1000,
+        size / 1e6 / current_time))
+
+
+if __name__ == '__main__':
+    hours = float(sys.argv[1]) if len(sys.argv) > 1 else 3
+    items = generated_transcript(hours)
+    words = sum(1 for item in items if item["type"] != "punctuation")
+    assert legacy_segment_captions(items) == segment_captions(transcript_columns(items))
+    legacy_time = min(timeit.repeat(lambda: legacy_segment_captions(items), number=5, repeat=3)) / 5
+    current_time = min(timeit.repeat(lambda: segment_captions(transcript_columns(items)), number=5, repeat=3)) / 5
+    print("segmentation: {} words, legacy {:.1f} ms, current {:.1f} ms".format(
+        words, legacy_time * 1000, current_time * 1000))
+
+    captions = generated_captions(hours)
+    print("{} captions for {} hours".format(len(captions), hours))
+    run("srt", legacy_srt, lambda webcaptions: "".join(srt_chunks(webcaptions)), captions)
+    run("vtt", legacy_vtt, lambda webcaptions: "".join(vtt_chunks(webcaptions)), captions)
+    run("text", legacy_text, lambda webcaptions: "".join(caption["caption"] for caption in webcaptions), captions)
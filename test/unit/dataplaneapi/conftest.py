@@ -10,6 +10,7 @@ import boto3
 @pytest.fixture(autouse=True)
 def mock_env_variables(monkeypatch):
     monkeypatch.syspath_prepend('../../source/dataplaneapi/')
+    monkeypatch.syspath_prepend('../../source/lib/MediaInsightsEngineLambdaHelper/')
     monkeypatch.setenv("DATAPLANE_TABLE_NAME", "testDataplaneTableName")
     monkeypatch.setenv("DATAPLANE_BUCKET", "testDataplaneBucketName")
     monkeypatch.setenv("botoConfig", '{"user_agent_extra": "AwsSolution/SO0163/vX.X.X"}')
@@ -36,9 +37,9 @@ def s3_client_stub(mock_env_variables):
         stubber.assert_no_pending_responses()
 
 @pytest.fixture
-def s3_resource_stub(mock_env_variables):
-    from app import s3_resource
-    with Stubber(s3_resource.meta.client) as stubber:
+def lambda_client_stub(mock_env_variables):
+    from app import lambda_client
+    with Stubber(lambda_client) as stubber:
         yield stubber
         stubber.assert_no_pending_responses()
 
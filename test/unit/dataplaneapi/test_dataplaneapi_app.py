@@ -6,8 +6,6 @@ import botocore.exceptions
 import json
 import uuid
 import boto3
-import datetime
-from dateutil.tz import tzutc
 import io
 from botocore.response import StreamingBody
 import base64
@@ -159,7 +157,8 @@ def test_create_asset(test_client, s3_client_stub, ddb_resource_stub):
                     'MediaType': 'Video',
                     'S3Bucket': 'InputBucketName',
                     'S3Key': 'InputKeyName',
-                    'Created': botocore.stub.ANY
+                    'Created': botocore.stub.ANY,
+                    'CreatedMonth': botocore.stub.ANY
                 },
             'TableName': 'testDataplaneTableName'
         },
@@ -179,6 +178,42 @@ def test_create_asset(test_client, s3_client_stub, ddb_resource_stub):
 
     print("Pass")
 
+def test_dataplane_helper_direct_mode_create_asset(s3_client_stub, ddb_resource_stub):
+    from app import storage
+    from MediaInsightsEngineLambdaHelper import DataPlane
+
+    s3_client_stub.add_response(
+        'put_object',
+        expected_params={'Bucket': 'testDataplaneBucketName', 'Key': botocore.stub.ANY},
+        service_response={}
+    )
+    ddb_resource_stub.add_response('put_item', expected_params={'Item': botocore.stub.ANY, 'TableName': 'testDataplaneTableName'}, service_response={})
+
+    dataplane = DataPlane(mode="direct")
+    dataplane.storage = storage
+    response = dataplane.create_asset("Video", "InputBucketName", "InputKeyName")
+
+    assert is_valid_uuid(response['AssetId'])
+    assert response['S3Bucket'] == 'InputBucketName'
+    print("Pass")
+
+def test_dataplane_helper_direct_mode_error_response(ddb_resource_stub):
+    from app import storage
+    from MediaInsightsEngineLambdaHelper import DataPlane
+
+    ddb_resource_stub.add_response(
+        'get_item',
+        expected_params={'Key': {'AssetId': 'missingAsset'}, 'TableName': 'testDataplaneTableName'},
+        service_response={}
+    )
+
+    dataplane = DataPlane(mode="direct")
+    dataplane.storage = storage
+    response = dataplane.retrieve_asset_metadata('missingAsset')
+
+    assert response['Code'] == 'NotFoundError'
+    print("Pass")
+
 def test_put_asset_metadata_input_error1(test_client, s3_client_stub, ddb_resource_stub):
     print('POST /metadata/{asset_id}')
     test_asset_id = str(uuid.uuid4())
@@ -278,51 +313,183 @@ def test_put_asset_metadata_paginated(test_client, s3_client_stub, ddb_resource_
     test_method_input = {"OperatorName": "testOperator",
                     "Results": {"serviceName": "testService", "someValue": {"nextValue": "testValue"}},
                     "WorkflowId": "abcd-1234-efgh-5678"}
-    test_metadata_key = 'private/assets/' + test_asset_id + '/' + 'workflows' + '/' + test_method_input[
-        'WorkflowId'] + '/' + test_method_input['OperatorName'] + '.json'
+    test_segment_prefix = 'private/assets/' + test_asset_id + '/' + 'workflows' + '/' + test_method_input[
+        'WorkflowId'] + '/' + test_method_input['OperatorName'] + '/'
 
-    test_pointer = [{"workflow": test_method_input["WorkflowId"], "pointer": test_metadata_key}]
+    ddb_resource_stub.add_response(
+        'get_item',
+        expected_params={"Key": {"AssetId": test_asset_id}, "TableName": "testDataplaneTableName"},
+        service_response={"Item": {}}
+    )
+    s3_client_stub.add_response(
+        'list_objects_v2',
+        expected_params={"Bucket": "testDataplaneBucketName", "Prefix": test_segment_prefix + 'page-'},
+        service_response={"KeyCount": 0, "IsTruncated": False}
+    )
+    s3_client_stub.add_response(
+        'put_object',
+        expected_params={"Bucket": "testDataplaneBucketName", "Key": test_segment_prefix + 'page-00000.json',
+                         "Body": json.dumps(test_method_input["Results"])},
+        service_response={}
+    )
+    response = test_client.http.post('/metadata/{asset_id}?paginated=true'.format(asset_id=test_asset_id),
+                                     body=bytes(json.dumps(test_method_input), encoding='utf-8'))
+    assert response.status_code == 200
+    formatted_response = json.loads(response.body)
+    assert formatted_response == {"Status": "Success"}
+    print('Pass')
 
-    test_update_expression = "SET #operator_result = :result"
-    test_expression_attr_name = {"#operator_result": test_method_input["OperatorName"]}
-    test_expression_attr_val = {":result": test_pointer}
+def test_put_asset_metadata_paginated_appends_page(test_client, s3_client_stub, ddb_resource_stub):
+    print('POST /metadata/{asset_id}?paginated=true')
+    test_asset_id = str(uuid.uuid4())
+    test_method_input = {"OperatorName": "testOperator",
+                    "Results": {"serviceName": "testService"},
+                    "WorkflowId": "abcd-1234-efgh-5678"}
+    test_segment_prefix = 'private/assets/' + test_asset_id + '/' + 'workflows' + '/' + test_method_input[
+        'WorkflowId'] + '/' + test_method_input['OperatorName'] + '/'
 
     ddb_resource_stub.add_response(
         'get_item',
         expected_params={"Key": {"AssetId": test_asset_id}, "TableName": "testDataplaneTableName"},
         service_response={"Item": {}}
     )
-    s3_client_stub.add_client_error(
-        'get_object',
-        expected_params={"Bucket": "testDataplaneBucketName", "Key": test_metadata_key},
-        service_error_code='404'
+    s3_client_stub.add_response(
+        'list_objects_v2',
+        expected_params={"Bucket": "testDataplaneBucketName", "Prefix": test_segment_prefix + 'page-'},
+        service_response={"Contents": [{"Key": test_segment_prefix + 'page-00001.json'},
+                                       {"Key": test_segment_prefix + 'page-00000.json'}],
+                          "IsTruncated": True, "NextContinuationToken": "testToken"}
     )
+    s3_client_stub.add_response(
+        'list_objects_v2',
+        expected_params={"Bucket": "testDataplaneBucketName", "Prefix": test_segment_prefix + 'page-',
+                         "ContinuationToken": "testToken"},
+        service_response={"Contents": [{"Key": test_segment_prefix + 'page-00002.json'}], "IsTruncated": False}
+    )
+    # Only the new page is written, existing pages are never read back or rewritten
     s3_client_stub.add_response(
         'put_object',
-        expected_params={"Bucket": "testDataplaneBucketName", "Key": test_metadata_key, "Body": botocore.stub.ANY},
+        expected_params={"Bucket": "testDataplaneBucketName", "Key": test_segment_prefix + 'page-00003.json',
+                         "Body": json.dumps(test_method_input["Results"])},
         service_response={}
     )
     response = test_client.http.post('/metadata/{asset_id}?paginated=true'.format(asset_id=test_asset_id),
                                      body=bytes(json.dumps(test_method_input), encoding='utf-8'))
     assert response.status_code == 200
-    formatted_response = json.loads(response.body)
-    print(formatted_response)
     print('Pass')
 
-def test_put_asset_metadata_paginated_dynamo_error(test_client, s3_client_stub, ddb_resource_stub):
+def test_put_asset_metadata_numbered_page(test_client, s3_client_stub, ddb_resource_stub):
+    print('POST /metadata/{asset_id}?paginated=true&page=4')
+    test_asset_id = str(uuid.uuid4())
+    test_method_input = {"OperatorName": "testOperator",
+                    "Results": {"serviceName": "testService"},
+                    "WorkflowId": "abcd-1234-efgh-5678"}
+    test_segment_prefix = 'private/assets/' + test_asset_id + '/' + 'workflows' + '/' + test_method_input[
+        'WorkflowId'] + '/' + test_method_input['OperatorName'] + '/'
+
+    # A numbered page is written to its own key without listing the stored pages, so a retry overwrites it
+    for _ in range(2):
+        ddb_resource_stub.add_response(
+            'get_item',
+            expected_params={"Key": {"AssetId": test_asset_id}, "TableName": "testDataplaneTableName"},
+            service_response={"Item": {}}
+        )
+        s3_client_stub.add_response(
+            'put_object',
+            expected_params={"Bucket": "testDataplaneBucketName", "Key": test_segment_prefix + 'page-00004.json',
+                             "Body": json.dumps(test_method_input["Results"])},
+            service_response={}
+        )
+        response = test_client.http.post(
+            '/metadata/{asset_id}?paginated=true&page=4'.format(asset_id=test_asset_id),
+            body=bytes(json.dumps(test_method_input), encoding='utf-8'))
+        assert response.status_code == 200
+    print('Pass')
+
+def test_put_asset_metadata_numbered_page_end(test_client, s3_client_stub, ddb_resource_stub):
+    print('POST /metadata/{asset_id}?paginated=true&end=true&page=1')
+    test_asset_id = str(uuid.uuid4())
+    test_method_input = {"OperatorName": "testOperator",
+                    "Results": {"serviceName": "testService"},
+                    "WorkflowId": "abcd-1234-efgh-5678"}
+    test_segment_prefix = 'private/assets/' + test_asset_id + '/' + 'workflows' + '/' + test_method_input[
+        'WorkflowId'] + '/' + test_method_input['OperatorName'] + '/'
+    test_manifest_key = test_segment_prefix + 'manifest.json'
+    test_manifest = {"Layout": "segmented", "PageCount": 2,
+                     "Pages": [test_segment_prefix + 'page-00000.json', test_segment_prefix + 'page-00001.json']}
+
+    ddb_resource_stub.add_response(
+        'get_item',
+        expected_params={"Key": {"AssetId": test_asset_id}, "TableName": "testDataplaneTableName"},
+        service_response={"Item": {}}
+    )
+    s3_client_stub.add_response(
+        'put_object',
+        expected_params={"Bucket": "testDataplaneBucketName", "Key": test_segment_prefix + 'page-00001.json',
+                         "Body": json.dumps(test_method_input["Results"])},
+        service_response={}
+    )
+    s3_client_stub.add_response(
+        'put_object',
+        expected_params={"Bucket": "testDataplaneBucketName", "Key": test_manifest_key,
+                         "Body": json.dumps(test_manifest)},
+        service_response={}
+    )
+    ddb_resource_stub.add_response(
+        'update_item',
+        expected_params={"Key": {"AssetId": test_asset_id}, "UpdateExpression": "SET #operator_result = :result",
+                         "ExpressionAttributeNames": {"#operator_result": test_method_input["OperatorName"]},
+                         "ExpressionAttributeValues": {":result": [{"workflow": test_method_input["WorkflowId"],
+                                                                    "pointer": test_manifest_key}]},
+                         "TableName": "testDataplaneTableName"},
+        service_response={})
+
+    response = test_client.http.post(
+        '/metadata/{asset_id}?paginated=true&end=true&page=1'.format(asset_id=test_asset_id),
+        body=bytes(json.dumps(test_method_input), encoding='utf-8'))
+    assert response.status_code == 200
+    assert json.loads(response.body) == {"Status": "Success", "Bucket": "testDataplaneBucketName",
+                                         "Key": test_manifest_key}
+    print('Pass')
+
+def test_put_asset_metadata_invalid_page(test_client, s3_client_stub, ddb_resource_stub):
+    print('POST /metadata/{asset_id}?paginated=true&page=-1')
+    test_asset_id = str(uuid.uuid4())
+    test_method_input = {"OperatorName": "testOperator",
+                    "Results": {"serviceName": "testService"},
+                    "WorkflowId": "abcd-1234-efgh-5678"}
+
+    for page in ['-1', 'first']:
+        response = test_client.http.post(
+            '/metadata/{asset_id}?paginated=true&page={page}'.format(asset_id=test_asset_id, page=page),
+            body=bytes(json.dumps(test_method_input), encoding='utf-8'))
+        assert response.status_code == 400
+    print('Pass')
+
+def test_put_asset_metadata_paginated_list_error(test_client, s3_client_stub, ddb_resource_stub):
     print('POST /metadata/{asset_id}?paginated=true')
     test_asset_id = str(uuid.uuid4())
     test_method_input = {"OperatorName": "testOperator",
-                    "Results": {"serviceName": "testService", "someValue": {"nextValue": "testValue"}},
+                    "Results": {"serviceName": "testService"},
                     "WorkflowId": "abcd-1234-efgh-5678"}
-    test_metadata_key = 'private/assets/' + test_asset_id + '/' + 'workflows' + '/' + test_method_input[
-        'WorkflowId'] + '/' + test_method_input['OperatorName'] + '.json'
 
-    test_pointer = [{"workflow": test_method_input["WorkflowId"], "pointer": test_metadata_key}]
+    ddb_resource_stub.add_response(
+        'get_item',
+        expected_params={"Key": {"AssetId": test_asset_id}, "TableName": "testDataplaneTableName"},
+        service_response={"Item": {}}
+    )
+    s3_client_stub.add_client_error('list_objects_v2')
+    response = test_client.http.post('/metadata/{asset_id}?paginated=true'.format(asset_id=test_asset_id),
+                                     body=bytes(json.dumps(test_method_input), encoding='utf-8'))
+    assert response.status_code == 500
+    print('Pass')
 
-    test_update_expression = "SET #operator_result = :result"
-    test_expression_attr_name = {"#operator_result": test_method_input["OperatorName"]}
-    test_expression_attr_val = {":result": test_pointer}
+def test_put_asset_metadata_paginated_dynamo_error(test_client, s3_client_stub, ddb_resource_stub):
+    print('POST /metadata/{asset_id}?paginated=true')
+    test_asset_id = str(uuid.uuid4())
+    test_method_input = {"OperatorName": "testOperator",
+                    "Results": {"serviceName": "testService", "someValue": {"nextValue": "testValue"}},
+                    "WorkflowId": "abcd-1234-efgh-5678"}
 
     ddb_resource_stub.add_client_error('get_item')
     response = test_client.http.post('/metadata/{asset_id}?paginated=true'.format(asset_id=test_asset_id),
@@ -332,24 +499,12 @@ def test_put_asset_metadata_paginated_dynamo_error(test_client, s3_client_stub,
 
 def test_put_asset_metadata_dynamo_error(test_client, s3_client_stub, ddb_resource_stub):
     print('POST /metadata/{asset_id}?paginated=true&end=true')
-    test_s3_get_object_response = {'ResponseMetadata': {'RequestId': 'C6B8150894ABC0CE',
-                                                        'HostId': 'AF2tM9QcyL4DJlvHpccJBKOgOQbydnQLjfplgHGT8Fo+BNWrzjCeRcNyBkzKoTru1pG5nFWfPfM=',
-                                                        'HTTPStatusCode': 200, 'HTTPHeaders': {
-            'x-amz-id-2': 'AF2tM9QcyL4DJlvHpccJBKOgOQbydnQLjfplgHGT8Fo+BNWrzjCeRcNyBkzKoTru1pG5nFWfPfM=',
-            'x-amz-request-id': 'C6B8150894ABC0CE', 'date': 'Mon, 23 Nov 2020 20:45:06 GMT',
-            'last-modified': 'Fri, 13 Nov 2020 01:09:08 GMT', 'etag': '"6e6e13b8c0dcd187864fb3d4a7fce913"',
-            'accept-ranges': 'bytes', 'content-type': 'binary/octet-stream', 'content-length': '10279',
-            'server': 'AmazonS3'}, 'RetryAttempts': 0}, 'AcceptRanges': 'bytes',
-                                   'LastModified': datetime.datetime(2020, 11, 13, 1, 9, 8, tzinfo=tzutc()),
-                                   'ContentLength': 10279, 'ETag': '"6e6e13b8c0dcd187864fb3d4a7fce913"',
-                                   'ContentType': 'binary/octet-stream', 'Metadata': {}, 'Body': gen_s3_streaming_object([{"serviceName": "testService", "someValue": {"nextValue": "testValue"}}])}
-
     test_asset_id = str(uuid.uuid4())
     test_method_input = {"OperatorName": "testOperator",
                     "Results": {"serviceName": "testService", "someValue": {"nextValue": "testValue"}},
                     "WorkflowId": "abcd-1234-efgh-5678"}
-    test_metadata_key = 'private/assets/' + test_asset_id + '/' + 'workflows' + '/' + test_method_input[
-        'WorkflowId'] + '/' + test_method_input['OperatorName'] + '.json'
+    test_segment_prefix = 'private/assets/' + test_asset_id + '/' + 'workflows' + '/' + test_method_input[
+        'WorkflowId'] + '/' + test_method_input['OperatorName'] + '/'
 
     ddb_resource_stub.add_response(
         'get_item',
@@ -357,13 +512,20 @@ def test_put_asset_metadata_dynamo_error(test_client, s3_client_stub, ddb_resour
         service_response={"Item": {}}
     )
     s3_client_stub.add_response(
-        'get_object',
-        expected_params={"Bucket": "testDataplaneBucketName", "Key": test_metadata_key},
-        service_response=test_s3_get_object_response
+        'list_objects_v2',
+        expected_params={"Bucket": "testDataplaneBucketName", "Prefix": test_segment_prefix + 'page-'},
+        service_response={"Contents": [{"Key": test_segment_prefix + 'page-00000.json'}], "IsTruncated": False}
+    )
+    s3_client_stub.add_response(
+        'put_object',
+        expected_params={"Bucket": "testDataplaneBucketName", "Key": test_segment_prefix + 'page-00001.json',
+                         "Body": botocore.stub.ANY},
+        service_response={}
     )
     s3_client_stub.add_response(
         'put_object',
-        expected_params={"Bucket": "testDataplaneBucketName", "Key": test_metadata_key, "Body": botocore.stub.ANY},
+        expected_params={"Bucket": "testDataplaneBucketName", "Key": test_segment_prefix + 'manifest.json',
+                         "Body": botocore.stub.ANY},
         service_response={}
     )
     ddb_resource_stub.add_client_error('update_item')
@@ -375,26 +537,17 @@ def test_put_asset_metadata_dynamo_error(test_client, s3_client_stub, ddb_resour
 
 def test_put_asset_metadata_paginated_end(test_client, s3_client_stub, ddb_resource_stub):
     print('POST /metadata/{asset_id}?paginated=true&end=true')
-    test_s3_get_object_response = {'ResponseMetadata': {'RequestId': 'C6B8150894ABC0CE',
-                                                        'HostId': 'AF2tM9QcyL4DJlvHpccJBKOgOQbydnQLjfplgHGT8Fo+BNWrzjCeRcNyBkzKoTru1pG5nFWfPfM=',
-                                                        'HTTPStatusCode': 200, 'HTTPHeaders': {
-            'x-amz-id-2': 'AF2tM9QcyL4DJlvHpccJBKOgOQbydnQLjfplgHGT8Fo+BNWrzjCeRcNyBkzKoTru1pG5nFWfPfM=',
-            'x-amz-request-id': 'C6B8150894ABC0CE', 'date': 'Mon, 23 Nov 2020 20:45:06 GMT',
-            'last-modified': 'Fri, 13 Nov 2020 01:09:08 GMT', 'etag': '"6e6e13b8c0dcd187864fb3d4a7fce913"',
-            'accept-ranges': 'bytes', 'content-type': 'binary/octet-stream', 'content-length': '10279',
-            'server': 'AmazonS3'}, 'RetryAttempts': 0}, 'AcceptRanges': 'bytes',
-                                   'LastModified': datetime.datetime(2020, 11, 13, 1, 9, 8, tzinfo=tzutc()),
-                                   'ContentLength': 10279, 'ETag': '"6e6e13b8c0dcd187864fb3d4a7fce913"',
-                                   'ContentType': 'binary/octet-stream', 'Metadata': {}, 'Body': gen_s3_streaming_object([{"serviceName": "testService", "someValue": {"nextValue": "testValue"}}])}
-
     test_asset_id = str(uuid.uuid4())
     test_method_input = {"OperatorName": "testOperator",
                     "Results": {"serviceName": "testService", "someValue": {"nextValue": "testValue"}},
                     "WorkflowId": "abcd-1234-efgh-5678"}
-    test_metadata_key = 'private/assets/' + test_asset_id + '/' + 'workflows' + '/' + test_method_input[
-        'WorkflowId'] + '/' + test_method_input['OperatorName'] + '.json'
+    test_segment_prefix = 'private/assets/' + test_asset_id + '/' + 'workflows' + '/' + test_method_input[
+        'WorkflowId'] + '/' + test_method_input['OperatorName'] + '/'
+    test_manifest_key = test_segment_prefix + 'manifest.json'
+    test_manifest = {"Layout": "segmented", "PageCount": 2,
+                     "Pages": [test_segment_prefix + 'page-00000.json', test_segment_prefix + 'page-00001.json']}
 
-    test_pointer = [{"workflow": test_method_input["WorkflowId"], "pointer": test_metadata_key}]
+    test_pointer = [{"workflow": test_method_input["WorkflowId"], "pointer": test_manifest_key}]
 
     test_update_expression = "SET #operator_result = :result"
     test_expression_attr_name = {"#operator_result": test_method_input["OperatorName"]}
@@ -406,13 +559,20 @@ def test_put_asset_metadata_paginated_end(test_client, s3_client_stub, ddb_resou
         service_response={"Item": {}}
     )
     s3_client_stub.add_response(
-        'get_object',
-        expected_params={"Bucket": "testDataplaneBucketName", "Key": test_metadata_key},
-        service_response=test_s3_get_object_response
+        'list_objects_v2',
+        expected_params={"Bucket": "testDataplaneBucketName", "Prefix": test_segment_prefix + 'page-'},
+        service_response={"Contents": [{"Key": test_segment_prefix + 'page-00000.json'}], "IsTruncated": False}
+    )
+    s3_client_stub.add_response(
+        'put_object',
+        expected_params={"Bucket": "testDataplaneBucketName", "Key": test_segment_prefix + 'page-00001.json',
+                         "Body": json.dumps(test_method_input["Results"])},
+        service_response={}
     )
     s3_client_stub.add_response(
         'put_object',
-        expected_params={"Bucket": "testDataplaneBucketName", "Key": test_metadata_key, "Body": botocore.stub.ANY},
+        expected_params={"Bucket": "testDataplaneBucketName", "Key": test_manifest_key,
+                         "Body": json.dumps(test_manifest)},
         service_response={}
     )
     ddb_resource_stub.add_response(
@@ -428,7 +588,162 @@ def test_put_asset_metadata_paginated_end(test_client, s3_client_stub, ddb_resou
                                      body=bytes(json.dumps(test_method_input), encoding='utf-8'))
     assert response.status_code == 200
     formatted_response = json.loads(response.body)
-    print(formatted_response)
+    assert formatted_response == {"Status": "Success", "Bucket": "testDataplaneBucketName", "Key": test_manifest_key}
+    print('Pass')
+
+def test_put_asset_metadata_batch(test_client, s3_client_stub, ddb_resource_stub):
+    print('POST /metadata/{asset_id}/batch')
+    test_asset_id = str(uuid.uuid4())
+    test_workflow_id = "abcd-1234-efgh-5678"
+    test_metadata_prefix = 'private/assets/' + test_asset_id + '/workflows/' + test_workflow_id + '/'
+    test_segment_prefix = test_metadata_prefix + 'pagedOperator/'
+    test_items = [
+        {"OperatorName": "testOperator", "WorkflowId": test_workflow_id, "Results": {"someValue": 1}},
+        {"OperatorName": "pagedOperator", "WorkflowId": test_workflow_id, "Results": {"page": 1},
+         "Paginated": True},
+        {"OperatorName": "pagedOperator", "WorkflowId": test_workflow_id, "Results": {"page": 2},
+         "Paginated": True, "EndPagination": True}
+    ]
+    test_manifest = {"Layout": "segmented", "PageCount": 3,
+                     "Pages": [test_segment_prefix + 'page-00000.json', test_segment_prefix + 'page-00001.json',
+                               test_segment_prefix + 'page-00002.json']}
+
+    ddb_resource_stub.add_response(
+        'get_item',
+        expected_params={"Key": {"AssetId": test_asset_id}, "TableName": "testDataplaneTableName"},
+        service_response={"Item": {"testOperator": {"L": [{"M": {"workflow": {"S": "oldWorkflow"},
+                                                                 "pointer": {"S": "oldPointer.json"}}}]}}}
+    )
+    s3_client_stub.add_response(
+        'list_objects_v2',
+        expected_params={"Bucket": "testDataplaneBucketName", "Prefix": test_segment_prefix + 'page-'},
+        service_response={"Contents": [{"Key": test_segment_prefix + 'page-00000.json'}], "IsTruncated": False}
+    )
+    # The objects are written concurrently, so the order of these calls is not fixed
+    for _ in range(3):
+        s3_client_stub.add_response(
+            'put_object',
+            expected_params={"Bucket": "testDataplaneBucketName", "Key": botocore.stub.ANY, "Body": botocore.stub.ANY},
+            service_response={}
+        )
+    s3_client_stub.add_response(
+        'put_object',
+        expected_params={"Bucket": "testDataplaneBucketName", "Key": test_segment_prefix + 'manifest.json',
+                         "Body": json.dumps(test_manifest)},
+        service_response={}
+    )
+    ddb_resource_stub.add_response(
+        'update_item',
+        expected_params={"Key": {"AssetId": test_asset_id},
+                         "UpdateExpression": "SET #operator_result0 = :result0, #operator_result1 = :result1",
+                         "ExpressionAttributeNames": {"#operator_result0": "testOperator",
+                                                      "#operator_result1": "pagedOperator"},
+                         "ExpressionAttributeValues": {
+                             ":result0": [{"workflow": test_workflow_id,
+                                           "pointer": test_metadata_prefix + 'testOperator.json'},
+                                          {"workflow": "oldWorkflow", "pointer": "oldPointer.json"}],
+                             ":result1": [{"workflow": test_workflow_id,
+                                           "pointer": test_segment_prefix + 'manifest.json'}]},
+                         "TableName": "testDataplaneTableName"
+                         },
+        service_response={})
+
+    response = test_client.http.post('/metadata/{asset_id}/batch'.format(asset_id=test_asset_id),
+                                     body=bytes(json.dumps({"Items": test_items}), encoding='utf-8'))
+    assert response.status_code == 200
+    formatted_response = json.loads(response.body)
+    assert formatted_response == {"Status": "Success", "Results": [
+        {"OperatorName": "testOperator", "Status": "Success", "Bucket": "testDataplaneBucketName",
+         "Key": test_metadata_prefix + 'testOperator.json'},
+        {"OperatorName": "pagedOperator", "Status": "Success"},
+        {"OperatorName": "pagedOperator", "Status": "Success", "Bucket": "testDataplaneBucketName",
+         "Key": test_segment_prefix + 'manifest.json'}
+    ]}
+    print('Pass')
+
+def test_put_asset_metadata_batch_numbered_pages(test_client, s3_client_stub, ddb_resource_stub):
+    print('POST /metadata/{asset_id}/batch')
+    test_asset_id = str(uuid.uuid4())
+    test_workflow_id = "abcd-1234-efgh-5678"
+    test_segment_prefix = 'private/assets/' + test_asset_id + '/workflows/' + test_workflow_id + '/pagedOperator/'
+    test_items = [
+        {"OperatorName": "pagedOperator", "WorkflowId": test_workflow_id, "Results": {"page": 5},
+         "Paginated": True, "Page": 5},
+        {"OperatorName": "pagedOperator", "WorkflowId": test_workflow_id, "Results": {"page": 6},
+         "Paginated": True, "Page": 6},
+        {"OperatorName": "pagedOperator", "WorkflowId": test_workflow_id, "Results": {"page": 7},
+         "Paginated": True, "Page": -1}
+    ]
+
+    ddb_resource_stub.add_response(
+        'get_item',
+        expected_params={"Key": {"AssetId": test_asset_id}, "TableName": "testDataplaneTableName"},
+        service_response={"Item": {}}
+    )
+    # Numbered pages go straight to their keys, the stored pages are not listed
+    for _ in range(2):
+        s3_client_stub.add_response(
+            'put_object',
+            expected_params={"Bucket": "testDataplaneBucketName", "Key": botocore.stub.ANY, "Body": botocore.stub.ANY},
+            service_response={}
+        )
+
+    response = test_client.http.post('/metadata/{asset_id}/batch'.format(asset_id=test_asset_id),
+                                     body=bytes(json.dumps({"Items": test_items}), encoding='utf-8'))
+    assert response.status_code == 200
+    formatted_response = json.loads(response.body)
+    assert [result['Status'] for result in formatted_response['Results']] == ['Success', 'Success', 'Error']
+    print('Pass')
+
+def test_put_asset_metadata_batch_item_errors(test_client, s3_client_stub, ddb_resource_stub):
+    print('POST /metadata/{asset_id}/batch')
+    test_asset_id = str(uuid.uuid4())
+    test_items = [
+        {"OperatorName": "testOperator", "Results": {"someValue": 1}},
+        {"OperatorName": "otherOperator", "WorkflowId": "abcd-1234-efgh-5678", "Results": {"someValue": 1}}
+    ]
+
+    ddb_resource_stub.add_response(
+        'get_item',
+        expected_params={"Key": {"AssetId": test_asset_id}, "TableName": "testDataplaneTableName"},
+        service_response={"Item": {}}
+    )
+    s3_client_stub.add_client_error('put_object')
+
+    response = test_client.http.post('/metadata/{asset_id}/batch'.format(asset_id=test_asset_id),
+                                     body=bytes(json.dumps({"Items": test_items}), encoding='utf-8'))
+    assert response.status_code == 200
+    formatted_response = json.loads(response.body)
+    assert formatted_response['Status'] == 'Error'
+    assert [result['Status'] for result in formatted_response['Results']] == ['Error', 'Error']
+    assert "'WorkflowId'" in formatted_response['Results'][0]['Message']
+    print('Pass')
+
+def test_put_asset_metadata_batch_input_error(test_client):
+    print('POST /metadata/{asset_id}/batch')
+    test_asset_id = str(uuid.uuid4())
+
+    response = test_client.http.post('/metadata/{asset_id}/batch'.format(asset_id=test_asset_id),
+                                     body=bytes(json.dumps({"Items": []}), encoding='utf-8'))
+    assert response.status_code == 400
+    formatted_response = json.loads(response.body)
+    assert formatted_response['Code'] == 'BadRequestError'
+    print('Pass')
+
+def test_put_asset_metadata_batch_asset_not_found(test_client, ddb_resource_stub):
+    print('POST /metadata/{asset_id}/batch')
+    test_asset_id = str(uuid.uuid4())
+    test_items = [{"OperatorName": "testOperator", "WorkflowId": "abcd-1234-efgh-5678", "Results": {}}]
+
+    ddb_resource_stub.add_response(
+        'get_item',
+        expected_params={"Key": {"AssetId": test_asset_id}, "TableName": "testDataplaneTableName"},
+        service_response={}
+    )
+
+    response = test_client.http.post('/metadata/{asset_id}/batch'.format(asset_id=test_asset_id),
+                                     body=bytes(json.dumps({"Items": test_items}), encoding='utf-8'))
+    assert response.status_code == 404
     print('Pass')
 
 def test_get_asset_metadata_first_call_without_returned_cursor(test_client, ddb_resource_stub):
@@ -975,56 +1290,384 @@ def test_get_asset_metadata_operator_cursor_call(test_client, s3_client_stub, dd
         'remaining': ['testOperator']
     })
 
-def test_lock_asset_dynamo_error(test_client, ddb_client_stub):
-    print('POST /checkout/{asset_id}')
-    test_asset_id = str(uuid.uuid4())
-    test_user_name = 'testUserName'
-
-    ddb_client_stub.add_client_error('update_item')
-
-    response = test_client.http.post(
-        '/checkout/{asset_id}'.format(asset_id = test_asset_id),
-        body = b'{"LockedBy": "testUserName"}'
-    )
-    assert response.status_code == 500
+def test_get_asset_metadata_operator_segmented(test_client, s3_client_stub, ddb_resource_stub):
+    print('GET /metadata/{asset_id}/{operator_name}')
 
-def test_lock_asset(test_client, ddb_client_stub):
-    print('POST /checkout/{asset_id}')
     test_asset_id = str(uuid.uuid4())
-    test_user_name = 'testUserName'
+    test_operator_name = 'testOperator'
+    test_manifest_key = 'testPrefix/testOperator/manifest.json'
 
-    ddb_client_stub.add_response(
-        'update_item',
+    ddb_resource_stub.add_response(
+        'get_item',
         expected_params = {
-            'TableName': 'testDataplaneTableName',
-            'Key': {'AssetId': {'S': test_asset_id}},
-            'UpdateExpression': 'set Locked = :locked, LockedBy = :lockedby, LockedAt = :timestamp',
-            'ExpressionAttributeValues': {':locked': {'S': 'true'}, ':lockedby': {'S': test_user_name}, ':timestamp': {'N': botocore.stub.ANY}},
-            'ConditionExpression': 'attribute_not_exists(LockedBy) and attribute_not_exists(LockedAt)'
+            "Key": {
+                "AssetId": test_asset_id,
+            },
+            "ProjectionExpression": "#attr",
+            "ExpressionAttributeNames": {"#attr": test_operator_name},
+            "TableName": "testDataplaneTableName"
         },
         service_response = {
-            'ResponseMetadata': {
-                'HTTPStatusCode': 200
+            "Item": {
+                "testOperator": {"L": [{"M": {"pointer": {"S": test_manifest_key}}}]}
             }
         }
     )
+    s3_client_stub.add_response(
+        'get_object',
+        expected_params = {"Bucket": "testDataplaneBucketName", "Key": test_manifest_key},
+        service_response = {
+            'Body': gen_s3_streaming_object({"Layout": "segmented", "PageCount": 2,
+                                             "Pages": ["testPage0", "testPage1"]})
+        }
+    )
+    s3_client_stub.add_response(
+        'get_object',
+        expected_params = {"Bucket": "testDataplaneBucketName", "Key": "testPage0"},
+        service_response = {'Body': gen_s3_streaming_object({"page": 0})}
+    )
 
-    response = test_client.http.post(
-        '/checkout/{asset_id}'.format(asset_id = test_asset_id),
-        body = b'{"LockedBy": "testUserName"}'
+    response = test_client.http.get(
+        '/metadata/{asset_id}/{operator_name}'.format(asset_id = test_asset_id, operator_name = test_operator_name)
     )
-    assert response != None
-    assert response.status_code == 200
+    formatted_response = json.loads(response.body)
+    assert formatted_response['results'] == {"page": 0}
+    assert formatted_response['cursor'] == encode_cursor({
+        'next': {
+            'testOperator': test_manifest_key,
+            'page': 1
+        },
+        'remaining': ['testOperator']
+    })
 
-def test_unlock_asset_dynamo_error(test_client, ddb_client_stub):
-    print('POST /checkin/{asset_id}')
-    test_asset_id = str(uuid.uuid4())
+def test_get_asset_metadata_operator_pointer(test_client, ddb_resource_stub):
+    print('GET /metadata/{asset_id}/{operator_name}?pointer=true')
 
-    ddb_client_stub.add_client_error('update_item')
+    test_asset_id = str(uuid.uuid4())
+    test_operator_name = 'testOperator'
 
-    response = test_client.http.post(
-        '/checkin/{asset_id}'.format(asset_id = test_asset_id),
-        body = b'{"LockedBy": "testUserName"}'
+    ddb_resource_stub.add_response(
+        'get_item',
+        expected_params = {
+            "Key": {
+                "AssetId": test_asset_id,
+            },
+            "ProjectionExpression": "#attr",
+            "ExpressionAttributeNames": {"#attr": test_operator_name},
+            "TableName": "testDataplaneTableName"
+        },
+        service_response = {
+            "Item": {
+                "testOperator": {"L": [{"M": {"pointer": {"S": "testPointer"}}}]}
+            }
+        }
+    )
+
+    response = test_client.http.get(
+        '/metadata/{asset_id}/{operator_name}?pointer=true'.format(asset_id = test_asset_id, operator_name = test_operator_name)
+    )
+    formatted_response = json.loads(response.body)
+    assert formatted_response == {
+        'asset_id': test_asset_id,
+        'operator': test_operator_name,
+        'S3Bucket': 'testDataplaneBucketName',
+        'S3Key': 'testPointer'
+    }
+
+def test_dataplane_helper_direct_mode_retrieve_operator_metadata_all(s3_client_stub, ddb_resource_stub):
+    from app import storage
+    from MediaInsightsEngineLambdaHelper import DataPlane
+
+    test_asset_id = str(uuid.uuid4())
+    test_operator_name = 'testOperator'
+    test_manifest_key = 'testPrefix/testOperator/manifest.json'
+
+    for pointer in ["testPointer", "testSinglePointer", test_manifest_key]:
+        ddb_resource_stub.add_response(
+            'get_item',
+            expected_params = {
+                "Key": {"AssetId": test_asset_id},
+                "ProjectionExpression": "#attr",
+                "ExpressionAttributeNames": {"#attr": test_operator_name},
+                "TableName": "testDataplaneTableName"
+            },
+            service_response = {
+                "Item": {
+                    "testOperator": {"L": [{"M": {"pointer": {"S": pointer}}}]}
+                }
+            }
+        )
+    s3_client_stub.add_response(
+        'get_object',
+        expected_params = {"Bucket": "testDataplaneBucketName", "Key": "testPointer"},
+        service_response = {'Body': gen_s3_streaming_object([{"page": 0}, {"page": 1}, {"page": 2}])}
+    )
+    s3_client_stub.add_response(
+        'get_object',
+        expected_params = {"Bucket": "testDataplaneBucketName", "Key": "testSinglePointer"},
+        service_response = {'Body': gen_s3_streaming_object({"page": 0})}
+    )
+    s3_client_stub.add_response(
+        'get_object',
+        expected_params = {"Bucket": "testDataplaneBucketName", "Key": test_manifest_key},
+        service_response = {
+            'Body': gen_s3_streaming_object({"Layout": "segmented", "PageCount": 1, "Pages": ["testPage0"]})
+        }
+    )
+    s3_client_stub.add_response(
+        'get_object',
+        expected_params = {"Bucket": "testDataplaneBucketName", "Key": "testPage0"},
+        service_response = {'Body': gen_s3_streaming_object({"page": 0})}
+    )
+
+    dataplane = DataPlane(mode="direct")
+    dataplane.storage = storage
+
+    response = dataplane.retrieve_operator_metadata_all(test_asset_id, test_operator_name)
+    assert response == {'asset_id': test_asset_id, 'operator': test_operator_name,
+                        'results': [{"page": 0}, {"page": 1}, {"page": 2}]}
+    response = dataplane.retrieve_operator_metadata_all(test_asset_id, test_operator_name)
+    assert response['results'] == [{"page": 0}]
+    response = dataplane.retrieve_operator_metadata_all(test_asset_id, test_operator_name)
+    assert response['results'] == [{"page": 0}]
+
+def test_get_asset_metadata_cursor_call_segmented_last_page(test_client, s3_client_stub):
+    print('GET /metadata/{asset_id}?cursor={cursor}')
+    test_asset_id = str(uuid.uuid4())
+    test_manifest_key = 'testPrefix/testOperator/manifest.json'
+    test_cursor = {
+        'next': {
+            'testOperator': test_manifest_key,
+            'page': 1
+        },
+        'remaining': [{
+            'testOperator': test_manifest_key,
+            'page': 0
+        }]
+    }
+
+    s3_client_stub.add_response(
+        'get_object',
+        expected_params = {"Bucket": "testDataplaneBucketName", "Key": test_manifest_key},
+        service_response = {
+            'Body': gen_s3_streaming_object({"Layout": "segmented", "PageCount": 2,
+                                             "Pages": ["testPage0", "testPage1"]})
+        }
+    )
+    s3_client_stub.add_response(
+        'get_object',
+        expected_params = {"Bucket": "testDataplaneBucketName", "Key": "testPage1"},
+        service_response = {'Body': gen_s3_streaming_object({"page": 1})}
+    )
+
+    response = test_client.http.get(
+        '/metadata/{asset_id}?cursor={test_cursor}'.format(asset_id = test_asset_id, test_cursor = encode_cursor(test_cursor))
+    )
+    formatted_response = json.loads(response.body)
+    assert formatted_response['operator'] == 'testOperator'
+    assert formatted_response['results'] == {"page": 1}
+    assert 'cursor' not in formatted_response
+
+def test_get_asset_metadata_cursor_call_segmented_missing_page(test_client, s3_client_stub):
+    print('GET /metadata/{asset_id}?cursor={cursor}')
+    test_asset_id = str(uuid.uuid4())
+    test_manifest_key = 'testPrefix/testOperator/manifest.json'
+    test_cursor = {
+        'next': {
+            'testOperator': test_manifest_key,
+            'page': 1
+        },
+        'remaining': [{
+            'testOperator': test_manifest_key,
+            'page': 0
+        }]
+    }
+
+    s3_client_stub.add_response(
+        'get_object',
+        expected_params = {"Bucket": "testDataplaneBucketName", "Key": test_manifest_key},
+        service_response = {
+            'Body': gen_s3_streaming_object({"Layout": "segmented", "PageCount": 2,
+                                             "Pages": ["testPage0", "testPage1"]})
+        }
+    )
+    s3_client_stub.add_client_error(
+        'get_object',
+        expected_params = {"Bucket": "testDataplaneBucketName", "Key": "testPage1"},
+        service_error_code='NoSuchKey'
+    )
+
+    response = test_client.http.get(
+        '/metadata/{asset_id}?cursor={test_cursor}'.format(asset_id = test_asset_id, test_cursor = encode_cursor(test_cursor))
+    )
+    formatted_response = json.loads(response.body)
+    assert response.status_code == 500
+    assert formatted_response['Code'] == 'ChaliceViewError'
+    assert 'testPage1' in formatted_response['Message']
+
+def test_get_asset_metadata_operator_cursor_call_single_object(test_client, s3_client_stub):
+    print('GET /metadata/{asset_id}/{operator_name}?cursor={cursor}')
+
+    test_asset_id = str(uuid.uuid4())
+    test_operator_name = 'testOperator'
+    test_cursor = {
+        'next': {
+            'testOperator': 'testPrefix/testOperator.json',
+            'page': 1
+        },
+        'remaining': ['testOperator']
+    }
+
+    # A list stored as a single object is read whole, no other object is looked up
+    s3_client_stub.add_response(
+        'get_object',
+        expected_params = {"Bucket": "testDataplaneBucketName", "Key": 'testPrefix/testOperator.json'},
+        service_response = {'Body': gen_s3_streaming_object(['testOperator1', 'testOperator2'])}
+    )
+
+    response = test_client.http.get(
+        '/metadata/{asset_id}/{operator_name}?cursor={test_cursor}'.format(asset_id = test_asset_id, operator_name = test_operator_name, test_cursor = encode_cursor(test_cursor))
+    )
+    formatted_response = json.loads(response.body)
+    assert formatted_response['results'] == 'testOperator2'
+    assert 'cursor' not in formatted_response
+
+def test_store_and_read_paginated_metadata(test_client, s3_client_stub, ddb_resource_stub):
+    print('POST /metadata/{asset_id}?paginated=true then GET /metadata/{asset_id}/{operator_name}')
+
+    test_asset_id = str(uuid.uuid4())
+    test_workflow_id = 'abcd-1234-efgh-5678'
+    test_operator_name = 'testOperator'
+    test_segment_prefix = 'private/assets/' + test_asset_id + '/workflows/' + test_workflow_id + '/' + \
+        test_operator_name + '/'
+    test_manifest_key = test_segment_prefix + 'manifest.json'
+    test_pages = [{"Labels": ["testLabel1"]}, {"Labels": ["testLabel2"]}]
+    test_manifest = {"Layout": "segmented", "PageCount": 2,
+                     "Pages": [test_segment_prefix + 'page-00000.json', test_segment_prefix + 'page-00001.json']}
+
+    # Store both pages through the API, recording every object it writes
+    for page_num, page in enumerate(test_pages):
+        ddb_resource_stub.add_response(
+            'get_item',
+            expected_params = {"Key": {"AssetId": test_asset_id}, "TableName": "testDataplaneTableName"},
+            service_response = {"Item": {}}
+        )
+        s3_client_stub.add_response(
+            'put_object',
+            expected_params = {"Bucket": "testDataplaneBucketName", "Key": test_manifest["Pages"][page_num],
+                               "Body": json.dumps(page)},
+            service_response = {}
+        )
+    s3_client_stub.add_response(
+        'put_object',
+        expected_params = {"Bucket": "testDataplaneBucketName", "Key": test_manifest_key,
+                           "Body": json.dumps(test_manifest)},
+        service_response = {}
+    )
+    ddb_resource_stub.add_response(
+        'update_item',
+        expected_params = {"Key": {"AssetId": test_asset_id}, "UpdateExpression": "SET #operator_result = :result",
+                           "ExpressionAttributeNames": {"#operator_result": test_operator_name},
+                           "ExpressionAttributeValues": {":result": [{"workflow": test_workflow_id,
+                                                                      "pointer": test_manifest_key}]},
+                           "TableName": "testDataplaneTableName"},
+        service_response = {}
+    )
+    for page_num, page in enumerate(test_pages):
+        query = 'paginated=true&page={page}'.format(page=page_num)
+        if page_num == len(test_pages) - 1:
+            query += '&end=true'
+        response = test_client.http.post(
+            '/metadata/{asset_id}?{query}'.format(asset_id = test_asset_id, query = query),
+            body = bytes(json.dumps({"OperatorName": test_operator_name, "WorkflowId": test_workflow_id,
+                                     "Results": page}), encoding='utf-8')
+        )
+        assert response.status_code == 200
+
+    # Read the pages back, serving the objects that were written. Only the manifest and the requested page are
+    # fetched, there is no side object per page
+    ddb_resource_stub.add_response(
+        'get_item',
+        expected_params = {"Key": {"AssetId": test_asset_id}, "ProjectionExpression": "#attr",
+                           "ExpressionAttributeNames": {"#attr": test_operator_name},
+                           "TableName": "testDataplaneTableName"},
+        service_response = {"Item": {test_operator_name: {"L": [{"M": {
+            "workflow": {"S": test_workflow_id}, "pointer": {"S": test_manifest_key}}}]}}}
+    )
+    for page_num, page in enumerate(test_pages):
+        s3_client_stub.add_response(
+            'get_object',
+            expected_params = {"Bucket": "testDataplaneBucketName", "Key": test_manifest_key},
+            service_response = {'Body': gen_s3_streaming_object(test_manifest)}
+        )
+        s3_client_stub.add_response(
+            'get_object',
+            expected_params = {"Bucket": "testDataplaneBucketName", "Key": test_manifest["Pages"][page_num]},
+            service_response = {'Body': gen_s3_streaming_object(page)}
+        )
+
+    response = test_client.http.get(
+        '/metadata/{asset_id}/{operator_name}'.format(asset_id = test_asset_id, operator_name = test_operator_name)
+    )
+    formatted_response = json.loads(response.body)
+    assert formatted_response['results'] == test_pages[0]
+    response = test_client.http.get(
+        '/metadata/{asset_id}/{operator_name}?cursor={test_cursor}'.format(asset_id = test_asset_id, operator_name = test_operator_name, test_cursor = formatted_response['cursor'])
+    )
+    formatted_response = json.loads(response.body)
+    assert formatted_response['results'] == test_pages[1]
+    assert 'cursor' not in formatted_response
+
+def test_lock_asset_dynamo_error(test_client, ddb_client_stub):
+    print('POST /checkout/{asset_id}')
+    test_asset_id = str(uuid.uuid4())
+    test_user_name = 'testUserName'
+
+    ddb_client_stub.add_client_error('update_item')
+
+    response = test_client.http.post(
+        '/checkout/{asset_id}'.format(asset_id = test_asset_id),
+        body = b'{"LockedBy": "testUserName"}'
+    )
+    assert response.status_code == 500
+
+def test_lock_asset(test_client, ddb_client_stub):
+    print('POST /checkout/{asset_id}')
+    test_asset_id = str(uuid.uuid4())
+    test_user_name = 'testUserName'
+
+    ddb_client_stub.add_response(
+        'update_item',
+        expected_params = {
+            'TableName': 'testDataplaneTableName',
+            'Key': {'AssetId': {'S': test_asset_id}},
+            'UpdateExpression': 'set Locked = :locked, LockedBy = :lockedby, LockedAt = :timestamp',
+            'ExpressionAttributeValues': {':locked': {'S': 'true'}, ':lockedby': {'S': test_user_name}, ':timestamp': {'N': botocore.stub.ANY}},
+            'ConditionExpression': 'attribute_not_exists(LockedBy) and attribute_not_exists(LockedAt)'
+        },
+        service_response = {
+            'ResponseMetadata': {
+                'HTTPStatusCode': 200
+            }
+        }
+    )
+
+    response = test_client.http.post(
+        '/checkout/{asset_id}'.format(asset_id = test_asset_id),
+        body = b'{"LockedBy": "testUserName"}'
+    )
+    assert response != None
+    assert response.status_code == 200
+
+def test_unlock_asset_dynamo_error(test_client, ddb_client_stub):
+    print('POST /checkin/{asset_id}')
+    test_asset_id = str(uuid.uuid4())
+
+    ddb_client_stub.add_client_error('update_item')
+
+    response = test_client.http.post(
+        '/checkin/{asset_id}'.format(asset_id = test_asset_id),
+        body = b'{"LockedBy": "testUserName"}'
     )
     assert response.status_code == 500
 
@@ -1147,6 +1790,87 @@ def test_list_all_assets(test_client, ddb_resource_stub):
     assert response.status_code == 200
     assert response.body == b'{"assets":["testAssetId"]}'
 
+def test_list_all_assets_paginated(test_client, ddb_resource_stub):
+    print('GET /metadata')
+
+    ddb_resource_stub.add_response(
+        'scan',
+        expected_params = {
+            'TableName': 'testDataplaneTableName',
+            'Select': 'SPECIFIC_ATTRIBUTES',
+            'AttributesToGet': ['AssetId'],
+            'Segment': 1,
+            'TotalSegments': 4,
+            'Limit': 2
+        },
+        service_response = {
+            'Items': [{'AssetId': {'S': 'testAssetId1'}}, {'AssetId': {'S': 'testAssetId2'}}],
+            'LastEvaluatedKey': {'AssetId': {'S': 'testAssetId2'}}
+        }
+    )
+
+    response = test_client.http.get('/metadata?limit=2&segment=1&totalSegments=4')
+
+    assert response.status_code == 200
+    assert response.json_body['assets'] == ['testAssetId1', 'testAssetId2']
+    cursor = response.json_body['cursor']
+
+    ddb_resource_stub.add_response(
+        'scan',
+        expected_params = {
+            'TableName': 'testDataplaneTableName',
+            'Select': 'SPECIFIC_ATTRIBUTES',
+            'AttributesToGet': ['AssetId'],
+            'Segment': 1,
+            'TotalSegments': 4,
+            'ExclusiveStartKey': {'AssetId': 'testAssetId2'},
+            'Limit': 2
+        },
+        service_response = {
+            'Items': [{'AssetId': {'S': 'testAssetId3'}}]
+        }
+    )
+
+    response = test_client.http.get('/metadata?limit=2&segment=1&totalSegments=4&cursor=' + cursor)
+
+    assert response.status_code == 200
+    assert response.json_body == {'assets': ['testAssetId3']}
+
+def test_list_all_assets_created_after(test_client, ddb_resource_stub, monkeypatch):
+    print('GET /metadata')
+    import app
+    monkeypatch.setattr(app, 'current_created_month', lambda: '2021-01')
+
+    # 2020-12-31T12:00:00Z
+    created_after = '1609416000.0'
+    for month, items in (('2020-12', ['testAssetId1']), ('2021-01', ['testAssetId2'])):
+        ddb_resource_stub.add_response(
+            'query',
+            expected_params = {
+                'TableName': 'testDataplaneTableName',
+                'IndexName': 'AssetCreated',
+                'KeyConditionExpression': 'CreatedMonth = :month AND Created > :created_after',
+                'ExpressionAttributeValues': {':month': month, ':created_after': created_after},
+                'Limit': 1000 - (month == '2021-01')
+            },
+            service_response = {
+                'Items': [{'AssetId': {'S': asset_id}} for asset_id in items]
+            }
+        )
+
+    response = test_client.http.get('/metadata?createdAfter=1609416000')
+
+    assert response.status_code == 200
+    assert response.json_body == {'assets': ['testAssetId1', 'testAssetId2']}
+
+def test_list_all_assets_invalid_query(test_client):
+    print('GET /metadata')
+
+    for query in ('limit=0', 'limit=1001', 'cursor=notacursor', 'segment=1', 'segment=4&totalSegments=4',
+                  'createdAfter=yesterday', 'createdAfter=1&segment=0&totalSegments=2'):
+        response = test_client.http.get('/metadata?' + query)
+        assert response.status_code == 400, query
+
 def test_delete_operator_metadata_dynamo_error(test_client, ddb_resource_stub):
     print('DELETE /metadata/{asset_id}/{operator_name}')
     
@@ -1246,6 +1970,54 @@ def test_delete_operator_metadata(test_client, ddb_resource_stub, s3_client_stub
     assert response.status_code == 200
     assert response.body == b'{}'
 
+def test_delete_operator_metadata_segmented(test_client, ddb_resource_stub, s3_client_stub):
+    print('DELETE /metadata/{asset_id}/{operator_name}')
+
+    test_asset_id = 'testAssetId'
+    test_operator_name = 'testOperatorName'
+    test_manifest_key = 'testPrefix/testOperatorName/manifest.json'
+
+    ddb_resource_stub.add_response(
+        'update_item',
+        expected_params = {
+            'TableName': 'testDataplaneTableName',
+            'Key': {
+                'AssetId': test_asset_id
+            },
+            'UpdateExpression': 'REMOVE #operator',
+            'ExpressionAttributeNames': {"#operator": test_operator_name},
+            'ReturnValues': 'UPDATED_OLD'
+        },
+        service_response = {
+            'Attributes': {
+                'testOperatorName': {'L': [{'M': {'pointer': {'S': test_manifest_key}}}]}
+            }
+        }
+    )
+    s3_client_stub.add_response(
+        'get_object',
+        expected_params = {"Bucket": "testDataplaneBucketName", "Key": test_manifest_key},
+        service_response = {
+            'Body': gen_s3_streaming_object({"Layout": "segmented", "PageCount": 2,
+                                             "Pages": ["testPage0", "testPage1"]})
+        }
+    )
+    s3_client_stub.add_response(
+        'delete_objects',
+        expected_params = {
+            'Bucket': 'testDataplaneBucketName',
+            'Delete': {
+                'Objects': [{'Key': 'testPage0'}, {'Key': 'testPage1'}, {'Key': test_manifest_key}]
+            }
+        },
+        service_response = {}
+    )
+
+    response = test_client.http.delete(
+        '/metadata/{asset_id}/{operator_name}'.format(asset_id = test_asset_id, operator_name = test_operator_name)
+    )
+    assert response.status_code == 200
+
 def test_delete_asset_dynamo_error(test_client, ddb_resource_stub):
     print('DELETE /metadata/{asset_id}')
 
@@ -1259,7 +2031,7 @@ def test_delete_asset_dynamo_error(test_client, ddb_resource_stub):
     assert response.status_code == 500
 
 
-def test_delete_asset_s3_delete_error(test_client, ddb_resource_stub, s3_client_stub, s3_resource_stub):
+def test_delete_asset_s3_delete_error(test_client, ddb_resource_stub, s3_client_stub):
     print('DELETE /metadata/{asset_id}')
 
     test_asset_id = str(uuid.uuid4())
@@ -1294,7 +2066,7 @@ def test_delete_asset_s3_delete_error(test_client, ddb_resource_stub, s3_client_
     )
     assert response.status_code == 500
 
-def test_delete_asset_s3_delete_error2(test_client, ddb_resource_stub, s3_client_stub, s3_resource_stub):
+def test_delete_asset_s3_list_error(test_client, ddb_resource_stub, s3_client_stub):
     print('DELETE /metadata/{asset_id}')
 
     test_asset_id = str(uuid.uuid4())
@@ -1337,14 +2109,14 @@ def test_delete_asset_s3_delete_error2(test_client, ddb_resource_stub, s3_client
         service_response = {}
     )
 
-    s3_resource_stub.add_client_error('delete_object')
+    s3_client_stub.add_client_error('list_objects_v2')
 
     response = test_client.http.delete(
         '/metadata/{asset_id}'.format(asset_id = test_asset_id)
     )
     assert response.status_code == 500
 
-def test_delete_asset(test_client, ddb_resource_stub, s3_client_stub, s3_resource_stub):
+def test_delete_asset(test_client, ddb_resource_stub, s3_client_stub):
     print('DELETE /metadata/{asset_id}')
 
     test_asset_id = str(uuid.uuid4())
@@ -1387,11 +2159,31 @@ def test_delete_asset(test_client, ddb_resource_stub, s3_client_stub, s3_resourc
         service_response = {}
     )
 
-    s3_resource_stub.add_response(
-        'delete_object',
+    # Workflow artifacts are found by listing the asset directory
+    s3_client_stub.add_response(
+        'list_objects_v2',
         expected_params = {
             'Bucket': 'testDataplaneBucketName',
-            'Key': 'private/assets/' + test_asset_id +'/',
+            'Prefix': 'private/assets/' + test_asset_id + '/'
+        },
+        service_response = {
+            'IsTruncated': False,
+            'Contents': [
+                {'Key': 'private/assets/' + test_asset_id + '/'},
+                {'Key': 'private/assets/' + test_asset_id + '/workflows/testWorkflowId/testArtifact.mp4'}
+            ]
+        }
+    )
+    s3_client_stub.add_response(
+        'delete_objects',
+        expected_params = {
+            'Bucket': 'testDataplaneBucketName',
+            'Delete': {
+                'Objects': [
+                    {'Key': 'private/assets/' + test_asset_id + '/'},
+                    {'Key': 'private/assets/' + test_asset_id + '/workflows/testWorkflowId/testArtifact.mp4'}
+                ]
+            }
         },
         service_response = {}
     )
@@ -1401,3 +2193,199 @@ def test_delete_asset(test_client, ddb_resource_stub, s3_client_stub, s3_resourc
     )
     assert response.status_code == 200
     assert response.body == 'Deleted asset: {asset_id} from the dataplane'.format(asset_id = test_asset_id).encode()
+
+
+def test_delete_asset_async(test_client, ddb_resource_stub, s3_client_stub, lambda_client_stub):
+    print('DELETE /metadata/{asset_id}?async=true')
+    import app
+
+    test_asset_id = str(uuid.uuid4())
+    asset_path = 'private/assets/' + test_asset_id + '/'
+
+    ddb_resource_stub.add_response(
+        'delete_item',
+        expected_params = {
+            'TableName': 'testDataplaneTableName',
+            'Key': {
+                'AssetId': test_asset_id
+            },
+            'ReturnValues': 'ALL_OLD'
+        },
+        service_response = {
+            'Attributes': {
+                'S3Key': {'S': asset_path + 'input/testKeyValue'},
+                'testOperatorName': {'L': [{'M': {'pointer': {'S': asset_path + 'workflows/testPointer.json'}}}]}
+            }
+        }
+    )
+    s3_client_stub.add_response(
+        'put_object',
+        expected_params = {'Bucket': 'testDataplaneBucketName', 'Key': botocore.stub.ANY, 'Body': botocore.stub.ANY},
+        service_response = {}
+    )
+    lambda_client_stub.add_response(
+        'invoke',
+        expected_params = {'FunctionName': botocore.stub.ANY, 'InvocationType': 'Event', 'Payload': botocore.stub.ANY},
+        service_response = {}
+    )
+
+    response = test_client.http.delete('/metadata/{asset_id}?async=true'.format(asset_id = test_asset_id))
+    assert response.status_code == 202
+    job = response.json_body
+    assert job['AssetId'] == test_asset_id
+    assert job['Status'] == 'Started'
+    assert 'Keys' not in job
+
+    class Context:
+        function_name = 'testFunctionName'
+
+        def __init__(self, remaining_ms):
+            self.remaining_ms = remaining_ms
+
+        def get_remaining_time_in_millis(self):
+            return self.remaining_ms
+
+    # The first invocation reads the keys outside the asset directory from the job object, runs out of time after
+    # one page and continues in a new invocation
+    s3_client_stub.add_response(
+        'get_object',
+        expected_params = {'Bucket': 'testDataplaneBucketName', 'Key': 'private/jobs/{}.json'.format(job['JobId'])},
+        service_response = {'Body': gen_s3_streaming_object(dict(job, Keys=['private/media/testSource.mp4']))}
+    )
+    s3_client_stub.add_response(
+        'delete_objects',
+        expected_params = {'Bucket': 'testDataplaneBucketName',
+                           'Delete': {'Objects': [{'Key': 'private/media/testSource.mp4'}]}},
+        service_response = {'Deleted': [{'Key': 'private/media/testSource.mp4'}]}
+    )
+    s3_client_stub.add_response(
+        'list_objects_v2',
+        expected_params = {'Bucket': 'testDataplaneBucketName', 'Prefix': asset_path},
+        service_response = {
+            'IsTruncated': True,
+            'NextContinuationToken': 'testToken',
+            'Contents': [{'Key': asset_path + 'input/testKeyValue'}]
+        }
+    )
+    s3_client_stub.add_response(
+        'delete_objects',
+        expected_params = {'Bucket': 'testDataplaneBucketName',
+                           'Delete': {'Objects': [{'Key': asset_path + 'input/testKeyValue'}]}},
+        service_response = {'Deleted': [{'Key': asset_path + 'input/testKeyValue'}]}
+    )
+    lambda_client_stub.add_response(
+        'invoke',
+        expected_params = {
+            'FunctionName': 'testFunctionName',
+            'InvocationType': 'Event',
+            'Payload': json.dumps({'DeleteAssetJob': dict(job, DeletedCount=1, ContinuationToken='testToken')})
+        },
+        service_response = {}
+    )
+    result = app.handler({'DeleteAssetJob': dict(job)}, Context(0))
+    assert result['ContinuationToken'] == 'testToken'
+
+    s3_client_stub.add_response(
+        'list_objects_v2',
+        expected_params = {'Bucket': 'testDataplaneBucketName', 'Prefix': asset_path,
+                           'ContinuationToken': 'testToken'},
+        service_response = {
+            'IsTruncated': False,
+            'Contents': [{'Key': asset_path + 'workflows/testPointer.json'}]
+        }
+    )
+    s3_client_stub.add_response(
+        'delete_objects',
+        expected_params = {'Bucket': 'testDataplaneBucketName',
+                           'Delete': {'Objects': [{'Key': asset_path + 'workflows/testPointer.json'}]}},
+        service_response = {'Deleted': [{'Key': asset_path + 'workflows/testPointer.json'}]}
+    )
+    s3_client_stub.add_response(
+        'put_object',
+        expected_params = {
+            'Bucket': 'testDataplaneBucketName',
+            'Key': 'private/jobs/{}.json'.format(job['JobId']),
+            'Body': json.dumps(dict(job, Status='Complete', DeletedCount=2))
+        },
+        service_response = {}
+    )
+    result = app.handler({'DeleteAssetJob': result}, Context(60000))
+    assert result['Status'] == 'Complete'
+
+    s3_client_stub.add_response(
+        'get_object',
+        expected_params = {'Bucket': 'testDataplaneBucketName', 'Key': 'private/jobs/{}.json'.format(job['JobId'])},
+        service_response = {'Body': gen_s3_streaming_object(result)}
+    )
+    response = test_client.http.get('/deletion/{job_id}'.format(job_id = job['JobId']))
+    assert response.status_code == 200
+    assert response.json_body['DeletedCount'] == 2
+
+
+def test_delete_asset_job_error(s3_client_stub):
+    import app
+
+    class Context:
+        function_name = 'testFunctionName'
+
+        def get_remaining_time_in_millis(self):
+            return 60000
+
+    job = {'JobId': 'testJobId', 'AssetId': 'testAssetId', 'Status': 'Started'}
+    s3_client_stub.add_client_error(
+        'get_object',
+        service_error_code = 'NoSuchKey',
+        expected_params = {'Bucket': 'testDataplaneBucketName', 'Key': 'private/jobs/testJobId.json'}
+    )
+    # a job that fails is saved with the error
+    s3_client_stub.add_response(
+        'put_object',
+        expected_params = {
+            'Bucket': 'testDataplaneBucketName',
+            'Key': 'private/jobs/testJobId.json',
+            'Body': json.dumps(dict(job, Status='Error', Message='Deletion job testJobId not found'))
+        },
+        service_response = {}
+    )
+
+    result = app.handler({'DeleteAssetJob': dict(job)}, Context())
+    assert result['Status'] == 'Error'
+
+
+def test_delete_metadata_objects_retries_errors(s3_client_stub, monkeypatch):
+    import app
+    from MediaInsightsEngineLambdaHelper import dataplane_storage
+    monkeypatch.setattr(dataplane_storage.time, 'sleep', lambda seconds: None)
+
+    s3_client_stub.add_response(
+        'delete_objects',
+        expected_params = {'Bucket': 'testDataplaneBucketName',
+                           'Delete': {'Objects': [{'Key': 'testKey1'}, {'Key': 'testKey2'}]}},
+        service_response = {
+            'Deleted': [{'Key': 'testKey1'}],
+            'Errors': [{'Key': 'testKey2', 'Code': 'SlowDown', 'Message': 'Please reduce your request rate.'}]
+        }
+    )
+    s3_client_stub.add_response(
+        'delete_objects',
+        expected_params = {'Bucket': 'testDataplaneBucketName', 'Delete': {'Objects': [{'Key': 'testKey2'}]}},
+        service_response = {'Deleted': [{'Key': 'testKey2'}]}
+    )
+
+    delete = app.storage.delete_metadata_objects(['testKey1', 'testKey2', 'testKey1'])
+    assert delete == {'Status': 'Success', 'Message': {'Deleted': [{'Key': 'testKey1'}, {'Key': 'testKey2'}]}}
+
+
+def test_delete_metadata_objects_batches(monkeypatch):
+    import app
+
+    batches = []
+    def delete_object_batch(keys):
+        batches.append(len(keys))
+        return [{'Key': key} for key in keys], []
+    monkeypatch.setattr(app.storage, 'delete_object_batch', delete_object_batch)
+
+    delete = app.storage.delete_metadata_objects(['testKey{}'.format(i) for i in range(2500)])
+    assert delete['Status'] == 'Success'
+    assert len(delete['Message']['Deleted']) == 2500
+    assert sorted(batches) == [500, 1000, 1000]
@@ -1,45 +1,47 @@
 # Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
 # SPDX-License-Identifier: Apache-2.0
 
+import pytest
+
 def test_deserialize_non_list_dict():
     # imports
-    import stream
+    from MediaInsightsEngineLambdaHelper.stream_records import deserialize
 
     # test parameters
     data_param = 'testData'
 
-    result = stream.deserialize(data_param)
+    result = deserialize(data_param)
 
     # assertions
     assert result == data_param
 
 def test_deserialize_dict_success():
     # imports
-    import stream
+    from MediaInsightsEngineLambdaHelper.stream_records import deserialize
 
     #test parameters
     data_param = {
         'S': 'World'
     }
-    result = stream.deserialize(data_param)
+    result = deserialize(data_param)
 
     # assertions
     assert result == 'World'
 
 def test_deserialize_dict_error_handling():
         # imports
-    import stream
+    from MediaInsightsEngineLambdaHelper.stream_records import deserialize
 
     #test parameters
     data_param = {'Hello': 'World'}
-    result = stream.deserialize(data_param)
+    result = deserialize(data_param)
 
     # assertions
     assert result == {'Hello': 'World'}
 
 def test_deserialize_list_success():
     # imports
-    import stream
+    from MediaInsightsEngineLambdaHelper.stream_records import deserialize
 
     #test parameters
     data_param = [
@@ -47,46 +49,118 @@ def test_deserialize_list_success():
         {'NULL': True},
         {'N': '123'}
     ]
-    result = stream.deserialize(data_param)
+    result = deserialize(data_param)
 
     # assertions
     assert result[0] == True
     assert result[1] == None
     assert result[2] == 123.0
 
-def test_put_ks_record(kinesis_client_stub):
+def test_put_ks_records(kinesis_client_stub):
     import stream
     kinesis_client_stub.add_response(
-        'put_record',
+        'put_records',
         expected_params = {
             'StreamName': 'testStreamName',
-            'Data': '{"test": "Data"}',
-            'PartitionKey': 'testPartitionKey'
+            'Records': [{
+                'Data': '{"test": "Data"}',
+                'PartitionKey': 'testPartitionKey'
+            }]
         },
         service_response = {
-            'ShardId': 'testShardId',
-            'SequenceNumber': '0.0'
+            'Records': [{'ShardId': 'testShardId', 'SequenceNumber': '0.0'}]
         }
     )
-    stream.put_ks_record(
-        'testPartitionKey',
-        {
-            'test': 'Data'
+    stream.put_ks_records([
+        ('testPartitionKey', {'test': 'Data'})
+    ])
+
+def test_put_ks_records_retries_failed_records_in_asset_order(kinesis_client_stub, monkeypatch):
+    import stream
+    monkeypatch.setattr(stream.time, 'sleep', lambda seconds: None)
+    # The second record of asset1 is held back until the first one was accepted
+    kinesis_client_stub.add_response(
+        'put_records',
+        expected_params = {
+            'StreamName': 'testStreamName',
+            'Records': [
+                {'Data': '{"n": 1}', 'PartitionKey': 'asset1'},
+                {'Data': '{"n": 2}', 'PartitionKey': 'asset2'}
+            ]
+        },
+        service_response = {
+            'FailedRecordCount': 1,
+            'Records': [
+                {'ErrorCode': 'ProvisionedThroughputExceededException', 'ErrorMessage': 'Rate exceeded'},
+                {'ShardId': 'testShardId', 'SequenceNumber': '0.0'}
+            ]
+        }
+    )
+    kinesis_client_stub.add_response(
+        'put_records',
+        expected_params = {
+            'StreamName': 'testStreamName',
+            'Records': [{'Data': '{"n": 1}', 'PartitionKey': 'asset1'}]
+        },
+        service_response = {
+            'Records': [{'ShardId': 'testShardId', 'SequenceNumber': '1.0'}]
         }
     )
+    kinesis_client_stub.add_response(
+        'put_records',
+        expected_params = {
+            'StreamName': 'testStreamName',
+            'Records': [{'Data': '{"n": 3}', 'PartitionKey': 'asset1'}]
+        },
+        service_response = {
+            'Records': [{'ShardId': 'testShardId', 'SequenceNumber': '2.0'}]
+        }
+    )
+    stream.put_ks_records([
+        ('asset1', {'n': 1}),
+        ('asset2', {'n': 2}),
+        ('asset1', {'n': 3})
+    ])
+
+def test_put_ks_records_fails_after_retries(kinesis_client_stub, monkeypatch):
+    import stream
+    monkeypatch.setattr(stream.time, 'sleep', lambda seconds: None)
+    monkeypatch.setattr(stream, 'KINESIS_MAX_RETRIES', 1)
+    for _ in range(2):
+        kinesis_client_stub.add_response(
+            'put_records',
+            expected_params = {
+                'StreamName': 'testStreamName',
+                'Records': [{'Data': '{"n": 1}', 'PartitionKey': 'asset1'}]
+            },
+            service_response = {
+                'FailedRecordCount': 1,
+                'Records': [{'ErrorCode': 'InternalFailure', 'ErrorMessage': 'Internal service failure'}]
+            }
+        )
+    with pytest.raises(Exception, match='Unable to put 1 records'):
+        stream.put_ks_records([('asset1', {'n': 1})])
+
+def test_chunk_ks_records_limits():
+    import stream
+    records = [{'Data': 'x' * 10, 'PartitionKey': 'asset' + str(i)} for i in range(1001)]
+    assert [len(chunk) for chunk in stream.chunk_ks_records(records)] == [500, 500, 1]
+    large = [{'Data': 'x' * (2 * 1024 * 1024), 'PartitionKey': 'asset' + str(i)} for i in range(5)]
+    assert [len(chunk) for chunk in stream.chunk_ks_records(large)] == [2, 2, 1]
 
 def test_lambda_handler_insert_record(kinesis_client_stub):
     import stream
     kinesis_client_stub.add_response(
-        'put_record',
+        'put_records',
         expected_params = {
             'StreamName': 'testStreamName',
-            'Data': '{"TestKey": "testValue", "Action": "INSERT"}',
-            'PartitionKey': 'testAssetId'
+            'Records': [{
+                'Data': '{"TestKey": "testValue", "Action": "INSERT"}',
+                'PartitionKey': 'testAssetId'
+            }]
         },
         service_response = {
-            'ShardId': 'testShardId',
-            'SequenceNumber': '0.0'
+            'Records': [{'ShardId': 'testShardId', 'SequenceNumber': '0.0'}]
         }
     )
 
@@ -94,18 +168,12 @@ def test_lambda_handler_insert_record(kinesis_client_stub):
         'Records': [{
             'eventName': 'INSERT',
             'dynamodb': {
-                'M': {
-                    'Keys': {
-                        'M': {
-                            'AssetId': {'S':'testAssetId'}
-                        }
-                    },
-                    'NewImage': {
-                        'M': {
-                            'AssetId': {'S': 'testAssetId'},
-                            'TestKey': {'S': 'testValue'}
-                        }
-                    }
+                'Keys': {
+                    'AssetId': {'S':'testAssetId'}
+                },
+                'NewImage': {
+                    'AssetId': {'S': 'testAssetId'},
+                    'TestKey': {'S': 'testValue'}
                 }
             }
         }]
@@ -116,15 +184,16 @@ def test_lambda_handler_insert_record(kinesis_client_stub):
 def test_lambda_handler_delete_record(kinesis_client_stub):
     import stream
     kinesis_client_stub.add_response(
-        'put_record',
+        'put_records',
         expected_params = {
             'StreamName': 'testStreamName',
-            'Data': '{"Action": "REMOVE"}',
-            'PartitionKey': 'testAssetId'
+            'Records': [{
+                'Data': '{"Action": "REMOVE"}',
+                'PartitionKey': 'testAssetId'
+            }]
         },
         service_response = {
-            'ShardId': 'testShardId',
-            'SequenceNumber': '0.0'
+            'Records': [{'ShardId': 'testShardId', 'SequenceNumber': '0.0'}]
         }
     )
 
@@ -132,18 +201,12 @@ def test_lambda_handler_delete_record(kinesis_client_stub):
         'Records': [{
             'eventName': 'REMOVE',
             'dynamodb': {
-                'M': {
-                    'Keys': {
-                        'M': {
-                            'AssetId': {'S': 'testAssetId'}
-                        }
-                    },
-                    'NewImage': {
-                        'M': {
-                            'AssetId': {'S': 'testAssetId'},
-                            'TestKey': {'S': 'testValue'}
-                        }
-                    }
+                'Keys': {
+                    'AssetId': {'S': 'testAssetId'}
+                },
+                'NewImage': {
+                    'AssetId': {'S': 'testAssetId'},
+                    'TestKey': {'S': 'testValue'}
                 }
             }
         }]
@@ -158,35 +221,27 @@ def test_lambda_handler_modify_record_no_modifications():
         'Records': [{
             'eventName': 'MODIFY',
             'dynamodb': {
-                'M': {
-                    'Keys': {
-                        'M': {
-                            'AssetId': {'S': 'testAssetId'}
-                        }
-                    },
-                    'NewImage': {
-                        'M': {
-                            'AssetId': {'S': 'testAssetId'},
-                            'TestOperator': {
-                                'L': [{
-                                    'M': {
-                                        'pointer': {'S':'Pointer1'}
-                                    }
-                                }]
+                'Keys': {
+                    'AssetId': {'S': 'testAssetId'}
+                },
+                'NewImage': {
+                    'AssetId': {'S': 'testAssetId'},
+                    'TestOperator': {
+                        'L': [{
+                            'M': {
+                                'pointer': {'S':'Pointer1'}
                             }
-                        }
-                    },
-                    'OldImage': {
-                        'M': {
-                            'AssetId': {'S': 'testAssetId'},
-                            'TestOperator': {
-                                'L': [{
-                                    'M': {
-                                        'pointer': {'S':'Pointer1'}
-                                    }
-                                }]
+                        }]
+                    }
+                },
+                'OldImage': {
+                    'AssetId': {'S': 'testAssetId'},
+                    'TestOperator': {
+                        'L': [{
+                            'M': {
+                                'pointer': {'S':'Pointer1'}
                             }
-                        }
+                        }]
                     }
                 }
             }
@@ -200,15 +255,16 @@ def test_lambda_handler_modify_record_existing_attribute_modified(kinesis_client
     import stream
 
     kinesis_client_stub.add_response(
-        'put_record',
+        'put_records',
         expected_params = {
             'StreamName': 'testStreamName',
-            'Data': '{"Action": "MODIFY", "Pointer": "Pointer1", "Operator": "TestOperator", "Workflow": "workflow1"}',
-            'PartitionKey': 'testAssetId'
+            'Records': [{
+                'Data': '{"Action": "MODIFY", "Pointer": "Pointer1", "Operator": "TestOperator", "Workflow": "workflow1"}',
+                'PartitionKey': 'testAssetId'
+            }]
         },
         service_response = {
-            'ShardId': 'testShardId',
-            'SequenceNumber': '0.0'
+            'Records': [{'ShardId': 'testShardId', 'SequenceNumber': '0.0'}]
         }
     )
 
@@ -216,36 +272,80 @@ def test_lambda_handler_modify_record_existing_attribute_modified(kinesis_client
         'Records': [{
             'eventName': 'MODIFY',
             'dynamodb': {
-                'M': {
-                    'Keys': {
-                        'M': {
-                            'AssetId': {'S': 'testAssetId'}
-                        }
-                    },
-                    'NewImage': {
-                        'M': {
-                            'AssetId': {'S': 'testAssetId'},
-                            'TestOperator': {
-                                'L': [{
-                                    'M': {
-                                        'workflow': {'S':'workflow1'},
-                                        'pointer': {'S':'Pointer1'}
-                                    }
-                                }]
+                'Keys': {
+                    'AssetId': {'S': 'testAssetId'}
+                },
+                'NewImage': {
+                    'AssetId': {'S': 'testAssetId'},
+                    'TestOperator': {
+                        'L': [{
+                            'M': {
+                                'workflow': {'S':'workflow1'},
+                                'pointer': {'S':'Pointer1'}
                             }
-                        }
-                    },
-                    'OldImage': {
-                        'M': {
-                            'AssetId': {'S': 'testAssetId'},
-                            'TestOperator': {
-                                'L': [{
-                                    'M': {
-                                        'pointer': {'S':'Pointer2'}
-                                    }
-                                }]
+                        }]
+                    }
+                },
+                'OldImage': {
+                    'AssetId': {'S': 'testAssetId'},
+                    'TestOperator': {
+                        'L': [{
+                            'M': {
+                                'pointer': {'S':'Pointer2'}
                             }
-                        }
+                        }]
+                    }
+                }
+            }
+        }]
+    }
+
+    response = stream.lambda_handler(event_param, {})
+    assert response == None
+
+def test_lambda_handler_modify_record_segmented_pointer(kinesis_client_stub):
+    import stream
+
+    kinesis_client_stub.add_response(
+        'put_records',
+        expected_params = {
+            'StreamName': 'testStreamName',
+            'Records': [{
+                'Data': '{"Action": "MODIFY", "Pointer": "prefix/TestOperator/manifest.json", "Operator": "TestOperator", "Workflow": "workflow1", "Layout": "segmented"}',
+                'PartitionKey': 'testAssetId'
+            }]
+        },
+        service_response = {
+            'Records': [{'ShardId': 'testShardId', 'SequenceNumber': '0.0'}]
+        }
+    )
+
+    event_param = {
+        'Records': [{
+            'eventName': 'MODIFY',
+            'dynamodb': {
+                'Keys': {
+                    'AssetId': {'S': 'testAssetId'}
+                },
+                'NewImage': {
+                    'AssetId': {'S': 'testAssetId'},
+                    'TestOperator': {
+                        'L': [{
+                            'M': {
+                                'workflow': {'S':'workflow1'},
+                                'pointer': {'S':'prefix/TestOperator/manifest.json'}
+                            }
+                        }]
+                    }
+                },
+                'OldImage': {
+                    'AssetId': {'S': 'testAssetId'},
+                    'TestOperator': {
+                        'L': [{
+                            'M': {
+                                'pointer': {'S':'Pointer2'}
+                            }
+                        }]
                     }
                 }
             }
@@ -259,15 +359,16 @@ def test_lambda_handler_modify_record_attribute_added(kinesis_client_stub):
     import stream
 
     kinesis_client_stub.add_response(
-        'put_record',
+        'put_records',
         expected_params = {
             'StreamName': 'testStreamName',
-            'Data': '{"Action": "MODIFY", "Pointer": "Pointer2", "Operator": "TestKey2", "Workflow": "workflow2"}',
-            'PartitionKey': 'testAssetId'
+            'Records': [{
+                'Data': '{"Action": "MODIFY", "Pointer": "Pointer2", "Operator": "TestKey2", "Workflow": "workflow2"}',
+                'PartitionKey': 'testAssetId'
+            }]
         },
         service_response = {
-            'ShardId': 'testShardId',
-            'SequenceNumber': '0.0'
+            'Records': [{'ShardId': 'testShardId', 'SequenceNumber': '0.0'}]
         }
     )
 
@@ -275,45 +376,37 @@ def test_lambda_handler_modify_record_attribute_added(kinesis_client_stub):
         'Records': [{
             'eventName': 'MODIFY',
             'dynamodb': {
-                'M': {
-                    'Keys': {
-                        'M': {
-                            'AssetId': {'S': 'testAssetId'}
-                        }
-                    },
-                    'NewImage': {
-                        'M': {
-                            'AssetId': {'S': 'testAssetId'},
-                            'TestKey1': {
-                                'L': [{
-                                    'M': {
-                                        'workflow': {'S':'workflow1'},
-                                        'pointer': {'S':'Pointer1'}
-                                    }
-                                }]
-                            },
-                            'TestKey2': {
-                                'L': [{
-                                    'M': {
-                                        'workflow': {'S':'workflow2'},
-                                        'pointer': {'S':'Pointer2'}
-                                    }
-                                }]
+                'Keys': {
+                    'AssetId': {'S': 'testAssetId'}
+                },
+                'NewImage': {
+                    'AssetId': {'S': 'testAssetId'},
+                    'TestKey1': {
+                        'L': [{
+                            'M': {
+                                'workflow': {'S':'workflow1'},
+                                'pointer': {'S':'Pointer1'}
                             }
-                        }
+                        }]
                     },
-                    'OldImage': {
-                        'M': {
-                            'AssetId': {'S': 'testAssetId'},
-                            'TestKey1': {
-                                'L': [{
-                                    'M': {
-                                        'workflow': {'S':'workflow1'},
-                                        'pointer': {'S':'Pointer1'}
-                                    }
-                                }]
+                    'TestKey2': {
+                        'L': [{
+                            'M': {
+                                'workflow': {'S':'workflow2'},
+                                'pointer': {'S':'Pointer2'}
+                            }
+                        }]
+                    }
+                },
+                'OldImage': {
+                    'AssetId': {'S': 'testAssetId'},
+                    'TestKey1': {
+                        'L': [{
+                            'M': {
+                                'workflow': {'S':'workflow1'},
+                                'pointer': {'S':'Pointer1'}
                             }
-                        }
+                        }]
                     }
                 }
             }
@@ -327,15 +420,16 @@ def test_lambda_handler_modify_record_attribute_removed(kinesis_client_stub):
     import stream
 
     kinesis_client_stub.add_response(
-        'put_record',
+        'put_records',
         expected_params = {
             'StreamName': 'testStreamName',
-            'Data': '{"Action": "REMOVE", "Operator": "TestKey2"}',
-            'PartitionKey': 'testAssetId'
+            'Records': [{
+                'Data': '{"Action": "REMOVE", "Operator": "TestKey2"}',
+                'PartitionKey': 'testAssetId'
+            }]
         },
         service_response = {
-            'ShardId': 'testShardId',
-            'SequenceNumber': '0.0'
+            'Records': [{'ShardId': 'testShardId', 'SequenceNumber': '0.0'}]
         }
     )
 
@@ -343,45 +437,37 @@ def test_lambda_handler_modify_record_attribute_removed(kinesis_client_stub):
         'Records': [{
             'eventName': 'MODIFY',
             'dynamodb': {
-                'M': {
-                    'Keys': {
-                        'M': {
-                            'AssetId': {'S': 'testAssetId'}
-                        }
-                    },
-                    'NewImage': {
-                        'M': {
-                            'AssetId': {'S': 'testAssetId'},
-                            'TestKey1': {
-                                'L': [{
-                                    'M': {
-                                        'workflow': {'S':'workflow1'},
-                                        'pointer': {'S':'Pointer1'}
-                                    }
-                                }]
+                'Keys': {
+                    'AssetId': {'S': 'testAssetId'}
+                },
+                'NewImage': {
+                    'AssetId': {'S': 'testAssetId'},
+                    'TestKey1': {
+                        'L': [{
+                            'M': {
+                                'workflow': {'S':'workflow1'},
+                                'pointer': {'S':'Pointer1'}
+                            }
+                        }]
+                    }
+                },
+                'OldImage': {
+                    'AssetId': {'S': 'testAssetId'},
+                    'TestKey1': {
+                        'L': [{
+                            'M': {
+                                'workflow': {'S':'workflow1'},
+                                'pointer': {'S':'Pointer1'}
                             }
-                        }
+                        }]
                     },
-                    'OldImage': {
-                        'M': {
-                            'AssetId': {'S': 'testAssetId'},
-                            'TestKey1': {
-                                'L': [{
-                                    'M': {
-                                        'workflow': {'S':'workflow1'},
-                                        'pointer': {'S':'Pointer1'}
-                                    }
-                                }]
-                            },
-                            'TestKey2': {
-                                'L': [{
-                                    'M': {
-                                        'workflow': {'S':'workflow2'},
-                                        'pointer': {'S':'Pointer2'}
-                                    }
-                                }]
+                    'TestKey2': {
+                        'L': [{
+                            'M': {
+                                'workflow': {'S':'workflow2'},
+                                'pointer': {'S':'Pointer2'}
                             }
-                        }
+                        }]
                     }
                 }
             }
@@ -390,3 +476,39 @@ def test_lambda_handler_modify_record_attribute_removed(kinesis_client_stub):
 
     response = stream.lambda_handler(event_param, {})
     assert response == None
+
+def test_diff_operators():
+    from MediaInsightsEngineLambdaHelper.stream_records import diff_operators
+
+    def operator(pointer):
+        return {'L': [{'M': {'pointer': {'S': pointer}, 'workflow': {'S': 'workflow1'}}}]}
+
+    new_image = {
+        'AssetId': {'S': 'testAssetId'},
+        'Unchanged': operator('Pointer1'),
+        'Modified': operator('Pointer3'),
+        'Added': operator('Pointer4')
+    }
+    old_image = {
+        'AssetId': {'S': 'testAssetId'},
+        'Unchanged': operator('Pointer1'),
+        'Modified': operator('Pointer2'),
+        'Removed': operator('Pointer5')
+    }
+    assert diff_operators(new_image, old_image) == (['Added'], ['Removed'], ['Modified'])
+
+def test_decode_attributes():
+    from decimal import Decimal
+    from MediaInsightsEngineLambdaHelper.stream_records import decode_attributes
+
+    image = {
+        'Count': {'N': '1.5'},
+        'Tags': {'SS': ['a', 'b']},
+        'Nested': {'M': {'List': {'L': [{'NULL': True}, {'BOOL': False}]}}},
+        'Skipped': {'S': 'value'}
+    }
+    assert decode_attributes(image, ['Count', 'Tags', 'Nested', 'Missing']) == {
+        'Count': Decimal('1.5'),
+        'Tags': {'a', 'b'},
+        'Nested': {'List': [None, False]}
+    }
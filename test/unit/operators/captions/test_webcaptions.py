@@ -8,10 +8,13 @@ from botocore.response import StreamingBody
 from io import BytesIO
 
 
-def mock_dataplane(lambda_function, mock_retrieve_response={}, mock_store_response={}, mock_generate_response={}):
+def mock_dataplane(lambda_function, mock_retrieve_response={}, mock_store_response={}, mock_generate_response={}, mock_retrieve_all_response={}):
     retrieve_function = lambda_function.dataplane.retrieve_asset_metadata
     lambda_function.dataplane.retrieve_asset_metadata = MagicMock(return_value=mock_retrieve_response)
 
+    retrieve_all_function = lambda_function.dataplane.retrieve_operator_metadata_all
+    lambda_function.dataplane.retrieve_operator_metadata_all = MagicMock(return_value=mock_retrieve_all_response)
+
     store_function = lambda_function.dataplane.store_asset_metadata
     lambda_function.dataplane.store_asset_metadata = MagicMock(return_value=mock_store_response)
 
@@ -20,6 +23,7 @@ def mock_dataplane(lambda_function, mock_retrieve_response={}, mock_store_respon
 
     return {
         'retrieve': retrieve_function,
+        'retrieve_all': retrieve_all_function,
         'store': store_function,
         'generate': generate_function
     }
@@ -27,6 +31,7 @@ def mock_dataplane(lambda_function, mock_retrieve_response={}, mock_store_respon
 
 def restore_mock(lambda_function, original_dataplane_functions):
     lambda_function.dataplane.retrieve_asset_metadata = original_dataplane_functions['retrieve']
+    lambda_function.dataplane.retrieve_operator_metadata_all = original_dataplane_functions['retrieve_all']
     lambda_function.dataplane.store_asset_metadata = original_dataplane_functions['store']
     lambda_function.dataplane.generate_media_storage_path = original_dataplane_functions['generate']
 
@@ -37,8 +42,11 @@ def test_web_captions_empty_transcript():
 
     original_functions = mock_dataplane(
         lambda_function,
-        {
-            'results': {
+        mock_store_response={
+            'Status': 'Success'
+        },
+        mock_retrieve_all_response={
+            'results': [{
                 'results': {
                     'items': [{
                         'type': 'punctuation',
@@ -52,10 +60,7 @@ def test_web_captions_empty_transcript():
                         }]
                     }]
                 }
-            }
-        },
-        {
-            'Status': 'Success'
+            }]
         }
     )
 
@@ -69,9 +74,9 @@ def test_web_captions_empty_transcript():
 
     response = lambda_function.web_captions(input_parameter, {})
     assert response['Status'] == 'Complete'
-    assert lambda_function.dataplane.retrieve_asset_metadata.call_count == 1
-    assert lambda_function.dataplane.retrieve_asset_metadata.call_args[0][0] == 'testAssetId'
-    assert lambda_function.dataplane.retrieve_asset_metadata.call_args[1]['operator_name'] == 'TranscribeVideo'
+    assert lambda_function.dataplane.retrieve_asset_metadata.call_count == 0
+    assert lambda_function.dataplane.retrieve_operator_metadata_all.call_count == 1
+    assert lambda_function.dataplane.retrieve_operator_metadata_all.call_args[0] == ('testAssetId', 'TranscribeVideo')
     assert lambda_function.dataplane.store_asset_metadata.call_count == 2
     assert lambda_function.dataplane.store_asset_metadata.call_args[1]['asset_id'] == 'testAssetId'
     assert lambda_function.dataplane.store_asset_metadata.call_args[1]['operator_name'] == 'WebCaptions_en'
@@ -81,6 +86,38 @@ def test_web_captions_empty_transcript():
     restore_mock(lambda_function, original_functions)
 
 
+def test_get_web_captions_memo():
+    import captions.webcaptions as lambda_function
+    import helper
+
+    webcaptions = [{'start': 2.0, 'end': 3.0, 'caption': 'transcribed text'}]
+    translated = [{'start': 2.0, 'end': 3.0, 'caption': 'texto transcrito', 'sourceCaption': 'transcribed text'}]
+    dataplane_functions = mock_dataplane(
+        lambda_function,
+        mock_retrieve_response={'results': {'WebCaptions': webcaptions}},
+        mock_store_response={'Status': 'Success'}
+    )
+
+    operator_object = lambda_function.MediaInsightsOperationHelper(helper.get_operator_parameter(
+        input={'MetaData': {'TranscribeSourceLanguage': 'en'}}
+    ))
+    webcaptions_object = lambda_function.WebCaptions(operator_object)
+    assert webcaptions_object.get_web_captions('en') == webcaptions
+    assert webcaptions_object.get_web_captions('en') == webcaptions
+    assert lambda_function.dataplane.retrieve_asset_metadata.call_count == 1
+
+    # Stored captions are served from the memo, captions stored under another source are not WebCaptions_<lang>
+    webcaptions_object.put_web_captions(translated, 'es')
+    webcaptions_object.put_web_captions(webcaptions, 'es', source='Translate')
+    assert webcaptions_object.get_web_captions('es') == translated
+    assert lambda_function.dataplane.retrieve_asset_metadata.call_count == 1
+
+    # The memo is per invocation
+    assert lambda_function.WebCaptions(operator_object).get_web_captions('en') == webcaptions
+    assert lambda_function.dataplane.retrieve_asset_metadata.call_count == 2
+    restore_mock(lambda_function, dataplane_functions)
+
+
 def test_create_srt_empty_target_language():
     import captions.webcaptions as lambda_function
     from MediaInsightsEngineLambdaHelper import MasExecutionError
@@ -975,3 +1012,116 @@ def test_vttToWebCaptions(s3_client_stub):
     assert response[0]['start'] == '2.0'
     assert response[0]['end'] == '3.0'
     assert response[0]['caption'] == 'transcribed text'
+
+
+def test_format_time():
+    import captions.webcaptions as lambda_function
+
+    assert lambda_function.format_time_srt(1.001) == '00:00:01,001'
+    assert lambda_function.format_time_srt('3725.5') == '01:02:05,500'
+    assert lambda_function.format_time_vtt(10799.999) == '02:59:59.999'
+
+
+def test_upload_text_multipart(s3_resource_stub, monkeypatch):
+    import captions.webcaptions as lambda_function
+    monkeypatch.setattr(lambda_function, 'CAPTIONS_UPLOAD_PART_BYTES', 10)
+
+    s3_resource_stub.add_response(
+        'create_multipart_upload',
+        expected_params={'Bucket': 'test_bucket', 'Key': 'test_key.srt'},
+        service_response={'Bucket': 'test_bucket', 'Key': 'test_key.srt', 'UploadId': 'testUploadId'}
+    )
+    for part_number, body in [(1, b'0123456789'), (2, b'abc')]:
+        s3_resource_stub.add_response(
+            'upload_part',
+            expected_params={
+                'Bucket': 'test_bucket',
+                'Key': 'test_key.srt',
+                'UploadId': 'testUploadId',
+                'PartNumber': part_number,
+                'Body': body
+            },
+            service_response={'ETag': 'etag' + str(part_number)}
+        )
+    s3_resource_stub.add_response(
+        'complete_multipart_upload',
+        expected_params={
+            'Bucket': 'test_bucket',
+            'Key': 'test_key.srt',
+            'UploadId': 'testUploadId',
+            'MultipartUpload': {'Parts': [{'ETag': 'etag1', 'PartNumber': 1}, {'ETag': 'etag2', 'PartNumber': 2}]}
+        },
+        service_response={}
+    )
+
+    s3_object = lambda_function.s3_resource.Object('test_bucket', 'test_key.srt')
+    lambda_function.upload_text(s3_object, ['01234', '56789', 'abc'])
+
+
+def transcribe_items(words):
+    items = []
+    for content, start, end in words:
+        if start is None:
+            items.append({'type': 'punctuation', 'alternatives': [{'content': content, 'confidence': '0.0'}]})
+        else:
+            items.append({
+                'type': 'pronunciation',
+                'start_time': start,
+                'end_time': end,
+                'alternatives': [{'content': content, 'confidence': '0.9'}]
+            })
+    return items
+
+
+def test_segment_captions():
+    import captions.webcaptions as lambda_function
+
+    items = transcribe_items([
+        (',', None, None),
+        ('Hello', '0.0', '0.5'),
+        ('there', '0.6', '1.0'),
+        (',', None, None),
+        ('how', '1.1', '1.3'),
+        ('are', '1.4', '1.6'),
+        ('you', '1.7', '2.0'),
+        ('?', None, None),
+        ('Fine', '5.0', '5.5'),
+        ('thanks', '5.6', '6.0')
+    ])
+    columns = lambda_function.transcript_columns(items)
+
+    captions = lambda_function.segment_captions(columns)
+    assert [(c['start'], c['caption'], c['end']) for c in captions] == [
+        (0.0, 'Hello there, how are you?', 2.0),
+        (5.0, 'Fine thanks', 6.0)
+    ]
+    assert captions[1]['wordConfidence'] == [{'w': 'fine', 'c': 0.9}, {'w': 'thanks', 'c': 0.9}]
+
+    # The comma after a caption that ends at the word limit is dropped
+    captions = lambda_function.segment_captions(columns, max_words=2, max_silence=0.5, break_punctuation='')
+    assert [(c['start'], c['caption'], c['end']) for c in captions] == [
+        (0.0, 'Hello there', 1.0),
+        (1.1, 'how are', 1.6),
+        (1.7, 'you?', 5.0),
+        (5.0, 'Fine thanks', 6.0)
+    ]
+
+
+def test_transcribe_to_web_captions_is_not_shared_between_invocations():
+    import captions.webcaptions as lambda_function
+    import helper
+
+    input_parameter = helper.get_operator_parameter(
+        input={
+            'MetaData': {
+                'TranscribeSourceLanguage': 'en'
+            }
+        }
+    )
+    input_parameter['Configuration']['MaxWordsPerCaption'] = '1'
+    transcripts = [{'results': {'items': transcribe_items([('Hello', '0.0', '0.5'), ('there', '0.6', '1.0')])}}]
+
+    for _ in range(2):
+        webcaptions_object = lambda_function.WebCaptions(lambda_function.MediaInsightsOperationHelper(input_parameter))
+        captions = webcaptions_object.transcribe_to_web_captions(transcripts)
+        assert [c['caption'] for c in captions] == ['Hello', 'there']
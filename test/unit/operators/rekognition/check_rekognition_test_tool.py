@@ -25,12 +25,12 @@ class CheckRekognitionTestTool:
         self.original_dataplane_function = None
 
     def start_mock(self, mock_response={}):
-        self.original_dataplane_function = self.subject_under_test.DataPlane.store_asset_metadata
-        self.subject_under_test.DataPlane.store_asset_metadata = MagicMock(return_value=mock_response)
+        self.original_dataplane_function = self.subject_under_test.DataPlane.store_asset_metadata_batch
+        self.subject_under_test.DataPlane.store_asset_metadata_batch = MagicMock(return_value=mock_response)
 
     def reset_subject_under_test(self):
         self.subject_under_test.output_object = self.subject_under_test.OutputHelper(self.subject_under_test.operator_name)
-        self.subject_under_test.DataPlane.store_asset_metadata = self.original_dataplane_function
+        self.subject_under_test.DataPlane.store_asset_metadata_batch = self.original_dataplane_function
 
     def run_tests(self):
         with Stubber(self.subject_under_test.rek) as stubber:
@@ -43,6 +43,7 @@ class CheckRekognitionTestTool:
             self.test_job_status_succeeded_non_paginated(stubber)
             self.test_job_status_invalid_non_paginated(stubber)
             self.test_job_status_succeeded_paginated(stubber)
+            self.test_job_status_page_limit(stubber)
 
     def test_empty_event_status(self):
         with pytest.raises(self.MasExecutionError) as err:
@@ -154,11 +155,14 @@ class CheckRekognitionTestTool:
         response = self.lambda_handler(input_parameter, {})
         assert response['Status'] == 'Complete'
         assert response['MetaData']['JobId'] == 'testJobId'
-        assert self.subject_under_test.DataPlane.store_asset_metadata.call_count == 1
-        assert self.subject_under_test.DataPlane.store_asset_metadata.call_args[1]['asset_id'] == 'testAssetId'
-        assert self.subject_under_test.DataPlane.store_asset_metadata.call_args[1]['operator_name'] == 'testOperatorName'
-        assert self.subject_under_test.DataPlane.store_asset_metadata.call_args[1]['workflow_id'] == 'testWorkflowId'
-        assert self.subject_under_test.DataPlane.store_asset_metadata.call_args[1]['results'] == {'JobStatus': 'SUCCEEDED'}
+        assert self.subject_under_test.DataPlane.store_asset_metadata_batch.call_count == 1
+        assert self.subject_under_test.DataPlane.store_asset_metadata_batch.call_args[0] == ('testAssetId', [{
+            'OperatorName': 'testOperatorName',
+            'WorkflowId': 'testWorkflowId',
+            'Results': {'JobStatus': 'SUCCEEDED'},
+            'Paginated': False,
+            'EndPagination': False
+        }])
         self.reset_subject_under_test()
 
     def test_job_status_invalid_non_paginated(self, stub):
@@ -188,11 +192,14 @@ class CheckRekognitionTestTool:
         assert err.value.args[0]['Status'] == 'Error'
         assert err.value.args[0]['MetaData'][self.error_key] == "Unable to upload metadata for testAssetId: {'test': 'error'}"
         assert err.value.args[0]['MetaData']['JobId'] == 'testJobId'
-        assert self.subject_under_test.DataPlane.store_asset_metadata.call_count == 1
-        assert self.subject_under_test.DataPlane.store_asset_metadata.call_args[1]['asset_id'] == 'testAssetId'
-        assert self.subject_under_test.DataPlane.store_asset_metadata.call_args[1]['operator_name'] == 'testOperatorName'
-        assert self.subject_under_test.DataPlane.store_asset_metadata.call_args[1]['workflow_id'] == 'testWorkflowId'
-        assert self.subject_under_test.DataPlane.store_asset_metadata.call_args[1]['results'] == {'JobStatus': 'SUCCEEDED'}
+        assert self.subject_under_test.DataPlane.store_asset_metadata_batch.call_count == 1
+        assert self.subject_under_test.DataPlane.store_asset_metadata_batch.call_args[0] == ('testAssetId', [{
+            'OperatorName': 'testOperatorName',
+            'WorkflowId': 'testWorkflowId',
+            'Results': {'JobStatus': 'SUCCEEDED'},
+            'Paginated': False,
+            'EndPagination': False
+        }])
         self.reset_subject_under_test()
 
     def test_job_status_succeeded_paginated(self, stub):
@@ -226,23 +233,63 @@ class CheckRekognitionTestTool:
                 'AssetId': 'testAssetId',
                 'JobId': 'testJobId',
                 'WorkflowExecutionId': 'testWorkflowId',
-                'PageToken': 'next_token'
+                'PageToken': 'next_token',
+                'PageNumber': 11
             }
         )
         response = self.lambda_handler(input_parameter, {})
         assert response['Status'] == 'Complete'
         assert response['MetaData']['JobId'] == 'testJobId'
-        assert self.subject_under_test.DataPlane.store_asset_metadata.call_count == 2
-        assert self.subject_under_test.DataPlane.store_asset_metadata.call_args_list[0][1]['asset_id'] == 'testAssetId'
-        assert self.subject_under_test.DataPlane.store_asset_metadata.call_args_list[0][1]['operator_name'] == 'testOperatorName'
-        assert self.subject_under_test.DataPlane.store_asset_metadata.call_args_list[0][1]['workflow_id'] == 'testWorkflowId'
-        assert self.subject_under_test.DataPlane.store_asset_metadata.call_args_list[0][1]['results'] == {'JobStatus': 'SUCCEEDED', 'NextToken': 'next_token2'}
-        assert self.subject_under_test.DataPlane.store_asset_metadata.call_args_list[0][1]['paginate'] is True
-        assert self.subject_under_test.DataPlane.store_asset_metadata.call_args_list[0][1]['end'] is False
-        assert self.subject_under_test.DataPlane.store_asset_metadata.call_args_list[1][1]['asset_id'] == 'testAssetId'
-        assert self.subject_under_test.DataPlane.store_asset_metadata.call_args_list[1][1]['operator_name'] == 'testOperatorName'
-        assert self.subject_under_test.DataPlane.store_asset_metadata.call_args_list[1][1]['workflow_id'] == 'testWorkflowId'
-        assert self.subject_under_test.DataPlane.store_asset_metadata.call_args_list[1][1]['results'] == {'JobStatus': 'SUCCEEDED'}
-        assert self.subject_under_test.DataPlane.store_asset_metadata.call_args_list[1][1]['paginate'] is True
-        assert self.subject_under_test.DataPlane.store_asset_metadata.call_args_list[1][1]['end'] is True
+        assert self.subject_under_test.DataPlane.store_asset_metadata_batch.call_count == 1
+        assert self.subject_under_test.DataPlane.store_asset_metadata_batch.call_args[0] == ('testAssetId', [{
+            'OperatorName': 'testOperatorName',
+            'WorkflowId': 'testWorkflowId',
+            'Results': {'JobStatus': 'SUCCEEDED', 'NextToken': 'next_token2'},
+            'Paginated': True,
+            'EndPagination': False,
+            'Page': 11
+        }, {
+            'OperatorName': 'testOperatorName',
+            'WorkflowId': 'testWorkflowId',
+            'Results': {'JobStatus': 'SUCCEEDED'},
+            'Paginated': True,
+            'EndPagination': True,
+            'Page': 12
+        }])
+        self.reset_subject_under_test()
+
+    def test_job_status_page_limit(self, stub):
+        self.start_mock({
+            'Status': 'Success'
+        })
+
+        for page in range(11):
+            stub.add_response(
+                self.rekognition_function_name,
+                expected_params={
+                    'JobId': 'testJobId',
+                    'NextToken': 'next_token{}'.format(page) if page else ''
+                },
+                service_response={
+                    'JobStatus': 'SUCCEEDED',
+                    'NextToken': 'next_token{}'.format(page + 1)
+                }
+            )
+        input_parameter = self.parameter_helper.get_operator_parameter(
+            metadata={
+                'AssetId': 'testAssetId',
+                'JobId': 'testJobId',
+                'WorkflowExecutionId': 'testWorkflowId'
+            }
+        )
+        response = self.lambda_handler(input_parameter, {})
+        assert response['Status'] == 'Executing'
+        assert response['MetaData']['PageToken'] == 'next_token11'
+        assert response['MetaData']['PageNumber'] == 11
+        # Every page read by the invocation is stored with one request
+        assert self.subject_under_test.DataPlane.store_asset_metadata_batch.call_count == 1
+        pages = self.subject_under_test.DataPlane.store_asset_metadata_batch.call_args[0][1]
+        assert [page['Results']['NextToken'] for page in pages] == ['next_token{}'.format(n) for n in range(1, 12)]
+        assert all(page['Paginated'] and not page['EndPagination'] for page in pages)
+        assert [page['Page'] for page in pages] == list(range(11))
         self.reset_subject_under_test()
@@ -18,6 +18,7 @@ def mock_env_variables(monkeypatch):
     monkeypatch.setenv('STAGE_EXECUTION_QUEUE_URL', 'testExecutionQueueUrl')
     monkeypatch.setenv('WORKFLOW_SCHEDULER_LAMBDA_ARN', 'testSchedulerLambdaArn')
     monkeypatch.setenv('SYSTEM_TABLE_NAME', 'testSystemTable')
+    monkeypatch.setenv('OPERATION_CALLBACK_TABLE_NAME', 'testCallbackTable')
     monkeypatch.setenv('DEFAULT_MAX_CONCURRENT_WORKFLOWS', '1')
     monkeypatch.setenv('ShortUUID', 'shortuuid')
     monkeypatch.setenv("AWS_DEFAULT_REGION", "us-east-1")
@@ -1,6 +1,13 @@
 # Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
 # SPDX-License-Identifier: Apache-2.0
 
+import hashlib
+import io
+import json
+
+import botocore.exceptions
+import botocore.response
+import botocore.stub
 import pytest
 from unittest.mock import MagicMock
 
@@ -68,7 +75,209 @@ def stub_list_workflows(count, dynamoStub):
     )
 
 
-def stub_update_workflow_status(status, dynamoStub):
+def stub_running_workflows(count, dynamoStub):
+    dynamoStub.add_response(
+        'get_item',
+        expected_params={
+            'TableName': 'testSystemTable',
+            'Key': {
+                'Name': 'RunningWorkflows'
+            },
+            'ConsistentRead': True
+        },
+        service_response={
+            'Item': {
+                'Value': {'N': str(count)}
+            }
+        }
+    )
+
+
+def stub_count_started_workflows(count, dynamoStub):
+    dynamoStub.add_response(
+        'query',
+        expected_params={
+            'TableName': 'testExecutionTable',
+            'IndexName': 'WorkflowExecutionStatus',
+            'ExpressionAttributeNames': {
+                '#workflow_status': 'Status'
+            },
+            'ExpressionAttributeValues': {
+                ':workflow_status': 'Started'
+            },
+            'KeyConditionExpression': '#workflow_status = :workflow_status',
+            'Select': 'COUNT'
+        },
+        service_response={
+            'Count': count,
+            'ScannedCount': count
+        }
+    )
+
+
+def stub_reconcile_running_workflows(started, dynamoStub, counted=None):
+    dynamoStub.add_response(
+        'update_item',
+        expected_params={
+            'TableName': 'testSystemTable',
+            'Key': {
+                'Name': 'RunningWorkflows'
+            },
+            'UpdateExpression': 'SET #value = :started',
+            'ConditionExpression': 'attribute_not_exists(#value)' if counted is None else '#value = :counted',
+            'ExpressionAttributeNames': {
+                '#value': 'Value'
+            },
+            'ExpressionAttributeValues': {
+                ':started': started,
+                **({} if counted is None else {':counted': counted})
+            }
+        },
+        service_response={}
+    )
+
+
+def stub_acquire_workflow_slot(max_concurrent_workflows, dynamoStub, available=True):
+    expected_params = {
+        'TableName': 'testSystemTable',
+        'Key': {
+            'Name': 'RunningWorkflows'
+        },
+        'UpdateExpression': 'SET #value = if_not_exists(#value, :zero) + :one',
+        'ConditionExpression': 'attribute_not_exists(#value) OR #value < :max',
+        'ExpressionAttributeNames': {
+            '#value': 'Value'
+        },
+        'ExpressionAttributeValues': {
+            ':zero': 0,
+            ':one': 1,
+            ':max': max_concurrent_workflows
+        }
+    }
+    if available:
+        dynamoStub.add_response('update_item', expected_params=expected_params, service_response={})
+    else:
+        dynamoStub.add_client_error('update_item', service_error_code='ConditionalCheckFailedException',
+                                    expected_params=expected_params)
+
+
+def stub_release_workflow_slot(dynamoStub):
+    dynamoStub.add_response(
+        'update_item',
+        expected_params={
+            'TableName': 'testSystemTable',
+            'Key': {
+                'Name': 'RunningWorkflows'
+            },
+            'UpdateExpression': 'SET #value = #value - :one',
+            'ConditionExpression': '#value > :zero',
+            'ExpressionAttributeNames': {
+                '#value': 'Value'
+            },
+            'ExpressionAttributeValues': {
+                ':zero': 0,
+                ':one': 1
+            }
+        },
+        service_response={}
+    )
+
+
+def stub_delete_message_batch(sqsStub, receipt_handles=('testReceiptHandle',), failed_ids=()):
+    ids = [str(index) for index in range(len(receipt_handles))]
+    sqsStub.add_response(
+        'delete_message_batch',
+        expected_params={
+            'QueueUrl': 'testExecutionQueueUrl',
+            'Entries': [{'Id': id, 'ReceiptHandle': handle} for id, handle in zip(ids, receipt_handles)]
+        },
+        service_response={
+            'Successful': [{'Id': id} for id in ids if id not in failed_ids],
+            'Failed': [{'Id': id, 'SenderFault': False, 'Code': 'InternalError'} for id in failed_ids]
+        }
+    )
+
+
+def stub_mark_workflow_started(queued_status, dynamoStub, arn=None, started=True):
+    expected_params = {
+        'TableName': 'testExecutionTable',
+        'Key': {
+            'Id': 'testWorkflowId'
+        },
+        'UpdateExpression': 'SET #workflow_status = :workflow_status' + (', StateMachineExecutionArn = :arn' if arn else ''),
+        'ConditionExpression': '#workflow_status = :queued_status',
+        'ExpressionAttributeNames': {
+            '#workflow_status': 'Status'
+        },
+        'ExpressionAttributeValues': {
+            ':workflow_status': 'Started',
+            ':queued_status': queued_status,
+            **({':arn': arn} if arn else {})
+        }
+    }
+    if started:
+        dynamoStub.add_response('update_item', expected_params=expected_params, service_response={})
+    else:
+        dynamoStub.add_client_error('update_item', service_error_code='ConditionalCheckFailedException',
+                                    expected_params=expected_params)
+
+
+def stub_trigger_workflow_scheduler(dynamoStub, pending=False):
+    expected_params = {
+        'TableName': 'testSystemTable',
+        'Key': {'Name': 'WorkflowSchedulerPendingUntil'},
+        'UpdateExpression': 'SET #value = :pending_until',
+        'ConditionExpression': 'attribute_not_exists(#value) OR #value < :now',
+        'ExpressionAttributeNames': {'#value': 'Value'},
+        'ExpressionAttributeValues': botocore.stub.ANY
+    }
+    if pending:
+        dynamoStub.add_client_error('update_item', service_error_code='ConditionalCheckFailedException',
+                              expected_params=expected_params)
+    else:
+        dynamoStub.add_response('update_item', expected_params=expected_params, service_response={})
+
+
+def stub_execution_queue_depth(depth, sqsStub):
+    sqsStub.add_response(
+        'get_queue_attributes',
+        expected_params={
+            'QueueUrl': 'testExecutionQueueUrl',
+            'AttributeNames': ['ApproximateNumberOfMessages']
+        },
+        service_response={
+            'Attributes': {'ApproximateNumberOfMessages': str(depth)}
+        }
+    )
+
+
+def stub_receive_empty_queue(count, sqsStub):
+    sqsStub.add_response(
+        'receive_message',
+        expected_params={
+            'QueueUrl': 'testExecutionQueueUrl',
+            'MaxNumberOfMessages': count,
+            'WaitTimeSeconds': 1,
+            'AttributeNames': ['SentTimestamp']
+        },
+        service_response={}
+    )
+
+
+def stub_clear_scheduler_pending(dynamoStub):
+    dynamoStub.add_response(
+        'delete_item',
+        expected_params={
+            'TableName': 'testSystemTable',
+            'Key': {
+                'Name': 'WorkflowSchedulerPendingUntil'
+            }
+        },
+        service_response={}
+    )
+
+
+def stub_update_workflow_status(status, dynamoStub, old_status=None):
     dynamoStub.add_response(
         'update_item',
         expected_params={
@@ -82,9 +291,10 @@ def stub_update_workflow_status(status, dynamoStub):
             },
             'ExpressionAttributeValues': {
                 ':workflow_status': status
-            }
+            },
+            'ReturnValues': 'UPDATED_OLD'
         },
-        service_response={}
+        service_response={'Attributes': {'Status': {'S': old_status}}} if old_status else {}
     )
 
 
@@ -176,11 +386,95 @@ def test_list_workflow_executions(dynamo_client_stub):
     assert results[1]['TestExecution'] == 'testExecutionValue2'
 
 
-def test_workflow_scheduler_lambda_max_concurrency_reached(dynamo_client_stub):
+def test_workflow_scheduler_lambda_max_concurrency_reached(dynamo_client_stub, sqs_client_stub):
     import app
 
+    stub_clear_scheduler_pending(dynamo_client_stub)
+    stub_execution_queue_depth(0, sqs_client_stub)
     stub_max_concurrent_workflows(1, dynamo_client_stub)
-    stub_list_workflows(1, dynamo_client_stub)
+    stub_running_workflows(1, dynamo_client_stub)
+    stub_count_started_workflows(1, dynamo_client_stub)
+
+    result = app.workflow_scheduler_lambda({}, {})
+    assert result == ''
+
+
+def test_workflow_scheduler_lambda_scheduled_run_reclaims_leases(dynamo_client_stub, sqs_client_stub, sfn_client_stub):
+    import app
+
+    # The run started by the schedule rule gives back the tokens of executions that are no longer running
+    stub_clear_scheduler_pending(dynamo_client_stub)
+    stub_operation_leases(dynamo_client_stub, ['testRunningArn', 'testStoppedArn', 'testDeletedArn'])
+    sfn_client_stub.add_response('describe_execution', expected_params={'executionArn': 'testRunningArn'},
+                                 service_response={'executionArn': 'testRunningArn', 'stateMachineArn': 'testStateMachineArn',
+                                                   'status': 'RUNNING', 'startDate': 0})
+    sfn_client_stub.add_response('describe_execution', expected_params={'executionArn': 'testStoppedArn'},
+                                 service_response={'executionArn': 'testStoppedArn', 'stateMachineArn': 'testStateMachineArn',
+                                                   'status': 'ABORTED', 'startDate': 0})
+    stub_reclaim_operation_lease(dynamo_client_stub, 'testStoppedArn')
+    sfn_client_stub.add_client_error('describe_execution', service_error_code='ExecutionDoesNotExist',
+                                     expected_params={'executionArn': 'testDeletedArn'})
+    stub_reclaim_operation_lease(dynamo_client_stub, 'testDeletedArn')
+    stub_execution_queue_depth(0, sqs_client_stub)
+    stub_max_concurrent_workflows(1, dynamo_client_stub)
+    stub_running_workflows(1, dynamo_client_stub)
+    stub_count_started_workflows(1, dynamo_client_stub)
+
+    result = app.workflow_scheduler_lambda({'source': 'aws.events'}, {})
+    assert result == ''
+
+
+def test_workflow_scheduler_lambda_queue_depth_unavailable(dynamo_client_stub, sqs_client_stub):
+    import app
+
+    # The queue depth metric can not be read, the scheduler still looks for workflows to admit
+    stub_clear_scheduler_pending(dynamo_client_stub)
+    sqs_client_stub.add_client_error('get_queue_attributes', service_error_code='AccessDenied', http_status_code=403)
+    stub_max_concurrent_workflows(1, dynamo_client_stub)
+    stub_running_workflows(0, dynamo_client_stub)
+    stub_receive_empty_queue(1, sqs_client_stub)
+
+    result = app.workflow_scheduler_lambda({}, {})
+    assert result == ''
+
+
+def test_workflow_scheduler_lambda_reconciles_leaked_slot(dynamo_client_stub, sqs_client_stub):
+    import app
+
+    # The counter is at the limit but no workflow is Started, so the leaked slot is taken back
+    # before the queue is read
+    stub_clear_scheduler_pending(dynamo_client_stub)
+    stub_execution_queue_depth(0, sqs_client_stub)
+    stub_max_concurrent_workflows(1, dynamo_client_stub)
+    stub_running_workflows(1, dynamo_client_stub)
+    stub_count_started_workflows(0, dynamo_client_stub)
+    stub_reconcile_running_workflows(0, dynamo_client_stub, counted=1)
+    stub_receive_empty_queue(1, sqs_client_stub)
+
+    result = app.workflow_scheduler_lambda({}, {})
+    assert result == ''
+
+
+def test_workflow_scheduler_lambda_seeds_running_workflows(dynamo_client_stub, sqs_client_stub):
+    import app
+
+    # Workflows that were Started before the counter existed hold their slots
+    stub_clear_scheduler_pending(dynamo_client_stub)
+    stub_execution_queue_depth(0, sqs_client_stub)
+    stub_max_concurrent_workflows(1, dynamo_client_stub)
+    dynamo_client_stub.add_response(
+        'get_item',
+        expected_params={
+            'TableName': 'testSystemTable',
+            'Key': {
+                'Name': 'RunningWorkflows'
+            },
+            'ConsistentRead': True
+        },
+        service_response={}
+    )
+    stub_count_started_workflows(1, dynamo_client_stub)
+    stub_reconcile_running_workflows(1, dynamo_client_stub)
 
     result = app.workflow_scheduler_lambda({}, {})
     assert result == ''
@@ -190,13 +484,17 @@ def test_workflow_scheduler_lambda_empty_queue(dynamo_client_stub, sqs_client_st
     import app
 
     # stubs
+    stub_clear_scheduler_pending(dynamo_client_stub)
+    stub_execution_queue_depth(0, sqs_client_stub)
     stub_max_concurrent_workflows(2, dynamo_client_stub)
-    stub_list_workflows(1, dynamo_client_stub)
+    stub_running_workflows(1, dynamo_client_stub)
     sqs_client_stub.add_response(
         'receive_message',
         expected_params={
             'QueueUrl': 'testExecutionQueueUrl',
-            'MaxNumberOfMessages': 1
+            'MaxNumberOfMessages': 1,
+            'WaitTimeSeconds': 1,
+            'AttributeNames': ['SentTimestamp']
         },
         service_response={
             'Messages': [{
@@ -216,16 +514,8 @@ def test_workflow_scheduler_lambda_empty_queue(dynamo_client_stub, sqs_client_st
             }]
         }
     )
-    sqs_client_stub.add_response(
-        'delete_message',
-        expected_params={
-            'QueueUrl': 'testExecutionQueueUrl',
-            'ReceiptHandle': 'testReceiptHandle'
-        },
-        service_response={}
-    )
-
-    stub_update_workflow_status('Started', dynamo_client_stub)
+    stub_acquire_workflow_slot(2, dynamo_client_stub)
+    stub_delete_message_batch(sqs_client_stub)
 
     sfn_client_stub.add_response(
         'start_execution',
@@ -240,35 +530,426 @@ def test_workflow_scheduler_lambda_empty_queue(dynamo_client_stub, sqs_client_st
         }
     )
 
-    dynamo_client_stub.add_response(
-        'update_item',
+    stub_mark_workflow_started('testStatus', dynamo_client_stub, 'testExecutionArn')
+    stub_running_workflows(2, dynamo_client_stub)
+
+    result = app.workflow_scheduler_lambda({}, {})
+    assert result == ''
+
+
+def test_workflow_scheduler_lambda_slot_taken_by_another_scheduler(dynamo_client_stub, sqs_client_stub):
+    import app
+
+    stub_clear_scheduler_pending(dynamo_client_stub)
+    stub_execution_queue_depth(0, sqs_client_stub)
+    stub_max_concurrent_workflows(2, dynamo_client_stub)
+    stub_running_workflows(1, dynamo_client_stub)
+    sqs_client_stub.add_response(
+        'receive_message',
         expected_params={
-            'TableName': 'testExecutionTable',
+            'QueueUrl': 'testExecutionQueueUrl',
+            'MaxNumberOfMessages': 1,
+            'WaitTimeSeconds': 1,
+            'AttributeNames': ['SentTimestamp']
+        },
+        service_response={
+            'Messages': [{
+                'Body': '{"Status": "Queued", "Id": "testWorkflowId"}',
+                'ReceiptHandle': 'testReceiptHandle'
+            }]
+        }
+    )
+    stub_acquire_workflow_slot(2, dynamo_client_stub, available=False)
+    # The message goes back on the queue instead of being deleted
+    sqs_client_stub.add_response(
+        'change_message_visibility_batch',
+        expected_params={
+            'QueueUrl': 'testExecutionQueueUrl',
+            'Entries': [{'Id': '0', 'ReceiptHandle': 'testReceiptHandle', 'VisibilityTimeout': 0}]
+        },
+        service_response={'Successful': [{'Id': '0'}], 'Failed': []}
+    )
+
+    result = app.workflow_scheduler_lambda({}, {})
+    assert result == ''
+
+
+def test_workflow_scheduler_lambda_resumed_workflow(dynamo_client_stub, sqs_client_stub):
+    import app
+
+    stub_clear_scheduler_pending(dynamo_client_stub)
+    stub_execution_queue_depth(0, sqs_client_stub)
+    stub_max_concurrent_workflows(2, dynamo_client_stub)
+    stub_running_workflows(1, dynamo_client_stub)
+    sqs_client_stub.add_response(
+        'receive_message',
+        expected_params={
+            'QueueUrl': 'testExecutionQueueUrl',
+            'MaxNumberOfMessages': 1,
+            'WaitTimeSeconds': 1,
+            'AttributeNames': ['SentTimestamp']
+        },
+        service_response={
+            'Messages': [{
+                'Body': '{"Status": "Resumed", "Id": "testWorkflowId"}',
+                'ReceiptHandle': 'testReceiptHandle'
+            }]
+        }
+    )
+    stub_acquire_workflow_slot(2, dynamo_client_stub)
+    stub_delete_message_batch(sqs_client_stub)
+    # The state machine of a resumed workflow is already running, so only the status is written
+    stub_mark_workflow_started('Resumed', dynamo_client_stub)
+    stub_running_workflows(2, dynamo_client_stub)
+
+    result = app.workflow_scheduler_lambda({}, {})
+    assert result == ''
+
+
+def test_workflow_scheduler_lambda_delete_failed(dynamo_client_stub, sqs_client_stub):
+    import app
+
+    stub_clear_scheduler_pending(dynamo_client_stub)
+    stub_execution_queue_depth(0, sqs_client_stub)
+    stub_max_concurrent_workflows(2, dynamo_client_stub)
+    stub_running_workflows(1, dynamo_client_stub)
+    sqs_client_stub.add_response(
+        'receive_message',
+        expected_params={
+            'QueueUrl': 'testExecutionQueueUrl',
+            'MaxNumberOfMessages': 1,
+            'WaitTimeSeconds': 1,
+            'AttributeNames': ['SentTimestamp']
+        },
+        service_response={
+            'Messages': [{
+                'Body': '{"Status": "Queued", "Id": "testWorkflowId"}',
+                'ReceiptHandle': 'testReceiptHandle'
+            }]
+        }
+    )
+    stub_acquire_workflow_slot(2, dynamo_client_stub)
+    # The message stays on the queue, so the workflow is not started and its slot is given back
+    stub_delete_message_batch(sqs_client_stub, failed_ids=('0',))
+    stub_release_workflow_slot(dynamo_client_stub)
+    stub_running_workflows(1, dynamo_client_stub)
+    sqs_client_stub.add_response(
+        'receive_message',
+        expected_params={
+            'QueueUrl': 'testExecutionQueueUrl',
+            'MaxNumberOfMessages': 1,
+            'WaitTimeSeconds': 1,
+            'AttributeNames': ['SentTimestamp']
+        },
+        service_response={}
+    )
+
+    result = app.workflow_scheduler_lambda({}, {})
+    assert result == ''
+
+
+def test_workflow_scheduler_lambda_start_execution_error(dynamo_client_stub, sqs_client_stub, sfn_client_stub, lambda_client_stub):
+    import app
+
+    stub_clear_scheduler_pending(dynamo_client_stub)
+    stub_execution_queue_depth(0, sqs_client_stub)
+    stub_max_concurrent_workflows(2, dynamo_client_stub)
+    stub_running_workflows(1, dynamo_client_stub)
+    sqs_client_stub.add_response(
+        'receive_message',
+        expected_params={
+            'QueueUrl': 'testExecutionQueueUrl',
+            'MaxNumberOfMessages': 1,
+            'WaitTimeSeconds': 1,
+            'AttributeNames': ['SentTimestamp']
+        },
+        service_response={
+            'Messages': [{
+                'Body': '''{
+                    "Status": "Queued",
+                    "Id": "testWorkflowId",
+                    "CurrentStage": "testCurrentStage",
+                    "Workflow": {
+                        "StateMachineArn": "testStateMachineArn",
+                        "Name": "testWorkflowName",
+                        "Stages": {
+                            "testCurrentStage": {}
+                        }
+                    }
+                }''',
+                'ReceiptHandle': 'testReceiptHandle'
+            }]
+        }
+    )
+    stub_acquire_workflow_slot(2, dynamo_client_stub)
+    stub_delete_message_batch(sqs_client_stub)
+    sfn_client_stub.add_client_error('start_execution', service_error_code='ExecutionLimitExceeded')
+    stub_release_workflow_slot(dynamo_client_stub)
+    dynamo_client_stub.add_response('update_item', service_response={})
+    stub_trigger_workflow_scheduler(dynamo_client_stub)
+    lambda_client_stub.add_response('invoke', service_response={})
+
+    with pytest.raises(Exception):
+        app.workflow_scheduler_lambda({}, {})
+
+
+def test_receive_queued_workflows_shares_capacity_between_queues(sqs_client_stub, monkeypatch):
+    import app
+
+    monkeypatch.setattr(app, 'EXECUTION_QUEUES', {
+        'High': 'testHighQueueUrl',
+        'Normal': 'testExecutionQueueUrl',
+        'Low': 'testLowQueueUrl'
+    })
+    draws = {}
+
+    def choices(population, weights, k):
+        draws.update(population=list(population), weights=weights, k=k)
+        return ['High', 'Low', 'High']
+    monkeypatch.setattr(app.random, 'choices', choices)
+
+    sqs_client_stub.add_response(
+        'receive_message',
+        expected_params={
+            'QueueUrl': 'testHighQueueUrl',
+            'MaxNumberOfMessages': 2,
+            'WaitTimeSeconds': 1,
+            'AttributeNames': ['SentTimestamp']
+        },
+        service_response={
+            'Messages': [
+                {'Body': '{"Id": "testWorkflowId1"}', 'ReceiptHandle': 'testReceiptHandle1'},
+                {'Body': '{"Id": "testWorkflowId2"}', 'ReceiptHandle': 'testReceiptHandle2'}
+            ]
+        }
+    )
+    sqs_client_stub.add_response(
+        'receive_message',
+        expected_params={
+            'QueueUrl': 'testLowQueueUrl',
+            'MaxNumberOfMessages': 1,
+            'WaitTimeSeconds': 1,
+            'AttributeNames': ['SentTimestamp']
+        },
+        service_response={}
+    )
+
+    priorities = ['High', 'Normal', 'Low']
+    received = app.receive_queued_workflows(priorities, 3)
+
+    assert draws == {'population': ['High', 'Normal', 'Low'], 'weights': [6, 3, 1], 'k': 3}
+    assert [(priority, message['ReceiptHandle']) for priority, message in received] == [
+        ('High', 'testReceiptHandle1'), ('High', 'testReceiptHandle2')]
+    # The empty low priority queue is not drawn again during this scheduler run
+    assert priorities == ['High', 'Normal']
+
+
+def test_trigger_workflow_scheduler_coalesced(dynamo_client_stub, lambda_client_stub):
+    import app
+
+    # A scheduler run is already pending, so the scheduler is not invoked again
+    stub_trigger_workflow_scheduler(dynamo_client_stub, pending=True)
+
+    assert not app.trigger_workflow_scheduler(app.DYNAMO_CLIENT.Table('testSystemTable'), app.LAMBDA_CLIENT, app.WORKFLOW_SCHEDULER_LAMBDA_ARN)
+
+
+class PendingMarkerTable:
+    """
+    System table holding only the scheduler pending marker and evaluating the marker condition, so triggers are
+    coalesced the way DynamoDB would coalesce them.
+    """
+    def __init__(self):
+        self.items = {}
+
+    def get_item(self, Key, **_kwargs):
+        return {'Item': self.items[Key['Name']]} if Key['Name'] in self.items else {}
+
+    def update_item(self, Key, ExpressionAttributeValues, **_kwargs):
+        item = self.items.get(Key['Name'], {})
+        if 'Value' in item and item['Value'] >= ExpressionAttributeValues[':now']:
+            raise botocore.exceptions.ClientError({'Error': {'Code': 'ConditionalCheckFailedException'}}, 'UpdateItem')
+        self.items[Key['Name']] = {'Value': ExpressionAttributeValues[':pending_until']}
+
+    def delete_item(self, Key):
+        self.items.pop(Key['Name'], None)
+
+
+def test_workflow_scheduler_lambda_trigger_during_receive(sqs_client_stub, lambda_client_stub, monkeypatch):
+    import app
+
+    system_table = PendingMarkerTable()
+    monkeypatch.setattr(app, 'DYNAMO_CLIENT', MagicMock(**{'Table.return_value': system_table}))
+    monkeypatch.setattr(app, 'get_running_workflow_count', MagicMock(return_value=0))
+
+    def trigger():
+        return app.trigger_workflow_scheduler(system_table, app.LAMBDA_CLIENT, app.WORKFLOW_SCHEDULER_LAMBDA_ARN)
+
+    # A workflow queued while the scheduler is past its receive step is not coalesced into that run,
+    # the scheduler is invoked again right away instead of waiting for the schedule rule
+    def receive_queued_workflows(priorities, capacity):
+        assert trigger()
+        priorities.clear()
+        return []
+    monkeypatch.setattr(app, 'receive_queued_workflows', receive_queued_workflows)
+
+    stub_execution_queue_depth(0, sqs_client_stub)
+    for _ in range(2):
+        lambda_client_stub.add_response(
+            'invoke',
+            expected_params={
+                'FunctionName': 'testSchedulerLambdaArn',
+                'InvocationType': 'Event'
+            },
+            service_response={}
+        )
+
+    assert trigger()
+    # Coalesced into the run that was just invoked
+    assert not trigger()
+    app.workflow_scheduler_lambda({}, {})
+    # Coalesced into the run invoked during the receive step, which has not read the queue yet
+    assert not trigger()
+
+
+def stub_operation_budget(dynamoStub, budget=None, leases=True):
+    item = {'Value': {'N': str(budget)}}
+    if leases:
+        item['Leases'] = {'M': {}}
+    dynamoStub.add_response(
+        'get_item',
+        expected_params={
+            'TableName': 'testSystemTable',
             'Key': {
-                'Id': 'testWorkflowId'
+                'Name': 'MaxConcurrentOperations:testName'
+            },
+            'ProjectionExpression': '#value, #leases',
+            'ExpressionAttributeNames': {
+                '#value': 'Value',
+                '#leases': 'Leases'
+            }
+        },
+        service_response={'Item': item} if budget is not None else {}
+    )
+
+
+def stub_operation_leases_backfill(dynamoStub, error_code=None):
+    expected_params = {
+        'TableName': 'testSystemTable',
+        'Key': {
+            'Name': 'MaxConcurrentOperations:testName'
+        },
+        'UpdateExpression': 'SET #leases = if_not_exists(#leases, :no_leases)',
+        'ConditionExpression': 'attribute_exists(#value)',
+        'ExpressionAttributeNames': {
+            '#value': 'Value',
+            '#leases': 'Leases'
+        },
+        'ExpressionAttributeValues': {
+            ':no_leases': {}
+        }
+    }
+    if error_code:
+        dynamoStub.add_client_error('update_item', service_error_code=error_code, expected_params=expected_params)
+    else:
+        dynamoStub.add_response('update_item', expected_params=expected_params, service_response={})
+
+
+def stub_operation_leases(dynamoStub, leases):
+    dynamoStub.add_response(
+        'scan',
+        expected_params={
+            'TableName': 'testSystemTable',
+            'FilterExpression': 'begins_with(#name, :prefix) AND attribute_exists(#leases)',
+            'ProjectionExpression': '#name, #leases',
+            'ExpressionAttributeNames': {
+                '#name': 'Name',
+                '#leases': 'Leases'
             },
-            'UpdateExpression': 'SET StateMachineExecutionArn = :arn',
             'ExpressionAttributeValues': {
-                ':arn': 'testExecutionArn'
+                ':prefix': 'MaxConcurrentOperations:'
             }
         },
         service_response={
+            'Items': [
+                {
+                    'Name': {'S': 'MaxConcurrentOperations:testName'},
+                    'Leases': {'M': {arn: {'S': '2024-01-01T00:00:00Z'} for arn in leases}}
+                }
+            ]
+        }
+    )
+
+
+def stub_reclaim_operation_lease(dynamoStub, execution_arn):
+    dynamoStub.add_response(
+        'update_item',
+        expected_params={
+            'TableName': 'testSystemTable',
+            'Key': {
+                'Name': 'MaxConcurrentOperations:testName'
+            },
+            'UpdateExpression': 'REMOVE #leases.#lease',
+            'ConditionExpression': 'attribute_exists(#leases.#lease)',
+            'ExpressionAttributeNames': {
+                '#leases': 'Leases',
+                '#lease': execution_arn
+            }
+        },
+        service_response={}
+    )
+
+
+def test_filter_operation_lambda(dynamo_client_stub):
+    import app
+
+    # Operations without a concurrency budget do not take a token
+    stub_operation_budget(dynamo_client_stub)
+
+    event_param = test_operator_parameter
+    response = app.filter_operation_lambda(event_param, {})
+    event_param['Status'] = 'Started'
+    assert response == dict(event_param, ConcurrencyLimited=False)
+
+
+def test_filter_operation_lambda_concurrency_limited(dynamo_client_stub):
+    import app
+
+    stub_operation_budget(dynamo_client_stub, budget=2)
+
+    response = app.filter_operation_lambda(dict(test_operator_parameter), {})
+    assert response['Status'] == 'Started'
+    assert response['ConcurrencyLimited'] is True
+
+
+def test_filter_operation_lambda_backfills_leases(dynamo_client_stub):
+    import app
 
-        }
-    )
-    stub_list_workflows(2, dynamo_client_stub)
+    # A budget stored without the lease map gets an empty one, so the operation can take a token
+    stub_operation_budget(dynamo_client_stub, budget=2, leases=False)
+    stub_operation_leases_backfill(dynamo_client_stub)
 
-    result = app.workflow_scheduler_lambda({}, {})
-    assert result == ''
+    response = app.filter_operation_lambda(dict(test_operator_parameter), {})
+    assert response['ConcurrencyLimited'] is True
 
 
-def test_filter_operation_lambda():
+def test_filter_operation_lambda_budget_removed(dynamo_client_stub):
     import app
 
-    event_param = test_operator_parameter
-    response = app.filter_operation_lambda(event_param, {})
-    event_param['Status'] = 'Started'
-    assert response == event_param
+    # The budget was removed before the lease map could be added, so the operation is no longer limited
+    stub_operation_budget(dynamo_client_stub, budget=2, leases=False)
+    stub_operation_leases_backfill(dynamo_client_stub, error_code='ConditionalCheckFailedException')
+
+    response = app.filter_operation_lambda(dict(test_operator_parameter), {})
+    assert response['ConcurrencyLimited'] is False
+
+
+def test_filter_operation_lambda_skipped():
+    import app
+
+    # Skipped operations never take a token, so the budget is not looked up
+    response = app.filter_operation_lambda(dict(test_operator_parameter, Configuration={'Enabled': False, 'MediaType': 'testMedia'}), {})
+    assert response['Status'] == 'Skipped'
+    assert response['ConcurrencyLimited'] is False
 
 
 def test_start_wait_operation_lambda(dynamo_client_stub):
@@ -376,49 +1057,10 @@ def test_check_wait_operation_lambda_operator_waiting_status(dynamo_client_stub)
 def test_complete_stage_execution_lambda_error_output(dynamo_client_stub):
     import app
 
-    stub = app.start_next_stage_execution
-    app.start_next_stage_execution = MagicMock(return_value={'Id': 'testWorkflowId'})
     stub2 = app.update_workflow_execution_status
     app.update_workflow_execution_status = MagicMock()
 
-    dynamo_client_stub.add_response(
-        'get_item',
-        expected_params={
-            'TableName': 'testExecutionTable',
-            'Key': {
-                'Id': 'testWorkflowId'
-            },
-            'ConsistentRead': True
-        },
-        service_response={
-            'Item': {
-                'Workflow': {
-                    'M': {
-                        'Stages': {
-                            'M': {
-                                'testName': {
-                                    'M': {
-                                        'Outputs': {
-                                            'M': {}
-                                        }
-                                    }
-                                }
-                            }
-                        }
-                    }
-                },
-                'Globals': {
-                    'M': {
-                        'Media': {
-                            'M': {}
-                        }
-                    }
-                },
-                'CurrentStage': {'S': 'End'}
-            }
-        }
-    )
-
+    # the failed stage ends the workflow, its status is set with the error message
     dynamo_client_stub.add_response(
         'update_item',
         expected_params={
@@ -426,42 +1068,30 @@ def test_complete_stage_execution_lambda_error_output(dynamo_client_stub):
             'Key': {
                 'Id': 'testWorkflowId'
             },
-            'UpdateExpression': 'SET Workflow.Stages.#stage = :stage, Globals = :globals',
+            'UpdateExpression': 'SET Workflow.Stages.#stage.Outputs = :outputs, Workflow.Stages.#stage.#stage_status = :stage_status, '
+                                'CurrentStage = :current_stage',
+            'ConditionExpression': 'attribute_exists(Id)',
             'ExpressionAttributeNames': {
-                '#stage': 'testName'
+                '#stage': 'testName',
+                '#stage_status': 'Status'
             },
             'ExpressionAttributeValues': {
-                # ':stage': json.dumps(stage)
-                ':stage': {
-                    'Outputs': [{
-                        'Name': 'testName',
-                        'Status': 'Error'
-                    }, {
-                        'Name': 'testName',
-                        'Status': 'Error',
-                        'Message': 'message'
-                    }],
+                ':outputs': [{
+                    'Name': 'testName',
                     'Status': 'Error'
-                },
-                ':globals': {
-                    'Media': {},
-                    'MetaData': {}
-                }
-                # ':step_function_arn': step_function_execution_arn
+                }, {
+                    'Name': 'testName',
+                    'Status': 'Error',
+                    'Message': 'message'
+                }],
+                ':stage_status': 'Error',
+                ':current_stage': 'End'
             }
         },
         service_response={}
     )
-    dynamo_client_stub.add_response(
-        'put_item',
-        expected_params={
-            'TableName': 'testExecutionTable',
-            'Item': {'Id': 'testWorkflowId'}
-        },
-        service_response={}
-    )
 
-    event_param = test_operator_parameter
+    event_param = dict(test_operator_parameter, Next='stage2')
     event_param['Outputs'] = [{
         'Name': 'testName',
         'Status': 'Error'
@@ -474,62 +1104,33 @@ def test_complete_stage_execution_lambda_error_output(dynamo_client_stub):
     with pytest.raises(ValueError):
         app.complete_stage_execution_lambda(event_param, {})
 
-    assert app.start_next_stage_execution.call_count == 1
-    assert app.start_next_stage_execution.call_args[0][0] == 'testName'
     assert app.update_workflow_execution_status.call_count == 1
     assert app.update_workflow_execution_status.call_args[0][0] == 'testWorkflowId'
     assert app.update_workflow_execution_status.call_args[0][1] == 'Error'
 
-    app.start_next_stage_execution = stub
     app.update_workflow_execution_status = stub2
 
 
 def test_complete_stage_execution_lambda(dynamo_client_stub):
     import app
 
-    stub = app.start_next_stage_execution
-    app.start_next_stage_execution = MagicMock(return_value={
-        'CurrentStage': 'End'
-    })
-
-    dynamo_client_stub.add_response(
-        'get_item',
-        expected_params={
-            'TableName': 'testExecutionTable',
-            'Key': {
-                'Id': 'testWorkflowId'
-            },
-            'ConsistentRead': True
-        },
-        service_response={
-            'Item': {
-                'Workflow': {
-                    'M': {
-                        'Stages': {
-                            'M': {
-                                'testName': {
-                                    'M': {
-                                        'Outputs': {
-                                            'M': {}
-                                        }
-                                    }
-                                }
-                            }
-                        }
-                    }
-                },
-                'Globals': {
-                    'M': {
-                        'Media': {
-                            'M': {}
-                        }
-                    }
-                },
-                'CurrentStage': {'S': 'End'}
-            }
+    outputs = [{
+        'Name': 'testName',
+        'Status': 'Complete',
+        'Media': {
+            'media1': 'value1',
+            'media2': 'value2'
         }
-    )
+    }, {
+        'Name': 'testName',
+        'Status': 'Complete',
+        'MetaData': {
+            'metadata1': 'value1',
+            'metadata2': 'value2'
+        }
+    }]
 
+    # Only the stage result, the Globals keys written by the stage and the workflow status are sent to dynamo
     dynamo_client_stub.add_response(
         'update_item',
         expected_params={
@@ -537,41 +1138,42 @@ def test_complete_stage_execution_lambda(dynamo_client_stub):
             'Key': {
                 'Id': 'testWorkflowId'
             },
-            'UpdateExpression': 'SET Workflow.Stages.#stage = :stage, Globals = :globals',
+            'UpdateExpression': 'SET Workflow.Stages.#stage.Outputs = :outputs, Workflow.Stages.#stage.#stage_status = :stage_status, '
+                                'Globals.Media.#media0 = :media0, Globals.Media.#media1 = :media1, '
+                                'Globals.MetaData.#metadata0 = :metadata0, Globals.MetaData.#metadata1 = :metadata1, '
+                                '#workflow_status = :workflow_status, CurrentStage = :current_stage',
+            'ConditionExpression': 'attribute_exists(Id)',
             'ExpressionAttributeNames': {
-                '#stage': 'testName'
+                '#stage': 'testName',
+                '#stage_status': 'Status',
+                '#media0': 'media1',
+                '#media1': 'media2',
+                '#metadata0': 'metadata1',
+                '#metadata1': 'metadata2',
+                '#workflow_status': 'Status'
             },
             'ExpressionAttributeValues': {
-                # ':stage': json.dumps(stage)
-                ':stage': {
-                    'Outputs': [{
-                        'Name': 'testName',
-                        'Status': 'Complete',
-                        'Media': {
-                            'media1': 'value1',
-                            'media2': 'value2'
-                        }
-                    }, {
-                        'Name': 'testName',
-                        'Status': 'Complete',
-                        'MetaData': {
-                            'metadata1': 'value1',
-                            'metadata2': 'value2'
-                        }
-                    }],
-                    'Status': 'Complete'
-                },
-                ':globals': {
-                    'Media': {'media1': 'value1', 'media2': 'value2'},
-                    'MetaData': {'metadata1': 'value1', 'metadata2': 'value2'}
-                }
-                # ':step_function_arn': step_function_execution_arn
-            }
+                ':outputs': outputs,
+                ':stage_status': 'Complete',
+                ':media0': 'value1',
+                ':media1': 'value2',
+                ':metadata0': 'value1',
+                ':metadata1': 'value2',
+                ':workflow_status': 'Complete',
+                ':current_stage': 'End'
+            },
+            'ReturnValues': 'UPDATED_OLD'
         },
-        service_response={}
+        service_response={
+            'Attributes': {
+                'Status': {'S': 'Started'}
+            }
+        }
     )
+    stub_release_workflow_slot(dynamo_client_stub)
+    stub_trigger_workflow_scheduler(dynamo_client_stub, pending=True)
 
-    event_param = test_operator_parameter
+    event_param = dict(test_operator_parameter)
     event_param['Outputs'] = [{
         'Name': 'testName',
         'Status': 'Complete',
@@ -590,211 +1192,252 @@ def test_complete_stage_execution_lambda(dynamo_client_stub):
 
     response = app.complete_stage_execution_lambda(event_param, {})
     assert response == {}
-    assert app.start_next_stage_execution.call_count == 1
-    assert app.start_next_stage_execution.call_args[0][0] == 'testName'
-    app.start_next_stage_execution = stub
 
 
-def test_update_workflow_error_case(dynamo_client_stub, lambda_client_stub):
+def test_complete_stage_execution_starts_next_stage(dynamo_client_stub):
     import app
 
+    outputs = [{
+        'Name': 'testName',
+        'Status': 'Complete',
+        'MetaData': {
+            'metadata1': 'value1'
+        }
+    }]
+    next_stage_input = {
+        'Media': {
+            'testMedia': 'testMediaValue'
+        },
+        'MetaData': {
+            'metadata1': 'value1'
+        }
+    }
+
+    # the next stage is started in the same write, nothing is returned
     dynamo_client_stub.add_response(
         'update_item',
         expected_params={
             'TableName': 'testExecutionTable',
             'Key': {
-                'Id': 'testWorkflowId',
+                'Id': 'testWorkflowId'
             },
-            'UpdateExpression': 'SET #workflow_status = :workflow_status, Message = :message',
+            'UpdateExpression': 'SET Workflow.Stages.#stage.Outputs = :outputs, Workflow.Stages.#stage.#stage_status = :stage_status, '
+                                'Globals.MetaData.#metadata0 = :metadata0, '
+                                'Workflow.Stages.#next_stage.Input = :next_stage_input, '
+                                'Workflow.Stages.#next_stage.#stage_status = :next_stage_status, '
+                                'CurrentStage = :current_stage',
+            'ConditionExpression': 'attribute_exists(Id)',
             'ExpressionAttributeNames': {
-                '#workflow_status': "Status"
+                '#stage': 'testName',
+                '#stage_status': 'Status',
+                '#metadata0': 'metadata1',
+                '#next_stage': 'stage2'
             },
             'ExpressionAttributeValues': {
-                ':workflow_status': 'Error',
-                ':message': 'testMessage'
+                ':outputs': outputs,
+                ':stage_status': 'Complete',
+                ':metadata0': 'value1',
+                ':next_stage_input': next_stage_input,
+                ':next_stage_status': 'Started',
+                ':current_stage': 'stage2'
             }
         },
         service_response={}
     )
-
-    lambda_client_stub.add_response(
-        'invoke',
-        expected_params={
-            'FunctionName': 'testSchedulerLambdaArn',
-            'InvocationType': 'Event'
-        },
-        service_response={}
-    )
-
-    response = app.update_workflow_execution_status('testWorkflowId', 'Error', 'testMessage')
-    assert response is None
-
-
-def test_update_workflow_success_case(dynamo_client_stub):
-    import app
-
-    stub_update_workflow_status('Success', dynamo_client_stub)
-
-    response = app.update_workflow_execution_status('testWorkflowId', 'Success', '')
-    assert response is None
-
-
-def test_start_next_execution_end_stage(dynamo_client_stub):
-    import app
-
-    # mocks and stubs
-    saved_stub = app.update_workflow_execution_status
-    app.update_workflow_execution_status = MagicMock()
-
+    # only the definition of the next stage is read
     dynamo_client_stub.add_response(
-        'update_item',
+        'get_item',
         expected_params={
             'TableName': 'testExecutionTable',
             'Key': {
                 'Id': 'testWorkflowId'
             },
-            'UpdateExpression': 'SET CurrentStage = :current_stage',
-            'ExpressionAttributeValues': {
-                ':current_stage': "End"
+            'ProjectionExpression': 'Workflow.Stages.#stage',
+            'ExpressionAttributeNames': {
+                '#stage': 'stage2'
             }
         },
-        service_response={}
+        service_response={
+            'Item': {
+                'Workflow': {'M': {'Stages': {'M': {'stage2': {'M': {
+                    'Name': {'S': 'stage2'},
+                    'Status': {'S': 'Not Started'},
+                    'End': {'BOOL': True}
+                }}}}}}
+            }
+        }
     )
 
-    stage_name_param = 'testName'
-    workflow_execution_param = {
-        'Id': 'testWorkflowId',
-        'Workflow': {
-            'Stages': {
-                'testName': {
-                    'Status': 'Success',
-                    'Outputs': {
-                    },
-                    'End': True
-                }
-            }
-        },
-        'Globals': {
-        },
-        'CurrentStage': 'End'
+    event_param = dict(test_operator_parameter, Next='stage2', Outputs=outputs)
+
+    response = app.complete_stage_execution_lambda(event_param, {})
+    assert response == {
+        'Name': 'stage2',
+        'Status': 'Started',
+        'End': True,
+        'Input': next_stage_input
     }
 
-    response = app.start_next_stage_execution(stage_name_param, workflow_execution_param)
-    assert response == workflow_execution_param
-    assert app.update_workflow_execution_status.call_count == 1
-    assert app.update_workflow_execution_status.call_args[0][0] == 'testWorkflowId'
-    assert app.update_workflow_execution_status.call_args[0][1] == 'Success'
-    assert app.update_workflow_execution_status.call_args[0][2] == 'stage completed with status Success'
 
-    app.update_workflow_execution_status = saved_stub
+def test_operation_helper_spills_large_outputs_once(monkeypatch):
+    from MediaInsightsEngineLambdaHelper import MediaInsightsOperationHelper
+    from MediaInsightsEngineLambdaHelper import references
+    from MediaInsightsEngineLambdaHelper.clients import get_client
+
+    monkeypatch.setenv('DATAPLANE_BUCKET', 'testDataplaneBucket')
+    large = 'x' * 40000
+    body = json.dumps(large).encode('utf-8')
+    event = dict(test_operator_parameter, MetaData={'Large': large, 'Small': 'value'})
+
+    # Spilling is off unless a threshold is set
+    assert MediaInsightsOperationHelper(dict(event)).return_output_object()['MetaData']['Large'] == large
+
+    monkeypatch.setattr(references, 'SPILL_THRESHOLD_BYTES', 32768)
+    operator_object = MediaInsightsOperationHelper(dict(event))
+    with botocore.stub.Stubber(get_client('s3')) as s3_stub:
+        s3_stub.add_response(
+            'put_object',
+            expected_params={
+                'Bucket': 'testDataplaneBucket',
+                'Key': 'private/assets/testAssetId/workflows/testWorkflowId/references/Large-' +
+                       hashlib.sha256(body).hexdigest() + '.json',
+                'Body': body,
+                'ContentType': 'application/json'
+            },
+            service_response={}
+        )
+        output_object = operator_object.return_output_object()
+        # Returning the output object again, e.g. to print it, references the same object without writing it
+        assert operator_object.return_output_object() == output_object
+        s3_stub.assert_no_pending_responses()
+
+    assert output_object['MetaData']['Small'] == 'value'
+    assert output_object['MetaData']['Large'] == {
+        'MieReferenceType': 'S3',
+        'S3Bucket': 'testDataplaneBucket',
+        'S3Key': 'private/assets/testAssetId/workflows/testWorkflowId/references/Large-' +
+                 hashlib.sha256(body).hexdigest() + '.json',
+        'ContentLength': len(body)
+    }
 
 
-def test_start_next_execution_error(dynamo_client_stub):
-    import app
+def test_operation_helper_resolves_references_on_access():
+    from MediaInsightsEngineLambdaHelper import MediaInsightsOperationHelper
+    from MediaInsightsEngineLambdaHelper.clients import get_client
 
-    # mocks and stubs
-    saved_stub = app.update_workflow_execution_status
-    app.update_workflow_execution_status = MagicMock()
+    reference = {
+        'MieReferenceType': 'S3',
+        'S3Bucket': 'testDataplaneBucket',
+        'S3Key': 'testKey',
+        'ContentLength': 12
+    }
+    event = dict(test_operator_parameter,
+                 MetaData={'Large': dict(reference), 'Small': 'value'},
+                 Input={'Media': {}, 'MetaData': {'Large': dict(reference)}})
+    operator_object = MediaInsightsOperationHelper(event)
+
+    # values that are not read are passed on as references
+    assert json.loads(json.dumps(operator_object.return_output_object()))['Input']['MetaData']['Large'] == reference
+
+    body = b'["a", "b"]'
+    with botocore.stub.Stubber(get_client('s3')) as s3_stub:
+        s3_stub.add_response(
+            'get_object',
+            expected_params={'Bucket': 'testDataplaneBucket', 'Key': 'testKey'},
+            service_response={'Body': botocore.response.StreamingBody(io.BytesIO(body), len(body))}
+        )
+        assert operator_object.metadata['Large'] == ['a', 'b']
+        # the resolved value is kept, so it is only read once
+        assert operator_object.metadata.get('Large') == ['a', 'b']
+        assert operator_object.metadata.get('Missing') is None
+        s3_stub.add_response(
+            'get_object',
+            expected_params={'Bucket': 'testDataplaneBucket', 'Key': 'testKey'},
+            service_response={'Body': botocore.response.StreamingBody(io.BytesIO(body), len(body))}
+        )
+        assert operator_object.input['MetaData']['Large'] == ['a', 'b']
+        s3_stub.assert_no_pending_responses()
+
+    # values that were read are still passed on as references
+    output_object = json.loads(json.dumps(operator_object.return_output_object()))
+    assert output_object['Input']['MetaData']['Large'] == reference
+    assert output_object['MetaData']['Large'] == reference
+
+
+def test_update_workflow_error_case(dynamo_client_stub, lambda_client_stub):
+    import app
 
     dynamo_client_stub.add_response(
         'update_item',
         expected_params={
             'TableName': 'testExecutionTable',
             'Key': {
-                'Id': 'testWorkflowId'
+                'Id': 'testWorkflowId',
+            },
+            'UpdateExpression': 'SET #workflow_status = :workflow_status, Message = :message',
+            'ExpressionAttributeNames': {
+                '#workflow_status': "Status"
             },
-            'UpdateExpression': 'SET CurrentStage = :current_stage',
             'ExpressionAttributeValues': {
-                ':current_stage': "End"
-            }
+                ':workflow_status': 'Error',
+                ':message': 'testMessage'
+            },
+            'ReturnValues': 'UPDATED_OLD'
         },
-        service_response={}
+        service_response={'Attributes': {'Status': {'S': 'Started'}}}
     )
+    stub_release_workflow_slot(dynamo_client_stub)
 
-    stage_name_param = 'testName'
-    workflow_execution_param = {
-        'Id': 'testWorkflowId',
-        'Workflow': {
-            'Stages': {
-                'testName': {
-                    'Status': 'Error',
-                    'Outputs': {
-                    },
-                }
-            }
-        },
-        'Status': 'Error',
-        'Globals': {
+    stub_trigger_workflow_scheduler(dynamo_client_stub)
+    lambda_client_stub.add_response(
+        'invoke',
+        expected_params={
+            'FunctionName': 'testSchedulerLambdaArn',
+            'InvocationType': 'Event'
         },
-        'CurrentStage': 'testName'
-    }
-
-    response = app.start_next_stage_execution(stage_name_param, workflow_execution_param)
-    assert response == workflow_execution_param
-    assert app.update_workflow_execution_status.call_count == 1
-    assert app.update_workflow_execution_status.call_args[0][0] == 'testWorkflowId'
-    assert app.update_workflow_execution_status.call_args[0][1] == 'Error'
-    assert app.update_workflow_execution_status.call_args[0][2] == 'stage completed with status Error'
+        service_response={}
+    )
 
-    app.update_workflow_execution_status = saved_stub
+    response = app.update_workflow_execution_status('testWorkflowId', 'Error', 'testMessage')
+    assert response is None
 
 
-def test_start_next_execution(dynamo_client_stub):
+def test_update_workflow_success_case(dynamo_client_stub):
     import app
 
-    # mocks and stubs
-    saved_stub = app.update_workflow_execution_status
-    app.update_workflow_execution_status = MagicMock()
+    stub_update_workflow_status('Success', dynamo_client_stub, old_status='Started')
+    stub_release_workflow_slot(dynamo_client_stub)
+
+    response = app.update_workflow_execution_status('testWorkflowId', 'Success', '')
+    assert response is None
+
+
+def test_update_workflow_status_and_current_stage(dynamo_client_stub):
+    import app
 
     dynamo_client_stub.add_response(
         'update_item',
         expected_params={
             'TableName': 'testExecutionTable',
             'Key': {
-                'Id': 'testWorkflowId'
+                'Id': 'testWorkflowId',
             },
-            'UpdateExpression': 'SET Workflow.Stages.#stage = :stage, CurrentStage = :current_stage',
+            'UpdateExpression': 'SET #workflow_status = :workflow_status, CurrentStage = :current_stage',
             'ExpressionAttributeNames': {
-                '#stage': "stage2"
+                '#workflow_status': "Status"
             },
             'ExpressionAttributeValues': {
-                ':stage': {'End': True, 'Input': {}, 'Status': 'Started'},
-                ':current_stage': 'stage2'
-            }
+                ':workflow_status': 'Success',
+                ':current_stage': 'End'
+            },
+            'ReturnValues': 'UPDATED_OLD'
         },
-        service_response={}
+        service_response={'Attributes': {'Status': {'S': 'Started'}}}
     )
+    stub_release_workflow_slot(dynamo_client_stub)
 
-    stage_name_param = 'testName'
-    workflow_execution_param = {
-        'Id': 'testWorkflowId',
-        'Workflow': {
-            'Stages': {
-                'testName': {
-                    'Status': 'Success',
-                    'Outputs': {
-                    },
-                    'Next': 'stage2'
-                },
-                'stage2': {
-                    'End': True
-                }
-            }
-        },
-        'Status': 'Success',
-        'Globals': {
-        },
-        'CurrentStage': 'testName'
-    }
-
-    response = app.start_next_stage_execution(stage_name_param, workflow_execution_param)
-    assert response == workflow_execution_param
-    assert app.update_workflow_execution_status.call_count == 1
-    assert app.update_workflow_execution_status.call_args[0][0] == 'testWorkflowId'
-    assert app.update_workflow_execution_status.call_args[0][1] == 'Success'
-    assert app.update_workflow_execution_status.call_args[0][2] == 'stage completed with status Success'
-
-    app.update_workflow_execution_status = saved_stub
+    response = app.update_workflow_execution_status('testWorkflowId', 'Success', '', current_stage='End')
+    assert response is None
 
 
 def test_parse_execution_error():
@@ -856,6 +1499,9 @@ def test_workflow_error_handler(dynamo_client_stub):
     ])
     app.update_workflow_execution_status = MagicMock()
     stub_list_workflows(1, dynamo_client_stub)
+    # Only the leases of the halted execution are reclaimed
+    stub_operation_leases(dynamo_client_stub, ['testArn', 'testOtherArn'])
+    stub_reclaim_operation_lease(dynamo_client_stub, 'testArn')
 
     event_param = {
         'detail': {
@@ -879,3 +1525,103 @@ def test_workflow_error_handler(dynamo_client_stub):
 
     app.get_execution_errors = saved_stub
     app.update_workflow_execution_status = saved_stub2
+
+
+def stub_callback_update(update_expression, old_attributes, stub):
+    stub.add_response(
+        'update_item',
+        expected_params={
+            'TableName': 'testCallbackTable',
+            'Key': {'JobId': 'testJobId'},
+            'UpdateExpression': update_expression,
+            'ExpressionAttributeValues': botocore.stub.ANY,
+            'ReturnValues': 'ALL_OLD'
+        },
+        service_response={'Attributes': old_attributes}
+    )
+
+
+def stub_resume_operation(dynamoStub, sfnStub):
+    dynamoStub.add_response(
+        'delete_item',
+        expected_params={
+            'TableName': 'testCallbackTable',
+            'Key': {'JobId': 'testJobId'}
+        },
+        service_response={}
+    )
+    sfnStub.add_response(
+        'send_task_success',
+        expected_params={
+            'taskToken': 'testTaskToken',
+            'output': '{}'
+        },
+        service_response={}
+    )
+
+
+def callback_event():
+    return {
+        'TaskToken': 'testTaskToken',
+        'Operation': {
+            'Name': 'testOperation',
+            'Status': 'Executing',
+            'MetaData': {'TranscribeJobId': 'testJobId'}
+        }
+    }
+
+
+def test_register_operation_callback(dynamo_client_stub, sfn_client_stub):
+    import app
+
+    # Nothing has happened to the job yet, the operation waits for the completion event
+    stub_callback_update('SET TaskToken = :task_token, ExpiresAt = :expires_at', {}, dynamo_client_stub)
+
+    app.register_operation_callback_lambda(callback_event(), {})
+
+
+def test_register_operation_callback_after_completion(dynamo_client_stub, sfn_client_stub):
+    import app
+
+    stub_callback_update(
+        'SET TaskToken = :task_token, ExpiresAt = :expires_at',
+        {'JobId': {'S': 'testJobId'}, 'Completed': {'BOOL': True}},
+        dynamo_client_stub
+    )
+    stub_resume_operation(dynamo_client_stub, sfn_client_stub)
+
+    app.register_operation_callback_lambda(callback_event(), {})
+
+
+def test_operation_callback(dynamo_client_stub, sfn_client_stub):
+    import app
+
+    stub_callback_update(
+        'SET Completed = :completed, ExpiresAt = :expires_at',
+        {'JobId': {'S': 'testJobId'}, 'TaskToken': {'S': 'testTaskToken'}},
+        dynamo_client_stub
+    )
+    stub_resume_operation(dynamo_client_stub, sfn_client_stub)
+
+    app.operation_callback_lambda({
+        'source': 'aws.transcribe',
+        'detail': {'TranscriptionJobName': 'testJobId', 'TranscriptionJobStatus': 'COMPLETED'}
+    }, {})
+
+
+def test_operation_callback_token_expired(dynamo_client_stub, sfn_client_stub):
+    import app
+
+    stub_callback_update(
+        'SET Completed = :completed, ExpiresAt = :expires_at',
+        {'JobId': {'S': 'testJobId'}, 'TaskToken': {'S': 'testTaskToken'}},
+        dynamo_client_stub
+    )
+    dynamo_client_stub.add_response('delete_item', {}, {'TableName': 'testCallbackTable', 'Key': {'JobId': 'testJobId'}})
+    sfn_client_stub.add_client_error('send_task_success', service_error_code='TaskTimedOut')
+
+    # The operation already checked the job status itself
+    app.operation_callback_lambda({
+        'source': 'aws.mediaconvert',
+        'detail': {'jobId': 'testJobId', 'status': 'COMPLETE'}
+    }, {})
@@ -20,12 +20,14 @@ def mock_env_variables(monkeypatch):
     monkeypatch.setenv("OPERATION_TABLE_NAME", "testOperationTable")
     monkeypatch.setenv("WORKFLOW_EXECUTION_TABLE_NAME", "testExecutionTable")
     monkeypatch.setenv("HISTORY_TABLE_NAME", "testHistoryTable")
+    monkeypatch.setenv("WORKFLOW_DEPENDENCY_TABLE_NAME", "testWorkflowDependencyTable")
     monkeypatch.setenv("STAGE_EXECUTION_QUEUE_URL", "testQueueUrl")
     monkeypatch.setenv("STAGE_EXECUTION_ROLE", "testExecutionRole/role")
     monkeypatch.setenv("STEP_FUNCTION_LOG_GROUP_ARN", "testExecutionSfnLogGroup")
     monkeypatch.setenv("COMPLETE_STAGE_LAMBDA_ARN", "testCompleteStageArn")
     monkeypatch.setenv("FILTER_OPERATION_LAMBDA_ARN", "testFilterLambdaArn")
     monkeypatch.setenv("OPERATOR_FAILED_LAMBDA_ARN", "testFailedLambdaArn")
+    monkeypatch.setenv("REGISTER_OPERATION_CALLBACK_LAMBDA_ARN", "testRegisterCallbackLambdaArn")
     monkeypatch.setenv("WORKFLOW_SCHEDULER_LAMBDA_ARN", "testSchedulerArn")
     monkeypatch.setenv("DataplaneEndpoint", "testDataplaneEndpoint")
     monkeypatch.setenv("botoConfig", '{"user_agent_extra": "AwsSolution/SO0163/vX.X.X"}')
@@ -33,6 +35,11 @@ def mock_env_variables(monkeypatch):
     monkeypatch.setenv("AWS_REGION", "us-east-1")
     monkeypatch.setenv("AWS_DEFAULT_REGION", "us-east-1")
 
+@pytest.fixture(autouse=True)
+def workflow_dependency_index_ready(mock_env_variables, monkeypatch):
+    import app
+    monkeypatch.setattr(app, 'WORKFLOW_DEPENDENCY_INDEX_READY', True)
+
 @pytest.fixture
 def test_client(mock_env_variables):
     from app import app
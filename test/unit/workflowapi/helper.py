@@ -572,6 +572,7 @@ sample_workflow_execution = {
     'Created': botocore.stub.ANY,
     'ResourceType': 'WORKFLOW_EXECUTION',
     'ApiVersion': '3.0.0',
+    'Priority': 'Normal',
     'Workflow': {
         'ApiVersion': '3.0.0',
         'Created': '1605822398.292371',
@@ -2875,18 +2876,81 @@ def stub_delete_stage(stub, optional_input = None):
         service_response = {}
     )
 
-def stub_create_stage(stub):
-    stub_get_stage(stub, optional_output={})
-    stub_get_operation(
-        stub,
-        optional_input={
-            'TableName': 'testOperationTable',
-            'Key': {
-                'Name': test_operation_name
+def stub_batch_get_by_name(stub, table_name, names, items):
+    stub.add_response(
+        'batch_get_item',
+        expected_params = {
+            'RequestItems': {
+                table_name: {
+                    'Keys': [{'Name': name} for name in names]
+                }
+            }
+        },
+        service_response = {
+            'Responses': {
+                table_name: items
             }
         }
     )
 
+def stub_index_workflow_dependencies(stub, workflow_name, added=(), removed=()):
+    requests = [
+        {'DeleteRequest': {'Key': {'Dependency': dependency, 'WorkflowName': workflow_name}}}
+        for dependency in sorted(removed)
+    ]
+    requests.extend(
+        {'PutRequest': {'Item': {'Dependency': dependency, 'WorkflowName': workflow_name}}}
+        for dependency in sorted(added)
+    )
+    stub.add_response(
+        'batch_write_item',
+        expected_params = {
+            'RequestItems': {
+                'testWorkflowDependencyTable': requests
+            }
+        },
+        service_response = {
+            'UnprocessedItems': {}
+        }
+    )
+
+def stub_list_dependent_workflows(stub, dependency, workflows):
+    names = [workflow['Name']['S'] for workflow in workflows]
+    stub.add_response(
+        'query',
+        expected_params = {
+            'TableName': 'testWorkflowDependencyTable',
+            'KeyConditionExpression': 'Dependency = :dependency',
+            'ExpressionAttributeValues': {':dependency': dependency},
+            'ProjectionExpression': 'WorkflowName',
+            'ConsistentRead': True
+        },
+        service_response = {
+            'Items': [{'WorkflowName': {'S': name}} for name in names]
+        }
+    )
+    if names:
+        stub.add_response(
+            'batch_get_item',
+            expected_params = {
+                'RequestItems': {
+                    'testWorkflowTable': {
+                        'Keys': [{'Name': name} for name in names],
+                        'ConsistentRead': True
+                    }
+                }
+            },
+            service_response = {
+                'Responses': {
+                    'testWorkflowTable': workflows
+                }
+            }
+        )
+
+def stub_create_stage(stub):
+    stub_get_stage(stub, optional_output={})
+    stub_batch_get_by_name(stub, 'testOperationTable', [test_operation_name], [get_sample_operation_output()])
+
     stub.add_response(
         'put_item',
         expected_params = {
@@ -2920,3 +2984,19 @@ def stub_put_role_policy(stub, optional_input = None):
         expected_params = optional_input,
         service_response = {}
     )
+
+
+def stub_trigger_workflow_scheduler(stub, pending=False):
+    expected_params = {
+        'TableName': 'testSystemTable',
+        'Key': {'Name': 'WorkflowSchedulerPendingUntil'},
+        'UpdateExpression': 'SET #value = :pending_until',
+        'ConditionExpression': 'attribute_not_exists(#value) OR #value < :now',
+        'ExpressionAttributeNames': {'#value': 'Value'},
+        'ExpressionAttributeValues': botocore.stub.ANY
+    }
+    if pending:
+        stub.add_client_error('update_item', service_error_code='ConditionalCheckFailedException',
+                              expected_params=expected_params)
+    else:
+        stub.add_response('update_item', expected_params=expected_params, service_response={})
@@ -113,27 +113,12 @@ def test_delete_stage(test_client, ddb_resource_stub):
     print('DELETE /workflow/stage/{name}')
 
     stub_get_stage(ddb_resource_stub)
-    ddb_resource_stub.add_response(
-        'scan',
-        expected_params={
-            'TableName': 'testWorkflowTable',
-            'FilterExpression': botocore.stub.ANY,
-            'ConsistentRead': True
-        },
-        service_response={'Items': []}
-    )
+    stub_list_dependent_workflows(ddb_resource_stub, 'Stage:_testOperationName', [])
     stub_delete_stage(ddb_resource_stub)
-    ddb_resource_stub.add_response(
-        'scan',
-        expected_params={
-            'TableName': 'testWorkflowTable',
-            'FilterExpression': botocore.stub.ANY,
-            'ConsistentRead': True
-        },
-        service_response={'Items': [{
-            'Name': {'S': 'workflow1'}
-        }]}
-    )
+    stub_list_dependent_workflows(ddb_resource_stub, 'Stage:_testOperationName', [{
+        'Name': {'S': 'workflow1'},
+        'Stages': {'M': {'_testOperationName': {'M': {}}}}
+    }])
     ddb_resource_stub.add_response(
         'update_item',
         expected_params={
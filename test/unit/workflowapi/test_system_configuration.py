@@ -34,6 +34,89 @@ def test_create_system_configuration_api(test_client, ddb_resource_stub):
     )
     assert response.status_code == 200
 
+def test_create_operation_concurrency_api_input_error(test_client):
+    print('POST /system/configuration')
+
+    response = test_client.http.post(
+        system_configuration_endpoint,
+        body=b'{"Name":"MaxConcurrentOperations:Transcribe","Value":0}'
+    )
+    assert response.status_code == 500
+    assert "MaxConcurrentOperations:Transcribe must be an integer value > 0" in response.json_body['Message']
+
+def test_create_operation_concurrency_api(test_client, ddb_resource_stub):
+    print('POST /system/configuration')
+
+    # The budget is updated in place so the leases held by running operations are kept
+    ddb_resource_stub.add_response(
+        'update_item',
+        expected_params = {
+            'TableName': 'testSystemTable',
+            'Key': {'Name': 'MaxConcurrentOperations:Transcribe'},
+            'UpdateExpression': 'SET #value = :value, #leases = if_not_exists(#leases, :no_leases)',
+            'ExpressionAttributeNames': {'#value': 'Value', '#leases': 'Leases'},
+            'ExpressionAttributeValues': {':value': 5, ':no_leases': {}}
+        },
+        service_response = {}
+    )
+
+    response = test_client.http.post(
+        system_configuration_endpoint,
+        body=b'{"Name":"MaxConcurrentOperations:Transcribe","Value":5}'
+    )
+    assert response.status_code == 200
+
+def test_operation_asl_holds_concurrency_token(test_client):
+    from app import ASYNC_OPERATION_ASL
+
+    states = ASYNC_OPERATION_ASL["States"]
+    skip = states["Skip %%OPERATION_NAME%%? (%%STAGE_NAME%%)"]
+    acquire = states["Acquire %%OPERATION_NAME%% Token (%%STAGE_NAME%%)"]
+    holds_token = "Does %%OPERATION_NAME%% Hold A Token? (%%STAGE_NAME%%)"
+    release = "Release %%OPERATION_NAME%% Token (%%STAGE_NAME%%)"
+    release_failed = "Release %%OPERATION_NAME%% Token After Failure (%%STAGE_NAME%%)"
+
+    # Started operations with a budget take a token before the start lambda runs and back off while
+    # none is left.  Operations without a budget go straight to the start lambda.
+    assert states["Filter %%OPERATION_NAME%% Media Type? (%%STAGE_NAME%%)"]["Assign"] == {"tokenHeld": False}
+    assert skip["Choices"][0]["And"][1] == {"Variable": "$.ConcurrencyLimited", "BooleanEquals": True}
+    assert skip["Choices"][0]["Next"] == "Acquire %%OPERATION_NAME%% Token (%%STAGE_NAME%%)"
+    assert skip["Choices"][1]["Next"] == "Execute %%OPERATION_NAME%% (%%STAGE_NAME%%)"
+    assert acquire["Next"] == "Execute %%OPERATION_NAME%% (%%STAGE_NAME%%)"
+    assert acquire["Assign"] == {"tokenHeld": True}
+    assert acquire["Parameters"]["Key"]["Name"]["S"] == "MaxConcurrentOperations:%%OPERATION_NAME%%"
+    assert acquire["Retry"][0]["ErrorEquals"] == ["DynamoDB.ConditionalCheckFailedException"]
+    assert acquire["Catch"][0]["Next"] == "%%OPERATION_NAME%% Failed (%%STAGE_NAME%%)"
+
+    # A removed budget lets the condition pass, so the rejected update fails the operation without a retry
+    assert acquire["Parameters"]["ConditionExpression"].startswith(
+        "attribute_not_exists(#value) OR attribute_not_exists(#leases) OR ")
+    assert all("DynamoDB.AmazonDynamoDBException" not in retry["ErrorEquals"] for retry in acquire["Retry"])
+
+    # The token is a lease keyed by the execution, so it can be reclaimed and never released twice
+    assert acquire["Parameters"]["UpdateExpression"] == "SET #leases.#lease = :acquired"
+    assert acquire["Parameters"]["ExpressionAttributeNames"]["#lease.$"] == "$$.Execution.Id"
+    assert states[release]["Parameters"]["UpdateExpression"] == "REMOVE #leases.#lease"
+    assert states[release]["Parameters"]["ExpressionAttributeNames"]["#lease.$"] == "$$.Execution.Id"
+
+    # Every path after the token may have been taken gives it back
+    assert states["Execute %%OPERATION_NAME%% (%%STAGE_NAME%%)"]["Catch"][0]["Next"] == holds_token
+    assert states["Get %%OPERATION_NAME%% Status (%%STAGE_NAME%%)"]["Catch"][0]["Next"] == holds_token
+    assert states[holds_token]["Choices"][0]["Variable"] == "$tokenHeld"
+    assert states[holds_token]["Choices"][0]["Next"] == release_failed
+    assert states[holds_token]["Default"] == "%%OPERATION_NAME%% Failed (%%STAGE_NAME%%)"
+    check_complete = states["Did %%OPERATION_NAME%% Complete (%%STAGE_NAME%%)"]
+    assert check_complete["Default"] == holds_token
+    assert check_complete["Choices"][1]["Next"] == release
+    assert check_complete["Choices"][2]["Next"] == "%%OPERATION_NAME%% Succeeded (%%STAGE_NAME%%)"
+    assert states[release]["Next"] == "%%OPERATION_NAME%% Succeeded (%%STAGE_NAME%%)"
+    assert states[release_failed]["Next"] == "%%OPERATION_NAME%% Failed (%%STAGE_NAME%%)"
+    assert states[release]["ResultPath"] is None
+    assert states[release]["Parameters"]["ConditionExpression"] == "attribute_exists(#leases.#lease)"
+    assert states[release]["Catch"] == [{"ErrorEquals": ["DynamoDB.ConditionalCheckFailedException"],
+                                         "Next": "%%OPERATION_NAME%% Succeeded (%%STAGE_NAME%%)",
+                                         "ResultPath": None}]
+
 def test_get_system_configuration_api_dynamo_error(test_client, ddb_resource_stub):
     print ('GET /system/configuration')
     
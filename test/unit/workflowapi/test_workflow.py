@@ -1,43 +1,25 @@
 # Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
 # SPDX-License-Identifier: Apache-2.0
 
+import pytest
+from unittest.mock import MagicMock
+
 from helper import *
 
 
 def test_create_workflow(test_client, sfn_client_stub, ddb_resource_stub):
     print('POST /workflow')
 
-    stub_get_stage(
-        ddb_resource_stub,
-        optional_input={
-            'TableName': 'testStageTable',
-            'Key': {
-                'Name': '_testOperationName1'
-            }
-        },
-        optional_output={
-            'Item': {
-                'Name': {'S': '_testOperationName1'},
-                'Definition': {'S': '{"stage":"definition","StartAt":"_testOperationName1","States":{"_testOperation1": {"End":true}}}'}
-            }
-        }
-    )
-
-    stub_get_stage(
-        ddb_resource_stub,
-        optional_input={
-            'TableName': 'testStageTable',
-            'Key': {
-                'Name': '_testOperationName2'
-            }
+    stub_batch_get_by_name(ddb_resource_stub, 'testStageTable', ['_testOperationName1', '_testOperationName2'], [
+        {
+            'Name': {'S': '_testOperationName1'},
+            'Definition': {'S': '{"stage":"definition","StartAt":"_testOperationName1","States":{"_testOperation1": {"End":true}}}'}
         },
-        optional_output={
-            'Item': {
-                'Name': {'S': '_testOperationName2'},
-                'Definition': {'S': '{"stage":"definition","StartAt":"_testOperationName2","States":{"_testOperation2": "End"}}'}
-            }
+        {
+            'Name': {'S': '_testOperationName2'},
+            'Definition': {'S': '{"stage":"definition","StartAt":"_testOperationName2","States":{"_testOperation2": "End"}}'}
         }
-    )
+    ])
 
     sfn_client_stub.add_response(
         'create_state_machine',
@@ -97,6 +79,8 @@ def test_create_workflow(test_client, sfn_client_stub, ddb_resource_stub):
         },
         service_response={}
     )
+    stub_index_workflow_dependencies(
+        ddb_resource_stub, 'testWorkflowName', added=['Stage:_testOperationName1', 'Stage:_testOperationName2'])
 
     response = test_client.http.post(
         '/workflow',
@@ -139,7 +123,7 @@ def test_update_workflow(test_client, ddb_resource_stub, sfn_client_stub):
                 'ResourceType': {'S': 'WORKFLOW'},
                 'ApiVersion': {'S': '3.0.0'},
                 'StateMachineArn': {'S': 'sma'},
-                'Operations': {'L': []},
+                'Operations': {'L': [{'S': 'testRemovedOperation'}]},
                 'StaleOperations': {'L': []},
                 'StaleStages': {'L': []},
                 'Stages': {
@@ -160,39 +144,18 @@ def test_update_workflow(test_client, ddb_resource_stub, sfn_client_stub):
         }
     )
 
-    stub_get_stage(
-        ddb_resource_stub,
-        optional_input={
-            'TableName': 'testStageTable',
-            'Key': {
-                'Name': '_testOperationName1'
-            }
-        },
-        optional_output={
-            'Item': {
-                'Name': {'S': '_testOperationName1'},
-                'Definition': {'S': '{"stage":"definition","StartAt":"_testOperationName1","States":{"_testOperation1": {"End":true}}}'},
-                'Operations': {'L': []}
-            }
-        }
-    )
-
-    stub_get_stage(
-        ddb_resource_stub,
-        optional_input={
-            'TableName': 'testStageTable',
-            'Key': {
-                'Name': '_testOperationName2'
-            }
+    stub_batch_get_by_name(ddb_resource_stub, 'testStageTable', ['_testOperationName1', '_testOperationName2'], [
+        {
+            'Name': {'S': '_testOperationName1'},
+            'Definition': {'S': '{"stage":"definition","StartAt":"_testOperationName1","States":{"_testOperation1": {"End":true}}}'},
+            'Operations': {'L': []}
         },
-        optional_output={
-            'Item': {
-                'Name': {'S': '_testOperationName2'},
-                'Definition': {'S': '{"stage":"definition","StartAt":"_testOperationName2","States":{"_testOperation2": "End"}}'},
-                'Operations': {'L': []}
-            }
+        {
+            'Name': {'S': '_testOperationName2'},
+            'Definition': {'S': '{"stage":"definition","StartAt":"_testOperationName2","States":{"_testOperation2": "End"}}'},
+            'Operations': {'L': []}
         }
-    )
+    ])
 
     sfn_client_stub.add_response(
         'update_state_machine',
@@ -230,6 +193,12 @@ def test_update_workflow(test_client, ddb_resource_stub, sfn_client_stub):
         },
         service_response={}
     )
+    stub_index_workflow_dependencies(
+        ddb_resource_stub,
+        'testWorkflowName',
+        added=['Stage:_testOperationName1', 'Stage:_testOperationName2'],
+        removed=['Operation:testRemovedOperation']
+    )
 
     response = test_client.http.put(
         '/workflow',
@@ -241,6 +210,120 @@ def test_update_workflow(test_client, ddb_resource_stub, sfn_client_stub):
     assert response.status_code == 200
 
 
+def test_batch_get_by_name_retries_unprocessed_keys(test_client, ddb_resource_stub, monkeypatch):
+    import app
+    monkeypatch.setattr(app.time, 'sleep', lambda seconds: None)
+
+    ddb_resource_stub.add_response(
+        'batch_get_item',
+        expected_params={
+            'RequestItems': {
+                'testStageTable': {
+                    'Keys': [{'Name': 'stage1'}, {'Name': 'stage2'}]
+                }
+            }
+        },
+        service_response={
+            'Responses': {
+                'testStageTable': [{'Name': {'S': 'stage1'}}]
+            },
+            'UnprocessedKeys': {
+                'testStageTable': {
+                    'Keys': [{'Name': {'S': 'stage2'}}]
+                }
+            }
+        }
+    )
+    stub_batch_get_by_name(ddb_resource_stub, 'testStageTable', ['stage2'], [{'Name': {'S': 'stage2'}}])
+
+    # duplicate names are read once
+    items = app.batch_get_by_name('testStageTable', ['stage1', 'stage2', 'stage1'])
+    assert items == {'stage1': {'Name': 'stage1'}, 'stage2': {'Name': 'stage2'}}
+
+
+def test_batch_get_by_name_gives_up_on_unprocessed_keys(test_client, ddb_resource_stub, monkeypatch):
+    import app
+    monkeypatch.setattr(app.time, 'sleep', lambda seconds: None)
+    monkeypatch.setattr(app, 'BATCH_GET_MAX_RETRIES', 2)
+
+    for _ in range(3):
+        ddb_resource_stub.add_response(
+            'batch_get_item',
+            expected_params={
+                'RequestItems': {
+                    'testStageTable': {
+                        'Keys': [{'Name': 'stage1'}]
+                    }
+                }
+            },
+            service_response={
+                'Responses': {},
+                'UnprocessedKeys': {
+                    'testStageTable': {
+                        'Keys': [{'Name': {'S': 'stage1'}}]
+                    }
+                }
+            }
+        )
+
+    with pytest.raises(app.ChaliceViewError):
+        app.batch_get_by_name('testStageTable', ['stage1'])
+
+
+def test_build_workflow_stage_not_found(test_client, ddb_resource_stub):
+    import app
+
+    stub_batch_get_by_name(ddb_resource_stub, 'testStageTable', ['stage1'], [])
+
+    with pytest.raises(app.NotFoundError):
+        app.build_workflow({
+            'Name': 'testWorkflowName',
+            'StartAt': 'stage1',
+            'Stages': {'stage1': {'End': True}},
+            'Operations': []
+        })
+
+
+def test_build_workflow_uses_compiled_asl_cache(test_client, ddb_resource_stub, monkeypatch):
+    import app
+
+    compile_workflow_asl = MagicMock(wraps=app.compile_workflow_asl)
+    monkeypatch.setattr(app, 'compile_workflow_asl', compile_workflow_asl)
+    monkeypatch.setattr(app, 'COMPILED_ASL_CACHE', {})
+
+    def stage_item(stage_id):
+        return {
+            'Name': {'S': 'stage1'},
+            'Id': {'S': stage_id},
+            'Version': {'S': 'v0'},
+            'Definition': {'S': '{"StartAt": "op1", "States": {"op1": {"End": true}}}'},
+            'Operations': {'L': [{'S': 'op1'}]}
+        }
+
+    for _ in range(2):
+        stub_batch_get_by_name(ddb_resource_stub, 'testStageTable', ['stage1'], [stage_item('stage1-id')])
+        workflow = app.build_workflow({
+            'Name': 'testWorkflowName',
+            'StartAt': 'stage1',
+            'Stages': {'stage1': {'End': True}},
+            'Operations': []
+        })
+        assert workflow['WorkflowAsl'] == {'StartAt': 'op1', 'States': {'op1': {'End': True}}}
+        assert workflow['Operations'] == ['op1']
+
+    assert compile_workflow_asl.call_count == 1
+
+    # A new version of the stage is compiled again
+    stub_batch_get_by_name(ddb_resource_stub, 'testStageTable', ['stage1'], [stage_item('stage1-new-id')])
+    app.build_workflow({
+        'Name': 'testWorkflowName',
+        'StartAt': 'stage1',
+        'Stages': {'stage1': {'End': True}},
+        'Operations': []
+    })
+    assert compile_workflow_asl.call_count == 2
+
+
 def test_list_workflows(test_client, ddb_resource_stub):
     print('GET /workflow')
 
@@ -277,79 +360,139 @@ def test_list_workflows(test_client, ddb_resource_stub):
 def test_list_workflows_by_operator(test_client, ddb_resource_stub):
     print('GET /workflow/list/operation/{operator_name}')
 
+    stub_list_dependent_workflows(ddb_resource_stub, 'Operation:testOperatorName', [
+        {
+            'Name': {'S': 'workflow1'},
+            'Operations': {'L': [{'S': 'testOperatorName'}]}
+        },
+        {
+            'Name': {'S': 'workflow2'},
+            'Operations': {'L': [{'S': 'testOperatorName'}]}
+        },
+        {
+            # Stale index entry of a workflow that no longer uses the operator
+            'Name': {'S': 'workflow3'},
+            'Operations': {'L': []}
+        }
+    ])
+
+    response = test_client.http.get(
+        '/workflow/list/operation/testOperatorName'
+    )
+    assert response.status_code == 200
+    assert len(response.json_body) == 2
+    assert response.json_body[0]['Name'] == 'workflow1'
+    assert response.json_body[1]['Name'] == 'workflow2'
+
+
+def test_list_workflows_by_stage(test_client, ddb_resource_stub):
+    print('GET /workflow/list/stage')
+
     ddb_resource_stub.add_response(
-        'scan',
+        'query',
         expected_params={
-            'TableName': 'testWorkflowTable',
-            'FilterExpression': botocore.stub.ANY,
+            'TableName': 'testWorkflowDependencyTable',
+            'KeyConditionExpression': 'Dependency = :dependency',
+            'ExpressionAttributeValues': {':dependency': 'Stage:_testOperationName'},
+            'ProjectionExpression': 'WorkflowName',
             'ConsistentRead': True
         },
         service_response={
-            'LastEvaluatedKey': {'S': {'S': 'lastKey'}},
-            'Items': [{
-                'Name': {'S': 'operator1'}
-            }]
+            'LastEvaluatedKey': {'Dependency': {'S': 'Stage:_testOperationName'}, 'WorkflowName': {'S': 'workflow1'}},
+            'Items': [{'WorkflowName': {'S': 'workflow1'}}]
         }
     )
-
     ddb_resource_stub.add_response(
-        'scan',
+        'query',
         expected_params={
-            'TableName': 'testWorkflowTable',
-            'ExclusiveStartKey': {'S': 'lastKey'}
+            'TableName': 'testWorkflowDependencyTable',
+            'KeyConditionExpression': 'Dependency = :dependency',
+            'ExpressionAttributeValues': {':dependency': 'Stage:_testOperationName'},
+            'ProjectionExpression': 'WorkflowName',
+            'ConsistentRead': True,
+            'ExclusiveStartKey': {'Dependency': 'Stage:_testOperationName', 'WorkflowName': 'workflow1'}
         },
         service_response={
-            'Items': [{
-                'Name': {'S': 'operator2'}
-            }]
+            'Items': [{'WorkflowName': {'S': 'workflow2'}}]
         }
     )
-
-    response = test_client.http.get(
-        '/workflow/list/operation/testOperatorName'
+    ddb_resource_stub.add_response(
+        'batch_get_item',
+        expected_params={
+            'RequestItems': {
+                'testWorkflowTable': {
+                    'Keys': [{'Name': 'workflow1'}, {'Name': 'workflow2'}],
+                    'ConsistentRead': True
+                }
+            }
+        },
+        service_response={
+            'Responses': {
+                'testWorkflowTable': [
+                    {'Name': {'S': 'workflow2'}, 'Stages': {'M': {'_testOperationName': {'M': {}}}}},
+                    {'Name': {'S': 'workflow1'}, 'Stages': {'M': {'_testOperationName': {'M': {}}}}}
+                ]
+            }
+        }
     )
+
+    response = test_client.http.get('/workflow/list/stage/_testOperationName')
     assert response.status_code == 200
     assert len(response.json_body) == 2
-    assert response.json_body[0]['Name'] == 'operator1'
-    assert response.json_body[1]['Name'] == 'operator2'
+    assert response.json_body[0]['Name'] == 'workflow1'
+    assert response.json_body[1]['Name'] == 'workflow2'
 
 
-def test_list_workflows_by_stage(test_client, ddb_resource_stub):
+def test_list_workflows_by_stage_indexes_existing_workflows(test_client, ddb_resource_stub, monkeypatch):
     print('GET /workflow/list/stage')
 
+    import app
+    monkeypatch.setattr(app, 'WORKFLOW_DEPENDENCY_INDEX_READY', False)
+
     ddb_resource_stub.add_response(
-        'scan',
+        'get_item',
         expected_params={
-            'TableName': 'testWorkflowTable',
-            'FilterExpression': botocore.stub.ANY,
+            'TableName': 'testSystemTable',
+            'Key': {'Name': 'WorkflowDependencyIndex'},
             'ConsistentRead': True
         },
-        service_response={
-            'LastEvaluatedKey': {'S': {'S': 'lastKey'}},
-            'Items': [{
-                'Name': {'S': 'stage1'}
-            }]
-        }
+        service_response={}
     )
-
     ddb_resource_stub.add_response(
         'scan',
         expected_params={
             'TableName': 'testWorkflowTable',
-            'ExclusiveStartKey': {'S': 'lastKey'}
+            'ProjectionExpression': '#name, Operations, Stages',
+            'ExpressionAttributeNames': {'#name': 'Name'},
+            'ConsistentRead': True
         },
         service_response={
             'Items': [{
-                'Name': {'S': 'stage2'}
+                'Name': {'S': 'workflow1'},
+                'Operations': {'L': [{'S': 'testOperatorName'}]},
+                'Stages': {'M': {'_testOperationName': {'M': {}}}}
             }]
         }
     )
+    stub_index_workflow_dependencies(
+        ddb_resource_stub, 'workflow1', added=['Operation:testOperatorName', 'Stage:_testOperationName'])
+    ddb_resource_stub.add_response(
+        'put_item',
+        expected_params={
+            'TableName': 'testSystemTable',
+            'Item': {'Name': 'WorkflowDependencyIndex', 'Value': '3.0.0'}
+        },
+        service_response={}
+    )
+    stub_list_dependent_workflows(ddb_resource_stub, 'Stage:_testOperationName', [{
+        'Name': {'S': 'workflow1'},
+        'Stages': {'M': {'_testOperationName': {'M': {}}}}
+    }])
 
     response = test_client.http.get('/workflow/list/stage/_testOperationName')
     assert response.status_code == 200
-    assert len(response.json_body) == 2
-    assert response.json_body[0]['Name'] == 'stage1'
-    assert response.json_body[1]['Name'] == 'stage2'
+    assert [workflow['Name'] for workflow in response.json_body] == ['workflow1']
+    assert app.WORKFLOW_DEPENDENCY_INDEX_READY
 
 
 def test_get_workflow_configuration_by_name_does_not_exist(test_client, ddb_resource_stub):
@@ -445,7 +588,8 @@ def test_delete_workflow_api(test_client, ddb_resource_stub, sfn_client_stub):
         },
         service_response={
             'Item': {
-                'StateMachineArn': {'S': 'stateMachineArn'}
+                'StateMachineArn': {'S': 'stateMachineArn'},
+                'Operations': {'L': [{'S': 'testOperatorName'}]}
             }
         }
     )
@@ -466,6 +610,7 @@ def test_delete_workflow_api(test_client, ddb_resource_stub, sfn_client_stub):
         },
         service_response={}
     )
+    stub_index_workflow_dependencies(ddb_resource_stub, 'testWorkflowName', removed=['Operation:testOperatorName'])
 
     response = test_client.http.delete('/workflow/testWorkflowName')
     assert response.status_code == 200
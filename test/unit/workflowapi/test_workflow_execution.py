@@ -1,6 +1,7 @@
 # Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
 # SPDX-License-Identifier: Apache-2.0
 
+import pytest
 from helper import *
 
 
@@ -33,10 +34,12 @@ def test_create_workflow_execution_api_fail(test_client, ddb_resource_stub, sqs_
                 ':workflow_status': awsmie.WORKFLOW_STATUS_ERROR,
                 ':message': 'Exception An error occurred () when calling the SendMessage operation: '
 
-            }
+            },
+            'ReturnValues': 'UPDATED_OLD'
         },
         service_response={}
     )
+    stub_trigger_workflow_scheduler(ddb_resource_stub)
     lambda_client_stub.add_response(
         'invoke',
         expected_params={"FunctionName": "testSchedulerArn", "InvocationType": "Event"},
@@ -67,6 +70,7 @@ def test_create_workflow_execution_api_success(test_client, ddb_resource_stub, s
         expected_params={"QueueUrl": "testQueueUrl", "MessageBody": botocore.stub.ANY},
         service_response={"MessageId": "abcd-1234"}
     )
+    stub_trigger_workflow_scheduler(ddb_resource_stub)
     lambda_client_stub.add_response(
         'invoke',
         expected_params={"FunctionName": "testSchedulerArn", "InvocationType": "Event"},
@@ -86,7 +90,8 @@ def test_list_workflow_executions_by_assetid(test_client, ddb_resource_stub):
     test_asset_id = "c1752400-ba2f-4682-a8dd-6eba0932d148"
     ddb_resource_stub.add_response(
         'query',
-        expected_params={"IndexName": "WorkflowExecutionAssetId",
+        expected_params={"IndexName": "WorkflowExecutionAssetIdCreated",
+                         "ScanIndexForward": False,
                          "ExpressionAttributeNames": {'#workflow_status': "Status",
                                                       '#workflow_name': "Name"},
                          "ExpressionAttributeValues": {':assetid': test_asset_id},
@@ -195,7 +200,8 @@ def test_update_workflow_execution(test_client, ddb_resource_stub, sqs_client_st
                 ':workflow_waiting_status': awsmie.WORKFLOW_STATUS_WAITING,
                 ':workflow_status': awsmie.WORKFLOW_STATUS_RESUMED,
                 ':waiting_stage_name': 'testWaitStage'
-            }
+            },
+            'ReturnValues': 'ALL_NEW'
         },
         service_response={}
     )
@@ -214,6 +220,7 @@ def test_update_workflow_execution(test_client, ddb_resource_stub, sqs_client_st
         }
     )
 
+    stub_trigger_workflow_scheduler(ddb_resource_stub)
     lambda_client_stub.add_response(
         'invoke',
         expected_params={
@@ -237,6 +244,63 @@ def test_update_workflow_execution(test_client, ddb_resource_stub, sqs_client_st
     }
 
 
+def test_create_workflow_execution_api_unknown_priority(test_client):
+    print('POST /workflow/execution')
+
+    response = test_client.http.post('/workflow/execution', body=b'{"Name": "testWorkflow", "Priority": "Urgent",'
+                                                                 b'"Input": {"AssetId": "testAssetId"}}')
+
+    assert response.status_code == 400
+
+
+def test_resume_workflow_execution_uses_priority_queue(test_client, ddb_resource_stub, sqs_client_stub, lambda_client_stub, monkeypatch):
+    print('PUT /workflow/execution/{id}')
+    import app
+    monkeypatch.setattr(app, 'EXECUTION_QUEUES', {'Normal': 'testQueueUrl', 'Low': 'testLowQueueUrl'})
+
+    workflow_execution_id = 'testWorkflowExecutionId'
+
+    ddb_resource_stub.add_response(
+        'update_item',
+        expected_params={
+            'TableName': 'testExecutionTable',
+            'Key': {
+                'Id': workflow_execution_id
+            },
+            'UpdateExpression': 'SET #workflow_status = :workflow_status',
+            'ExpressionAttributeNames': {
+                '#workflow_status': "Status"
+            },
+            'ConditionExpression': "#workflow_status = :workflow_waiting_status AND CurrentStage = :waiting_stage_name",
+            'ExpressionAttributeValues': {
+                ':workflow_waiting_status': awsmie.WORKFLOW_STATUS_WAITING,
+                ':workflow_status': awsmie.WORKFLOW_STATUS_RESUMED,
+                ':waiting_stage_name': 'testWaitStage'
+            },
+            'ReturnValues': 'ALL_NEW'
+        },
+        service_response={'Attributes': {'Id': {'S': workflow_execution_id}, 'Priority': {'S': 'Low'}}}
+    )
+    sqs_client_stub.add_response(
+        'send_message',
+        expected_params={'QueueUrl': 'testLowQueueUrl', 'MessageBody': botocore.stub.ANY},
+        service_response={'MessageId': 'id'}
+    )
+    stub_trigger_workflow_scheduler(ddb_resource_stub)
+    lambda_client_stub.add_response(
+        'invoke',
+        expected_params={'FunctionName': 'testSchedulerArn', 'InvocationType': 'Event'},
+        service_response={}
+    )
+
+    response = test_client.http.put(
+        '/workflow/execution/{Id}'.format(Id=workflow_execution_id),
+        body=json.dumps({'WaitingStageName': 'testWaitStage'}).encode()
+    )
+
+    assert response.status_code == 200
+
+
 def test_list_workflow_executions(test_client, ddb_resource_stub):
     print('GET /workflow/execution')
 
@@ -289,7 +353,7 @@ def test_list_workflow_executions_by_status(test_client, ddb_resource_stub):
                 ':workflow_status': test_status
             },
             'KeyConditionExpression': '#workflow_status = :workflow_status',
-            'ProjectionExpression': 'Id, AssetId, CurrentStage, StateMachineExecutionArn, #workflow_status, Workflow.#workflow_name'
+            'ProjectionExpression': 'Id, AssetId, CurrentStage, Created, StateMachineExecutionArn, #workflow_status, Workflow.#workflow_name'
         },
         service_response={
             'LastEvaluatedKey': {'S': {'S': 'lastKey'}},
@@ -312,7 +376,7 @@ def test_list_workflow_executions_by_status(test_client, ddb_resource_stub):
                 ':workflow_status': test_status
             },
             'KeyConditionExpression': '#workflow_status = :workflow_status',
-            'ProjectionExpression': 'Id, AssetId, CurrentStage, StateMachineExecutionArn, #workflow_status, Workflow.#workflow_name',
+            'ProjectionExpression': 'Id, AssetId, CurrentStage, Created, StateMachineExecutionArn, #workflow_status, Workflow.#workflow_name',
             'ExclusiveStartKey': {'S': 'lastKey'}
         },
         service_response={
@@ -331,6 +395,41 @@ def test_list_workflow_executions_by_status(test_client, ddb_resource_stub):
     assert response.json_body[1]['Name'] == 'execution2'
 
 
+def test_list_workflow_executions_created_range_needs_asset_index(test_client):
+    # Only the asset index is sorted on Created, elsewhere the range would scan every execution outside it
+    for path in ['/workflow/execution/status/Complete?created_after=100', '/workflow/execution?created_before=100']:
+        response = test_client.http.get(path)
+        assert response.status_code == 400
+
+
+def test_list_workflow_executions_unpaginated(test_client, ddb_resource_stub):
+    ddb_resource_stub.add_response(
+        'scan',
+        expected_params={
+            'TableName': 'testExecutionTable'
+        },
+        service_response={
+            'LastEvaluatedKey': {'Id': {'S': 'execution2'}},
+            'Items': [{'Id': {'S': 'execution1'}}, {'Id': {'S': 'execution2'}}]
+        }
+    )
+    ddb_resource_stub.add_response(
+        'scan',
+        expected_params={
+            'TableName': 'testExecutionTable',
+            'ExclusiveStartKey': {'Id': 'execution2'}
+        },
+        service_response={
+            'Items': [{'Id': {'S': 'execution3'}}]
+        }
+    )
+
+    # without limit and cursor every execution is returned
+    response = test_client.http.get('/workflow/execution')
+    assert response.status_code == 200
+    assert response.json_body == [{'Id': 'execution1'}, {'Id': 'execution2'}, {'Id': 'execution3'}]
+
+
 def test_list_workflow_executions_by_asset_id(test_client, ddb_resource_stub):
     print('GET /workflow/execution/asset/{asset_id}')
     test_asset_id = 'testAssetId'
@@ -339,7 +438,8 @@ def test_list_workflow_executions_by_asset_id(test_client, ddb_resource_stub):
         'query',
         expected_params={
             'TableName': 'testExecutionTable',
-            'IndexName': 'WorkflowExecutionAssetId',
+            'IndexName': 'WorkflowExecutionAssetIdCreated',
+            'ScanIndexForward': False,
             'ExpressionAttributeNames': {
                 '#workflow_status': "Status",
                 '#workflow_name': "Name"
@@ -353,8 +453,8 @@ def test_list_workflow_executions_by_asset_id(test_client, ddb_resource_stub):
         service_response={
             'LastEvaluatedKey': {'S': {'S': 'lastKey'}},
             'Items': [{
-                'Name': {'S': 'workflowExecutionAsset1'},
-                'Created': {'N': '1'}
+                'Name': {'S': 'workflowExecutionAsset2'},
+                'Created': {'S': '2'}
             }]
         }
     )
@@ -363,7 +463,8 @@ def test_list_workflow_executions_by_asset_id(test_client, ddb_resource_stub):
         'query',
         expected_params={
             'TableName': 'testExecutionTable',
-            'IndexName': 'WorkflowExecutionAssetId',
+            'IndexName': 'WorkflowExecutionAssetIdCreated',
+            'ScanIndexForward': False,
             'ExpressionAttributeNames': {
                 '#workflow_status': "Status",
                 '#workflow_name': "Name"
@@ -377,8 +478,8 @@ def test_list_workflow_executions_by_asset_id(test_client, ddb_resource_stub):
         },
         service_response={
             'Items': [{
-                'Name': {'S': 'workflowExecutionAsset2'},
-                'Created': {'N': '2'}
+                'Name': {'S': 'workflowExecutionAsset1'},
+                'Created': {'S': '1'}
             }]
         }
     )
@@ -390,6 +491,109 @@ def test_list_workflow_executions_by_asset_id(test_client, ddb_resource_stub):
     assert response.json_body[1]['Name'] == 'workflowExecutionAsset1'
 
 
+def test_list_workflow_executions_paginated(test_client, ddb_resource_stub):
+    print('GET /workflow/execution')
+
+    ddb_resource_stub.add_response(
+        'scan',
+        expected_params={
+            'TableName': 'testExecutionTable',
+            'ProjectionExpression': '#field0, #field1.#field2',
+            'ExpressionAttributeNames': {
+                '#field0': 'Id',
+                '#field1': 'Workflow',
+                '#field2': 'Name'
+            },
+            'Limit': 2
+        },
+        service_response={
+            'LastEvaluatedKey': {'Id': {'S': 'execution1'}},
+            'Items': [{'Id': {'S': 'execution1'}}]
+        }
+    )
+    # The read stopped at 1 MB before the page was full, the rest of the page is read before returning
+    ddb_resource_stub.add_response(
+        'scan',
+        expected_params={
+            'TableName': 'testExecutionTable',
+            'ProjectionExpression': '#field0, #field1.#field2',
+            'ExpressionAttributeNames': {
+                '#field0': 'Id',
+                '#field1': 'Workflow',
+                '#field2': 'Name'
+            },
+            'Limit': 1,
+            'ExclusiveStartKey': {'Id': 'execution1'}
+        },
+        service_response={
+            'LastEvaluatedKey': {'Id': {'S': 'execution2'}},
+            'Items': [{'Id': {'S': 'execution2'}}]
+        }
+    )
+
+    response = test_client.http.get('/workflow/execution?limit=2&fields=Id,Workflow.Name')
+    assert response.status_code == 200
+    assert [execution['Id'] for execution in response.json_body['Items']] == ['execution1', 'execution2']
+    cursor = response.json_body['Cursor']
+
+    ddb_resource_stub.add_response(
+        'scan',
+        expected_params={
+            'TableName': 'testExecutionTable',
+            'Limit': 2,
+            'ExclusiveStartKey': {'Id': 'execution2'}
+        },
+        service_response={
+            'Items': [{'Id': {'S': 'execution3'}}]
+        }
+    )
+
+    response = test_client.http.get('/workflow/execution?limit=2&cursor={}'.format(cursor))
+    assert response.status_code == 200
+    assert response.json_body == {'Items': [{'Id': 'execution3'}]}
+
+
+def test_list_workflow_executions_by_asset_id_created_range(test_client, ddb_resource_stub):
+    print('GET /workflow/execution/asset/{asset_id}')
+
+    ddb_resource_stub.add_response(
+        'query',
+        expected_params={
+            'TableName': 'testExecutionTable',
+            'IndexName': 'WorkflowExecutionAssetIdCreated',
+            'ScanIndexForward': False,
+            'ExpressionAttributeNames': {
+                '#workflow_status': "Status",
+                '#workflow_name': "Name",
+                '#created': 'Created'
+            },
+            'ExpressionAttributeValues': {
+                ':assetid': 'testAssetId',
+                ':created_after': '1',
+                ':created_before': '2'
+            },
+            'KeyConditionExpression': 'AssetId = :assetid AND #created BETWEEN :created_after AND :created_before',
+            'ProjectionExpression': 'Id, AssetId, CurrentStage, Created, StateMachineExecutionArn, #workflow_status, Workflow.#workflow_name',
+            'Limit': 10
+        },
+        service_response={
+            'Items': [{'Id': {'S': 'execution1'}}]
+        }
+    )
+
+    response = test_client.http.get('/workflow/execution/asset/testAssetId?limit=10&created_after=1&created_before=2')
+    assert response.status_code == 200
+    assert response.json_body == {'Items': [{'Id': 'execution1'}]}
+
+
+@pytest.mark.parametrize('query', ['limit=0', 'limit=abc', 'cursor=notacursor', 'fields=Id,Workflow..Name'])
+def test_list_workflow_executions_invalid_query(test_client, query):
+    print('GET /workflow/execution')
+
+    response = test_client.http.get('/workflow/execution?' + query)
+    assert response.status_code == 400
+
+
 def test_get_workflow_execution_by_id2(test_client, ddb_resource_stub):
     print('GET /workflow/execution/{id}')
     test_workflow_execution_id = 'testWorkflowExecutionId'
@@ -462,7 +666,8 @@ def test_delete_workflow_execution(test_client, ddb_resource_stub):
             'TableName': 'testExecutionTable',
             'Key': {
                 'Id': test_execution_id
-            }
+            },
+            'ReturnValues': 'ALL_OLD'
         },
         service_response={}
     )
@@ -470,3 +675,37 @@ def test_delete_workflow_execution(test_client, ddb_resource_stub):
     response = test_client.http.delete('/workflow/execution/{Id}'.format(Id=test_execution_id))
     assert response.status_code == 200
     assert response.json_body['Name'] == test_execution_id
+
+
+def test_delete_started_workflow_execution_releases_slot(test_client, ddb_resource_stub):
+    print('DELETE /workflow/execution/{id}')
+
+    test_execution_id = 'workflowExecutionId'
+    def test_item():
+        return {'Id': {'S': test_execution_id}, 'Status': {'S': awsmie.WORKFLOW_STATUS_STARTED}}
+
+    ddb_resource_stub.add_response(
+        'get_item',
+        expected_params={'TableName': 'testExecutionTable', 'Key': {'Id': test_execution_id}, 'ConsistentRead': True},
+        service_response={'Item': test_item()}
+    )
+    ddb_resource_stub.add_response(
+        'delete_item',
+        expected_params={'TableName': 'testExecutionTable', 'Key': {'Id': test_execution_id}, 'ReturnValues': 'ALL_OLD'},
+        service_response={'Attributes': test_item()}
+    )
+    ddb_resource_stub.add_response(
+        'update_item',
+        expected_params={
+            'TableName': 'testSystemTable',
+            'Key': {'Name': 'RunningWorkflows'},
+            'UpdateExpression': 'SET #value = #value - :one',
+            'ConditionExpression': '#value > :zero',
+            'ExpressionAttributeNames': {'#value': 'Value'},
+            'ExpressionAttributeValues': {':zero': 0, ':one': 1}
+        },
+        service_response={}
+    )
+
+    response = test_client.http.delete('/workflow/execution/{Id}'.format(Id=test_execution_id))
+    assert response.status_code == 200
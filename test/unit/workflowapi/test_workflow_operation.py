@@ -1,6 +1,9 @@
 # Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
 # SPDX-License-Identifier: Apache-2.0
 
+import copy
+import json
+from decimal import Decimal
 from helper import *
 
 workflow_operation_endpoint = '/workflow/operation'
@@ -279,17 +282,10 @@ def test_delete_operation_api_workflow_running(test_client, ddb_resource_stub):
 
     stub_get_operation(ddb_resource_stub)
 
-    ddb_resource_stub.add_response(
-        'scan',
-        expected_params={
-            'TableName': 'testWorkflowTable',
-            'FilterExpression': botocore.stub.ANY,
-            'ConsistentRead': True
-        },
-        service_response={
-            'Items': [{}]
-        }
-    )
+    stub_list_dependent_workflows(ddb_resource_stub, 'Operation:' + test_operation_name, [{
+        'Name': {'S': 'workflow1'},
+        'Operations': {'L': [{'S': test_operation_name}]}
+    }])
 
     response = test_client.http.delete('/workflow/operation/{Name}'.format(Name=test_operation_name))
     assert response.status_code == 400
@@ -306,44 +302,14 @@ def test_delete_operation_api(test_client, ddb_resource_stub, iam_client_stub):
 
     stub_get_operation(ddb_resource_stub)
 
-    ddb_resource_stub.add_response(
-        'scan',
-        expected_params={
-            'TableName': 'testWorkflowTable',
-            'FilterExpression': botocore.stub.ANY,
-            'ConsistentRead': True
-        },
-        service_response={
-            'Items': []
-        }
-    )
+    stub_list_dependent_workflows(ddb_resource_stub, 'Operation:' + test_operation_name, [])
     stub_get_stage(ddb_resource_stub)
 
-    ddb_resource_stub.add_response(
-        'scan',
-        expected_params={
-            'TableName': 'testWorkflowTable',
-            'FilterExpression': botocore.stub.ANY,
-            'ConsistentRead': True
-        },
-        service_response={
-            'Items': []
-        }
-    )
+    stub_list_dependent_workflows(ddb_resource_stub, 'Stage:_testOperationName', [])
 
     stub_delete_stage(ddb_resource_stub)
 
-    ddb_resource_stub.add_response(
-        'scan',
-        expected_params={
-            'TableName': 'testWorkflowTable',
-            'FilterExpression': botocore.stub.ANY,
-            'ConsistentRead': True
-        },
-        service_response={
-            'Items': []
-        }
-    )
+    stub_list_dependent_workflows(ddb_resource_stub, 'Stage:_testOperationName', [])
     stub_delete_operation(ddb_resource_stub)
 
     iam_client_stub.add_response(
@@ -367,19 +333,10 @@ def test_delete_operation_api(test_client, ddb_resource_stub, iam_client_stub):
         service_response={}
     )
 
-    ddb_resource_stub.add_response(
-        'scan',
-        expected_params={
-            'TableName': 'testWorkflowTable',
-            'FilterExpression': botocore.stub.ANY,
-            'ConsistentRead': True
-        },
-        service_response={
-            'Items': [{
-                'Name': {'S': 'workflow1'}
-            }]
-        }
-    )
+    stub_list_dependent_workflows(ddb_resource_stub, 'Operation:' + test_operation_name, [{
+        'Name': {'S': 'workflow1'},
+        'Operations': {'L': [{'S': test_operation_name}]}
+    }])
     ddb_resource_stub.add_response(
         'update_item',
         expected_params={
@@ -398,3 +355,101 @@ def test_delete_operation_api(test_client, ddb_resource_stub, iam_client_stub):
 
     response = test_client.http.delete('/workflow/operation/{Name}'.format(Name=test_operation_name))
     assert response.status_code == 200
+
+def test_async_operation_asl_waits_for_callback(test_client):
+    from app import ASYNC_OPERATION_ASL, SYNC_OPERATION_ASL
+
+    states = ASYNC_OPERATION_ASL["States"]
+    has_callback = states["Can %%OPERATION_NAME%% Call Back? (%%STAGE_NAME%%)"]
+    callback = states["Wait For %%OPERATION_NAME%% Callback (%%STAGE_NAME%%)"]
+
+    # Jobs that announce their completion wait for the event, everything else keeps polling
+    assert states["Execute %%OPERATION_NAME%% (%%STAGE_NAME%%)"]["Next"] == "Can %%OPERATION_NAME%% Call Back? (%%STAGE_NAME%%)"
+    assert states["Did %%OPERATION_NAME%% Complete (%%STAGE_NAME%%)"]["Choices"][0]["Next"] == "Can %%OPERATION_NAME%% Call Back? (%%STAGE_NAME%%)"
+    assert [rule["Variable"] for rule in has_callback["Choices"][0]["Or"]] == ["$.MetaData.TranscribeJobId", "$.MetaData.MediaconvertJobId"]
+    assert has_callback["Default"] == "Back Off %%OPERATION_NAME%% Polling? (%%STAGE_NAME%%)"
+
+    # A missing event only delays the status check
+    assert callback["Resource"] == "arn:aws:states:::lambda:invoke.waitForTaskToken"
+    assert callback["Parameters"]["FunctionName"] == "testRegisterCallbackLambdaArn"
+    assert callback["Next"] == "Get %%OPERATION_NAME%% Status (%%STAGE_NAME%%)"
+    assert callback["Catch"][0]["ErrorEquals"] == ["States.Timeout"]
+    assert callback["Catch"][0]["Next"] == "Get %%OPERATION_NAME%% Status (%%STAGE_NAME%%)"
+    # An operation whose callback can not be registered polls the job status instead of failing
+    assert callback["Catch"][1]["ErrorEquals"] == ["States.ALL"]
+    assert callback["Catch"][1]["Next"] == "Back Off %%OPERATION_NAME%% Polling? (%%STAGE_NAME%%)"
+    assert len(callback["Catch"]) == 2
+
+    assert "Wait For %%OPERATION_NAME%% Callback (%%STAGE_NAME%%)" not in SYNC_OPERATION_ASL["States"]
+
+def test_create_operation_api_operation_poll_policy(test_client, ddb_resource_stub, iam_client_stub):
+    print('POST {endpoint}'.format(endpoint=workflow_operation_endpoint))
+
+    stub_get_operation(ddb_resource_stub, optional_output={})
+    operation_input = get_sample_operation_input()
+    operation_input['Item']['PollPolicy'] = {'InitialSeconds': 30, 'Multiplier': Decimal('1.5'), 'MaxSeconds': 120}
+    stub_put_operation(ddb_resource_stub, optional_input=operation_input)
+    stub_create_stage(ddb_resource_stub)
+    operation_input = copy.deepcopy(operation_input)
+    operation_input['Item']['StageName'] = '_' + test_operation_name
+    stub_put_operation(ddb_resource_stub, optional_input=operation_input)
+    stub_put_role_policy(iam_client_stub)
+
+    response = test_client.http.post(
+        workflow_operation_endpoint,
+        body=b'''{
+            "Name": "testOperationName",
+            "Type":"Async",
+            "Configuration": {
+                "MediaType": "Video",
+                "Enabled": true
+            },
+            "StartLambdaArn": "startArn",
+            "MonitorLambdaArn": "monitorArn",
+            "PollPolicy": {
+                "InitialSeconds": 30,
+                "Multiplier": 1.5,
+                "MaxSeconds": 120
+            }
+        }'''
+    )
+
+    assert response.status_code == 200
+    states = json.loads(response.json_body['StateMachineAsl'])['States']
+    next_poll = states['Schedule Next testOperationName Status Check (%%STAGE_NAME%%)']
+    assert next_poll['Assign']['pollSeconds.$'] == 'States.ArrayGetItem(States.Array(30, 45, 68, 101, 120), $pollIndex)'
+    assert states['Back Off testOperationName Polling? (%%STAGE_NAME%%)']['Choices'][0]['NumericLessThan'] == 5
+
+def test_create_operation_api_poll_policy_input_error(test_client):
+    print('POST {endpoint}'.format(endpoint=workflow_operation_endpoint))
+
+    response = test_client.http.post(
+        workflow_operation_endpoint,
+        body=b'''{
+            "Name": "testOperationName",
+            "Type":"Async",
+            "Configuration": {
+                "MediaType": "Video",
+                "Enabled": true
+            },
+            "StartLambdaArn": "startArn",
+            "MonitorLambdaArn": "monitorArn",
+            "PollPolicy": {
+                "InitialSeconds": 0
+            }
+        }'''
+    )
+
+    assert response.status_code == 400
+
+def test_poll_schedule(test_client):
+    from app import poll_schedule, DEFAULT_POLL_POLICY
+
+    # A two hour job is checked about 20 times instead of about 700
+    schedule = poll_schedule(DEFAULT_POLL_POLICY)
+    assert schedule == [10, 20, 40, 80, 160, 320, 480]
+    checks = len(schedule) + (7200 - sum(schedule)) // schedule[-1]
+    assert checks < 25
+
+    assert poll_schedule({'InitialSeconds': 10, 'Multiplier': 1, 'MaxSeconds': 480}) == [10]
+    assert poll_schedule({'InitialSeconds': 600, 'Multiplier': 2, 'MaxSeconds': 480}) == [480]
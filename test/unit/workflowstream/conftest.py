@@ -7,6 +7,7 @@ from botocore.stub import Stubber
 @pytest.fixture(autouse=True)
 def mock_env_variables(monkeypatch):
     monkeypatch.syspath_prepend('../../source/workflowstream/')
+    monkeypatch.syspath_prepend('../../source/lib/MediaInsightsEngineLambdaHelper/')
     monkeypatch.setenv("botoConfig", '{"user_agent_extra": "AwsSolution/SO0163/vX.X.X"}')
     monkeypatch.setenv('StreamName', 'testStreamName')
     monkeypatch.setenv('AWS_XRAY_CONTEXT_MISSING', 'LOG_ERROR')
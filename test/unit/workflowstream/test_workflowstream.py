@@ -6,43 +6,43 @@ from botocore.stub import ANY
 
 def test_deserialize_non_list_dict():
     # imports
-    import workflowstream
+    from MediaInsightsEngineLambdaHelper.stream_records import deserialize
 
     # test parameters
     data_param = 'testData'
 
-    result = workflowstream.deserialize(data_param)
+    result = deserialize(data_param)
 
     # assertions
     assert result == data_param
 
 def test_deserialize_dict_success():
     # imports
-    import workflowstream
+    from MediaInsightsEngineLambdaHelper.stream_records import deserialize
 
     #test parameters
     data_param = {
         'S': 'World'
     }
-    result = workflowstream.deserialize(data_param)
+    result = deserialize(data_param)
 
     # assertions
     assert result == 'World'
 
 def test_deserialize_dict_error_handling():
         # imports
-    import workflowstream
+    from MediaInsightsEngineLambdaHelper.stream_records import deserialize
 
     #test parameters
     data_param = {'Hello': 'World'}
-    result = workflowstream.deserialize(data_param)
+    result = deserialize(data_param)
 
     # assertions
     assert result == {'Hello': 'World'}
 
 def test_deserialize_list_success():
     # imports
-    import workflowstream
+    from MediaInsightsEngineLambdaHelper.stream_records import deserialize
 
     #test parameters
     data_param = [
@@ -50,7 +50,7 @@ def test_deserialize_list_success():
         {'NULL': True},
         {'N': '123'}
     ]
-    result = workflowstream.deserialize(data_param)
+    result = deserialize(data_param)
 
     # assertions
     assert result[0] == True
@@ -83,10 +83,10 @@ def test_lambda_handler_modify_no_change():
         'Records': [{
             'dynamodb': {
                 'OldImage': {
-                    'Status': 'Created'
+                    'Status': {'S': 'Created'}
                 },
                 'NewImage': {
-                    'Status': 'Created'
+                    'Status': {'S': 'Created'}
                 }
             },
             'eventName': event_type
@@ -101,28 +101,33 @@ def test_lambda_handler_modify(sns_client_stub):
     import workflowstream
 
     sns_client_stub.add_response(
-        'publish',
+        'publish_batch',
         expected_params = {
-            'TargetArn': 'testTopicArn',
-            'Message': ANY,
-            'MessageStructure': 'json'
+            'TopicArn': 'testTopicArn',
+            'PublishBatchRequestEntries': [{
+                'Id': '0',
+                'Message': ANY,
+                'MessageStructure': 'json'
+            }]
         },
-        service_response = {}
+        service_response = {
+            'Successful': [{'Id': '0', 'MessageId': 'testMessageId'}]
+        }
     )
 
     event_param = {
         'Records': [{
             'dynamodb': {
                 'OldImage': {
-                    'Status': 'Created',
-                    'Id': 'testId',
-                    'AssetId': 'testAssetId',
+                    'Status': {'S': 'Created'},
+                    'Id': {'S': 'testId'},
+                    'AssetId': {'S': 'testAssetId'},
                 },
                 'NewImage': {
-                    'Status': 'Success',
-                    'Globals': 'testGlobals',
-                    'Configuration': 'testConfiguration',
-                    'Created': 'testCreated'
+                    'Status': {'S': 'Success'},
+                    'Globals': {'S': 'testGlobals'},
+                    'Configuration': {'S': 'testConfiguration'},
+                    'Created': {'S': 'testCreated'}
                 }
             },
             'eventName': 'MODIFY'
@@ -131,4 +136,74 @@ def test_lambda_handler_modify(sns_client_stub):
     }
 
     response = workflowstream.lambda_handler(event_param, {})
-    assert response == None
\ No newline at end of file
+    assert response == None
+
+def modify_record(execution_id, globals_value='testGlobals'):
+    return {
+        'dynamodb': {
+            'OldImage': {
+                'Status': {'S': 'Started'},
+                'Id': {'S': execution_id},
+                'AssetId': {'S': 'testAssetId'}
+            },
+            'NewImage': {
+                'Status': {'S': 'Complete'},
+                'Id': {'S': execution_id},
+                'Globals': {'S': globals_value},
+                'Configuration': {'M': {'stage': {'M': {'Enabled': {'BOOL': True}}}}},
+                'Created': {'N': '1700000000'}
+            }
+        },
+        'eventName': 'MODIFY'
+    }
+
+def test_lambda_handler_modify_batches_messages(sns_client_stub):
+    import workflowstream
+
+    for ids in [range(10), range(2)]:
+        sns_client_stub.add_response(
+            'publish_batch',
+            expected_params = {
+                'TopicArn': 'testTopicArn',
+                'PublishBatchRequestEntries': [
+                    {'Id': ANY, 'Message': ANY, 'MessageStructure': 'json'} for _ in ids
+                ]
+            },
+            service_response = {
+                'Successful': [{'Id': str(i), 'MessageId': 'testMessageId'} for i in ids]
+            }
+        )
+
+    event_param = {'Records': [modify_record('testId' + str(i)) for i in range(12)]}
+    workflowstream.lambda_handler(event_param, {})
+
+def test_build_message_slims_large_fields(monkeypatch):
+    import workflowstream
+    monkeypatch.setattr(workflowstream, 'MESSAGE_FIELD_MAX_BYTES', 100)
+    monkeypatch.setattr(workflowstream, 'MESSAGE_FIELDS', ['WorkflowExecutionId', 'Status', 'Globals', 'Created'])
+
+    record = modify_record('testId', globals_value='x' * 200)['dynamodb']
+    message = workflowstream.build_message(record['OldImage'], record['NewImage'], 0)
+
+    assert message == {
+        'WorkflowExecutionId': 'testId',
+        'Status': 'Complete',
+        'Globals': {
+            'MieReferenceType': 'WorkflowExecution',
+            'Path': '/workflow/execution/testId',
+            'ContentLength': 202
+        },
+        'Created': 1700000000
+    }
+
+def test_build_message_keeps_large_fields_by_default(monkeypatch):
+    import workflowstream
+    monkeypatch.setattr(workflowstream, 'MESSAGE_FIELDS', ['WorkflowExecutionId', 'Globals'])
+
+    record = modify_record('testId', globals_value='x' * 20000)['dynamodb']
+    message = workflowstream.build_message(record['OldImage'], record['NewImage'], 0)
+
+    assert message == {
+        'WorkflowExecutionId': 'testId',
+        'Globals': 'x' * 20000
+    }